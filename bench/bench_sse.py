@@ -0,0 +1,160 @@
+# bench/bench_sse.py
+"""
+Micro-benchmark: client-side cost of consuming a llama-server SSE stream.
+
+Compares the original chat-message loop (requests.iter_lines -> decode -> startswith ->
+json.loads -> click.echo per token) with llama_sse (byte-level SSEDecoder ->
+extract_content -> OutputBuffer). Both consume the same recorded stream, delivered as
+one network read per event like llama-server's flushes, through a requests Response.
+
+The bundled recording was captured with --record from fake_llama_server.py, which emits
+llama.cpp b5061's event layout; record a real server to benchmark its exact stream.
+
+    uv run bench/bench_sse.py                              # bundled recording
+    uv run bench/bench_sse.py --stream my_capture.sse --json
+    uv run bench/bench_sse.py --record http://127.0.0.1:8012 --prompt "..." --stream out.sse
+"""
+import os
+import io
+import sys
+import json
+import time
+import argparse
+import contextlib
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import click
+import requests
+
+import llama_sse
+
+DEFAULT_STREAM = os.path.join(os.path.dirname(os.path.abspath(__file__)), "data", "completion_stream.sse")
+
+
+class _NullStdout(io.TextIOBase):
+    """Swallows terminal output but keeps the write/flush calls the CLI would make."""
+    def write(self, s):
+        return len(s)
+
+    def flush(self):
+        pass
+
+
+class _ReplayRaw:
+    """Stands in for urllib3's response: yields the recorded network reads."""
+    def __init__(self, reads):
+        self._reads = reads
+
+    def stream(self, chunk_size=None, decode_content=True):
+        for read in self._reads:
+            if chunk_size:
+                for i in range(0, len(read), chunk_size):
+                    yield read[i:i + chunk_size]
+            else:
+                yield read
+
+
+def _response(reads):
+    response = requests.models.Response()
+    response.status_code = 200
+    response.raw = _ReplayRaw(reads)
+    return response
+
+
+def split_reads(raw):
+    """Splits a recorded body into one read per event, as llama-server flushes them."""
+    return [event + b"\n\n" for event in raw.split(b"\n\n") if event]
+
+
+def baseline_loop(reads):
+    """The original clitest_server loop."""
+    tokens = 0
+    for line in _response(reads).iter_lines():
+        if line:
+            decoded_line = line.decode('utf-8')
+            if decoded_line.startswith('data:'):
+                json_data_part = decoded_line[len('data:'):].strip()
+                if json_data_part:
+                    data = json.loads(json_data_part)
+                    if isinstance(data, dict) and 'content' in data:
+                        chunk = data.get('content', '')
+                        if chunk:
+                            click.echo(chunk, nl=False)
+                            tokens += 1
+    return tokens
+
+
+def decoder_loop(reads):
+    """The llama_sse based loop used by chat-message now."""
+    tokens = 0
+    output = llama_sse.OutputBuffer(lambda text: click.echo(text, nl=False))
+    for data in llama_sse.iter_events(_response(reads).iter_content(chunk_size=None)):
+        chunk = llama_sse.extract_content(data.decode('utf-8'))
+        if chunk:
+            output.add(chunk)
+            tokens += 1
+    output.flush()
+    return tokens
+
+
+def measure(loop, reads, repeat):
+    """Best-of-`repeat` wall time and CPU time for one pass over the stream."""
+    best_wall, best_cpu, tokens = float("inf"), float("inf"), 0
+    with contextlib.redirect_stdout(_NullStdout()):
+        for _ in range(repeat):
+            wall, cpu = time.perf_counter(), time.process_time()
+            tokens = loop(reads)
+            best_wall = min(best_wall, time.perf_counter() - wall)
+            best_cpu = min(best_cpu, time.process_time() - cpu)
+    return {"tokens": tokens, "wall_s": best_wall, "cpu_s": best_cpu,
+            "us_per_token": best_cpu / tokens * 1e6 if tokens else None,
+            "tokens_per_cpu_sec": tokens / best_cpu if best_cpu else None}
+
+
+def record(url, prompt, n_predict, path):
+    """Captures the raw SSE body of one /completion stream from a running server."""
+    response = requests.post(f"{url}/completion", json={"prompt": prompt, "n_predict": n_predict, "stream": True},
+                             stream=True, timeout=600)
+    response.raise_for_status()
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    with open(path, "wb") as f:
+        for chunk in response.iter_content(chunk_size=None):
+            f.write(chunk)
+    print(f"Recorded {os.path.getsize(path)} bytes to {path}")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--stream", default=DEFAULT_STREAM, help="Recorded SSE body to replay.")
+    parser.add_argument("--repeat", type=int, default=20, help="Passes per loop; the best one is reported.")
+    parser.add_argument("--copies", type=int, default=4, help="Concatenate the recording this many times.")
+    parser.add_argument("--json", action="store_true", help="Print machine-readable results.")
+    parser.add_argument("--record", metavar="URL", help="Record a new stream from a server instead of benchmarking.")
+    parser.add_argument("--prompt", default="Write a long story about a lighthouse keeper.")
+    parser.add_argument("--n-predict", type=int, default=512)
+    args = parser.parse_args(argv)
+
+    if args.record:
+        return record(args.record, args.prompt, args.n_predict, args.stream)
+
+    with open(args.stream, "rb") as f:
+        reads = split_reads(f.read()) * args.copies
+
+    results = {"stream": os.path.basename(args.stream), "events": len(reads),
+               "baseline": measure(baseline_loop, reads, args.repeat),
+               "decoder": measure(decoder_loop, reads, args.repeat)}
+    results["speedup_cpu"] = results["baseline"]["cpu_s"] / results["decoder"]["cpu_s"]
+
+    if args.json:
+        print(json.dumps(results, indent=2))
+        return
+    print(f"{results['events']} events from {results['stream']}")
+    for name in ("baseline", "decoder"):
+        r = results[name]
+        print(f"  {name:8s}: {r['us_per_token']:7.2f} us/token CPU  ({r['tokens_per_cpu_sec']:,.0f} tokens/CPU-sec)")
+    print(f"  speedup : {results['speedup_cpu']:.2f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,80 @@
+# bench/bench_startup.py
+"""
+Micro-benchmark: wall time from launching `main.py --prompt ...` to the first byte on its
+stdout and to its exit, through the full CLI and through the resident daemon
+(llama_daemon.py). The CLI's first byte is its "Using ... port" status line, so the exit
+time (4 tokens at 1 ms each) is the fairer comparison.
+
+Runs offline: an in-process fake_llama_server is registered as a one-instance pool in a
+temporary working directory, so both paths find the same ready server and only the client
+side differs.
+
+    uv run bench/bench_startup.py [--runs 20] [--json]
+"""
+import os
+import sys
+import json
+import time
+import argparse
+import tempfile
+import subprocess
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import llama_pool
+import llama_bench
+import llama_daemon
+from fake_llama_server import FakeLlamaServer
+
+MAIN_PY = os.path.join(ROOT, "main.py")
+
+
+def run_once(prompt):
+    """(seconds to the first stdout byte, seconds to exit) of one main.py run."""
+    start = time.perf_counter()
+    process = subprocess.Popen([sys.executable, MAIN_PY, "--prompt", prompt, "--n-predict", "4"],
+                               stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+    process.stdout.read(1)
+    first_byte = time.perf_counter() - start
+    process.stdout.read()
+    process.wait()
+    return first_byte, time.perf_counter() - start
+
+
+def measure(runs):
+    first_bytes, exits = zip(*(run_once("a b c") for _ in range(runs)))
+    return {"first_byte_ms": llama_bench.summarize(first_bytes, scale=1000),
+            "exit_ms": llama_bench.summarize(exits, scale=1000)}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--runs", type=int, default=20)
+    parser.add_argument("--json", action="store_true", help="Print the result as JSON.")
+    args = parser.parse_args()
+
+    result = {}
+    with tempfile.TemporaryDirectory() as tmp, FakeLlamaServer(token_delay=0.001) as server:
+        os.chdir(tmp) # Pool state, daemon socket and metrics stay in the temp dir
+        llama_pool.write_pool_state({'instances': [{'index': 0, 'port': server.port, 'pid': os.getpid()}]})
+        result["cli"] = measure(args.runs)
+        success, message = llama_daemon.start_background()
+        if not success:
+            sys.exit(message)
+        try:
+            result["daemon"] = measure(args.runs)
+        finally:
+            llama_daemon.call("stop")
+            os.chdir(ROOT)
+
+    if args.json:
+        print(json.dumps(result, indent=2))
+    else:
+        for name, timings in result.items():
+            print(f"{name:>6}: first byte p50 {timings['first_byte_ms']['p50']:.1f} ms, "
+                  f"exit p50 {timings['exit_ms']['p50']:.1f} ms, p90 {timings['exit_ms']['p90']:.1f} ms")
+
+
+if __name__ == "__main__":
+    main()
@@ -3,18 +3,83 @@ import click
 import sys
 import requests # For making HTTP requests
 import json     # For parsing JSON data from SSE
+import os
+import time
+import signal
+import threading
+import contextlib
 
 # Import server management functions and config (PORT)
 import llama_man
+import llama_batch
+import llama_pool
+import llama_router
+import llama_sched
+import llama_cache
+import llama_sse
+import llama_bench
+import llama_metrics
+import llama_tune
+import llama_daemon
+import llama_slots
+import llama_activate
+import llama_models
+import llama_gguf
+import llama_logs
+import llama_client
+import llama_embed
+import llama_session
+import llama_rpc
+import llama_trace
 from llama_man import PORT # Import PORT for constructing URL
 
-@click.command('chat-message')
-@click.option('--prompt', required=True, help='The prompt to send to the server.')
-def chat_message_command(prompt):
-    """Sends prompt to llama-server, auto-starting if needed. Streams response."""
+def resolve_server_port(model=None, direct=False, params=None):
+    """
+    Returns the port to send a request to: with `model`, that registered model's server
+    (loaded, evicting others, if needed); else the priority scheduler if one is running;
+    else the prefix-affinity router if one is running;
+    else the on-demand listener if one is running (it starts the server itself);
+    else, when a pool is running, the healthy instance with the fewest busy slots;
+    otherwise the single server, auto-started if needed.
+    `direct` skips the scheduler, router and pool, for callers whose requests must all
+    reach the same server (slot ids). `params` are launch parameters for a single server
+    started here (see llama_man.start_llama_server).
+    Exits the CLI when no server can be used.
+    """
+    if model:
+        success, message, port = llama_models.ensure_model(model)
+        if not success:
+            click.secho(message, fg='red')
+            click.echo("Aborting prompt.")
+            sys.exit(1)
+        click.secho(message, fg='green')
+        return port
+
+    sched_port = None if direct else llama_sched.running_sched_port()
+    if sched_port:
+        click.secho(f"Using priority scheduler on port {sched_port}.", fg='green')
+        return sched_port
+
+    router_port = None if direct else llama_router.running_router_port()
+    if router_port:
+        click.secho(f"Using prefix-affinity router on port {router_port}.", fg='green')
+        return router_port
+
+    activate_port = llama_activate.running_activate_port()
+    if activate_port:
+        click.secho(f"Using on-demand listener on port {activate_port}.", fg='green')
+        return activate_port
+
+    if not direct and llama_pool.read_pool_state()['instances']:
+        port = llama_pool.pick_instance_port()
+        if port is None:
+            click.secho("Pool is configured but no instance is ready. See `pool status`.", fg='red')
+            click.echo("Aborting prompt.")
+            sys.exit(1)
+        click.secho(f"Using pool instance on port {port}.", fg='green')
+        return port
 
-    # --- Ensure server is running ---
-    status_code, message = llama_man.ensure_server_running_or_fail()
+    status_code, message = llama_man.ensure_server_running_or_fail(params=params)
 
     if status_code == "RUNNING":
         click.secho(message, fg='green')
@@ -26,89 +91,1274 @@ def chat_message_command(prompt):
         click.secho(f"Unexpected server status: {status_code} - {message}", fg='yellow')
         click.echo("Aborting prompt.")
         sys.exit(1)
-    # --- Server confirmed running ---
+    return llama_man.PORT
 
-    click.echo("Server confirmed running. Sending prompt...")
 
-    # --- Chat Logic using Requests with Streaming ---
-    server_url = f"http://127.0.0.1:{PORT}/completion"
+def stream_sse_data(base_url, payload, resume=0):
+    """Streams a completion and yields the JSON text of every SSE event's data (see llama_client)."""
+    return llama_client.iter_completion(base_url, payload, resume=resume)
+
+
+def resume_attempts():
+    """Broken streams to resume: llama_client.RESUME_ATTEMPTS while a supervisor restarts crashed servers, else 0."""
+    state = llama_man.read_supervisor_state()
+    return llama_client.RESUME_ATTEMPTS if state and state['running'] else 0
+
+
+@click.command('chat-message')
+@click.option('--prompt', required=True, help='The prompt to send to the server.')
+@click.option('--n-predict', type=int, default=-1, show_default=True, help='Maximum tokens to generate (-1 = until stop).')
+@click.option('--temperature', type=float, default=None, help='Sampling temperature (server default if omitted).')
+@click.option('--seed', type=int, default=None, help='Sampling seed (server default if omitted).')
+@click.option('--cache/--no-cache', default=False, show_default=True,
+              help='Serve deterministic requests (temperature 0 or fixed seed) from the local completion cache.')
+@click.option('--replay-pace', type=float, default=None,
+              help='Replay cache hits at the original token timing scaled by this factor (e.g. 1.0).')
+@click.option('--model', '-m', default=None, help='Registered model to use (see `models`); default: the managed server.')
+@click.option('--trace/--no-trace', default=None,
+              help=f'Record this request into {llama_trace.TRACE_FILENAME} (default: llama_trace.TRACE_REQUESTS).')
+def chat_message_command(prompt, n_predict=-1, temperature=None, seed=None, cache=False, replay_pace=None, model=None,
+                         trace=None):
+    """Sends prompt to llama-server, auto-starting if needed. Streams response."""
+
     # Add "stream": True to the payload to request streaming
-    payload = {"prompt": prompt, "n_predict": -1, "stream": True}
-    response = None # Define outside try for potential use in except? Not needed here.
+    payload = {"prompt": prompt, "n_predict": n_predict, "stream": True}
+    if temperature is not None:
+        payload["temperature"] = temperature
+    if seed is not None:
+        payload["seed"] = seed
+
+    model_path = llama_man.MODEL_PATH
+    if model:
+        entry = llama_models.read_registry().get(model)
+        if entry is None:
+            click.secho(f"Unknown model '{model}'. Register it with `models add`.", fg='red')
+            sys.exit(1)
+        model_path = entry['path']
+
+    # --- Completion cache lookup ---
+    cache_key = None
+    if cache:
+        if not llama_cache.is_cacheable(payload):
+            llama_cache.record_uncacheable()
+            click.secho("Cache bypassed: request is not deterministic (set --temperature 0 or --seed).", fg='yellow')
+        else:
+            try:
+                cache_key = llama_cache.cache_key(llama_cache.model_fingerprint(model_path), payload)
+            except OSError as e:
+                click.secho(f"Cache bypassed: cannot fingerprint model '{model_path}': {e}", fg='yellow')
+
+    server_url = None
+    port = None
+    if cache_key and llama_cache.contains(cache_key):
+        click.secho(f"Cache hit ({cache_key[:12]}); replaying without contacting the server.", fg='green')
+    else:
+        # --- Pick a pool instance, or ensure the single server is running ---
+        port = resolve_server_port(model)
+        # --- Server confirmed running ---
+
+        click.echo("Server confirmed running. Sending prompt...")
+
+        # --- Chat Logic: streamed over llama_client ---
+        server_url = f"http://127.0.0.1:{port}/completion"
+        click.echo(f"Sending request to: {server_url}")
+
+    def generate():
+        # A hit can be evicted between contains() and the replay; fall back to the server then
+        target = port or resolve_server_port(model)
+        # Only the single managed server has a supervisor to restart it
+        return stream_sse_data(f"http://127.0.0.1:{target}", payload, resume=resume_attempts() if target == llama_man.PORT else 0)
 
-    click.echo(f"Sending request to: {server_url}")
     click.echo("\n--- Response ---")
 
+    timer = llama_metrics.RequestTimer("cache" if server_url is None else "chat", port=port)
+    status = "error"
+    # Tokens are batched into a few terminal writes per second instead of one flush each
+    output = llama_sse.OutputBuffer(lambda text: click.echo(text, nl=False))
     try:
-        # Make the request with stream=True
-        response = requests.post(
-            server_url,
-            headers={"Content-Type": "application/json", "Accept": "text/event-stream"}, # Added Accept header
-            json=payload,
-            timeout=90, # Overall timeout still applies
-            stream=True # <<<--- Enable streaming
-        )
-        response.raise_for_status() # Check for initial HTTP errors (4xx, 5xx)
+        events = llama_cache.stream(cache_key, generate, pace=replay_pace) if cache_key else generate()
 
-        # Process the stream line by line
         found_content = False
-        for line in response.iter_lines():
-            if line: # Filter out keep-alive new lines
-                decoded_line = line.decode('utf-8')
-                if decoded_line.startswith('data:'):
-                    json_data_part = decoded_line[len('data:'):].strip()
-                    if json_data_part: # Ensure there's data after "data:"
-                        try:
-                            data = json.loads(json_data_part)
-                            # Check for content chunk and print
-                            if isinstance(data, dict) and 'content' in data:
-                                chunk = data.get('content', '')
-                                if chunk:
-                                    click.echo(chunk, nl=False)
-                                    found_content = True
-                            # Optional: Check for stop signal if server sends one
-                            # if isinstance(data, dict) and data.get('stop') == True:
-                            #    break
-
-                        except json.JSONDecodeError:
-                            # Handle cases where a 'data:' line isn't valid JSON
-                            # Could happen if connection interrupted or server sends malformed event
-                             click.secho(f"\n[Warning: Could not decode stream chunk: {json_data_part}]", fg='yellow', nl=True)
-                             continue # Try processing next line
+        resumed = None
+        for json_data_part in events:
+            try:
+                # Only the "content" string is decoded; the rest of the event is skipped
+                chunk = llama_sse.extract_content(json_data_part)
+                if chunk:
+                    output.add(chunk)
+                    found_content = True
+                    timer.token()
+                if llama_sse.is_final(json_data_part):
+                    final = json.loads(json_data_part)
+                    timer.final(final) # Server timings and cache counts
+                    resumed = final.get('resumed')
+
+            except json.JSONDecodeError:
+                # Handle cases where a 'data:' line isn't valid JSON
+                # Could happen if connection interrupted or server sends malformed event
+                 output.flush()
+                 click.secho(f"\n[Warning: Could not decode stream chunk: {json_data_part}]", fg='yellow', nl=True)
+                 continue # Try processing next line
+        output.flush()
 
         if not found_content:
             click.echo("[No content received from stream or stream empty]")
 
         click.echo() # Final newline after streaming completes
+        if resumed:
+            click.secho(f"[Resumed after {resumed} server crash{'es' if resumed > 1 else ''}]", fg='yellow')
+        status = "ok"
 
-    except requests.exceptions.ConnectionError:
-        click.secho(f"\nError: Connection refused at {server_url}.", fg='red')
+    except KeyboardInterrupt:
+        # The stream is already closed, so llama-server has stopped generating and freed the slot
+        output.flush()
+        click.secho("\n[Cancelled]", fg='yellow')
+        sys.exit(130)
+    except llama_client.ConnectError as e:
+        click.secho(f"\nError: {e} ({server_url}).", fg='red')
         click.secho("=> Server might have stopped or is not listening.", fg='yellow')
         sys.exit(1)
-    except requests.exceptions.Timeout:
-        click.secho(f"\nError: Request timed out connecting to {server_url}.", fg='red')
+    except llama_client.ClientTimeout as e:
+        click.secho(f"\nError: Request to {server_url} timed out: {e}.", fg='red')
         sys.exit(1)
-    except requests.exceptions.RequestException as e:
-        # Handles HTTP errors caught by raise_for_status and other request issues
-        click.secho(f"\nError during request to {server_url}: {e}", fg='red')
-        if e.response is not None:
-            # Try to show raw response if available, even with streaming on error
-            try:
-                 # Reading response.text might fail if stream=True and error occurred early
-                 raw_text = e.response.text
-            except Exception:
-                 raw_text = "[Could not read error response body]"
-            click.secho(f"Server raw response: {raw_text}", fg='red')
+    except llama_client.HTTPStatusError as e:
+        if e.status == 429 and e.retry_after is not None:
+            click.secho(f"\nServer is busy (queue wait over its limit); retry in {e.retry_after:g}s.", fg='yellow')
+            sys.exit(1)
+        click.secho(f"\nError during request to {server_url}: HTTP {e.status}", fg='red')
+        click.secho(f"Server raw response: {e.body}", fg='red')
         sys.exit(1)
     # Removed specific JSONDecodeError handler here, as it's handled per-chunk in the loop
     except Exception as e:
         # Catch-all for other unexpected errors during request or stream processing
         click.secho(f"\nAn unexpected error occurred: {e}", fg='red')
         sys.exit(1)
+    finally:
+        record = llama_metrics.record_timer(timer, status)
+        if server_url is not None and llama_trace.enabled(trace): # Cache hits never reached the server
+            llama_trace.record(payload, record)
     # --- End Chat Logic ---
 
     click.echo("----------------\n")
 
 
-# Export the command function directly as 'cli' for main.py
-cli = chat_message_command
\ No newline at end of file
+@click.command('batch')
+@click.argument('input_path', type=click.Path(exists=True, dir_okay=False))
+@click.option('--output', '-o', 'output_path', required=True, type=click.Path(dir_okay=False),
+              help='Output JSONL; one result per line, written as each prompt completes.')
+@click.option('--concurrency', '-j', type=click.IntRange(min=1), default=None,
+              help='Requests in flight. Defaults to the server slot count (--parallel).')
+@click.option('--prompt-field', default='prompt', show_default=True, help='JSON field holding the prompt.')
+@click.option('--id-field', default=None, help='JSON field holding the record id (default: id / request_id / line number).')
+@click.option('--resume/--no-resume', default=True, show_default=True,
+              help='Skip ids already completed in the output file.')
+@click.option('--model', '-m', default=None, help='Registered model to use (see `models`); default: the managed server.')
+def batch_command(input_path, output_path, concurrency, prompt_field, id_field, resume, model):
+    """Runs every prompt in a JSONL file through llama-server with bounded concurrency."""
+    sched_port = None if model else llama_sched.running_sched_port()
+    router_port = None if model or sched_port else llama_router.running_router_port()
+    activate_port = None if router_port or sched_port or model else llama_activate.running_activate_port()
+    pool_ports = llama_pool.healthy_ports() if not model and llama_pool.read_pool_state()['instances'] else []
+    if model:
+        pool_ports = [resolve_server_port(model)]
+    elif sched_port:
+        click.secho(f"Using priority scheduler on port {sched_port} (batch class).", fg='green')
+        pool_ports = [sched_port]
+    elif router_port:
+        click.secho(f"Using prefix-affinity router on port {router_port}.", fg='green')
+        pool_ports = [router_port]
+    elif activate_port:
+        click.secho(f"Using on-demand listener on port {activate_port}.", fg='green')
+        pool_ports = [activate_port]
+    elif pool_ports:
+        click.secho(f"Using {len(pool_ports)} pool instances on ports {', '.join(map(str, pool_ports))}.", fg='green')
+    else:
+        status_code, message = llama_man.ensure_server_running_or_fail()
+        if status_code != "RUNNING":
+            click.secho(message, fg='red')
+            sys.exit(1)
+        click.secho(message, fg='green')
+        pool_ports = [llama_man.PORT]
+
+    if resume and os.path.exists(output_path):
+        click.echo(f"Resuming: {len(llama_batch.load_completed_ids(output_path))} prompts already done in {output_path}")
+
+    def report(result):
+        llama_metrics.record_request(llama_metrics.batch_record(result))
+        if "error" in result:
+            click.secho(f"[{result['id']}] error: {result['error']}", fg='red', err=True)
+
+    try:
+        summary = llama_batch.run_batch(
+            input_path, output_path, base_urls=[f"http://127.0.0.1:{p}" for p in pool_ports], concurrency=concurrency,
+            prompt_field=prompt_field, id_field=id_field, resume=resume, on_result=report,
+            resume_streams=resume_attempts() if pool_ports == [llama_man.PORT] else 0,
+        )
+    except ValueError as e:
+        click.secho(f"Error reading {input_path}: {e}", fg='red')
+        sys.exit(1)
+
+    click.echo(f"Concurrency: {summary['concurrency']} (server slots: {summary['server_slots'] or 'unknown'})")
+    click.echo(f"Completed {summary['completed']}, failed {summary['failed']}, skipped {summary['skipped']} "
+               f"in {summary['elapsed_s']:.2f}s")
+    click.echo(f"Throughput: {summary['prompts_per_sec']:.2f} prompts/sec, "
+               f"{summary['tokens_per_sec']:.1f} tokens/sec")
+    if summary['failed']:
+        sys.exit(1)
+
+
+@click.command('embed')
+@click.argument('input_path', type=click.Path(exists=True, dir_okay=False))
+@click.option('--output', '-o', 'output_path', required=True, type=click.Path(dir_okay=False),
+              help='Output .npy (float32, one row per input); ids go to OUT.ids.jsonl, progress to OUT.done.npy.')
+@click.option('--text-field', default='text', show_default=True, help='JSON field holding the text (JSONL input).')
+@click.option('--id-field', default=None, help='JSON field holding the record id (default: id / request_id / line number).')
+@click.option('--concurrency', '-j', type=int, default=None, help='Requests in flight (default: the server slot count).')
+@click.option('--batch-tokens', type=int, default=None, help="Estimated tokens per request (default: the server's -b).")
+@click.option('--max-inputs', type=int, default=llama_embed.MAX_INPUTS, show_default=True, help='Inputs per request.')
+@click.option('--resume/--no-resume', default=True, show_default=True, help='Skip rows finished by an earlier run.')
+@click.option('--model', '-m', default=None, help='Registered model to use (added with --embedding); default: the managed server.')
+def embed_command(input_path, output_path, text_field, id_field, concurrency, batch_tokens, max_inputs, resume, model):
+    """Embeds every line of a JSONL or text file into a memory-mapped .npy through /embedding."""
+    if llama_embed.numpy is None:
+        click.secho("embed needs numpy: uv sync --extra embed", fg='red')
+        sys.exit(1)
+    port = resolve_server_port(model, params={'embedding': True}) # Only used if the managed server is started here
+    model_path = llama_models.read_registry()[model]['path'] if model else None
+    batch_tokens = batch_tokens or llama_man.launch_settings(model_path=model_path)['batch_size']
+
+    try:
+        summary = llama_embed.run_embed(
+            input_path, output_path, base_url=f"http://127.0.0.1:{port}", concurrency=concurrency,
+            batch_tokens=batch_tokens, max_inputs=max_inputs, text_field=text_field, id_field=id_field, resume=resume,
+        )
+    except ValueError as e:
+        click.secho(f"Error: {e}", fg='red')
+        sys.exit(1)
+
+    click.echo(f"Rows: {summary['rows']} (dim {summary['dim'] or 'unknown'}); embedded {summary['embedded']}, "
+               f"skipped {summary['skipped']} already done, failed {summary['failed']}")
+    click.echo(f"Requests: {summary['requests']} (up to {summary['batch_tokens']} tokens each, "
+               f"concurrency {summary['concurrency']}) in {summary['elapsed_s']:.2f}s")
+    click.echo(f"Throughput: {summary['vectors_per_sec']:.1f} vectors/sec")
+    for record_id, message in summary['errors']:
+        click.secho(f"[{record_id}] error: {message}", fg='red', err=True)
+    if any("--embeddings" in message for _, message in summary['errors']):
+        click.secho("=> The server was already running without --embedding; stop it so embed starts it with"
+                    " --embedding, register the model with `models add --embedding` or set EMBEDDING in llama_man.py.",
+                    fg='yellow', err=True)
+    if summary['failed']:
+        sys.exit(1)
+
+
+@click.group('session')
+def session_group():
+    """Multi-turn chat sessions pinned to one server slot (only new tokens are evaluated each turn)."""
+
+
+def _print_turn_stats(turn, slot):
+    reuse = 1 - turn['prompt_n'] / turn['tokens_evaluated'] if turn['tokens_evaluated'] else 0.0
+    click.secho(f"[prompt eval: {turn['prompt_n']} of {turn['tokens_evaluated']} tokens ({reuse:.0%} from cache, "
+                f"slot {slot}) | {turn['tokens_predicted']} generated, {turn['predicted_per_second']:.1f} tok/s]",
+                fg='cyan')
+
+
+@session_group.command('chat')
+@click.argument('name')
+@click.option('--system', default=None, help='System prompt (new sessions only).')
+@click.option('--n-predict', type=int, default=llama_session.N_PREDICT, show_default=True, help='Answer length limit per turn.')
+@click.option('--summarize/--trim', default=False, show_default=True,
+              help='Near the context limit, fold the oldest turns into a summary instead of dropping them.')
+@click.option('--model', '-m', default=None, help='Registered model to use (see `models`); default: the managed server.')
+def session_chat_command(name, system, n_predict, summarize, model):
+    """Opens (or resumes) session NAME as a REPL. /history, /stats, /exit."""
+    # Slot ids only mean something on one server, so sessions talk to it directly
+    port = resolve_server_port(model, direct=True)
+    base_url = f"http://127.0.0.1:{port}"
+    n_slots, n_ctx = llama_sched.discover_limits(port)
+
+    session = llama_session.load_session(name)
+    if session:
+        if system and system != session['system']:
+            click.secho("Keeping the session's original system prompt (--system applies to new sessions).", fg='yellow')
+        session['slot'] %= n_slots
+        click.secho(f"Resumed session '{name}': {len(session['turns'])} turns, slot {session['slot']}.", fg='green')
+    else:
+        try:
+            session = llama_session.new_session(name, system, slot=llama_session.pick_slot(n_slots))
+        except ValueError as e:
+            click.secho(str(e), fg='red')
+            sys.exit(1)
+        llama_session.save_session(session)
+        click.secho(f"New session '{name}' on slot {session['slot']} (context {n_ctx or 'unknown'} tokens).", fg='green')
+
+    summarize_fn = llama_session.summarizer(base_url, session['system']) if summarize else None
+    while True:
+        try:
+            text = input("you> ").strip()
+        except (EOFError, KeyboardInterrupt):
+            click.echo()
+            break
+        if not text:
+            continue
+        if text in ("/exit", "/quit"):
+            break
+        if text == "/history":
+            click.echo(llama_session.render(session) or "[empty]")
+            continue
+        if text == "/stats":
+            for i, turn in enumerate(session['turns'], start=session.get('trimmed_turns', 0) + 1):
+                click.echo(f"turn {i}: ", nl=False)
+                _print_turn_stats(turn, session['slot'])
+            continue
+
+        output = llama_sse.OutputBuffer(lambda chunk: click.echo(chunk, nl=False))
+        try:
+            turn = llama_session.run_turn(session, text, base_url, n_ctx=n_ctx, n_predict=n_predict,
+                                          summarize=summarize_fn, on_text=output.add)
+        except KeyboardInterrupt:
+            output.flush()
+            click.secho("\n[Cancelled; turn not kept]", fg='yellow')
+            continue
+        except llama_client.ClientError as e:
+            output.flush()
+            click.secho(f"\nError: {e}", fg='red')
+            continue
+        output.flush()
+        click.echo()
+        if turn['trimmed']:
+            click.secho(f"[{turn['trimmed']} oldest turn(s) {'summarized' if summarize else 'dropped'} "
+                        f"to stay within the context]", fg='yellow')
+        _print_turn_stats(turn, session['slot'])
+
+
+@session_group.command('list')
+def session_list_command():
+    """Lists saved sessions."""
+    sessions = llama_session.list_sessions()
+    if not sessions:
+        click.echo(f"No sessions in '{llama_session.SESSIONS_DIR}'.")
+    for s in sessions:
+        click.echo(f"{s['name']}: {len(s['turns'])} turns (+{s.get('trimmed_turns', 0)} trimmed), slot {s['slot']}, "
+                   f"~{s['context_tokens']} context tokens, last used {time.strftime('%Y-%m-%d %H:%M', time.localtime(s['updated_at']))}")
+
+
+@session_group.command('delete')
+@click.argument('name')
+def session_delete_command(name):
+    """Deletes a saved session."""
+    if not llama_session.delete_session(name):
+        click.secho(f"No session '{name}'.", fg='red')
+        sys.exit(1)
+    click.echo(f"Deleted session '{name}'.")
+
+
+@click.group('pool')
+def pool_group():
+    """Manages a pool of llama-server instances on consecutive ports."""
+
+
+@pool_group.command('start')
+@click.option('--instances', '-n', type=int, default=2, show_default=True, help='Number of llama-server processes.')
+@click.option('--base-port', type=int, default=PORT, show_default=True, help='Port of the first instance.')
+@click.option('--threads', '-t', type=int, default=None, help='Threads per instance (default: CPUs / instances).')
+@click.option('--pin-cpus', is_flag=True, help='Pin each instance to its own block of CPUs (Linux).')
+def pool_start_command(instances, base_port, threads, pin_cpus):
+    """Starts the pool and waits until every instance is ready."""
+    success, messages = llama_pool.start_pool(instances, base_port=base_port, threads=threads, pin_cpus=pin_cpus)
+    for message in messages:
+        click.echo(message)
+    if not success:
+        sys.exit(1)
+
+
+@pool_group.command('status')
+def pool_status_command():
+    """Shows every pool instance and its health."""
+    instances = llama_pool.status_pool()
+    if not instances:
+        click.echo(f"No pool running (no '{llama_pool.POOL_STATE_FILENAME}').")
+        return
+    for i in instances:
+        color = 'green' if i['state'] == 'READY' else 'yellow' if i['state'] == 'LOADING' else 'red'
+        cpus = f" cpus={i['cpus'][0]}-{i['cpus'][-1]}" if i.get('cpus') else ""
+        click.secho(f"[{i['index']}] port {i['port']} PID {i.get('pid')} threads={i['threads']}{cpus}: {i['state']}", fg=color)
+
+
+@pool_group.command('stop')
+@click.option('--force', is_flag=True, help='Kill instances that do not stop gracefully.')
+def pool_stop_command(force):
+    """Stops every pool instance."""
+    success, messages = llama_pool.stop_pool(force=force)
+    for message in messages:
+        click.echo(message)
+    if not success:
+        sys.exit(1)
+
+
+@pool_group.command('restart')
+@click.option('--force', is_flag=True, help='Kill instances that do not stop gracefully.')
+def pool_restart_command(force):
+    """Rolling restart: one instance at a time, each ready before the next."""
+    success, messages = llama_pool.restart_pool(force=force)
+    for message in messages:
+        click.echo(message)
+    if not success:
+        sys.exit(1)
+
+
+@click.group('rpc')
+def rpc_group():
+    """Spreads the managed server's model over rpc-server workers (ggml RPC backend, --rpc)."""
+
+
+@rpc_group.command('start')
+@click.option('--local', '-n', 'local', type=int, default=0, show_default=True, help='rpc-server workers to start on this host.')
+@click.option('--worker', '-w', 'remote', multiple=True, help='Remote worker HOST:PORT (started there with rpc-server -H HOST -p PORT); repeatable.')
+@click.option('--base-port', type=int, default=llama_rpc.RPC_BASE_PORT, show_default=True, help='Port of the first local worker.')
+@click.option('--threads', '-t', type=int, default=None, help='Threads per local worker (default: CPUs / workers).')
+@click.option('--mem-mb', type=int, default=None, help='Memory each local worker offers (rpc-server -m; default: all).')
+@click.option('--no-server', is_flag=True, help='Only start and check the workers.')
+def rpc_start_command(local, remote, base_port, threads, mem_mb, no_server):
+    """Starts the workers, health-checks them, then (re)starts the server with --rpc over all of them."""
+    success, messages = llama_rpc.start_group(local, remote, base_port=base_port, threads=threads, mem_mb=mem_mb,
+                                              start_server=not no_server)
+    for message in messages:
+        click.echo(message)
+    if not success:
+        sys.exit(1)
+
+
+@rpc_group.command('status')
+def rpc_status_command():
+    """Shows each worker's health, memory and latency, and the server."""
+    status = llama_rpc.status_group()
+    if status is None:
+        click.echo(f"No RPC group running (no '{llama_man.RPC_GROUP_FILENAME}').")
+        return
+    click.echo(f"{'WORKER':24s} {'WHERE':6s} {'PID':>7s} {'STATE':6s} {'FREE MB':>8s} {'TOTAL MB':>8s} {'CONNECT MS':>10s} {'RTT MS':>7s}")
+    number = lambda value, spec: format(value, spec) if value is not None else '-'
+    for w in status['workers']:
+        color = {llama_rpc.READY: 'green', llama_rpc.BUSY: 'cyan'}.get(w['state'], 'red')
+        click.secho(f"{w['endpoint']:24s} {'local' if w.get('local') else 'remote':6s} {w.get('pid') or '-':>7} {w['state']:6s} "
+                    f"{number(w['free_mb'], '.0f'):>8s} {number(w['total_mb'], '.0f'):>8s} "
+                    f"{number(w['connect_ms'], '.2f'):>10s} {number(w['rtt_ms'], '.2f'):>7s}", fg=color)
+    if any(w['state'] == llama_rpc.BUSY for w in status['workers']):
+        click.echo("BUSY: the worker is serving a client (normally the server), so only the connect latency is measured.")
+    click.echo(status['server_message'])
+
+
+@rpc_group.command('stop')
+@click.option('--force', is_flag=True, help='Kill processes that do not stop gracefully.')
+def rpc_stop_command(force):
+    """Stops the server, then the local workers."""
+    success, messages = llama_rpc.stop_group(force=force)
+    for message in messages:
+        click.echo(message)
+    if not success:
+        sys.exit(1)
+
+
+@click.group('router')
+def router_group():
+    """Prefix-affinity routing proxy in front of the server or pool."""
+
+
+@router_group.command('serve')
+@click.option('--port', type=int, default=llama_router.ROUTER_PORT, show_default=True, help='Port the router listens on.')
+def router_serve_command(port):
+    """Runs the router in the foreground (Ctrl-C to stop). Clients pick it up automatically."""
+    if not llama_pool.read_pool_state()['instances']:
+        resolve_server_port(direct=True) # The listener, or the single server started if needed
+    targets = llama_router.discover_targets()
+    if not targets:
+        click.secho("Pool is configured but no instance is ready. See `pool status`.", fg='red')
+        sys.exit(1)
+    click.secho(f"Routing port {port} -> " + ", ".join(f"{p} ({n} slots)" for _, p, n in targets), fg='green')
+    llama_router.serve(port=port, targets=targets)
+
+
+@router_group.command('stats')
+def router_stats_command():
+    """Shows prefix hit ratios and routing decisions of the running router."""
+    port = llama_router.running_router_port()
+    if not port:
+        click.secho("Router is not running.", fg='red')
+        sys.exit(1)
+    stats = requests.get(f"http://127.0.0.1:{port}/router/stats", timeout=5).json()
+    click.echo(f"Requests: {stats['requests']} (affinity {stats['affinity']}, "
+               f"saturated fallbacks {stats['saturated_fallbacks']}, misses {stats['misses']})")
+    click.echo(f"Prefix hit ratio (router): {stats['prefix_hit_ratio']:.1%}")
+    if stats['server_reuse_ratio'] is not None:
+        click.echo(f"Prompt tokens served from KV cache (server): {stats['server_reuse_ratio']:.1%}")
+    for t in stats['targets']:
+        click.echo(f"  port {t['port']}: {t['outstanding']} outstanding / {t['slots']} slots")
+
+
+@click.group('sched')
+def sched_group():
+    """Priority scheduler (interactive before batch) in front of the managed server."""
+
+
+@sched_group.command('serve')
+@click.option('--port', type=int, default=llama_sched.SCHED_PORT, show_default=True, help='Port the scheduler listens on.')
+@click.option('--token-budget', type=int, default=None,
+              help='Tokens (prompt + n_predict) in flight at once (default: slots x per-slot context).')
+@click.option('--interactive-slo', type=float, default=llama_sched.QUEUE_SLO['interactive'], show_default=True,
+              help='Longest queue wait (s) for interactive requests before answering 429.')
+@click.option('--batch-slo', type=float, default=llama_sched.QUEUE_SLO['batch'], show_default=True,
+              help='Longest queue wait (s) for batch requests before answering 429.')
+def sched_serve_command(port, token_budget, interactive_slo, batch_slo):
+    """Runs the scheduler in the foreground (Ctrl-C to stop). Clients pick it up automatically."""
+    target = resolve_server_port(direct=True) # The scheduler owns the single server's slots
+    slots, slot_ctx = llama_sched.discover_limits(target)
+    budget = token_budget or (slots * slot_ctx if slot_ctx else None)
+    click.secho(f"Scheduling port {port} -> {target} ({slots} slots, "
+                f"token budget {budget or 'unlimited'})", fg='green')
+    llama_sched.serve(port=port, target_port=target, slots=slots, slot_ctx=slot_ctx, token_budget=budget,
+                      slo={llama_sched.INTERACTIVE: interactive_slo, llama_sched.BATCH: batch_slo})
+
+
+@sched_group.command('stats')
+def sched_stats_command():
+    """Shows queue depths, queue waits and rejections of the running scheduler."""
+    port = llama_sched.running_sched_port()
+    if not port:
+        click.secho("Scheduler is not running.", fg='red')
+        sys.exit(1)
+    stats = requests.get(f"http://127.0.0.1:{port}/sched/stats", timeout=5).json()
+    service = f"{stats['service_s']:.2f}s" if stats['service_s'] is not None else "n/a"
+    click.echo(f"Running: {stats['running']} / {stats['slots']} slots (batch up to {stats['batch_slots']}), "
+               f"tokens in flight {stats['tokens_in_flight']} / {stats['token_budget'] or 'unlimited'}, "
+               f"avg request {service}")
+    for cls, c in stats['classes'].items():
+        rejected = c['rejected']
+        waits = "n/a" if c['wait_p50_ms'] is None else \
+            f"p50 {c['wait_p50_ms']:.0f} ms, p95 {c['wait_p95_ms']:.0f} ms, max {c['wait_max_ms']:.0f} ms"
+        click.echo(f"  {cls}: {c['queued']} queued, {c['admitted']} admitted, {c['completed']} completed; "
+                   f"wait {waits} (SLO {c['slo_s']:g}s)")
+        click.echo(f"    rejected: {rejected['overloaded']} overloaded, {rejected['queue_timeout']} past SLO, "
+                   f"{rejected['queue_full']} queue full")
+
+
+@click.group('cache')
+def cache_group():
+    """Local completion cache for deterministic requests."""
+
+
+@cache_group.command('stats')
+def cache_stats_command():
+    """Shows hit/miss/byte counters and the cache size."""
+    stats = llama_cache.stats()
+    lookups = stats['hits'] + stats['misses'] + stats['coalesced']
+    hit_rate = (stats['hits'] + stats['coalesced']) / lookups if lookups else 0.0
+    click.echo(f"Entries: {stats['entries']} ({stats['size_bytes'] / 2**20:.1f} MiB of {stats['max_bytes'] / 2**20:.0f} MiB)")
+    click.echo(f"Hits: {stats['hits']}  Coalesced: {stats['coalesced']}  Misses: {stats['misses']}  "
+               f"Hit rate: {hit_rate:.1%}")
+    click.echo(f"Bytes served: {stats['bytes_served']}  Bytes written: {stats['bytes_written']}  "
+               f"Evictions: {stats['evictions']}  Uncacheable: {stats['uncacheable']}")
+
+
+@cache_group.command('clear')
+def cache_clear_command():
+    """Deletes every cached completion."""
+    click.echo(f"Removed {llama_cache.clear()} cached completions.")
+
+
+@click.command('bench')
+@click.option('--concurrency', '-c', default=','.join(map(str, llama_bench.CONCURRENCY)), show_default=True,
+              help='Comma-separated numbers of parallel streams, one benchmark level each.')
+@click.option('--requests', 'requests_per_level', type=int, default=None,
+              help='Requests per level (default: 4 per stream, at least 8).')
+@click.option('--n-predict', type=int, default=llama_bench.N_PREDICT, show_default=True, help='Tokens per request.')
+@click.option('--prompt-words', type=int, default=llama_bench.PROMPT_WORDS, show_default=True, help='Prompt length in words.')
+@click.option('--ready-runs', type=int, default=llama_bench.READY_RUNS, show_default=True,
+              help='Cold starts to time (skipped if the server is already running).')
+@click.option('--fake/--real', default=True, show_default=True,
+              help='Benchmark the bundled fake server (offline) or the configured llama-server.')
+@click.option('--startup-delay', type=float, default=llama_bench.FAKE_STARTUP_DELAY, show_default=True, help='Fake server model load time (s).')
+@click.option('--token-rate', type=float, default=llama_bench.FAKE_TOKEN_RATE, show_default=True, help='Fake server tokens/sec per stream.')
+@click.option('--jitter', type=float, default=llama_bench.FAKE_JITTER, show_default=True, help='Fake server token delay variation (fraction).')
+@click.option('--output', '-o', 'output_path', type=click.Path(dir_okay=False), default=None,
+              help='Write the JSON result here instead of stdout.')
+@click.option('--compare', 'baseline_path', type=click.Path(exists=True, dir_okay=False), default=None,
+              help='Earlier JSON result to compare against; exits 1 on a regression.')
+@click.option('--tolerance', type=float, default=0.10, show_default=True, help='Relative change counted as a regression.')
+def bench_command(concurrency, requests_per_level, n_predict, prompt_words, ready_runs, fake,
+                  startup_delay, token_rate, jitter, output_path, baseline_path, tolerance):
+    """Measures time-to-ready, TTFT, inter-token latency, tokens/sec and client CPU per token."""
+    try:
+        levels = [int(n) for n in concurrency.split(',') if n.strip()]
+    except ValueError:
+        raise click.BadParameter(f"expected comma-separated integers, got '{concurrency}'", param_hint='--concurrency')
+
+    # Progress from start/stop goes to stderr so stdout stays valid JSON
+    with contextlib.redirect_stdout(sys.stderr):
+        result = llama_bench.run_benchmark(
+            concurrency=levels, requests_per_level=requests_per_level, n_predict=n_predict,
+            prompt_words=prompt_words, ready_runs=ready_runs, fake=fake, startup_delay=startup_delay,
+            token_rate=token_rate, jitter=jitter,
+        )
+
+    text = json.dumps(result, indent=2)
+    if output_path:
+        with open(output_path, 'w') as f:
+            f.write(text + "\n")
+        click.echo(f"Wrote {output_path}", err=True)
+    else:
+        click.echo(text)
+    if 'error' in result:
+        click.secho(result['error'], fg='red', err=True)
+        sys.exit(1)
+
+    if baseline_path:
+        with open(baseline_path) as f:
+            rows = llama_bench.compare(json.load(f), result, tolerance=tolerance)
+        for row in rows:
+            color = 'red' if row['regression'] else None
+            click.secho(f"{row['metric']:40s} {row['baseline']:12.3f} -> {row['current']:12.3f} ({row['change']:+.1%})",
+                        fg=color, err=True)
+        if any(row['regression'] for row in rows):
+            sys.exit(1)
+
+
+def _int_list(value, param_hint):
+    try:
+        return [int(v) for v in value.split(',') if v.strip()]
+    except ValueError:
+        raise click.BadParameter(f"expected comma-separated integers, got '{value}'", param_hint=param_hint)
+
+
+@click.command('tune')
+@click.option('--batch-sizes', default=','.join(map(str, llama_tune.BATCH_SIZES)), show_default=True, help='Candidate -b values.')
+@click.option('--ubatch-sizes', default=','.join(map(str, llama_tune.UBATCH_SIZES)), show_default=True, help='Candidate -ub values.')
+@click.option('--threads', default=None, help='Candidate -t values (default: half and all CPUs).')
+@click.option('--threads-batch', default=None, help='Candidate -tb values (default: same as -t).')
+@click.option('--parallel', default=','.join(map(str, llama_tune.PARALLEL_SLOTS)), show_default=True, help='Candidate --parallel values.')
+@click.option('--ctx-sizes', default=None, help='Candidate --ctx-size values (default: the configured one).')
+@click.option('--workload', type=click.Path(exists=True, dir_okay=False), default=None,
+              help='JSONL prompt file to replay (default: synthetic prompts).')
+@click.option('--prompt-field', default='prompt', show_default=True, help='JSON field holding the prompt.')
+@click.option('--requests', 'requests_per_config', type=int, default=llama_tune.REQUESTS_PER_CONFIG, show_default=True,
+              help='Requests per candidate.')
+@click.option('--concurrency', type=int, default=None, help='Parallel client streams (default: largest --parallel).')
+@click.option('--n-predict', type=int, default=llama_tune.N_PREDICT, show_default=True, help='Tokens per request.')
+@click.option('--margin', type=float, default=llama_tune.MARGIN, show_default=True,
+              help='Skip a candidate whose probe is this much worse on TTFT and tokens/sec than a measured one.')
+@click.option('--prefer', type=click.Choice(llama_tune.PREFERENCES), default='balanced', show_default=True,
+              help='Which Pareto point becomes the profile.')
+@click.option('--dry-run', is_flag=True, help='List the candidates and exit.')
+def tune_command(batch_sizes, ubatch_sizes, threads, threads_batch, parallel, ctx_sizes, workload, prompt_field,
+                 requests_per_config, concurrency, n_predict, margin, prefer, dry_run):
+    """Sweeps launch parameters and saves the Pareto-best profile for start_llama_server."""
+    grid = llama_tune.candidate_grid(
+        batch_sizes=_int_list(batch_sizes, '--batch-sizes'), ubatch_sizes=_int_list(ubatch_sizes, '--ubatch-sizes'),
+        threads=_int_list(threads, '--threads') if threads else None,
+        threads_batch=_int_list(threads_batch, '--threads-batch') if threads_batch else None,
+        parallel=_int_list(parallel, '--parallel'), ctx_sizes=_int_list(ctx_sizes, '--ctx-sizes') if ctx_sizes else None,
+    )
+    if dry_run or not grid:
+        for params in grid:
+            click.echo(llama_tune.describe(params))
+        click.echo(f"{len(grid)} candidates.")
+        return
+    if llama_pool.read_pool_state()['instances']:
+        click.secho("A pool is running; stop it first so the measurements are not disturbed.", fg='red')
+        sys.exit(1)
+    payloads = None
+    if workload:
+        try:
+            payloads = llama_tune.load_workload(workload, prompt_field=prompt_field, n_predict=n_predict)
+        except ValueError as e:
+            click.secho(f"Error reading {workload}: {e}", fg='red')
+            sys.exit(1)
+
+    click.echo(f"Tuning {len(grid)} candidates, {requests_per_config} requests each...")
+
+    out = sys.stdout # start/stop progress is redirected to stderr below; the per-candidate lines stay here
+
+    def report(index, result):
+        label = f"[{index + 1}/{len(grid)}] {llama_tune.describe(result['params'])}"
+        m = result['metrics']
+        if result['status'] == 'ok':
+            click.echo(f"{label}: {m['tokens_per_sec']:.1f} tok/s, TTFT p50 {m['ttft_ms']:.1f} ms", file=out)
+        elif result['status'] == 'pruned':
+            click.secho(f"{label}: pruned after probe ({m['tokens_per_sec']:.1f} tok/s, TTFT p50 {m['ttft_ms']:.1f} ms)", fg='yellow', file=out)
+        else:
+            click.secho(f"{label}: failed: {result.get('error')}", fg='red', file=out)
+
+    with contextlib.redirect_stdout(sys.stderr):
+        profile, _ = llama_tune.tune(grid, payloads=payloads, concurrency=concurrency, requests=requests_per_config,
+                                     margin=margin, prefer=prefer, n_predict=n_predict, on_result=report)
+    if profile is None:
+        click.secho("No candidate completed; profile not changed.", fg='red')
+        sys.exit(1)
+    if 'error' in profile:
+        click.secho(profile['error'], fg='red')
+        sys.exit(1)
+    click.echo("Pareto frontier:")
+    for point in profile['pareto']:
+        m = point['metrics']
+        click.echo(f"  {llama_tune.describe(point['params'])}: {m['tokens_per_sec']:.1f} tok/s, TTFT p50 {m['ttft_ms']:.1f} ms")
+    click.secho(f"Saved {prefer} profile to {llama_man.PROFILE_FILENAME}: {llama_tune.describe(profile['params'])} "
+                f"({profile['pruned']} pruned, {profile['failed']} failed)", fg='green')
+
+
+@click.group('trace')
+def trace_group():
+    """Recorded request traces and open-loop replay against a server."""
+
+
+def _load_trace_or_exit(trace_path):
+    try:
+        entries = llama_trace.load_trace(trace_path)
+    except OSError as e:
+        click.secho(f"Cannot read trace: {e}", fg='red')
+        sys.exit(1)
+    if not entries:
+        click.secho(f"No requests in {trace_path or llama_trace.TRACE_FILENAME}.", fg='yellow')
+        sys.exit(1)
+    return entries
+
+
+def _ms(summary, key):
+    return f"{summary[key]:8.1f}" if summary else f"{'-':>8}"
+
+
+@trace_group.command('stats')
+@click.argument('trace_path', required=False, type=click.Path(dir_okay=False))
+def trace_stats_command(trace_path):
+    """Summarises a trace: requests, arrival rate and the latencies observed when it was recorded."""
+    stats = llama_trace.trace_stats(_load_trace_or_exit(trace_path))
+    rate = f"{stats['rate_rps']:.2f} req/s" if stats['rate_rps'] else "-"
+    click.echo(f"{stats['requests']} requests over {stats['span_s']:.1f}s ({rate})")
+    click.echo(f"TTFT ms     p50 {_ms(stats['ttft_ms'], 'p50')}  p90 {_ms(stats['ttft_ms'], 'p90')}  p99 {_ms(stats['ttft_ms'], 'p99')}")
+    click.echo(f"Elapsed ms  p50 {_ms(stats['elapsed_ms'], 'p50')}  p90 {_ms(stats['elapsed_ms'], 'p90')}  p99 {_ms(stats['elapsed_ms'], 'p99')}")
+
+
+@trace_group.command('replay')
+@click.argument('trace_path', required=False, type=click.Path(dir_okay=False))
+@click.option('--mode', type=click.Choice(llama_trace.MODES), default='original', show_default=True,
+              help="Arrivals at the trace's own spacing, or a Poisson process.")
+@click.option('--levels', default=None,
+              help='Comma-separated load levels: speed factors for original (default 1,2,4,8), '
+                   'requests/sec for poisson (default 1, 2, 4 and 8 times the trace rate).')
+@click.option('--count', type=int, default=None, help='Requests per level (default: the whole trace).')
+@click.option('--seed', type=int, default=0, show_default=True, help='Poisson arrival seed.')
+@click.option('--port', type=int, default=None, help='Replay against this port instead of the managed server.')
+@click.option('--fake', is_flag=True, help='Replay against an in-process fake llama-server (offline).')
+@click.option('--fake-slots', type=int, default=llama_man.PARALLEL, show_default=True, help='Fake server slots.')
+@click.option('--token-rate', type=float, default=llama_bench.FAKE_TOKEN_RATE, show_default=True,
+              help='Fake server tokens/sec per stream.')
+@click.option('--output', '-o', 'output_path', type=click.Path(dir_okay=False), default=None,
+              help='Also write the levels and the knee as JSON.')
+def trace_replay_command(trace_path, mode, levels, count, seed, port, fake, fake_slots, token_rate, output_path):
+    """Replays a trace open-loop at increasing load; reports latency percentiles vs offered load and the knee."""
+    entries = _load_trace_or_exit(trace_path)
+    try:
+        values = [float(v) for v in levels.split(',') if v.strip()] if levels else None
+    except ValueError:
+        raise click.BadParameter(f"expected comma-separated numbers, got '{levels}'", param_hint='--levels')
+    if values is None:
+        rate = llama_trace.trace_stats(entries)['rate_rps'] or 1.0
+        values = [1.0, 2.0, 4.0, 8.0] if mode == 'original' else [rate * f for f in (1, 2, 4, 8)]
+
+    with contextlib.ExitStack() as stack:
+        if fake:
+            from fake_llama_server import FakeLlamaServer
+            server = stack.enter_context(FakeLlamaServer(n_slots=fake_slots, token_delay=1.0 / token_rate,
+                                                         jitter=llama_bench.FAKE_JITTER))
+            port = server.port
+            click.echo(f"Replaying against a fake llama-server ({fake_slots} slots, {token_rate:g} tok/s per stream).")
+        elif port is None:
+            port = resolve_server_port()
+
+        click.echo(f"{'level':>8} {'offered/s':>9} {'done/s':>7} {'ok':>5} {'err':>4} "
+                   f"{'TTFT p50':>8} {'p90':>8} {'p99':>8} {'E2E p50':>8} {'p99':>8} {'lag max':>8}")
+
+        def report(level):
+            click.echo(f"{level['level']:8g} {level['offered_rps'] or 0:9.2f} {level['completed_rps'] or 0:7.2f} "
+                       f"{level['ok']:5d} {level['errors']:4d} {_ms(level['ttft_ms'], 'p50')} {_ms(level['ttft_ms'], 'p90')} "
+                       f"{_ms(level['ttft_ms'], 'p99')} {_ms(level['e2e_ms'], 'p50')} {_ms(level['e2e_ms'], 'p99')} "
+                       f"{_ms(level['lag_ms'], 'max')}")
+
+        try:
+            result = llama_trace.sweep(f"http://127.0.0.1:{port}", entries, mode=mode, levels=values, count=count,
+                                       seed=seed, on_level=report)
+        except ValueError as e:
+            click.secho(f"Error: {e}", fg='red')
+            sys.exit(1)
+
+    knee = result['knee']
+    if knee is None:
+        click.secho("No saturation: every level kept up with its offered load.", fg='green')
+    else:
+        sustained = f"; last level that kept up: {knee['sustained_rps']:.2f} req/s" if knee['sustained_rps'] else ""
+        click.secho(f"Saturation knee at {knee['offered_rps'] or 0:.2f} req/s offered ({knee['reason']}){sustained}.",
+                    fg='yellow')
+    if output_path:
+        with open(output_path, 'w') as f:
+            f.write(json.dumps(result, indent=2) + "\n")
+        click.echo(f"Wrote {output_path}")
+
+
+@click.group('metrics')
+def metrics_group():
+    """Per-request timings and the Prometheus exporter."""
+
+
+@metrics_group.command('export')
+def metrics_export_command():
+    """Prints client and llama-server metrics in Prometheus text format."""
+    click.echo(llama_metrics.prometheus_text(), nl=False)
+
+
+@metrics_group.command('serve')
+@click.option('--port', type=int, default=llama_metrics.EXPORT_PORT, show_default=True, help='Port to serve /metrics on.')
+def metrics_serve_command(port):
+    """Serves /metrics for a Prometheus scraper in the foreground (Ctrl-C to stop)."""
+    httpd = llama_metrics.make_server(port=port)
+    click.secho(f"Exporting metrics on http://127.0.0.1:{port}/metrics", fg='green')
+    try:
+        httpd.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        httpd.server_close()
+
+
+@metrics_group.command('recent')
+@click.option('--limit', '-n', type=int, default=20, show_default=True, help='Number of requests to show.')
+@click.option('--json', 'as_json', is_flag=True, help='Print the raw records as JSON lines.')
+def metrics_recent_command(limit, as_json):
+    """Shows the most recent per-request timings."""
+    records = llama_metrics.recent(limit)
+    if as_json:
+        for record in records:
+            click.echo(json.dumps(record))
+        return
+    if not records:
+        click.echo("No requests recorded yet.")
+        return
+    def ms(value):
+        return f"{value * 1000:8.1f}" if value is not None else "       -"
+    click.echo(f"{'time':19s} {'source':6s} {'status':6s} {'ttft ms':>8s} {'itl p50':>8s} {'tok/s':>7s} {'prompt':>7s} {'reused':>7s}")
+    for r in records:
+        tok_s = f"{r['predicted_n'] / r['predicted_ms'] * 1000:7.1f}" if r.get('predicted_ms') else "      -"
+        click.echo(f"{time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(r['ts']))} {r['source']:6s} {r['status']:6s} "
+                   f"{ms(r.get('ttft_s'))} {ms(r.get('itl_p50_s'))} {tok_s} "
+                   f"{r.get('tokens_evaluated') or 0:7d} {r.get('prompt_reused') or 0:7d}")
+
+
+@metrics_group.command('spec')
+@click.option('--limit', '-n', type=int, default=llama_metrics.RING_SIZE, show_default=True, help='Recent requests to include.')
+def metrics_spec_command(limit):
+    """Draft acceptance and generation tok/s of speculative vs plain requests, per model."""
+    stats = llama_metrics.speculation_stats(llama_metrics.recent(limit))
+    if not stats:
+        click.echo("No completed requests with server timings recorded yet.")
+        return
+    fmt = lambda value, spec: format(value, spec) if value is not None else '-'
+    click.echo(f"{'MODEL':32s} {'REQS':>5s} {'SPEC':>5s} {'DRAFTED':>8s} {'ACCEPT':>7s} {'SPEC TOK/S':>10s} {'PLAIN TOK/S':>11s} {'SPEEDUP':>7s}")
+    for row in stats:
+        click.echo(f"{row['model'][-32:]:32s} {row['requests']:5d} {row['speculative']:5d} {row['draft_n']:8d} "
+                   f"{fmt(row['acceptance'], '.1%'):>7s} {fmt(row['spec_tok_s'], '.1f'):>10s} "
+                   f"{fmt(row['plain_tok_s'], '.1f'):>11s} {fmt(row['speedup'], '.2f'):>7s}")
+        if row['verdict'] == 'keep':
+            click.secho(f"  Speculation pays off ({row['speedup']:.2f}x); keep the draft model.", fg='green')
+        elif row['verdict'] == 'off':
+            click.secho(f"  Speculation is slower ({row['speedup']:.2f}x); start this model without a draft.", fg='red')
+        elif row['verdict'] == 'marginal':
+            click.secho(f"  Speculation gains under {llama_metrics.SPEC_MIN_SPEEDUP:.1f}x; not worth the draft's memory.", fg='yellow')
+
+
+@click.group('daemon')
+def daemon_group():
+    """Resident daemon that answers `--prompt` over a Unix socket with warm connections."""
+
+
+@daemon_group.command('start')
+@click.option('--socket', 'socket_path', default=llama_daemon.DAEMON_SOCKET, show_default=True, help='Unix socket path.')
+@click.option('--stop-server-on-exit', is_flag=True, help='Stop llama-server when the daemon stops.')
+def daemon_start_command(socket_path, stop_server_on_exit):
+    """Starts the daemon in the background."""
+    success, message = llama_daemon.start_background(socket_path, stop_server_on_exit=stop_server_on_exit)
+    click.secho(message, fg='green' if success else 'red')
+    if not success:
+        sys.exit(1)
+
+
+@daemon_group.command('run')
+@click.option('--socket', 'socket_path', default=llama_daemon.DAEMON_SOCKET, show_default=True, help='Unix socket path.')
+@click.option('--stop-server-on-exit', is_flag=True, help='Stop llama-server when the daemon stops.')
+def daemon_run_command(socket_path, stop_server_on_exit):
+    """Runs the daemon in the foreground (Ctrl-C to stop)."""
+    try:
+        llama_daemon.serve(socket_path, stop_server_on_exit=stop_server_on_exit)
+    except RuntimeError as e:
+        click.secho(str(e), fg='red')
+        sys.exit(1)
+
+
+@daemon_group.command('stop')
+@click.option('--socket', 'socket_path', default=llama_daemon.DAEMON_SOCKET, show_default=True, help='Unix socket path.')
+def daemon_stop_command(socket_path):
+    """Stops the daemon (llama-server keeps running unless started with --stop-server-on-exit)."""
+    reply = llama_daemon.call('stop', socket_path)
+    click.echo("Daemon stopping." if reply else "Daemon is not running.")
+
+
+@daemon_group.command('status')
+@click.option('--socket', 'socket_path', default=llama_daemon.DAEMON_SOCKET, show_default=True, help='Unix socket path.')
+def daemon_status_command(socket_path):
+    """Shows whether the daemon is running."""
+    reply = llama_daemon.call('ping', socket_path)
+    if not reply:
+        click.echo("Daemon is not running.")
+        sys.exit(1)
+    click.echo(f"Daemon PID {reply['pid']}: llama-server port {reply['port'] or '(starting)'}, "
+               f"{reply['requests']} requests, up {reply['uptime_s']}s.")
+
+
+@click.group('slots')
+def slots_group():
+    """KV-cache slot persistence of the managed server (saved on stop, restored on start)."""
+
+
+def _slot_save_dir():
+    if not llama_man.SLOT_SAVE_PATH:
+        click.secho("Slot persistence is disabled (llama_man.SLOT_SAVE_PATH is None).", fg='red')
+        sys.exit(1)
+    return llama_man.SLOT_SAVE_PATH
+
+
+@slots_group.command('save')
+def slots_save_command():
+    """Saves the idle slots of the running server now."""
+    save_dir = _slot_save_dir()
+    if llama_man.status_llama_server()[0] != "RUNNING":
+        click.secho("Server is not running.", fg='red')
+        sys.exit(1)
+    saved, message = llama_slots.save_slots(llama_man.PORT, llama_man.MODEL_PATH, save_dir)
+    click.secho(message, fg='green' if saved else 'yellow')
+
+
+@slots_group.command('restore')
+def slots_restore_command():
+    """Restores saved slots and prefills the warm-up prompts into the running server."""
+    save_dir = _slot_save_dir()
+    if llama_man.status_llama_server()[0] != "RUNNING":
+        click.secho("Server is not running.", fg='red')
+        sys.exit(1)
+    click.echo(llama_slots.warm_start(llama_man.PORT, llama_man.MODEL_PATH, save_dir))
+
+
+@slots_group.command('status')
+def slots_status_command():
+    """Shows the saved slots and the warm-up prompts."""
+    save_dir = _slot_save_dir()
+    manifest = llama_slots.read_manifest(save_dir)
+    if not manifest['slots']:
+        click.echo(f"No saved slots in '{save_dir}'.")
+    else:
+        current = manifest.get('model_hash') == llama_slots.model_fingerprint(llama_man.MODEL_PATH)
+        click.secho(f"Saved for {manifest.get('model')}" + ("" if current else " (different model: will be discarded)"),
+                    fg='green' if current else 'yellow')
+        for entry in manifest['slots']:
+            saved_at = time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(entry['saved_at']))
+            click.echo(f"  slot {entry['id_slot']}: {entry['n_tokens']} tokens, {entry.get('bytes') or 0} bytes, saved {saved_at}")
+    click.echo(f"Warm-up prompts ({llama_slots.WARM_PROMPTS_FILE}): {len(llama_slots.load_warm_prompts())}")
+
+
+@click.group('activate')
+def activate_group():
+    """Scale-to-zero: llama-server runs only while requests arrive."""
+
+
+@activate_group.command('serve')
+@click.option('--port', type=int, default=PORT, show_default=True, help='Port the listener holds (clients connect here).')
+@click.option('--idle-timeout', type=float, default=llama_activate.IDLE_TIMEOUT, show_default=True,
+              help='Seconds without requests before llama-server is stopped.')
+@click.option('--backend-port', type=int, default=None, help='Port llama-server runs on (default: a free port).')
+def activate_serve_command(port, idle_timeout, backend_port):
+    """Runs the on-demand listener in the foreground (Ctrl-C to stop)."""
+    try:
+        llama_activate.serve(port=port, idle_timeout=idle_timeout, backend_port=backend_port)
+    except (RuntimeError, OSError) as e:
+        click.secho(str(e), fg='red')
+        sys.exit(1)
+
+
+@activate_group.command('stats')
+def activate_stats_command():
+    """Shows the listener state and the cold-start / idle-stop history."""
+    port = llama_activate.running_activate_port()
+    if port:
+        stats = requests.get(f"http://127.0.0.1:{port}/activate/stats", timeout=5).json()
+        click.echo(f"Listener on port {port}: llama-server {stats['state']} (backend port {stats['backend_port']}), "
+                   f"idle {stats['idle_s']:.0f}s of {stats['idle_timeout']:g}s, {stats['inflight']} in flight")
+    else:
+        click.echo("On-demand listener is not running.")
+    summary = llama_activate.summarize_events(llama_activate.read_events())
+    if not summary['cold_starts']:
+        click.echo(f"No cold starts recorded in '{llama_activate.ACTIVATE_EVENTS}'.")
+        return
+    latency = summary['cold_start_s']
+    click.echo(f"Cold starts: {summary['cold_starts']} (p50 {latency['p50']:.2f}s, max {latency['max']:.2f}s); "
+               f"idle stops: {summary['idle_stops']}")
+    click.echo(f"Model resident {summary['resident_s'] / 3600:.2f}h, unloaded {summary['unloaded_s'] / 3600:.2f}h"
+               + (f", ~{summary['reclaimed_mb_hours']:.0f} MB-hours reclaimed" if summary['reclaimed_mb_hours'] else ""))
+
+
+@click.group('supervisor')
+def supervisor_group():
+    """Watchdog that restarts the managed server when it crashes."""
+
+
+@supervisor_group.command('run')
+def supervisor_run_command():
+    """Keeps llama-server running in the foreground, restarting it with backoff after a crash (Ctrl-C to stop)."""
+    state = llama_man.read_supervisor_state()
+    if state and state['running']:
+        click.secho(f"A supervisor is already running (PID {state['pid']}).", fg='red')
+        sys.exit(1)
+    stop = threading.Event()
+    signal.signal(signal.SIGTERM, lambda signum, frame: stop.set())
+    click.echo("Supervising llama-server; chat-message and batch resume streams cut by a crash.")
+    try:
+        success, message = llama_man.supervise(stop)
+    except KeyboardInterrupt:
+        success, message = True, "Supervisor stopped."
+    click.secho(message, fg='green' if success else 'red')
+    if not success:
+        sys.exit(1)
+
+
+@supervisor_group.command('status')
+def supervisor_status_command():
+    """Shows whether a supervisor is running and how often it restarted the server."""
+    state = llama_man.read_supervisor_state()
+    if state is None:
+        click.echo(f"No supervisor has run here (no '{llama_man.SUPERVISOR_FILENAME}').")
+        return
+    since = time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(state['started_at']))
+    if state['running']:
+        click.secho(f"Supervisor PID {state['pid']} running since {since}: server PID {state['server_pid']} ({state['state']}).", fg='green')
+    else:
+        click.echo(f"Supervisor not running (last run started {since}).")
+    click.echo(f"Restarts: {state['restarts']}, crashes: {state['crashes']}, failed starts: {state['failed_starts']}"
+               + (f", last restart took {state['last_restart_s']:.2f}s" if state.get('last_restart_s') is not None else ""))
+    crash = state.get('last_crash')
+    if crash:
+        at = time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(crash['at']))
+        click.echo(f"Last crash: {at}, PID {crash['pid']} after {crash['uptime_s']:.1f}s up")
+
+
+@click.group('models')
+def models_group():
+    """Several models, each in its own llama-server, within a memory budget (least recently used evicted)."""
+
+
+@models_group.command('add')
+@click.argument('name')
+@click.argument('path', type=click.Path(exists=True, dir_okay=False))
+@click.option('--ctx-size', type=int, default=None, help='--ctx-size for this model (default: the configured one).')
+@click.option('--parallel', type=int, default=None, help='--parallel for this model (default: the configured one).')
+@click.option('--mem-mb', type=float, default=None, help='Memory to reserve instead of the estimate from file size and context.')
+@click.option('--embedding', is_flag=True, help='Start its server with --embedding (for `embed --model NAME`).')
+@click.option('--draft', type=click.Path(exists=True, dir_okay=False), default=None,
+              help='Small GGUF model with the same vocabulary for speculative decoding (-md).')
+@click.option('--draft-max', type=int, default=None, help='--draft-max: tokens drafted per step (default: llama-server\'s).')
+@click.option('--draft-min', type=int, default=None, help='--draft-min: shortest draft worth verifying (default: llama-server\'s).')
+def models_add_command(name, path, ctx_size, parallel, mem_mb, embedding, draft, draft_max, draft_min):
+    """Registers a GGUF model under NAME (with --draft: a speculative decoding profile; see `metrics spec`)."""
+    if (draft_max is not None or draft_min is not None) and not draft:
+        raise click.UsageError("--draft-max/--draft-min need --draft.")
+    success, message = llama_models.add_model(name, path, ctx_size=ctx_size, parallel=parallel, mem_mb=mem_mb,
+                                              embedding=embedding, draft=draft, draft_max=draft_max, draft_min=draft_min)
+    click.secho(message, fg='green' if success else 'red')
+    if not success:
+        sys.exit(1)
+
+
+@models_group.command('remove')
+@click.argument('name')
+def models_remove_command(name):
+    """Unloads and unregisters a model."""
+    success, message = llama_models.remove_model(name)
+    click.secho(message, fg='green' if success else 'red')
+    if not success:
+        sys.exit(1)
+
+
+@models_group.command('load')
+@click.argument('name')
+def models_load_command(name):
+    """Starts a model's server now (evicting others if the budget requires it)."""
+    success, message, _ = llama_models.ensure_model(name)
+    click.secho(message, fg='green' if success else 'red')
+    if not success:
+        sys.exit(1)
+
+
+@models_group.command('unload')
+@click.argument('name', required=False)
+@click.option('--all', 'unload_all', is_flag=True, help='Unload every resident model.')
+def models_unload_command(name, unload_all):
+    """Stops a resident model (its slots are saved first)."""
+    if unload_all:
+        success, messages = llama_models.unload_all()
+    elif name:
+        success, message = llama_models.unload_model(name)
+        messages = [message]
+    else:
+        raise click.UsageError("Give a model NAME or --all.")
+    for message in messages:
+        click.secho(message, fg='green' if success else 'red')
+    if not success:
+        sys.exit(1)
+
+
+@models_group.command('info')
+@click.argument('model', required=False)
+@click.option('--ctx-size', type=int, default=None, help='Context to estimate for (default: the configured one; 0 = trained).')
+@click.option('--parallel', type=int, default=None, help='Slots to estimate for (default: the configured --parallel).')
+def models_info_command(model, ctx_size, parallel):
+    """Reads a model's GGUF header: architecture, context and the memory a launch needs. MODEL is a registered name or a path (default: the managed model)."""
+    entry = llama_models.read_registry().get(model) if model else None
+    path = entry['path'] if entry else (model or llama_man.MODEL_PATH)
+    try:
+        info = llama_gguf.read_gguf(path)
+    except (llama_gguf.GGUFError, OSError) as e:
+        click.secho(f"{path}: {e}", fg='red')
+        sys.exit(1)
+    params = llama_gguf.model_params(info)
+    settings = llama_man.launch_settings(dict(entry or {}, **{k: v for k, v in (('ctx_size', ctx_size), ('parallel', parallel)) if v is not None}), path)
+    click.echo(f"{path}: GGUF v{info['version']}, {len(info['tensors'])} tensors, {info['file_size'] / (1 << 20):.0f} MB")
+    for key in ('architecture', 'name', 'block_count', 'context_length', 'embedding_length', 'head_count', 'head_count_kv', 'key_length', 'value_length'):
+        click.echo(f"  {key}: {params[key]}")
+    error = llama_gguf.check_complete(info)
+    if error:
+        click.secho(f"  {error}", fg='red')
+        sys.exit(1)
+    if settings.get('draft_model'):
+        _, error = llama_man.check_draft(path, settings['draft_model'], info)
+        click.secho(f"  {error}" if error else f"  Draft model {settings['draft_model']}: vocabulary matches.",
+                    fg='red' if error else 'green')
+    fitted, estimate, error = llama_gguf.fit_context(info, settings.get('ctx_size') or 0, settings.get('parallel') or 1)
+    click.echo(f"  {llama_gguf.describe(info, estimate, settings.get('parallel') or 1)}")
+    available = llama_gguf.available_memory_mb()
+    if error:
+        click.secho(f"  Does not fit: {error}", fg='red')
+    elif fitted != (settings.get('ctx_size') or 0):
+        click.secho(f"  Full context does not fit in {available:.0f} MB available; a start would use --ctx-size {fitted}.", fg='yellow')
+    elif available is not None:
+        click.secho(f"  Fits in {available:.0f} MB available.", fg='green')
+
+
+@models_group.command('status')
+def models_status_command():
+    """Shows registered models, what is resident, memory use and hit/load/eviction counts."""
+    rows = llama_models.status_models()
+    used = sum(row['estimate_mb'] for row in rows if row['resident']) + llama_models.single_server_mb()
+    click.echo(f"Memory budget {llama_models.memory_budget_mb():.0f} MB, {used:.0f} MB in use by resident servers (estimated).")
+    if not rows:
+        click.echo(f"No models registered in '{llama_models.MODELS_FILENAME}'.")
+        return
+    click.echo(f"{'MODEL':16s} {'STATE':9s} {'PORT':>5s} {'PID':>7s} {'EST MB':>8s} {'RSS MB':>8s} "
+               f"{'HITS':>5s} {'LOADS':>5s} {'EVICT':>5s}  LAST USED")
+    for row in rows:
+        last_used = time.strftime('%H:%M:%S', time.localtime(row['last_used'])) if row['last_used'] else '-'
+        click.secho(f"{row['name']:16s} {'resident' if row['resident'] else 'unloaded':9s} {row['port'] or '-':>5} "
+                    f"{row['pid'] or '-':>7} {row['estimate_mb']:8.0f} {row['rss_mb'] if row['rss_mb'] is not None else '-':>8} "
+                    f"{row['hits']:5d} {row['loads']:5d} {row['evictions']:5d}  {last_used}",
+                    fg='green' if row['resident'] else None)
+
+
+@click.group('logs')
+def logs_group():
+    """Captured llama-server output and the per-request timings parsed from it."""
+
+
+def _log_target(port, model):
+    return llama_logs.log_path(port or model)
+
+
+@logs_group.command('tail')
+@click.option('--lines', '-n', type=int, default=llama_logs.TAIL_LINES, show_default=True, help='Number of lines.')
+@click.option('--port', type=int, default=None, help='Log of the pool instance on this port.')
+@click.option('--model', '-m', default=None, help='Log of this registered model.')
+def logs_tail_command(lines, port, model):
+    """Prints the last lines of a server log."""
+    path = _log_target(port, model)
+    if not os.path.exists(path):
+        click.echo(f"No log at '{path}'.")
+        return
+    for line in llama_logs.tail(path, lines):
+        click.echo(line)
+
+
+@logs_group.command('perf')
+@click.option('--limit', '-n', type=int, default=20, show_default=True, help='Number of requests to show.')
+@click.option('--json', 'as_json', is_flag=True, help='Print the records as JSON lines.')
+@click.option('--port', type=int, default=None, help='Log of the pool instance on this port.')
+@click.option('--model', '-m', default=None, help='Log of this registered model.')
+def logs_perf_command(limit, as_json, port, model):
+    """Model load times and per-request prompt/eval rates from llama-server's timing lines."""
+    records = llama_logs.parse_lines(llama_logs.read_lines(_log_target(port, model)))
+    if as_json:
+        for record in records[-limit:]:
+            click.echo(json.dumps(record))
+        return
+    summary = llama_logs.summarize(records)
+    if not records:
+        click.echo(f"No timing records in '{_log_target(port, model)}'.")
+        return
+    click.echo(f"{'TIME':8s} {'SLOT':>4s} {'TASK':>6s} {'PROMPT':>6s} {'CACHED':>6s} {'PP TOK/S':>9s} {'GEN':>5s} {'TG TOK/S':>9s} {'TOTAL MS':>9s}")
+    for record in records[-limit:]:
+        at = time.strftime('%H:%M:%S', time.localtime(record['at'])) if record.get('at') else '-'
+        if record['type'] == 'load':
+            click.echo(f"{at:8s} model loaded in {record['load_s']:.2f}s")
+            continue
+        click.echo(f"{at:8s} {record['slot']:4d} {record['task']:6d} {record.get('n_prompt_tokens') or 0:6d} {record['n_cached']:6d} "
+                   f"{record.get('prompt_tps') or 0:9.1f} {record.get('eval_n') or 0:5d} {record.get('eval_tps') or 0:9.1f} "
+                   f"{record.get('total_ms') or 0:9.1f}")
+    click.echo(f"{summary['requests']} requests: prompt p50 {summary['prompt_tps_p50'] or 0:.1f} tok/s, "
+               f"generation p50 {summary['eval_tps_p50'] or 0:.1f} tok/s, "
+               f"{(summary['cached_fraction'] or 0):.0%} of prompt tokens from the KV cache"
+               + (f"; last load {summary['last_load_s']:.2f}s" if summary['last_load_s'] is not None else ""))
+
+
+@click.group('llama-cli', invoke_without_command=True)
+@click.option('--prompt', default=None, help='Shortcut for `chat-message --prompt`.')
+@click.pass_context
+def cli(ctx, prompt):
+    """llama-server helper. `--prompt` without a subcommand runs chat-message."""
+    if ctx.invoked_subcommand is not None:
+        return
+    if prompt is None:
+        click.echo(ctx.get_help())
+        return
+    ctx.invoke(chat_message_command, prompt=prompt)
+
+
+# Export the group as 'cli' for main.py
+cli.add_command(chat_message_command)
+cli.add_command(batch_command)
+cli.add_command(embed_command)
+cli.add_command(session_group)
+cli.add_command(pool_group)
+cli.add_command(rpc_group)
+cli.add_command(router_group)
+cli.add_command(sched_group)
+cli.add_command(cache_group)
+cli.add_command(bench_command)
+cli.add_command(metrics_group)
+cli.add_command(tune_command)
+cli.add_command(trace_group)
+cli.add_command(daemon_group)
+cli.add_command(slots_group)
+cli.add_command(activate_group)
+cli.add_command(models_group)
+cli.add_command(logs_group)
+cli.add_command(supervisor_group)
\ No newline at end of file
@@ -0,0 +1,602 @@
+# fake_llama_server.py
+"""
+Local stand-in for llama-server, used by the tests and for offline experiments.
+
+Emulates the parts of the llama.cpp HTTP API this project talks to:
+GET /health, GET /props, GET /slots, GET /metrics (with --metrics), POST /completion
+(plain JSON or SSE streaming), POST /tokenize, POST /slots/{id}?action=save|restore|erase
+(with --slot-save-path) and POST /embedding (with --embedding; inputs over -ub tokens are refused). Tokens are whitespace separated words; the reply is deterministic for a
+given prompt, and a prompt ending in whitespace, extended by part of its reply, continues
+that reply. Startup delay, prompt processing rate, token rate and jitter are configurable;
+--crash-after N dies after streaming N tokens, as llama-server does on an abort or OOM.
+With a draft model (-md) it emulates speculative decoding: each drafted token is accepted
+with probability --draft-p-accept, tokens arrive correspondingly faster (or slower, when
+drafting costs more than it saves) and the timings report draft_n and draft_n_accepted.
+With --rpc it connects to each rpc-server endpoint at startup (asking for its device memory)
+and holds the connections, or exits like llama-server when one cannot be reached.
+Run as a program, it logs model loading and every request to stderr in llama-server's
+format (slot events and print_timing blocks); --fail-load exits like a model load error.
+
+Run it in place of the real binary (unknown llama-server flags are ignored):
+    python fake_llama_server.py --port 8012 -m model.gguf --parallel 2
+    python fake_llama_server.py --port 8012 --startup-delay 2 --token-rate 40 --jitter 0.2 --metrics
+    python fake_llama_server.py --port 8012 --prompt-rate 2000 --slot-save-path /tmp/slots
+    python fake_llama_server.py --port 8012 --fail-load
+    python fake_llama_server.py --port 8012 --token-rate 20 --crash-after 50
+    python fake_llama_server.py --port 8012 --embedding -ub 512
+    python fake_llama_server.py --port 8012 --token-rate 20 -md draft.gguf --draft-max 8 --draft-p-accept 0.8
+"""
+import os
+import re
+import sys
+import json
+import math
+import hashlib
+import socket
+import struct
+import time
+import random
+import argparse
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+DEFAULT_N_PREDICT = 16  # Tokens generated when the request asks for n_predict = -1
+DEFAULT_N_CTX = 4096
+DEFAULT_N_EMBD = 16
+DEFAULT_N_UBATCH = 512
+DEFAULT_DRAFT_MAX = 16
+DRAFT_COST = 0.05  # Time of one drafted token, as a fraction of a main model step
+
+
+def tokenize(text):
+    """Fake tokenizer: one token per whitespace separated word."""
+    return text.split()
+
+
+def reply_tokens(prompt, n_predict):
+    """Deterministic reply for a prompt: 'tok0 tok1 ...' seeded by the prompt length."""
+    seed = len(tokenize(prompt))
+    return [f"tok{(seed + i) % 1000} " for i in range(n_predict)]
+
+
+def embedding_vector(text, n_embd=DEFAULT_N_EMBD):
+    """Deterministic unit-length embedding of `text`, derived from its hash."""
+    values = [b / 255.0 - 0.5 for b in hashlib.shake_256(text.encode("utf-8")).digest(n_embd)]
+    norm = math.sqrt(sum(v * v for v in values)) or 1.0
+    return [v / norm for v in values]
+
+
+class FakeLlamaServer:
+    """
+    Threaded HTTP server emulating llama-server.
+    `startup_delay` keeps /health at 503 "Loading model" for that many seconds,
+    `token_delay` is the pause between generated tokens, varied uniformly by
+    +/- `jitter` (a fraction of token_delay), and `n_slots` bounds concurrent
+    generations the same way llama-server's --parallel does. Each slot remembers
+    its last prompt so `timings.prompt_n` reflects prompt-cache reuse.
+    `metrics` enables GET /metrics (llama-server needs --metrics for it too).
+    `prompt_delay` is the processing time per prompt token not found in the slot's cache, and
+    `slot_save_path` enables saving and restoring a slot's cache, as llama-server's flag does.
+    `log_file` (e.g. sys.stderr) receives llama-server's log lines for each request.
+    `crash_after` makes the server "crash" once it has streamed that many tokens: `on_crash()`
+    is called (the program exits there); without it the stream is cut with a TCP reset and the
+    count starts again, as if the server had been restarted.
+    `embedding` enables POST /embedding (vectors of `n_embd` floats, see embedding_vector());
+    an input longer than `n_ubatch` tokens fails the request, as in llama-server.
+    `draft_max` > 0 emulates speculative decoding with drafts of that many tokens, each
+    accepted with probability `draft_p_accept` (see speculation()).
+    """
+
+    def __init__(self, host="127.0.0.1", port=0, startup_delay=0.0, token_delay=0.0,
+                 n_slots=1, n_ctx=DEFAULT_N_CTX, jitter=0.0, metrics=False, seed=0,
+                 prompt_delay=0.0, slot_save_path=None, log_file=None, crash_after=None, on_crash=None,
+                 embedding=False, n_embd=DEFAULT_N_EMBD, n_ubatch=DEFAULT_N_UBATCH, draft_max=0, draft_p_accept=0.7):
+        self.log_file = log_file # llama-server style log lines go here (None: not logged)
+        self.crash_after = crash_after
+        self.on_crash = on_crash
+        self.crashes = 0
+        self.embedding = embedding
+        self.n_embd = n_embd
+        self.n_ubatch = n_ubatch
+        self.embedding_requests = 0
+        self.draft_max = draft_max
+        self.draft_p_accept = draft_p_accept
+        self.tokens_streamed = 0
+        self.startup_delay = startup_delay
+        self.token_delay = token_delay
+        self.prompt_delay = prompt_delay
+        self.slot_save_path = slot_save_path
+        self.jitter = jitter
+        self.metrics_enabled = metrics
+        self.n_slots = n_slots
+        self.n_ctx = n_ctx
+        self.requests_served = 0
+        self.requests_deferred = 0
+        self.counters = {"prompt_tokens_total": 0, "prompt_seconds_total": 0.0,
+                         "tokens_predicted_total": 0, "tokens_predicted_seconds_total": 0.0,
+                         "n_decode_total": 0}
+        self._random = random.Random(seed)
+        self.busy_slots = set()
+        self.slot_cache = {}   # slot id -> tokens held in its emulated KV cache
+        self._slot_used = {}
+        self._slot_free = threading.Condition()
+        self._started_at = time.monotonic()
+        self.httpd = ThreadingHTTPServer((host, port), _make_handler(self))
+        self.httpd.daemon_threads = True
+        self._thread = None
+
+    @property
+    def port(self):
+        return self.httpd.server_address[1]
+
+    @property
+    def url(self):
+        return f"http://{self.httpd.server_address[0]}:{self.port}"
+
+    def is_loading(self):
+        return time.monotonic() - self._started_at < self.startup_delay
+
+    def tokens_per_step(self):
+        """Expected tokens per verification step: the accepted prefix of the draft plus the model's own token."""
+        return 1 + sum(self.draft_p_accept ** i for i in range(1, self.draft_max + 1))
+
+    def speculation(self, predicted_n):
+        """Returns (draft_n, draft_n_accepted) for `predicted_n` generated tokens ((0, 0) without drafting)."""
+        if not self.draft_max or not predicted_n:
+            return 0, 0
+        steps = math.ceil(predicted_n / self.tokens_per_step())
+        return steps * self.draft_max, predicted_n - steps
+
+    def next_token_delay(self):
+        """Pause before the next token: token_delay +/- jitter, scaled by the speculative speedup."""
+        delay = self.token_delay
+        if self.draft_max:
+            delay *= (1 + DRAFT_COST * self.draft_max) / self.tokens_per_step()
+        if not self.jitter:
+            return delay
+        with self._slot_free:
+            factor = self._random.uniform(1 - self.jitter, 1 + self.jitter)
+        return max(0.0, delay * factor)
+
+    def start(self):
+        """Serves requests on a background thread. Returns self."""
+        self._started_at = time.monotonic()
+        self._thread = threading.Thread(target=self.httpd.serve_forever, kwargs={"poll_interval": 0.05}, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+    def serve_forever(self):
+        self._started_at = time.monotonic()
+        self.httpd.serve_forever()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+    def log(self, *lines):
+        if self.log_file is not None:
+            self.log_file.write("".join(line + "\n" for line in lines))
+            self.log_file.flush()
+
+    def log_request(self, id_slot, task, prompt_tokens, prompt_n, n_predicted, prompt_ms, predicted_ms):
+        """Logs a finished request the way llama-server does (slot events, then print_timing)."""
+        head = f"id {id_slot:2d} | task {task} |"
+        n_past = len(prompt_tokens)
+        prompt_ms = prompt_n * 0.01 if prompt_ms is None else prompt_ms
+        timing = lambda label, ms, n: (f"{label} = {ms:10.2f} ms / {n:5d} tokens ({ms / max(n, 1):8.2f} ms per token, "
+                                       f"{n / ms * 1000 if ms else 0.0:8.2f} tokens per second)")
+        self.log(f"slot launch_slot_: {head} processing task",
+                 f"slot update_slots: {head} new prompt, n_ctx_slot = {self.n_ctx // self.n_slots}, n_keep = 0, n_prompt_tokens = {n_past}",
+                 f"slot update_slots: {head} kv cache rm [{n_past - prompt_n}, end)",
+                 f"slot update_slots: {head} prompt done, n_past = {n_past}, n_tokens = {prompt_n}",
+                 f"slot      release: {head} stop processing: n_past = {n_past + n_predicted}, truncated = 0",
+                 f"slot print_timing: {head} ",
+                 timing("prompt eval time", prompt_ms, prompt_n),
+                 timing("       eval time", predicted_ms, n_predicted),
+                 f"      total time = {prompt_ms + predicted_ms:10.2f} ms / {prompt_n + n_predicted:5d} tokens",
+                 "srv  update_slots: all slots are idle")
+
+    # --- Request handling ---
+
+    def completion(self, body):
+        """Returns (prompt tokens, reply tokens) for a /completion request body."""
+        prompt = body.get("prompt", "")
+        if isinstance(prompt, list):
+            prompt = " ".join(str(p) for p in prompt)
+        n_predict = body.get("n_predict", -1)
+        if n_predict is None or n_predict < 0:
+            n_predict = DEFAULT_N_PREDICT
+        return tokenize(prompt), reply_tokens(prompt, n_predict)
+
+    def embeddings(self, body):
+        """Returns (HTTP status, response body) for a /embedding request body."""
+        if not self.embedding:
+            return 501, {"error": {"code": 501, "message": "This server does not support embeddings. Start it with `--embeddings`", "type": "not_supported_error"}}
+        content = body.get("content", body.get("input"))
+        texts = content if isinstance(content, list) else [content]
+        if not texts or not all(isinstance(t, str) for t in texts):
+            return 400, {"error": {"code": 400, "message": "\"content\" must be a string or an array of strings", "type": "invalid_request_error"}}
+        n_tokens = [max(1, len(tokenize(t))) for t in texts]
+        if max(n_tokens) > self.n_ubatch:
+            return 500, {"error": {"code": 500, "message": f"input ({max(n_tokens)} tokens) is too large to process. increase the physical batch size (current batch size: {self.n_ubatch})", "type": "server_error"}}
+        if self.prompt_delay:
+            time.sleep(sum(n_tokens) * self.prompt_delay)
+        with self._slot_free:
+            self.embedding_requests += 1
+            self.counters["prompt_tokens_total"] += sum(n_tokens)
+        return 200, [{"index": i, "embedding": [embedding_vector(t, self.n_embd)]} for i, t in enumerate(texts)]
+
+    def count_token(self):
+        """Counts a streamed token. Returns True if the server should crash instead of sending it."""
+        with self._slot_free:
+            if self.crash_after is not None and self.tokens_streamed >= self.crash_after:
+                self.tokens_streamed = 0
+                self.crashes += 1
+                return True
+            self.tokens_streamed += 1
+            return False
+
+    def acquire_slot(self, id_slot=-1):
+        """Waits until the requested slot (or any slot for -1) is free, marks it busy and returns its id."""
+        with self._slot_free:
+            if id_slot is None or id_slot < 0 or id_slot >= self.n_slots:
+                self.requests_deferred += 1 # Waiting for a free slot, as llama-server's deferred queue
+                self._slot_free.wait_for(lambda: len(self.busy_slots) < self.n_slots)
+                self.requests_deferred -= 1
+                # Like llama-server, prefer the idle slot that was used least recently
+                id_slot = min((i for i in range(self.n_slots) if i not in self.busy_slots),
+                              key=lambda i: self._slot_used.get(i, 0))
+            else:
+                self._slot_free.wait_for(lambda: id_slot not in self.busy_slots)
+            self.busy_slots.add(id_slot)
+            self.requests_served += 1
+            self._slot_used[id_slot] = self.requests_served
+            return id_slot
+
+    def release_slot(self, id_slot, cached_tokens, prompt_n=0, predicted_n=0, predicted_ms=0.0):
+        """Frees a slot, leaving `cached_tokens` in its (emulated) KV cache, and updates the metrics counters."""
+        with self._slot_free:
+            self.counters["prompt_tokens_total"] += prompt_n
+            self.counters["prompt_seconds_total"] += prompt_n * 0.01 / 1000
+            self.counters["tokens_predicted_total"] += predicted_n
+            self.counters["tokens_predicted_seconds_total"] += predicted_ms / 1000
+            self.counters["n_decode_total"] += predicted_n
+            self.slot_cache[id_slot] = cached_tokens
+            self.busy_slots.discard(id_slot)
+            self._slot_free.notify_all()
+
+    def evaluate_prompt(self, id_slot, prompt_tokens, cache_prompt=True):
+        """Number of prompt tokens that must be processed given the slot's cached prefix."""
+        reused = 0
+        if cache_prompt:
+            for cached, token in zip(self.slot_cache.get(id_slot, ()), prompt_tokens):
+                if cached != token:
+                    break
+                reused += 1
+        # llama-server always re-evaluates at least the last prompt token
+        return max(len(prompt_tokens) - reused, 1 if prompt_tokens else 0)
+
+    def slot_action(self, id_slot, action, filename=None):
+        """
+        Saves, restores or erases a slot's cache like POST /slots/{id}?action=...
+        Returns (HTTP status, response body).
+        """
+        if not self.slot_save_path:
+            return 501, {"error": {"code": 501, "message": "This server does not support slots action. Start it with `--slot-save-path`", "type": "not_supported_error"}}
+        if not 0 <= id_slot < self.n_slots:
+            return 400, {"error": {"code": 400, "message": "Invalid slot ID", "type": "invalid_request_error"}}
+        if action == "erase":
+            with self._slot_free:
+                n_erased = len(self.slot_cache.pop(id_slot, ()))
+            return 200, {"id_slot": id_slot, "n_erased": n_erased}
+        if not filename or not re.fullmatch(r"[\w.-]+", filename) or filename.startswith("."):
+            return 400, {"error": {"code": 400, "message": "Invalid filename", "type": "invalid_request_error"}}
+        path = os.path.join(self.slot_save_path, filename)
+        start = time.monotonic()
+        if action == "save":
+            with self._slot_free:
+                tokens = list(self.slot_cache.get(id_slot, ()))
+            data = json.dumps(tokens).encode()
+            with open(path, "wb") as f:
+                f.write(data)
+            return 200, {"id_slot": id_slot, "filename": filename, "n_saved": len(tokens), "n_written": len(data),
+                         "timings": {"save_ms": (time.monotonic() - start) * 1000}}
+        if action == "restore":
+            try:
+                with open(path, "rb") as f:
+                    data = f.read()
+                tokens = json.loads(data)
+            except (OSError, ValueError):
+                return 400, {"error": {"code": 400, "message": "Unable to restore slot, no available space in KV cache or invalid slot save file", "type": "invalid_request_error"}}
+            with self._slot_free:
+                self.slot_cache[id_slot] = tokens
+            return 200, {"id_slot": id_slot, "filename": filename, "n_restored": len(tokens), "n_read": len(data),
+                         "timings": {"restore_ms": (time.monotonic() - start) * 1000}}
+        return 400, {"error": {"code": 400, "message": "Invalid action", "type": "invalid_request_error"}}
+
+    def metrics_text(self):
+        """Prometheus exposition in llama-server's format (metric names prefixed 'llamacpp:')."""
+        with self._slot_free:
+            c = dict(self.counters)
+            processing, deferred = len(self.busy_slots), self.requests_deferred
+        metrics = [
+            ("prompt_tokens_total", "counter", "Number of prompt tokens processed.", c["prompt_tokens_total"]),
+            ("prompt_seconds_total", "counter", "Prompt process time", c["prompt_seconds_total"]),
+            ("tokens_predicted_total", "counter", "Number of generation tokens processed.", c["tokens_predicted_total"]),
+            ("tokens_predicted_seconds_total", "counter", "Predict process time", c["tokens_predicted_seconds_total"]),
+            ("n_decode_total", "counter", "Total number of llama_decode() calls", c["n_decode_total"]),
+            ("prompt_tokens_seconds", "gauge", "Average prompt throughput in tokens/s.",
+             c["prompt_tokens_total"] / c["prompt_seconds_total"] if c["prompt_seconds_total"] else 0.0),
+            ("predicted_tokens_seconds", "gauge", "Average generation throughput in tokens/s.",
+             c["tokens_predicted_total"] / c["tokens_predicted_seconds_total"] if c["tokens_predicted_seconds_total"] else 0.0),
+            ("requests_processing", "gauge", "Number of requests processing.", processing),
+            ("requests_deferred", "gauge", "Number of requests deferred.", deferred),
+        ]
+        lines = []
+        for name, kind, help_text, value in metrics:
+            lines += [f"# HELP llamacpp:{name} {help_text}", f"# TYPE llamacpp:{name} {kind}", f"llamacpp:{name} {value}"]
+        return "\n".join(lines) + "\n"
+
+    def final_event(self, prompt_tokens, tokens, content, id_slot, prompt_n, predicted_ms, prompt_ms=None):
+        predicted_n = len(tokens)
+        if prompt_ms is None:
+            prompt_ms = prompt_n * 0.01
+        draft_n, draft_n_accepted = self.speculation(predicted_n)
+        event = {
+            "index": 0, "content": content, "tokens": [], "id_slot": id_slot, "stop": True,
+            "model": "fake-llama", "tokens_predicted": predicted_n, "tokens_evaluated": len(prompt_tokens),
+            "stop_type": "limit", "stopping_word": "", "tokens_cached": len(prompt_tokens) + predicted_n,
+            "truncated": False,
+            "timings": {
+                "prompt_n": prompt_n,
+                "prompt_ms": prompt_ms,
+                "prompt_per_token_ms": prompt_ms / prompt_n if prompt_n else 0.0,
+                "prompt_per_second": prompt_n / prompt_ms * 1000 if prompt_ms else 0.0,
+                "predicted_n": predicted_n,
+                "predicted_ms": predicted_ms,
+                "predicted_per_token_ms": predicted_ms / predicted_n if predicted_n else 0.0,
+                "predicted_per_second": predicted_n / predicted_ms * 1000 if predicted_ms else 0.0,
+            },
+        }
+        if draft_n: # llama-server only reports the draft counts when it drafted
+            event["timings"].update(draft_n=draft_n, draft_n_accepted=draft_n_accepted)
+        return event
+
+
+def _make_handler(server):
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def log_message(self, format, *args):
+            pass
+
+        def setup(self):
+            super().setup()
+            # Small SSE chunks must not wait on Nagle + delayed ACK (adds ~40ms to the first token)
+            self.connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+        def _send_json(self, status, data):
+            payload = json.dumps(data, separators=(",", ":")).encode()
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(payload)))
+            self.end_headers()
+            self.wfile.write(payload)
+
+        def _loading(self):
+            self._send_json(503, {"error": {"code": 503, "message": "Loading model", "type": "unavailable_error"}})
+
+        def do_GET(self):
+            if self.path == "/health":
+                if server.is_loading():
+                    return self._loading()
+                return self._send_json(200, {"status": "ok"})
+            if self.path == "/props":
+                return self._send_json(200, {
+                    "total_slots": server.n_slots,
+                    "default_generation_settings": {"n_ctx": server.n_ctx},
+                    "model_path": "fake.gguf",
+                })
+            if self.path == "/metrics":
+                if not server.metrics_enabled:
+                    return self._send_json(501, {"error": {"code": 501, "message": "This server does not support metrics endpoint. Start it with `--metrics`", "type": "not_supported_error"}})
+                payload = server.metrics_text().encode()
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain; version=0.0.4")
+                self.send_header("Content-Length", str(len(payload)))
+                self.end_headers()
+                return self.wfile.write(payload)
+            if self.path == "/slots":
+                return self._send_json(200, [{"id": i, "is_processing": i in server.busy_slots}
+                                             for i in range(server.n_slots)])
+            self._send_json(404, {"error": {"code": 404, "message": "File Not Found", "type": "not_found_error"}})
+
+        def do_POST(self):
+            length = int(self.headers.get("Content-Length", 0))
+            raw = self.rfile.read(length) if length else b""
+            slot_match = re.fullmatch(r"/slots/(\d+)\?action=(\w+)", self.path)
+            if slot_match:
+                try:
+                    filename = json.loads(raw or b"{}").get("filename")
+                except (ValueError, AttributeError):
+                    filename = None
+                return self._send_json(*server.slot_action(int(slot_match.group(1)), slot_match.group(2), filename))
+            if self.path == "/tokenize":
+                try:
+                    content = json.loads(raw or b"{}").get("content", "")
+                except (ValueError, AttributeError):
+                    content = None
+                if not isinstance(content, str):
+                    return self._send_json(400, {"error": {"code": 400, "message": "\"content\" must be provided", "type": "invalid_request_error"}})
+                return self._send_json(200, {"tokens": [int.from_bytes(hashlib.blake2b(w.encode(), digest_size=2).digest(), "little")
+                                                        for w in tokenize(content)]})
+            if self.path in ("/embedding", "/embeddings"):
+                if server.is_loading():
+                    return self._loading()
+                try:
+                    body = json.loads(raw or b"{}")
+                except ValueError:
+                    return self._send_json(400, {"error": {"code": 400, "message": "Invalid JSON", "type": "invalid_request_error"}})
+                return self._send_json(*server.embeddings(body))
+            if self.path != "/completion":
+                return self._send_json(404, {"error": {"code": 404, "message": "File Not Found", "type": "not_found_error"}})
+            if server.is_loading():
+                return self._loading()
+            try:
+                body = json.loads(raw or b"{}")
+            except ValueError:
+                return self._send_json(400, {"error": {"code": 400, "message": "Invalid JSON", "type": "invalid_request_error"}})
+
+            prompt_tokens, tokens = server.completion(body)
+            id_slot = server.acquire_slot(body.get("id_slot", -1))
+            task = server.requests_served - 1
+            prompt_n, predicted_ms, prompt_ms = 0, 0.0, None
+            try:
+                prompt_n = server.evaluate_prompt(id_slot, prompt_tokens, body.get("cache_prompt", True))
+                prompt_ms = None
+                if server.prompt_delay:
+                    time.sleep(prompt_n * server.prompt_delay)
+                    prompt_ms = prompt_n * server.prompt_delay * 1000
+                if body.get("stream"):
+                    predicted_ms = self._stream(prompt_tokens, tokens, id_slot, prompt_n, prompt_ms)
+                else:
+                    start = time.monotonic()
+                    if server.token_delay:
+                        time.sleep(sum(server.next_token_delay() for _ in tokens))
+                    predicted_ms = (time.monotonic() - start) * 1000
+                    final = server.final_event(prompt_tokens, tokens, "".join(tokens), id_slot, prompt_n, predicted_ms, prompt_ms)
+                    self._send_json(200, final)
+            finally:
+                server.release_slot(id_slot, prompt_tokens + tokenize("".join(tokens)), prompt_n, len(tokens), predicted_ms)
+                server.log_request(id_slot, task, prompt_tokens, prompt_n, len(tokens), prompt_ms, predicted_ms)
+
+        def _stream(self, prompt_tokens, tokens, id_slot, prompt_n, prompt_ms=None):
+            """Streams the reply as SSE events. Returns the generation time in ms."""
+            self.send_response(200)
+            self.send_header("Content-Type", "text/event-stream")
+            self.send_header("Transfer-Encoding", "chunked")
+            self.end_headers()
+            start = time.monotonic()
+            try:
+                for i, token in enumerate(tokens):
+                    if server.token_delay:
+                        time.sleep(server.next_token_delay())
+                    if server.count_token():
+                        self._crash()
+                        return (time.monotonic() - start) * 1000
+                    self._chunk({"index": 0, "content": token, "tokens": [], "stop": False, "id_slot": -1,
+                                 "tokens_predicted": i + 1, "tokens_evaluated": len(prompt_tokens)})
+                predicted_ms = (time.monotonic() - start) * 1000
+                self._chunk(server.final_event(prompt_tokens, tokens, "", id_slot, prompt_n, predicted_ms, prompt_ms))
+                self.wfile.write(b"0\r\n\r\n")
+            except (BrokenPipeError, ConnectionResetError):
+                self.close_connection = True
+            return (time.monotonic() - start) * 1000
+
+        def _crash(self):
+            if server.on_crash:
+                server.on_crash()
+            # Reset instead of an orderly close, so the client sees the stream break mid-response
+            self.connection.setsockopt(socket.SOL_SOCKET, socket.SO_LINGER, struct.pack("ii", 1, 0))
+            self.connection.close()
+            self.close_connection = True
+
+        def _chunk(self, data):
+            event = b"data: " + json.dumps(data, separators=(",", ":")).encode() + b"\n\n"
+            self.wfile.write(f"{len(event):x}\r\n".encode() + event + b"\r\n")
+            self.wfile.flush()
+
+    return Handler
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Fake llama-server for offline testing.")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8080)
+    parser.add_argument("--parallel", "-np", type=int, default=1)
+    parser.add_argument("--ctx-size", "-c", type=int, default=0)
+    parser.add_argument("--startup-delay", type=float, default=0.0)
+    parser.add_argument("--token-delay", type=float, default=0.0, help="Seconds between generated tokens.")
+    parser.add_argument("--token-rate", type=float, default=None, help="Tokens per second (overrides --token-delay).")
+    parser.add_argument("--jitter", type=float, default=0.0, help="Token delay variation, as a fraction (0.2 = +/-20%%).")
+    parser.add_argument("--jitter-seed", type=int, default=0, help="Seed for the jitter.")
+    parser.add_argument("--metrics", action="store_true", help="Enable the /metrics endpoint.")
+    parser.add_argument("--prompt-rate", type=float, default=None, help="Prompt tokens processed per second (default: instant).")
+    parser.add_argument("--slot-save-path", default=None, help="Directory for slot save/restore files.")
+    parser.add_argument("--model", "-m", default="fake.gguf")
+    parser.add_argument("--fail-load", action="store_true", help="Log a model load error and exit with code 1.")
+    parser.add_argument("--crash-after", type=int, default=None, help="Abort (exit code 134) after streaming this many tokens.")
+    parser.add_argument("--embedding", "--embeddings", action="store_true", help="Enable the /embedding endpoint.")
+    parser.add_argument("--ubatch-size", "-ub", type=int, default=DEFAULT_N_UBATCH, help="Longest /embedding input in tokens.")
+    parser.add_argument("--rpc", default=None, help="Comma-separated rpc-server endpoints to connect to at startup.")
+    parser.add_argument("--n-gpu-layers", "-ngl", type=int, default=0, help="Accepted and ignored.")
+    parser.add_argument("--model-draft", "-md", default=None, help="Draft model: emulate speculative decoding.")
+    parser.add_argument("--draft-max", "--draft", "--draft-n", type=int, default=DEFAULT_DRAFT_MAX, help="Tokens drafted per step.")
+    parser.add_argument("--draft-min", "--draft-n-min", type=int, default=0, help="Accepted and ignored.")
+    parser.add_argument("--draft-p-accept", type=float, default=0.7, help="Probability that a drafted token is accepted.")
+    args, _unknown = parser.parse_known_args(argv)
+
+    log = lambda line: print(line, file=sys.stderr, flush=True)
+    log(f"build: 5061 (fake) with {sys.implementation.name} {sys.version.split()[0]}")
+    log(f"srv    load_model: loading model '{args.model}'")
+    if args.fail_load:
+        log("llama_model_load: error loading model: tensor 'blk.0.attn_q.weight' data is not within the file bounds, model is corrupted or incomplete")
+        log("llama_model_load_from_file_impl: failed to load model")
+        log(f"srv    load_model: failed to load model, '{args.model}'")
+        log("main: exiting due to model loading error")
+        sys.exit(1)
+    rpc_connections = [] # Held open while the server runs, as llama-server keeps its RPC sockets
+    for endpoint in filter(None, (args.rpc or "").split(",")):
+        host, _, port = endpoint.rpartition(":")
+        try:
+            conn = socket.create_connection((host, int(port)), timeout=10)
+            conn.sendall(struct.pack("<BQ", 11, 0)) # GET_DEVICE_MEMORY
+            reply = b""
+            while len(reply) < 24:
+                chunk = conn.recv(24 - len(reply))
+                if not chunk:
+                    raise ConnectionError("connection closed")
+                reply += chunk
+        except (OSError, ValueError) as e:
+            log(f"failed to connect to rpc server {endpoint}: {e}")
+            log("main: exiting due to model loading error")
+            sys.exit(1)
+        free = struct.unpack("<QQQ", reply)[1]
+        log(f"llama_model_load_from_file_impl: using device RPC[{endpoint}] (RPC[{endpoint}]) - {free >> 20} MiB free")
+        rpc_connections.append(conn)
+
+    def crash():
+        log(f"/llama.cpp/ggml/src/ggml.c:1536: GGML_ASSERT(ggml_can_mul_mat(a, b)) failed (fake crash after {args.crash_after} tokens)")
+        os._exit(134) # What SIGABRT leaves as the exit status
+
+    token_delay = 1.0 / args.token_rate if args.token_rate else args.token_delay
+    server = FakeLlamaServer(host=args.host, port=args.port, startup_delay=args.startup_delay,
+                             token_delay=token_delay, n_slots=max(1, args.parallel),
+                             n_ctx=args.ctx_size or DEFAULT_N_CTX, jitter=args.jitter,
+                             metrics=args.metrics, seed=args.jitter_seed,
+                             prompt_delay=1.0 / args.prompt_rate if args.prompt_rate else 0.0,
+                             slot_save_path=args.slot_save_path, log_file=sys.stderr,
+                             crash_after=args.crash_after, on_crash=crash,
+                             embedding=args.embedding, n_ubatch=args.ubatch_size,
+                             draft_max=args.draft_max if args.model_draft else 0, draft_p_accept=args.draft_p_accept)
+    log(f"main: HTTP server is listening, hostname: {args.host}, port: {server.port}, http threads: {max(1, args.parallel) + 1}")
+    def loaded():
+        log("main: model loaded")
+        log(f"main: server is listening on {server.url} - starting the main loop")
+    threading.Timer(args.startup_delay, loaded).start()
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.httpd.server_close()
+
+
+if __name__ == "__main__":
+    main()
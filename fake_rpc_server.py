@@ -0,0 +1,123 @@
+# fake_rpc_server.py
+"""
+Local stand-in for ggml's rpc-server, used by the tests and for offline experiments.
+
+Speaks just enough of the ggml RPC protocol (one command byte, a little-endian u64 payload
+size, the payload; replies are a u64 size and the payload) to answer GET_DEVICE_MEMORY with
+the configured free/total memory. Like rpc-server, it serves one client connection at a time:
+while a llama-server is connected, further connections wait in the listen backlog. Any other
+command closes the connection. `delay` adds latency to every reply.
+
+Run it in place of the real binary (unknown rpc-server flags are ignored):
+    python fake_rpc_server.py -H 127.0.0.1 -p 50052 -m 2048
+"""
+import sys
+import time
+import socket
+import struct
+import argparse
+import threading
+
+RPC_CMD_GET_DEVICE_MEMORY = 11
+DEFAULT_PORT = 50052
+DEFAULT_MEM_MB = 4096
+
+
+def _recv_exact(conn, size):
+    data = b""
+    while len(data) < size:
+        chunk = conn.recv(size - len(data))
+        if not chunk:
+            return None
+        data += chunk
+    return data
+
+
+class FakeRpcServer:
+    """
+    Threaded TCP server emulating rpc-server on (host, port). Reports `free_mb` of `total_mb`
+    device memory. `clients` counts accepted connections; `log_file` receives rpc-server style lines.
+    """
+
+    def __init__(self, host="127.0.0.1", port=0, total_mb=DEFAULT_MEM_MB, free_mb=None, delay=0.0, log_file=None):
+        self.total_mb = total_mb
+        self.free_mb = total_mb if free_mb is None else free_mb
+        self.delay = delay
+        self.log_file = log_file
+        self.clients = 0
+        self.sock = socket.create_server((host, port), backlog=16)
+        self._stopping = threading.Event()
+        self._thread = None
+
+    @property
+    def port(self):
+        return self.sock.getsockname()[1]
+
+    @property
+    def endpoint(self):
+        return f"{self.sock.getsockname()[0]}:{self.port}"
+
+    def log(self, line):
+        if self.log_file is not None:
+            self.log_file.write(line + "\n")
+            self.log_file.flush()
+
+    def start(self):
+        self._thread = threading.Thread(target=self.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._stopping.set()
+        self.sock.close()
+        if self._thread:
+            self._thread.join(5)
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+    def serve_forever(self):
+        self.log(f"Starting RPC server on {self.endpoint}, backend memory: {self.total_mb} MB")
+        while not self._stopping.is_set():
+            try:
+                conn, _ = self.sock.accept()
+            except OSError:
+                break
+            self.clients += 1
+            self.log(f"Accepted client connection, free_mem={self.free_mb << 20}, total_mem={self.total_mb << 20}")
+            with conn: # One client at a time, as rpc-server's accept loop
+                self.serve_client(conn)
+            self.log("Client connection closed")
+
+    def serve_client(self, conn):
+        while not self._stopping.is_set():
+            header = _recv_exact(conn, 9)
+            if header is None:
+                return
+            command, size = struct.unpack("<BQ", header)
+            if _recv_exact(conn, size) is None or command != RPC_CMD_GET_DEVICE_MEMORY:
+                return
+            if self.delay:
+                time.sleep(self.delay)
+            conn.sendall(struct.pack("<QQQ", 16, self.free_mb << 20, self.total_mb << 20))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Fake rpc-server for tests.")
+    parser.add_argument("--host", "-H", default="127.0.0.1")
+    parser.add_argument("--port", "-p", type=int, default=DEFAULT_PORT)
+    parser.add_argument("--mem", "-m", type=int, default=DEFAULT_MEM_MB, help="Backend memory in MB.")
+    parser.add_argument("--delay", type=float, default=0.0, help="Seconds added to every reply.")
+    args, _unknown = parser.parse_known_args(argv)
+    server = FakeRpcServer(args.host, args.port, total_mb=args.mem, delay=args.delay, log_file=sys.stderr)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
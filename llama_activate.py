@@ -0,0 +1,320 @@
+# llama_activate.py
+"""
+Scale-to-zero front end for the managed server.
+
+A small listener holds llama_man.PORT while llama-server itself runs on a private backend
+port and only when needed: the first request after an idle period starts it through
+start_llama_server (requests arriving meanwhile wait in their handler threads), and a
+reaper stops it through stop_llama_server once nothing has been served for `idle_timeout`
+seconds. Slots are saved on that stop and restored on the next start (llama_slots).
+
+Passive requests (/health, /metrics, /slots) never start the server or keep it alive, so
+readiness probes and Prometheus scrapes do not defeat the idle shutdown. While the server is
+scaled to zero they get 503, so /health reports ready only when llama-server really is.
+
+Every cold start and idle stop is appended to ACTIVATE_EVENTS with its timings, and
+summarize_events() weighs the resident time (and memory) saved against the latency the
+cold starts added.
+
+Under systemd socket activation (LISTEN_FDS), the inherited socket is used instead of
+binding the port.
+"""
+import os
+import json
+import time
+import signal
+import socket
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import llama_man
+import llama_pid
+import llama_proxy
+import llama_ready
+
+# --- Activation Configuration ---
+ACTIVATE_STATE_FILENAME = ".llama_activate.json"
+ACTIVATE_EVENTS = ".llama_activate_events.jsonl"
+IDLE_TIMEOUT = 600.0  # Seconds without requests before llama-server is stopped
+REAP_INTERVAL = 1.0   # Seconds between idle checks
+# --- End Configuration ---
+
+PASSIVE_PATHS = {"/health", "/metrics", "/slots"}
+SD_LISTEN_FDS_START = 3
+
+# Backend states
+STOPPED = "STOPPED"
+STARTING = "STARTING"
+RUNNING = "RUNNING"
+STOPPING = "STOPPING"
+
+
+def log_event(event):
+    """Appends one event (a dict) to ACTIVATE_EVENTS and prints it. Write errors are ignored."""
+    event = dict(event, at=round(time.time(), 3))
+    print(json.dumps(event), flush=True)
+    try:
+        with open(ACTIVATE_EVENTS, 'a') as f:
+            f.write(json.dumps(event) + "\n")
+    except OSError:
+        pass
+
+def read_events(path=None):
+    """Events logged so far, oldest first."""
+    events = []
+    try:
+        with open(path or ACTIVATE_EVENTS, 'r') as f:
+            for line in f:
+                try:
+                    events.append(json.loads(line))
+                except ValueError:
+                    continue
+    except OSError:
+        pass
+    return events
+
+class Backend:
+    """
+    Starts and stops llama-server on demand. Request handlers bracket their work with
+    acquire()/release(); reap() stops the server once it has been idle long enough.
+    Thread-safe.
+    """
+
+    def __init__(self, idle_timeout=IDLE_TIMEOUT):
+        self.idle_timeout = idle_timeout
+        self.state = STOPPED
+        self.error = None
+        self.inflight = 0
+        self.waiting = 0
+        self.last_active = time.monotonic()
+        self.ready_at = None
+        self.pid = None
+        self._cond = threading.Condition()
+
+    def _alive(self):
+        return self.pid is not None and llama_man.is_server_process(self.pid)
+
+    def acquire(self):
+        """
+        Waits until llama-server is running, starting it if this is the first request.
+        Returns None when the request may proceed (release() must follow), else an error message.
+        """
+        with self._cond:
+            if self.state == RUNNING and not self._alive():
+                log_event({"event": "crashed", "pid": self.pid})
+                self.state, self.pid = STOPPED, None
+            while self.state in (STARTING, STOPPING):
+                self.waiting += 1
+                self._cond.wait()
+                self.waiting -= 1
+            if self.state == RUNNING:
+                self.inflight += 1
+                return None
+            self.state = STARTING
+        return self._cold_start()
+
+    def _cold_start(self):
+        start = time.monotonic()
+        success, message, pid = llama_man.start_llama_server()
+        elapsed = time.monotonic() - start
+        with self._cond:
+            log_event({"event": "cold_start", "ok": success, "ready_s": round(elapsed, 3),
+                       "waiting_requests": self.waiting + 1, **({} if success else {"error": message})})
+            if success:
+                self.state, self.pid, self.error = RUNNING, pid, None
+                self.ready_at = self.last_active = time.monotonic()
+                self.inflight += 1
+            else:
+                if pid:
+                    llama_man.stop_llama_server(force=True, save_slots=False) # Started but never became ready
+                self.state, self.error = STOPPED, message
+            self._cond.notify_all()
+        return None if success else message
+
+    def release(self):
+        with self._cond:
+            self.inflight -= 1
+            self.last_active = time.monotonic()
+
+    def is_running(self):
+        with self._cond:
+            return self.state == RUNNING
+
+    def reap(self, now=None):
+        """Stops llama-server if it has been idle for idle_timeout. Returns True if it was stopped."""
+        now = now if now is not None else time.monotonic()
+        with self._cond:
+            idle = now - self.last_active
+            if self.state != RUNNING or self.inflight or idle < self.idle_timeout:
+                return False
+            self.state = STOPPING
+            pid, resident_s = self.pid, now - self.ready_at
+        rss = llama_pid.resident_mb(pid)
+        start = time.monotonic()
+        success, message = llama_man.stop_llama_server()
+        with self._cond:
+            log_event({"event": "idle_stop", "ok": success, "idle_s": round(idle, 3), "resident_s": round(resident_s, 3),
+                       "rss_mb": rss, "stop_s": round(time.monotonic() - start, 3),
+                       **({} if success else {"error": message})})
+            self.state = STOPPED if success else RUNNING
+            if success:
+                self.pid = None
+            else:
+                self.last_active = time.monotonic() # Try again after another idle period
+            self._cond.notify_all()
+        return success
+
+    def stats(self):
+        with self._cond:
+            return {"state": self.state, "pid": self.pid, "inflight": self.inflight, "waiting": self.waiting,
+                    "idle_s": round(time.monotonic() - self.last_active, 3), "idle_timeout": self.idle_timeout,
+                    "backend_port": llama_man.PORT, "last_error": self.error}
+
+
+def summarize_events(events):
+    """
+    Totals over logged events: cold starts and their latency, idle stops, time the model was
+    resident vs unloaded (from the first cold start to the last event) and the memory-time
+    reclaimed (mean resident MB x unloaded hours).
+    """
+    starts = [e for e in events if e.get("event") == "cold_start" and e.get("ok")]
+    stops = [e for e in events if e.get("event") == "idle_stop" and e.get("ok")]
+    summary = {"cold_starts": len(starts), "idle_stops": len(stops), "cold_start_s": None,
+               "resident_s": 0.0, "unloaded_s": 0.0, "reclaimed_mb_hours": None}
+    if not starts:
+        return summary
+    latencies = sorted(e["ready_s"] for e in starts)
+    summary["cold_start_s"] = {"p50": latencies[len(latencies) // 2], "max": latencies[-1],
+                               "mean": round(sum(latencies) / len(latencies), 3)}
+    resident = sum(e["resident_s"] for e in stops)
+    # A server still running since the last cold start counts as resident until the last event
+    if events[-1].get("event") != "idle_stop":
+        resident += max(0.0, events[-1]["at"] - starts[-1]["at"])
+    span = events[-1]["at"] - (starts[0]["at"] - starts[0]["ready_s"])
+    summary["resident_s"] = round(resident, 3)
+    summary["unloaded_s"] = round(max(0.0, span - resident), 3)
+    rss = [e["rss_mb"] for e in stops if e.get("rss_mb")]
+    if rss:
+        summary["reclaimed_mb_hours"] = round(sum(rss) / len(rss) * summary["unloaded_s"] / 3600, 2)
+    return summary
+
+
+# --- HTTP Front End ---
+
+def _make_handler(backend, upstream):
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def log_message(self, format, *args):
+            pass
+
+        def do_GET(self):
+            self._forward("GET", b"")
+
+        def do_POST(self):
+            self._forward("POST", llama_proxy.read_body(self))
+
+        def _forward(self, method, body):
+            if self.path == "/activate/stats":
+                return llama_proxy.send_json(self, 200, backend.stats())
+            if self.path in PASSIVE_PATHS:
+                if not backend.is_running():
+                    return llama_proxy.send_json(self, 503, {"error": {"code": 503, "message": "llama-server is scaled to zero", "type": "unavailable_error"}})
+                return llama_proxy.relay(self, upstream, llama_ready.HOST, llama_man.PORT, method, self.path, body)
+            error = backend.acquire()
+            if error:
+                return llama_proxy.send_json(self, 503, {"error": {"code": 503, "message": f"llama-server failed to start: {error}", "type": "unavailable_error"}})
+            try:
+                llama_proxy.relay(self, upstream, llama_ready.HOST, llama_man.PORT, method, self.path, body)
+            finally:
+                backend.release()
+
+    return Handler
+
+
+def _free_port():
+    with socket.socket() as s:
+        s.bind((llama_ready.HOST, 0))
+        return s.getsockname()[1]
+
+def make_server(backend, port=None, host=llama_ready.HOST):
+    """
+    Creates (but does not start) the listener. A socket passed by systemd (LISTEN_FDS) is
+    used as is; otherwise `port` (default llama_man.PORT) is bound.
+    """
+    handler = _make_handler(backend, llama_proxy.UpstreamPool())
+    if os.environ.get("LISTEN_PID") == str(os.getpid()) and int(os.environ.get("LISTEN_FDS", 0)) >= 1:
+        httpd = ThreadingHTTPServer((host, 0), handler, bind_and_activate=False)
+        httpd.socket.close()
+        httpd.socket = socket.socket(fileno=SD_LISTEN_FDS_START)
+        httpd.server_address = httpd.socket.getsockname()[:2]
+    else:
+        httpd = ThreadingHTTPServer((host, port or llama_man.PORT), handler)
+    httpd.daemon_threads = True
+    return httpd
+
+
+def read_activate_state():
+    """Returns the running listener's state dict ({'pid', 'port', 'backend_port', ...}) or None."""
+    try:
+        with open(ACTIVATE_STATE_FILENAME, 'r') as f:
+            state = json.load(f)
+    except (IOError, ValueError):
+        return None
+    if isinstance(state, dict) and llama_pid.is_process_running(state.get('pid')):
+        return state
+    return None
+
+def running_activate_port():
+    """Port of a running, responsive on-demand listener (whether or not llama-server is up behind it), or None."""
+    state = read_activate_state()
+    # Scaled to zero, the listener answers /health with 503: only no answer at all means it is gone
+    if state and llama_ready.probe_health(state['port'])[0] != llama_ready.UNREACHABLE:
+        return state['port']
+    return None
+
+
+def serve(port=None, idle_timeout=IDLE_TIMEOUT, backend_port=None):
+    """
+    Runs the listener in the foreground until interrupted. llama-server is started on
+    `backend_port` (default: a free port) and stopped when the listener exits.
+    """
+    port = port or llama_man.PORT
+    status_code, _ = llama_man.status_llama_server()
+    if status_code == "RUNNING":
+        raise RuntimeError("llama-server is already running; stop it first so the listener can manage it")
+    backend = Backend(idle_timeout=idle_timeout)
+    httpd = make_server(backend, port=port)
+    listen_port = httpd.server_address[1]
+    configured_port = llama_man.PORT
+    llama_man.PORT = backend_port or _free_port() # This process starts and stops the server on the private port
+    with open(ACTIVATE_STATE_FILENAME, 'w') as f:
+        json.dump({'pid': os.getpid(), 'port': listen_port, 'backend_port': llama_man.PORT,
+                   'idle_timeout': idle_timeout}, f)
+    print(f"On-demand listener on port {listen_port}; llama-server starts on port {llama_man.PORT} "
+          f"at the first request and stops after {idle_timeout:g}s idle.", flush=True)
+
+    def terminate(signum, frame):
+        raise KeyboardInterrupt # systemd stops the unit with SIGTERM; clean up as for Ctrl-C
+    if threading.current_thread() is threading.main_thread():
+        signal.signal(signal.SIGTERM, terminate)
+
+    stop = threading.Event()
+    def reaper():
+        while not stop.wait(min(REAP_INTERVAL, idle_timeout)):
+            backend.reap()
+    threading.Thread(target=reaper, daemon=True).start()
+    try:
+        httpd.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        stop.set()
+        httpd.server_close()
+        if backend.is_running():
+            llama_man.stop_llama_server()
+        llama_man.PORT = configured_port
+        try:
+            os.remove(ACTIVATE_STATE_FILENAME)
+        except OSError:
+            pass
@@ -0,0 +1,232 @@
+# llama_batch.py
+import os
+import json
+import time
+import asyncio
+
+import requests
+
+import llama_man
+import llama_pool
+import llama_client
+import llama_sched
+
+# Per-record fields passed through to /completion when present in the input JSONL
+PASSTHROUGH_FIELDS = ("n_predict", "temperature", "top_k", "top_p", "min_p", "seed", "stop", "grammar")
+DEFAULT_ID_FIELDS = ("id", "request_id")
+REQUEST_TIMEOUT = 600 # Seconds; a batch item may wait behind other slots before generating
+# Batch items queue behind interactive requests at a scheduler (llama_sched); other servers ignore the header
+REQUEST_HEADERS = {llama_sched.PRIORITY_HEADER: llama_sched.BATCH}
+
+
+def iter_prompts(input_path, prompt_field="prompt", id_field=None, skip_ids=(), on_skip=None):
+    """
+    Streams (record_id, payload) pairs from a JSONL file without loading it into memory.
+    Ids come from `id_field` (default: "id" or "request_id", else the 1-based line number).
+    Records whose id is in `skip_ids` are skipped (reported to `on_skip(record_id)`).
+    Raises ValueError on malformed lines.
+    """
+    id_fields = (id_field,) if id_field else DEFAULT_ID_FIELDS
+    with open(input_path, "r", encoding="utf-8") as f:
+        for line_no, line in enumerate(f, start=1):
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                record = json.loads(line)
+            except json.JSONDecodeError as e:
+                raise ValueError(f"{input_path}:{line_no}: invalid JSON ({e})") from e
+            if not isinstance(record, dict) or prompt_field not in record:
+                raise ValueError(f"{input_path}:{line_no}: missing prompt field '{prompt_field}'")
+
+            record_id = next((record[k] for k in id_fields if k in record), None)
+            record_id = str(record_id) if record_id is not None else str(line_no)
+            if record_id in skip_ids:
+                if on_skip:
+                    on_skip(record_id)
+                continue
+
+            payload = {"prompt": record[prompt_field], "n_predict": -1}
+            payload.update({k: record[k] for k in PASSTHROUGH_FIELDS if k in record})
+            yield record_id, payload
+
+
+def load_completed_ids(output_path):
+    """Returns the set of ids already completed successfully in an output JSONL (the checkpoint)."""
+    done = set()
+    if not os.path.exists(output_path):
+        return done
+    with open(output_path, "r", encoding="utf-8") as f:
+        for line in f:
+            try:
+                result = json.loads(line)
+            except json.JSONDecodeError:
+                continue # A torn last line from an interrupted run; that item is redone
+            if isinstance(result, dict) and "id" in result and "error" not in result:
+                done.add(str(result["id"]))
+    return done
+
+
+def truncate_torn_tail(output_path):
+    """Cuts a partially written last line (from an interrupted run) so appends start on a fresh line."""
+    if not os.path.exists(output_path):
+        return
+    with open(output_path, "rb+") as f:
+        size = f.seek(0, os.SEEK_END)
+        if size == 0:
+            return
+        f.seek(size - 1)
+        if f.read(1) == b"\n":
+            return
+        # Walk back to the last newline; the torn record is dropped and will be redone
+        pos = size
+        while pos > 0:
+            step = min(4096, pos)
+            pos -= step
+            f.seek(pos)
+            newline = f.read(step).rfind(b"\n")
+            if newline != -1:
+                f.truncate(pos + newline + 1)
+                return
+        f.truncate(0)
+
+
+def detect_server_slots(session, base_url):
+    """Reads the number of server slots from /props. Returns int or None."""
+    try:
+        response = session.get(f"{base_url}/props", timeout=5)
+        response.raise_for_status()
+        slots = response.json().get("total_slots")
+        return int(slots) if slots else None
+    except (requests.exceptions.RequestException, ValueError, TypeError):
+        return None
+
+
+async def _complete(pool, balancer, record_id, payload, resume=0):
+    """
+    Runs one completion on the least loaded endpoint. Returns a result dict (with 'error' on failure).
+    A 429 with Retry-After (a scheduler shedding load) is retried after that pause, for up to REQUEST_TIMEOUT.
+    """
+    start = time.monotonic()
+    base_url = balancer.acquire()
+    failed = False
+    try:
+        while True:
+            try:
+                data = await llama_client.complete(base_url, payload, pool=pool, first_token_timeout=REQUEST_TIMEOUT,
+                                                   resume=resume, headers=REQUEST_HEADERS)
+                break
+            except llama_client.HTTPStatusError as e:
+                if e.status != 429 or e.retry_after is None or time.monotonic() + e.retry_after - start > REQUEST_TIMEOUT:
+                    raise
+                await asyncio.sleep(e.retry_after)
+    except (llama_client.ConnectError, llama_client.ClientTimeout) as e:
+        failed = True
+        return {"id": record_id, "error": str(e), "elapsed_s": round(time.monotonic() - start, 4)}
+    except (llama_client.ClientError, ValueError) as e:
+        return {"id": record_id, "error": str(e), "elapsed_s": round(time.monotonic() - start, 4)}
+    finally:
+        balancer.release(base_url, failed=failed)
+    result = {
+        "id": record_id,
+        "content": data.get("content", ""),
+        "tokens_predicted": data.get("tokens_predicted", 0),
+        "tokens_evaluated": data.get("tokens_evaluated", 0),
+        "timings": data.get("timings"),
+        "elapsed_s": round(time.monotonic() - start, 4),
+    }
+    if data.get("resumed"):
+        result["resumed"] = data["resumed"]
+    return result
+
+
+async def _run(prompts, concurrency, base_urls, write, resume_streams=0):
+    """Keeps up to `concurrency` completions in flight on one event loop, calling `write(result)` as each ends."""
+    pool = llama_client.ConnectionPool(max_idle=concurrency)
+    balancer = llama_pool.LeastOutstandingBalancer(base_urls)
+    pending = set()
+
+    async def drain(return_when):
+        nonlocal pending
+        done, pending = await asyncio.wait(pending, return_when=return_when)
+        for task in done:
+            write(task.result())
+
+    try:
+        for record_id, payload in prompts:
+            pending.add(asyncio.create_task(_complete(pool, balancer, record_id, payload, resume_streams)))
+            # Keep the input streaming: read the next prompt only when a request finishes
+            if len(pending) >= concurrency:
+                await drain(asyncio.FIRST_COMPLETED)
+    except asyncio.CancelledError:
+        # Interrupted: drop the open streams so the server stops generating; --resume redoes them
+        for task in pending:
+            task.cancel()
+        await asyncio.gather(*pending, return_exceptions=True)
+        pending = set()
+        raise
+    finally:
+        if pending:
+            await drain(asyncio.ALL_COMPLETED)
+        await pool.close()
+
+
+def run_batch(input_path, output_path, base_url=None, concurrency=None, prompt_field="prompt",
+              id_field=None, resume=True, on_result=None, base_urls=None, resume_streams=0):
+    """
+    Sends every prompt in `input_path` to llama-server with at most `concurrency` streams
+    in flight on one event loop over keep-alive connections (llama_client), appending one
+    JSON result per line to `output_path` as soon as it completes.
+
+    `base_urls` spreads requests over several servers (e.g. a pool) by least-outstanding-requests.
+    With `resume`, ids already present (without error) in `output_path` are skipped.
+    Concurrency defaults to the servers' total slot count (/props), else llama_man.PARALLEL per server.
+    `on_result(result)` is called for each finished item.
+    `resume_streams` lets each request survive that many server crashes (llama_client resume).
+    Returns a summary dict with counts, elapsed seconds, prompts/sec and tokens/sec.
+    Raises ValueError if `concurrency` is not positive.
+    """
+    if concurrency is not None and concurrency <= 0:
+        raise ValueError(f"concurrency must be positive, got {concurrency}")
+    base_urls = base_urls or [base_url or f"http://127.0.0.1:{llama_man.PORT}"]
+    skip_ids = set()
+    if resume:
+        skip_ids = load_completed_ids(output_path)
+        truncate_torn_tail(output_path)
+
+    probe_session = requests.Session()
+    server_slots = [detect_server_slots(probe_session, url) for url in base_urls]
+    probe_session.close()
+    slots = sum(n or llama_man.PARALLEL for n in server_slots) if any(server_slots) else None
+    concurrency = concurrency or slots or llama_man.PARALLEL * len(base_urls)
+
+    summary = {"completed": 0, "failed": 0, "skipped": 0, "tokens_predicted": 0,
+               "tokens_evaluated": 0, "concurrency": concurrency, "server_slots": slots}
+    mode = "a" if resume else "w"
+    start = time.monotonic()
+
+    with open(output_path, mode, encoding="utf-8") as out:
+        def write(result):
+            out.write(json.dumps(result) + "\n")
+            out.flush() # Each line is a checkpoint for --resume
+            if "error" in result:
+                summary["failed"] += 1
+            else:
+                summary["completed"] += 1
+                summary["tokens_predicted"] += result["tokens_predicted"] or 0
+                summary["tokens_evaluated"] += result["tokens_evaluated"] or 0
+            if on_result:
+                on_result(result)
+
+        def skip(record_id):
+            summary["skipped"] += 1
+
+        prompts = iter_prompts(input_path, prompt_field=prompt_field, id_field=id_field, skip_ids=skip_ids,
+                               on_skip=skip)
+        asyncio.run(_run(prompts, concurrency, base_urls, write, resume_streams))
+
+    elapsed = time.monotonic() - start
+    summary["elapsed_s"] = elapsed
+    summary["prompts_per_sec"] = summary["completed"] / elapsed if elapsed > 0 else 0.0
+    summary["tokens_per_sec"] = summary["tokens_predicted"] / elapsed if elapsed > 0 else 0.0
+    return summary
@@ -0,0 +1,335 @@
+# llama_bench.py
+"""
+End-to-end latency and throughput benchmark.
+
+Measures time-to-ready of start_llama_server, then for each concurrency level N runs
+streaming completions on N parallel clients and records time-to-first-token, inter-token
+latency percentiles, tokens/sec and client CPU per token, plus the server's /metrics
+when it exposes them. Results are a JSON-serialisable dict; compare() diffs two runs
+so regressions show up across commits.
+
+With fake=True (the default) the server is fake_llama_server.py launched through
+start_llama_server with a configurable startup delay, token rate and jitter, and the
+PID file lives in a temporary directory, so the benchmark runs offline and never
+touches a real server.
+"""
+import os
+import sys
+import json
+import time
+import shutil
+import socket
+import platform
+import tempfile
+import threading
+import contextlib
+import subprocess
+import concurrent.futures
+
+import requests
+
+import llama_man
+import llama_pid
+import llama_gguf
+import llama_logs
+import llama_ready
+import llama_sse
+import llama_metrics
+
+# --- Benchmark Configuration ---
+CONCURRENCY = (1, 4)      # Parallel streams per level
+N_PREDICT = 64            # Tokens generated per request
+PROMPT_WORDS = 32         # Prompt length in words
+READY_RUNS = 3            # start_llama_server cold starts to time
+FAKE_STARTUP_DELAY = 0.5  # Seconds the fake server reports "Loading model"
+FAKE_TOKEN_RATE = 100.0   # Tokens per second per stream from the fake server
+FAKE_JITTER = 0.1         # Fake token delay variation (fraction of the delay)
+REQUEST_TIMEOUT = 600
+RESULT_VERSION = 1
+# --- End Configuration ---
+
+FAKE_SERVER = os.path.join(os.path.dirname(os.path.abspath(__file__)), "fake_llama_server.py")
+FAKE_MODEL_METADATA = {"general.architecture": "llama", "general.name": "fake", "llama.block_count": 2,
+                       "llama.context_length": 2048, "llama.embedding_length": 64, "llama.attention.head_count": 4}
+
+# (path in the result, True if higher is better) checked by compare(); per-level paths are prefixed "streams=N."
+_COMPARED_TOP = (("time_to_ready_s.p50", False),)
+_COMPARED_LEVEL = (("tokens_per_sec", True), ("ttft_ms.p50", False), ("ttft_ms.p99", False),
+                   ("itl_ms.p50", False), ("itl_ms.p99", False), ("client_cpu_us_per_token", False))
+
+
+# --- Statistics ---
+
+def percentile(sorted_values, q):
+    """Linear-interpolated percentile (q in 0..100) of an already sorted list."""
+    if not sorted_values:
+        return None
+    pos = (len(sorted_values) - 1) * q / 100
+    low = int(pos)
+    high = min(low + 1, len(sorted_values) - 1)
+    return sorted_values[low] + (sorted_values[high] - sorted_values[low]) * (pos - low)
+
+
+def summarize(values, scale=1.0):
+    """mean/p50/p90/p99/max of `values` multiplied by `scale`, or None if empty."""
+    if not values:
+        return None
+    data = sorted(v * scale for v in values)
+    return {"mean": sum(data) / len(data), "p50": percentile(data, 50), "p90": percentile(data, 90),
+            "p99": percentile(data, 99), "max": data[-1], "n": len(data)}
+
+
+# --- Server Side ---
+
+def write_fake_install(directory, startup_delay=FAKE_STARTUP_DELAY, token_rate=FAKE_TOKEN_RATE, jitter=FAKE_JITTER):
+    """
+    Writes an executable 'llama-server' wrapper around fake_llama_server.py (with the given
+    timing and /metrics enabled) and a dummy model into `directory`. Returns (server_path, model_path).
+    """
+    server_path = os.path.join(directory, "llama-server")
+    with open(server_path, "w") as f:
+        f.write(f'#!/bin/sh\nexec "{sys.executable}" "{FAKE_SERVER}" --startup-delay {startup_delay} '
+                f'--token-rate {token_rate} --jitter {jitter} --metrics "$@"\n')
+    os.chmod(server_path, 0o755)
+    model_path = llama_gguf.write_gguf(os.path.join(directory, "fake.gguf"), FAKE_MODEL_METADATA)
+    return server_path, model_path
+
+
+def _free_port():
+    with socket.socket() as s:
+        s.bind((llama_ready.HOST, 0))
+        return s.getsockname()[1]
+
+
+@contextlib.contextmanager
+def _overridden(module, **values):
+    """Temporarily replaces module-level configuration constants."""
+    saved = {name: getattr(module, name) for name in values}
+    for name, value in values.items():
+        setattr(module, name, value)
+    try:
+        yield
+    finally:
+        for name, value in saved.items():
+            setattr(module, name, value)
+
+
+def measure_time_to_ready(runs=READY_RUNS, keep_running=True):
+    """
+    Cold-starts the configured server `runs` times through start_llama_server and times each
+    start until /health is ready (slot restore and warm-up skipped). The server is stopped
+    between runs (and after the last one unless `keep_running`).
+    Returns (list of seconds, error message or None).
+    """
+    times = []
+    for i in range(runs):
+        start = time.perf_counter()
+        success, message, _ = llama_man.start_llama_server(warm=False)
+        elapsed = time.perf_counter() - start
+        if not success:
+            return times, message
+        times.append(elapsed)
+        if i < runs - 1 or not keep_running:
+            llama_man.stop_llama_server(force=True, save_slots=False)
+    return times, None
+
+
+# --- Client Side ---
+
+def stream_once(session, url, payload):
+    """
+    Runs one streaming completion and times it from the client's point of view.
+    Returns a dict with ttft, inter-token gaps, token count, elapsed time and the CPU time
+    this thread spent (requests + SSE decoding).
+    """
+    cpu_start = time.thread_time()
+    start = time.perf_counter()
+    token_times = []
+    timings = None
+    with session.post(url, json=payload, stream=True, timeout=REQUEST_TIMEOUT) as response:
+        response.raise_for_status()
+        for data in llama_sse.iter_events(response.iter_content(chunk_size=None)):
+            text = data.decode("utf-8")
+            if llama_sse.extract_content(text):
+                token_times.append(time.perf_counter())
+            if llama_sse.is_final(text):
+                timings = json.loads(text).get("timings")
+    end = time.perf_counter()
+    return {
+        "ttft": token_times[0] - start if token_times else None,
+        "itl": [b - a for a, b in zip(token_times, token_times[1:])],
+        "tokens": len(token_times),
+        "elapsed": end - start,
+        "cpu": time.thread_time() - cpu_start,
+        "server_timings": timings,
+    }
+
+
+def make_payload(index, n_predict=N_PREDICT, prompt_words=PROMPT_WORDS):
+    """A distinct prompt per request so runs are not skewed by prompt caching."""
+    words = " ".join(f"word{(index * 7 + i) % 997}" for i in range(prompt_words))
+    return {"prompt": f"Request {index}: {words}", "n_predict": n_predict, "stream": True}
+
+
+def run_level(base_url, streams, requests_total, n_predict=N_PREDICT, prompt_words=PROMPT_WORDS, payloads=None):
+    """
+    Runs `requests_total` streaming completions on `streams` parallel clients and aggregates them.
+    `payloads` (a list of /completion bodies, cycled) replaces the synthetic prompts.
+    """
+    url = f"{base_url}/completion"
+    local = threading.local()
+    sessions = []
+
+    def one(index):
+        if not hasattr(local, "session"):
+            local.session = requests.Session()
+            sessions.append(local.session)
+        if payloads:
+            payload = dict(payloads[index % len(payloads)], stream=True)
+        else:
+            payload = make_payload(index, n_predict, prompt_words)
+        return stream_once(local.session, url, payload)
+
+    results, errors = [], []
+    start = time.perf_counter()
+    with concurrent.futures.ThreadPoolExecutor(max_workers=streams) as executor:
+        for future in concurrent.futures.as_completed([executor.submit(one, i) for i in range(requests_total)]):
+            try:
+                results.append(future.result())
+            except (requests.exceptions.RequestException, ValueError) as e:
+                errors.append(str(e))
+    wall = time.perf_counter() - start
+    for session in sessions:
+        session.close()
+
+    tokens = sum(r["tokens"] for r in results)
+    cpu = sum(r["cpu"] for r in results)
+    return {
+        "streams": streams,
+        "requests": len(results),
+        "errors": len(errors),
+        "error_samples": errors[:3],
+        "tokens": tokens,
+        "wall_s": wall,
+        "tokens_per_sec": tokens / wall if wall else 0.0,
+        "requests_per_sec": len(results) / wall if wall else 0.0,
+        "ttft_ms": summarize([r["ttft"] for r in results if r["ttft"] is not None], 1000),
+        "itl_ms": summarize([gap for r in results for gap in r["itl"]], 1000),
+        "client_cpu_us_per_token": cpu / tokens * 1e6 if tokens else None,
+    }
+
+
+# --- Orchestration ---
+
+def _git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=os.path.dirname(os.path.abspath(__file__)),
+                              capture_output=True, text=True, timeout=5).stdout.strip() or None
+    except (OSError, subprocess.SubprocessError):
+        return None
+
+
+def run_benchmark(concurrency=CONCURRENCY, requests_per_level=None, n_predict=N_PREDICT, prompt_words=PROMPT_WORDS,
+                  ready_runs=READY_RUNS, fake=True, startup_delay=FAKE_STARTUP_DELAY, token_rate=FAKE_TOKEN_RATE,
+                  jitter=FAKE_JITTER):
+    """
+    Runs the whole benchmark and returns the result dict.
+    `requests_per_level` defaults to 4 requests per stream (at least 8).
+    With fake=False the configured llama-server is used: an already running server is
+    benchmarked as is (time-to-ready is skipped), otherwise it is started and stopped here.
+    """
+    concurrency = sorted(set(concurrency))
+    result = {
+        "version": RESULT_VERSION,
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+        "commit": _git_commit(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "server": {"fake": fake},
+        "params": {"concurrency": concurrency, "n_predict": n_predict, "prompt_words": prompt_words,
+                   "ready_runs": ready_runs},
+    }
+    if fake:
+        result["server"].update({"startup_delay_s": startup_delay, "token_rate": token_rate, "jitter": jitter})
+
+    with contextlib.ExitStack() as stack:
+        if fake:
+            workdir = tempfile.mkdtemp(prefix="llama-bench-")
+            stack.callback(shutil.rmtree, workdir, ignore_errors=True)
+            server_path, model_path = write_fake_install(workdir, startup_delay, token_rate, jitter)
+            stack.enter_context(_overridden(llama_man, SERVER_PATH=server_path, MODEL_PATH=model_path,
+                                            PORT=_free_port(), PARALLEL=max(concurrency),
+                                            SLOT_SAVE_PATH=os.path.join(workdir, ".llama_slots"),
+                                            RPC_GROUP_FILENAME=os.path.join(workdir, llama_man.RPC_GROUP_FILENAME),
+                                            SUPERVISOR_FILENAME=os.path.join(workdir, llama_man.SUPERVISOR_FILENAME)))
+            stack.enter_context(_overridden(llama_pid, PID_FILENAME=os.path.join(workdir, llama_pid.PID_FILENAME)))
+            stack.enter_context(_overridden(llama_logs, LOG_FILENAME=os.path.join(workdir, llama_logs.LOG_FILENAME)))
+
+        already_running = llama_man.status_llama_server()[0] == "RUNNING"
+        if already_running:
+            result["time_to_ready_s"] = None
+            result["time_to_ready_note"] = "server was already running"
+        else:
+            times, error = measure_time_to_ready(ready_runs)
+            stack.callback(llama_man.stop_llama_server, force=True, save_slots=False)
+            result["time_to_ready_s"] = summarize(times)
+            if error:
+                result["error"] = f"Server failed to start: {error}"
+                return result
+        result["server"]["port"] = llama_man.PORT
+        result["server"]["slots"] = llama_man.PARALLEL
+
+        base_url = f"http://{llama_ready.HOST}:{llama_man.PORT}"
+        metrics_before = llama_metrics.scrape_metrics(llama_man.PORT)
+        result["levels"] = [run_level(base_url, n, requests_per_level or max(8, 4 * n), n_predict, prompt_words)
+                            for n in concurrency]
+        metrics_after = llama_metrics.scrape_metrics(llama_man.PORT)
+        if metrics_after is not None:
+            before = metrics_before or {}
+            result["server_metrics"] = {
+                name: value - before.get(name, 0.0) if name.endswith("_total") else value
+                for name, value in metrics_after.items()
+            }
+        else:
+            result["server_metrics"] = None
+    return result
+
+
+# --- Regression Comparison ---
+
+def _lookup(data, path):
+    for part in path.split("."):
+        if not isinstance(data, dict) or data.get(part) is None:
+            return None
+        data = data[part]
+    return data
+
+
+def _flatten_compared(result):
+    """{metric path: (value, higher_is_better)} for the metrics compare() looks at."""
+    values = {}
+    for path, higher in _COMPARED_TOP:
+        values[path] = (_lookup(result, path), higher)
+    for level in result.get("levels") or []:
+        for path, higher in _COMPARED_LEVEL:
+            values[f"streams={level['streams']}.{path}"] = (_lookup(level, path), higher)
+    return values
+
+
+def compare(baseline, current, tolerance=0.10):
+    """
+    Compares two benchmark results. Returns a list of dicts (metric, baseline, current, change,
+    regression) for every metric present in both; `change` is the relative difference and a
+    regression is a change in the bad direction larger than `tolerance`.
+    """
+    old, new = _flatten_compared(baseline), _flatten_compared(current)
+    rows = []
+    for metric, (old_value, higher) in old.items():
+        new_value = new.get(metric, (None, higher))[0]
+        if old_value is None or new_value is None or old_value == 0:
+            continue
+        change = (new_value - old_value) / old_value
+        worse = -change if higher else change
+        rows.append({"metric": metric, "baseline": old_value, "current": new_value,
+                     "change": change, "regression": worse > tolerance})
+    return rows
@@ -0,0 +1,289 @@
+# llama_cache.py
+"""
+Persistent, content-addressed cache of streamed completions.
+
+Entries are keyed by sha256 over (model file hash, sampling parameters, prompt) and stored
+as one JSONL file per key holding every SSE `data:` payload with its time offset, so a hit
+can be replayed as a stream (optionally at the original pace). An SQLite index tracks size
+and last access for LRU eviction under CACHE_MAX_BYTES and keeps hit/miss/byte counters.
+
+Concurrent identical requests, from threads or separate CLI processes, are coalesced: the
+first one takes an flock on the key and generates; the others follow its partial file as
+tokens arrive instead of starting a second generation.
+"""
+import os
+import json
+import time
+import sqlite3
+import hashlib
+import contextlib
+
+import llama_lock
+import llama_sse
+
+# --- Cache Configuration ---
+CACHE_DIR = ".llama_cache"
+CACHE_MAX_BYTES = 512 * 1024 * 1024
+FOLLOW_POLL = 0.005  # Seconds between checks while following another process's generation
+# Request fields that never change the generated text and are left out of the key
+NON_KEY_FIELDS = ("prompt", "stream", "id_slot", "cache_prompt")
+# --- End Configuration ---
+
+_COUNTERS = ("hits", "misses", "coalesced", "bytes_served", "bytes_written", "evictions", "uncacheable")
+
+
+def is_cacheable(payload):
+    """A request is deterministic (and safe to cache) at temperature 0 or with a fixed seed."""
+    if payload.get("temperature") == 0:
+        return True
+    seed = payload.get("seed")
+    return isinstance(seed, int) and seed >= 0
+
+
+@contextlib.contextmanager
+def _db():
+    """Opens the index database (WAL mode, safe for concurrent processes)."""
+    os.makedirs(CACHE_DIR, exist_ok=True)
+    conn = sqlite3.connect(os.path.join(CACHE_DIR, "index.db"), timeout=30, isolation_level=None)
+    try:
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("CREATE TABLE IF NOT EXISTS entries (key TEXT PRIMARY KEY, size INTEGER, created REAL, last_access REAL, hits INTEGER DEFAULT 0)")
+        conn.execute("CREATE TABLE IF NOT EXISTS counters (name TEXT PRIMARY KEY, value INTEGER)")
+        conn.execute("CREATE TABLE IF NOT EXISTS models (path TEXT, size INTEGER, mtime_ns INTEGER, sha256 TEXT, PRIMARY KEY (path, size, mtime_ns))")
+        yield conn
+    finally:
+        conn.close()
+
+
+def _bump(conn, **deltas):
+    for name, delta in deltas.items():
+        conn.execute("INSERT INTO counters (name, value) VALUES (?, ?) ON CONFLICT(name) DO UPDATE SET value = value + excluded.value",
+                     (name, delta))
+
+
+def model_fingerprint(model_path):
+    """
+    sha256 of the model file, memoised in the index by (path, size, mtime) so the
+    multi-GB read only happens when the file changes.
+    """
+    st = os.stat(model_path)
+    real_path = os.path.realpath(model_path)
+    with _db() as conn:
+        row = conn.execute("SELECT sha256 FROM models WHERE path = ? AND size = ? AND mtime_ns = ?",
+                           (real_path, st.st_size, st.st_mtime_ns)).fetchone()
+        if row:
+            return row[0]
+        digest = hashlib.sha256()
+        with open(model_path, "rb") as f:
+            for block in iter(lambda: f.read(1 << 20), b""):
+                digest.update(block)
+        conn.execute("INSERT OR REPLACE INTO models VALUES (?, ?, ?, ?)",
+                     (real_path, st.st_size, st.st_mtime_ns, digest.hexdigest()))
+        return digest.hexdigest()
+
+
+def cache_key(model_hash, payload):
+    """Canonical key: sha256 over the model hash, the sampling parameters and the prompt."""
+    params = {k: v for k, v in payload.items() if k not in NON_KEY_FIELDS}
+    canonical = json.dumps({"model": model_hash, "params": params, "prompt": payload.get("prompt", "")},
+                           sort_keys=True, separators=(",", ":"), ensure_ascii=False)
+    return hashlib.sha256(canonical.encode("utf-8")).hexdigest()
+
+
+def _entry_path(key):
+    return os.path.join(CACHE_DIR, key[:2], f"{key}.jsonl")
+
+
+def _partial_path(key):
+    return os.path.join(CACHE_DIR, key[:2], f"{key}.partial")
+
+
+def _lock_path(key):
+    return os.path.join(CACHE_DIR, "locks", f"{key}.lock")
+
+
+def _replay(path, pace=None):
+    """Yields the cached data payloads; `pace` (e.g. 1.0) reproduces the original timing scaled by 1/pace."""
+    start = time.monotonic()
+    with open(path, "r", encoding="utf-8") as f:
+        for line in f:
+            offset, data = json.loads(line)
+            if pace:
+                delay = offset / pace - (time.monotonic() - start)
+                if delay > 0:
+                    time.sleep(delay)
+            yield data
+
+
+def contains(key):
+    """True if a complete entry for `key` is on disk (does not count as a use)."""
+    return os.path.exists(_entry_path(key))
+
+
+def lookup(key):
+    """Returns the entry path if the key is cached (and marks it used), else None."""
+    path = _entry_path(key)
+    if not os.path.exists(path):
+        return None
+    with _db() as conn:
+        conn.execute("UPDATE entries SET last_access = ?, hits = hits + 1 WHERE key = ?", (time.time(), key))
+    return path
+
+
+def stream(key, generate, pace=None, max_bytes=None):
+    """
+    Yields SSE data payloads (JSON strings) for `key`:
+    replayed from the cache on a hit, followed live from a concurrent identical request,
+    or produced by calling `generate()` (an iterator of data payloads) and teed into the cache.
+    Only complete streams (ending with stop: true) are stored.
+    """
+    while True:
+        path = lookup(key)
+        if path:
+            yield from _served(_replay(path, pace), "hits")
+            return
+        try:
+            with llama_lock.file_lock(_lock_path(key), blocking=False):
+                path = lookup(key) # Filled while we were checking?
+                if path:
+                    yield from _served(_replay(path, pace), "hits")
+                else:
+                    yield from _generate_and_store(key, generate, max_bytes)
+                return
+        except llama_lock.LockBusy:
+            pass
+        # Another request is generating this key: follow its output as it is written
+        completed = yield from _follow(key)
+        if completed:
+            return
+        # The other generation failed; loop and try to take over
+
+
+def _served(events, counter):
+    served = 0
+    for data in events:
+        served += len(data)
+        yield data
+    with _db() as conn:
+        _bump(conn, **{counter: 1, "bytes_served": served})
+
+
+def _generate_and_store(key, generate, max_bytes):
+    partial = _partial_path(key)
+    os.makedirs(os.path.dirname(partial), exist_ok=True)
+    with contextlib.suppress(FileNotFoundError):
+        os.remove(partial) # Leftover of a crashed writer; followers of it will retry
+    start = time.monotonic()
+    complete = False
+    try:
+        with open(partial, "x", encoding="utf-8") as f:
+            for data in generate():
+                f.write(json.dumps([round(time.monotonic() - start, 4), data]) + "\n")
+                f.flush() # Followers read the partial file as it grows
+                complete = llama_sse.is_final(data)
+                yield data
+        if not complete:
+            return
+        os.replace(partial, _entry_path(key))
+        size = os.path.getsize(_entry_path(key))
+        with _db() as conn:
+            now = time.time()
+            conn.execute("INSERT OR REPLACE INTO entries (key, size, created, last_access, hits) VALUES (?, ?, ?, ?, 0)",
+                         (key, size, now, now))
+            _bump(conn, misses=1, bytes_written=size)
+        evict(max_bytes)
+    finally:
+        if not complete:
+            with contextlib.suppress(FileNotFoundError):
+                os.remove(partial)
+            with _db() as conn:
+                _bump(conn, misses=1)
+
+
+def _follow(key):
+    """
+    Yields payloads from another request's partial file. Returns True if its stream completed,
+    False if it ended before we read anything (the caller retries). Raises RuntimeError if the
+    other generation died midway.
+    """
+    partial, lock = _partial_path(key), _lock_path(key)
+    f = None
+    while f is None:
+        try:
+            f = open(partial, "r", encoding="utf-8")
+        except FileNotFoundError:
+            if not llama_lock.is_locked(lock):
+                return False # Finished (or failed) before we got here; caller re-checks the cache
+            time.sleep(FOLLOW_POLL)
+    served, buffer = 0, ""
+    with f:
+        while True:
+            line = f.readline()
+            buffer += line
+            if buffer.endswith("\n"):
+                _, data = json.loads(buffer)
+                buffer = ""
+                served += len(data)
+                yield data
+                if llama_sse.is_final(data):
+                    with _db() as conn:
+                        _bump(conn, coalesced=1, bytes_served=served)
+                    return True
+            elif llama_lock.is_locked(lock):
+                time.sleep(FOLLOW_POLL) # Writer still generating
+            elif not line:
+                # Writer released the lock and everything it wrote has been read
+                if served:
+                    raise RuntimeError("Coalesced generation ended before completion.")
+                return False
+
+
+def evict(max_bytes=None):
+    """Deletes least recently used entries until the cache fits in `max_bytes` (default CACHE_MAX_BYTES)."""
+    budget = CACHE_MAX_BYTES if max_bytes is None else max_bytes
+    with _db() as conn:
+        conn.execute("BEGIN IMMEDIATE") # Serialise evictors across processes
+        try:
+            total = conn.execute("SELECT COALESCE(SUM(size), 0) FROM entries").fetchone()[0]
+            evicted = 0
+            for key, size in conn.execute("SELECT key, size FROM entries ORDER BY last_access ASC").fetchall():
+                if total <= budget:
+                    break
+                with contextlib.suppress(FileNotFoundError):
+                    os.remove(_entry_path(key))
+                conn.execute("DELETE FROM entries WHERE key = ?", (key,))
+                total -= size
+                evicted += 1
+            if evicted:
+                _bump(conn, evictions=evicted)
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+    return evicted
+
+
+def record_uncacheable():
+    with _db() as conn:
+        _bump(conn, uncacheable=1)
+
+
+def stats():
+    """Returns a dict of counters plus current entry count and size."""
+    with _db() as conn:
+        result = {name: 0 for name in _COUNTERS}
+        result.update(dict(conn.execute("SELECT name, value FROM counters").fetchall()))
+        entries, size = conn.execute("SELECT COUNT(*), COALESCE(SUM(size), 0) FROM entries").fetchone()
+    result.update({"entries": entries, "size_bytes": size, "max_bytes": CACHE_MAX_BYTES})
+    return result
+
+
+def clear():
+    """Removes every cached entry (counters are kept). Returns the number of entries removed."""
+    with _db() as conn:
+        keys = [row[0] for row in conn.execute("SELECT key FROM entries").fetchall()]
+        for key in keys:
+            with contextlib.suppress(FileNotFoundError):
+                os.remove(_entry_path(key))
+        conn.execute("DELETE FROM entries")
+    return len(keys)
@@ -0,0 +1,427 @@
+# llama_client.py
+"""
+Asyncio client for llama-server's streaming /completion endpoint.
+
+stream_completion() is an async generator over the SSE event payloads of one completion,
+built on asyncio streams: any number of streams share one event loop, no thread each.
+Connections come from a ConnectionPool and are handed back (HTTP/1.1 keep-alive) once a
+response has been read to its end, so a batch or a session pays the TCP setup once.
+
+Timeouts are separate: connecting (CONNECT_TIMEOUT), from sending the request to the first
+event (FIRST_TOKEN_TIMEOUT; covers waiting for a slot and prompt processing) and the longest
+gap between events after that (IDLE_TIMEOUT). There is no overall limit: a long answer that
+keeps producing tokens is never cut off.
+
+When the consumer stops early (break, aclose(), task cancellation, Ctrl-C in iter_completion)
+the connection is aborted instead of being reused. llama-server notices on its next write,
+stops generating and frees the slot for the next request.
+
+With `resume`, a stream cut by a server crash is picked up again once the server is back
+(e.g. restarted by llama_man.supervise): the prompt is re-sent with the text received so far
+appended and n_predict reduced by it, so only the missing tokens are generated. The consumer
+sees one uninterrupted stream; the final event counts all tokens and says how often it resumed.
+
+post_json() is the non-streaming counterpart for endpoints such as /embedding, over the same pool.
+"""
+import json
+import asyncio
+from urllib.parse import urlsplit
+
+import llama_sse
+
+# --- Client Configuration ---
+CONNECT_TIMEOUT = 5.0      # Seconds to open the TCP connection
+FIRST_TOKEN_TIMEOUT = 90.0 # Seconds from sending the request to the first event (slot wait + prompt processing)
+IDLE_TIMEOUT = 30.0        # Longest pause between events once the first one has arrived
+POOL_MAX_IDLE = 32         # Idle keep-alive connections kept per server
+RESUME_ATTEMPTS = 3        # Interruptions a stream survives when resuming is on (stream_completion(resume=...))
+RESUME_WAIT = 60.0         # Seconds to wait for a crashed server to come back (restart + model load)
+RESUME_POLL = 0.1          # First pause between reconnection attempts; doubles up to 1s
+RESPONSE_TIMEOUT = 300.0   # Seconds for a whole non-streaming exchange (post_json)
+# --- End Configuration ---
+
+
+class ClientError(Exception):
+    """A completion request failed."""
+
+class ConnectError(ClientError):
+    """The server could not be reached, or closed the connection before the response was complete."""
+
+class ClientTimeout(ClientError):
+    """A timeout expired; `phase` is 'connect', 'first_token', 'idle' or 'response' (post_json)."""
+
+    WAITED_FOR = {"connect": "connection", "first_token": "first token", "idle": "event", "response": "response"}
+
+    def __init__(self, phase, seconds):
+        super().__init__(f"no {self.WAITED_FOR[phase]} within {seconds:g}s ({phase} timeout)")
+        self.phase = phase
+        self.seconds = seconds
+
+class HTTPStatusError(ClientError):
+    """
+    The server answered with a non-2xx status; `body` is the response text and
+    `retry_after` the seconds from a Retry-After header (e.g. on a 429), else None.
+    """
+
+    def __init__(self, status, body, retry_after=None):
+        super().__init__(f"HTTP {status}: {body[:200]}")
+        self.status = status
+        self.body = body
+        self.retry_after = retry_after
+
+
+class ConnectionPool:
+    """
+    Keep-alive connections per (host, port). Not thread-safe: use one pool per event loop.
+    `opened` counts TCP connections made, so requests - opened is the number reused.
+    """
+
+    def __init__(self, max_idle=POOL_MAX_IDLE, connect_timeout=CONNECT_TIMEOUT):
+        self.max_idle = max_idle
+        self.connect_timeout = connect_timeout
+        self.opened = 0
+        self._idle = {}
+
+    async def acquire(self, host, port):
+        """Returns (reader, writer, reused): an idle connection if one is still open, else a new one."""
+        idle = self._idle.get((host, port))
+        while idle:
+            reader, writer = idle.pop()
+            if not reader.at_eof() and not writer.is_closing():
+                return reader, writer, True
+            writer.close()
+        try:
+            async with asyncio.timeout(self.connect_timeout):
+                reader, writer = await asyncio.open_connection(host, port)
+        except TimeoutError:
+            raise ClientTimeout("connect", self.connect_timeout) from None
+        except OSError as e:
+            raise ConnectError(f"cannot connect to {host}:{port}: {e}") from e
+        self.opened += 1
+        return reader, writer, False
+
+    def release(self, host, port, reader, writer, reusable):
+        """Keeps a connection whose response was read completely; closes any other."""
+        idle = self._idle.setdefault((host, port), [])
+        if reusable and len(idle) < self.max_idle and not writer.is_closing():
+            idle.append((reader, writer))
+        else:
+            writer.transport.abort() # RST at once: a generating server sees it on its next write
+
+    async def close(self):
+        """Closes every idle connection."""
+        writers = [writer for idle in self._idle.values() for _, writer in idle]
+        self._idle.clear()
+        for writer in writers:
+            writer.close()
+        for writer in writers:
+            try:
+                await writer.wait_closed()
+            except OSError:
+                pass
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        await self.close()
+
+
+# --- HTTP/1.1 ---
+
+async def _read_head(reader):
+    """Reads the status line and headers. Returns (status, headers with lowercased names)."""
+    line = await reader.readline()
+    if not line:
+        raise ConnectError("connection closed before the response")
+    try:
+        status = int(line.split(None, 2)[1])
+    except (IndexError, ValueError):
+        raise ClientError(f"malformed status line: {line[:80]!r}") from None
+    headers = {}
+    while True:
+        line = await reader.readline()
+        if not line.endswith(b"\n"):
+            raise ConnectError("connection closed in the response headers")
+        if line in (b"\r\n", b"\n"):
+            return status, headers
+        name, _, value = line.decode("latin-1").partition(":")
+        headers[name.strip().lower()] = value.strip()
+
+
+class _Body:
+    """Reads a response body (chunked, Content-Length or until EOF) one piece at a time."""
+
+    __slots__ = ("_reader", "_chunked", "_remaining", "done")
+
+    def __init__(self, reader, headers):
+        self._reader = reader
+        self._chunked = "chunked" in headers.get("transfer-encoding", "").lower()
+        self._remaining = int(headers["content-length"]) if "content-length" in headers and not self._chunked else None
+        self.done = self._remaining == 0
+
+    async def read(self):
+        """Next piece of the body as bytes, or b"" at its end."""
+        if self.done:
+            return b""
+        try:
+            if self._chunked:
+                line = await self._reader.readline()
+                if not line.endswith(b"\n"):
+                    raise ConnectError("connection closed mid-response")
+                size = int(line.split(b";", 1)[0], 16)
+                if size == 0:
+                    while (await self._reader.readline()) not in (b"\r\n", b"\n", b""):
+                        pass # Trailers
+                    self.done = True
+                    return b""
+                return (await self._reader.readexactly(size + 2))[:-2]
+            if self._remaining is not None:
+                data = await self._reader.read(min(self._remaining, 65536))
+                if not data:
+                    raise ConnectError("connection closed mid-response")
+                self._remaining -= len(data)
+                self.done = self._remaining == 0
+                return data
+            data = await self._reader.read(65536)
+            self.done = not data
+            return data
+        except asyncio.IncompleteReadError:
+            raise ConnectError("connection closed mid-response") from None
+        except ConnectionError as e:
+            raise ConnectError(f"connection lost mid-response: {e}") from e
+        except ValueError:
+            raise ClientError("malformed chunked encoding") from None
+
+
+async def _send(pool, host, port, path, body, headers=None):
+    """Sends a POST (with extra request `headers`) and reads the response head. Returns (reader, writer, status, headers)."""
+    extra = "".join(f"{name}: {value}\r\n" for name, value in (headers or {}).items())
+    request = (f"POST {path} HTTP/1.1\r\nHost: {host}:{port}\r\nContent-Type: application/json\r\n"
+               f"Accept: text/event-stream\r\n{extra}Content-Length: {len(body)}\r\n\r\n").encode() + body
+    while True:
+        reader, writer, reused = await pool.acquire(host, port)
+        try:
+            writer.write(request)
+            await writer.drain()
+            status, headers = await _read_head(reader)
+            return reader, writer, status, headers
+        except ConnectError:
+            writer.transport.abort()
+            if not reused:
+                raise
+            # The server closed an idle keep-alive connection; retry on a fresh one
+        except ConnectionError as e:
+            writer.transport.abort()
+            if not reused:
+                raise ConnectError(f"connection to {host}:{port} failed: {e}") from e
+        except BaseException:
+            writer.transport.abort()
+            raise
+
+
+def _retry_after(headers):
+    """Seconds from a Retry-After header, or None."""
+    try:
+        return float(headers["retry-after"])
+    except (KeyError, ValueError):
+        return None
+
+
+async def post_json(base_url, payload, pool=None, path="/embedding", timeout=RESPONSE_TIMEOUT):
+    """
+    Sends one non-streaming JSON request (e.g. a batch of /embedding inputs) and returns the
+    decoded response. `timeout` bounds the whole exchange (None: no limit).
+    Raises ConnectError, ClientTimeout ('response'), HTTPStatusError, or ClientError on a malformed body.
+    """
+    url = urlsplit(base_url)
+    host, port = url.hostname or "127.0.0.1", url.port or 80
+    own_pool = pool is None
+    pool = pool or ConnectionPool(max_idle=0)
+    body = json.dumps(payload, separators=(",", ":")).encode()
+    writer = None
+    reusable = False
+    try:
+        try:
+            async with asyncio.timeout(timeout):
+                reader, writer, status, headers = await _send(pool, host, port, path, body)
+                response = _Body(reader, headers)
+                data = bytearray()
+                while chunk := await response.read():
+                    data += chunk
+        except TimeoutError:
+            raise ClientTimeout("response", timeout) from None
+        reusable = headers.get("connection", "").lower() != "close"
+        if not 200 <= status < 300:
+            raise HTTPStatusError(status, data.decode("utf-8", "replace"), _retry_after(headers))
+        try:
+            return json.loads(data)
+        except ValueError as e:
+            raise ClientError(f"invalid JSON response from {host}:{port}{path}: {e}") from None
+    finally:
+        if writer is not None:
+            pool.release(host, port, reader, writer, reusable)
+        if own_pool:
+            await pool.close()
+
+
+# --- Completions ---
+
+async def stream_completion(base_url, payload, pool=None, path="/completion",
+                            first_token_timeout=FIRST_TOKEN_TIMEOUT, idle_timeout=IDLE_TIMEOUT, resume=0, headers=None):
+    """
+    Streams one completion from llama-server at `base_url` (e.g. 'http://127.0.0.1:8012').
+    Yields the JSON text of every SSE event, the last one carrying stop: true and the timings.
+    `pool` (a ConnectionPool) lets requests share keep-alive connections; without it a
+    connection is opened for this request only. A timeout of None disables that limit.
+    `headers` are sent with the request (e.g. llama_sched's X-Priority).
+    `resume` (e.g. RESUME_ATTEMPTS) is how many broken streams are resumed (text prompts only),
+    each after waiting up to RESUME_WAIT for the server to accept requests again.
+    Raises ConnectError, ClientTimeout, HTTPStatusError (all ClientError).
+    """
+    prompt = payload.get("prompt")
+    if not resume or not isinstance(prompt, str):
+        async for data in _stream_once(base_url, payload, pool, path, first_token_timeout, idle_timeout, headers):
+            yield data
+        return
+
+    loop = asyncio.get_running_loop()
+    n_predict = payload.get("n_predict", -1)
+    received, resumes, deadline, delay = [], 0, None, RESUME_POLL
+    request = payload
+    while True:
+        progressed, earlier = False, len(received)
+        try:
+            async for data in _stream_once(base_url, request, pool, path, first_token_timeout, idle_timeout, headers):
+                progressed = True
+                if llama_sse.is_final(data):
+                    if resumes:
+                        final = json.loads(data)
+                        final["tokens_predicted"] = final.get("tokens_predicted", 0) + earlier
+                        final["resumed"] = resumes
+                        data = json.dumps(final, separators=(",", ":"))
+                else:
+                    content = llama_sse.extract_content(data)
+                    if content:
+                        received.append(content)
+                yield data
+            return
+        except (ConnectError, HTTPStatusError) as e:
+            if isinstance(e, HTTPStatusError) and not (e.status == 503 and deadline is not None):
+                raise # Only "Loading model" while the restarted server comes up is waited out
+            if progressed or deadline is None: # A new interruption
+                if resumes >= resume:
+                    raise
+                resumes += 1
+                deadline, delay = loop.time() + RESUME_WAIT, RESUME_POLL
+            elif loop.time() >= deadline:
+                raise
+            else:
+                await asyncio.sleep(delay)
+                delay = min(delay * 2, 1.0)
+        request = dict(payload, prompt=prompt + "".join(received))
+        if n_predict is not None and n_predict >= 0:
+            request["n_predict"] = max(n_predict - len(received), 0)
+
+
+async def _stream_once(base_url, payload, pool, path, first_token_timeout, idle_timeout, headers=None):
+    """One request of stream_completion(), without resuming."""
+    url = urlsplit(base_url)
+    host, port = url.hostname or "127.0.0.1", url.port or 80
+    own_pool = pool is None
+    pool = pool or ConnectionPool(max_idle=0)
+    body = json.dumps(dict(payload, stream=True), separators=(",", ":")).encode()
+    loop = asyncio.get_running_loop()
+    first_token_at = loop.time() + first_token_timeout if first_token_timeout is not None else None
+    writer = None
+    reusable = False
+    try:
+        try:
+            async with asyncio.timeout_at(first_token_at):
+                reader, writer, status, response_headers = await _send(pool, host, port, path, body, headers)
+                response = _Body(reader, response_headers)
+                keep_alive = response_headers.get("connection", "").lower() != "close"
+                if not 200 <= status < 300:
+                    data = b""
+                    while chunk := await response.read():
+                        data += chunk
+                    reusable = keep_alive
+                    raise HTTPStatusError(status, data.decode("utf-8", "replace"), _retry_after(response_headers))
+        except TimeoutError:
+            raise ClientTimeout("first_token", first_token_timeout) from None
+
+        decoder = llama_sse.SSEDecoder()
+        first = True
+        while True:
+            try:
+                if first: # Headers arrive at once; the first event only after prompt processing
+                    async with asyncio.timeout_at(first_token_at):
+                        chunk = await response.read()
+                else:
+                    async with asyncio.timeout(idle_timeout):
+                        chunk = await response.read()
+            except TimeoutError:
+                raise ClientTimeout(*(("first_token", first_token_timeout) if first else ("idle", idle_timeout))) from None
+            for data in decoder.feed(chunk) if chunk else decoder.close():
+                if not data:
+                    continue
+                first = False
+                text = data.decode("utf-8")
+                if llama_sse.is_final(text):
+                    # Read to the end of the body before handing out the last event, so the
+                    # connection goes back to the pool even if the consumer stops right here
+                    async with asyncio.timeout(idle_timeout):
+                        while await response.read():
+                            pass
+                    reusable = keep_alive
+                yield text
+            if not chunk:
+                return
+    finally:
+        if writer is not None:
+            pool.release(host, port, reader, writer, reusable)
+        if own_pool:
+            await pool.close()
+
+
+async def complete(base_url, payload, pool=None, **timeouts):
+    """
+    Runs one streamed completion to its end. Returns the final event (dict) with `content`
+    set to the whole generated text, like a non-streaming response.
+    """
+    parts, final = [], None
+    async for data in stream_completion(base_url, payload, pool=pool, **timeouts):
+        if llama_sse.is_final(data):
+            final = json.loads(data)
+            continue
+        content = llama_sse.extract_content(data)
+        if content:
+            parts.append(content)
+    if final is None:
+        raise ConnectError("stream ended without a final event")
+    final["content"] = "".join(parts) + (final.get("content") or "") # The final event's own text, once
+    return final
+
+
+async def _next(events):
+    return await anext(events)
+
+async def _close(events):
+    await events.aclose()
+
+def iter_completion(base_url, payload, **kwargs):
+    """
+    Blocking iterator over stream_completion() for synchronous callers (the CLI, the cache).
+    Runs on a private event loop; Ctrl-C cancels the stream (freeing the server slot) and then
+    raises KeyboardInterrupt, and closing the iterator early closes the stream too.
+    """
+    events = stream_completion(base_url, payload, **kwargs)
+    with asyncio.Runner() as runner:
+        try:
+            while True:
+                try:
+                    yield runner.run(_next(events))
+                except StopAsyncIteration:
+                    return
+        finally:
+            runner.run(_close(events))
@@ -0,0 +1,337 @@
+# llama_daemon.py
+"""
+Optional resident control daemon.
+
+The daemon keeps llama-server running (started, and restarted after a failure, through
+llama_man), holds warm keep-alive connections to it and serves completions over a Unix
+domain socket, so a short prompt from a script does not pay for imports, PID probing and
+a new HTTP connection on every call.
+
+Wire protocol: the client sends one JSON line,
+    {"op": "complete", "payload": {...}} | {"op": "ping"} | {"op": "stop"}
+and reads lines that start with a type byte:
+    T<json string>   streamed content
+    E<json object>   final event (timings); ends a completion
+    R<json object>   reply to ping/stop
+    X<json string>   error; ends the response
+
+The client half (fast_main) needs only os/socket/json, so main.py answers `--prompt`
+through a running daemon before click or requests are imported. The server half imports
+the rest of the project inside serve() for the same reason.
+"""
+import os
+import sys
+import json
+import socket
+
+# --- Daemon Configuration ---
+DAEMON_SOCKET = ".llama_daemon.sock"
+DAEMON_LOG = ".llama_daemon.log"
+CONNECT_TIMEOUT = 0.5 # Seconds; a daemon that does not accept this fast is treated as absent
+START_TIMEOUT = 30.0  # Seconds `daemon start` waits for the socket (the model loads afterwards)
+PORT_TTL = 2.0        # Seconds a resolved port is reused, so a router/scheduler/listener/pool started later is picked up
+# --- End Configuration ---
+
+# Options the fast path understands; anything else goes through the full CLI
+FAST_OPTIONS = {"--prompt": ("prompt", str), "--n-predict": ("n_predict", int),
+                "--temperature": ("temperature", float), "--seed": ("seed", int)}
+
+
+# --- Client ---
+
+def connect(path=None, timeout=CONNECT_TIMEOUT):
+    """Returns a socket connected to the daemon, or None if no daemon is listening."""
+    if not hasattr(socket, "AF_UNIX"):
+        return None
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    sock.settimeout(timeout)
+    try:
+        sock.connect(path or DAEMON_SOCKET)
+    except OSError:
+        sock.close()
+        return None
+    sock.settimeout(None)
+    return sock
+
+
+def exchange(sock, message):
+    """Sends one request and yields (kind, value) frames until the response ends. Closes the socket."""
+    with sock, sock.makefile("rb") as f:
+        sock.sendall(json.dumps(message).encode() + b"\n")
+        for line in f:
+            kind = line[:1].decode()
+            yield kind, json.loads(line[1:])
+            if kind in "ERX":
+                return
+    raise ConnectionError("daemon closed the connection mid-response")
+
+
+def call(op, path=None, **fields):
+    """Sends a control request (ping, stop). Returns the reply dict, or None if no daemon is running."""
+    sock = connect(path)
+    if sock is None:
+        return None
+    try:
+        for kind, value in exchange(sock, dict(fields, op=op)):
+            return value if kind == "R" else None
+    except (OSError, ValueError):
+        return None
+
+
+def parse_fast_args(argv):
+    """Payload for a `[chat-message] --prompt X [--n-predict N ...]` command line, or None if the fast path can't handle it."""
+    args = list(argv)
+    if args and args[0] == "chat-message":
+        args.pop(0)
+    payload, seen = {"n_predict": -1, "stream": True}, set()
+    while args:
+        option = args.pop(0)
+        value = None
+        if "=" in option:
+            option, value = option.split("=", 1)
+        if option not in FAST_OPTIONS or option in seen:
+            return None
+        seen.add(option)
+        if value is None:
+            if not args:
+                return None
+            value = args.pop(0)
+        field, convert = FAST_OPTIONS[option]
+        try:
+            payload[field] = convert(value)
+        except ValueError:
+            return None
+    return payload if "prompt" in payload else None
+
+
+def fast_main(argv, path=None, out=None, err=None):
+    """
+    Runs a plain prompt through a running daemon and streams the reply to `out`.
+    Returns the exit code, or None when the command line or the missing daemon means
+    the full CLI has to handle it.
+    """
+    payload = parse_fast_args(argv)
+    if payload is None:
+        return None
+    sock = connect(path)
+    if sock is None:
+        return None
+    out, err = out or sys.stdout, err or sys.stderr
+    try:
+        for kind, value in exchange(sock, {"op": "complete", "payload": payload}):
+            if kind == "T":
+                out.write(value)
+                out.flush()
+            elif kind == "E":
+                out.write("\n")
+                return 0
+            elif kind == "X":
+                err.write(f"Error: {value}\n")
+                return 1
+    except (OSError, ValueError) as e:
+        err.write(f"\nError: lost connection to the daemon: {e}\n")
+        return 1
+    return 1
+
+
+# --- Server ---
+
+def serve(path=None, stop_server_on_exit=False):
+    """Runs the daemon in the foreground until `daemon stop` or Ctrl-C."""
+    import time
+    import threading
+    import http.client
+    import socketserver
+
+    import llama_man
+    import llama_pool
+    import llama_activate
+    import llama_proxy
+    import llama_ready
+    import llama_router
+    import llama_sched
+    import llama_sse
+    import llama_metrics
+    import llama_trace
+
+    path = path or DAEMON_SOCKET
+    upstream = llama_proxy.UpstreamPool()
+    state = {"port": None, "resolved_at": 0.0, "requests": 0, "started": time.time()}
+    port_lock = threading.Lock()
+
+    def resolve_port(force=False):
+        """
+        Scheduler, else router, else the on-demand listener, else a ready pool instance, else the
+        single server (started if needed), as clitest_server.resolve_server_port. Returns (port, error).
+        """
+        with port_lock:
+            if state["port"] and not force and time.monotonic() - state["resolved_at"] < PORT_TTL:
+                return state["port"], None
+            port = (llama_sched.running_sched_port() or llama_router.running_router_port()
+                    or llama_activate.running_activate_port())
+            if port is None and llama_pool.read_pool_state()['instances']:
+                port = llama_pool.pick_instance_port()
+                if port is None:
+                    return None, "pool is configured but no instance is ready"
+            if port is None:
+                status_code, message = llama_man.ensure_server_running_or_fail()
+                if status_code != "RUNNING":
+                    return None, message
+                port = llama_man.PORT
+            state["port"], state["resolved_at"] = port, time.monotonic()
+            return port, None
+
+    def open_stream(port, body):
+        conn = upstream.get(llama_ready.HOST, port)
+        try:
+            conn.request("POST", "/completion", body=body, headers={"Content-Type": "application/json"})
+            return conn, conn.getresponse()
+        except (OSError, http.client.HTTPException):
+            conn.close()
+            raise
+
+    class Handler(socketserver.StreamRequestHandler):
+        def send(self, kind, value):
+            self.wfile.write(kind + json.dumps(value, separators=(",", ":")).encode() + b"\n")
+            self.wfile.flush()
+
+        def handle(self):
+            try:
+                message = json.loads(self.rfile.readline() or b"{}")
+            except ValueError:
+                return self.send(b"X", "invalid request")
+            op = message.get("op")
+            if op == "ping":
+                return self.send(b"R", {"pid": os.getpid(), "port": state["port"], "requests": state["requests"],
+                                        "uptime_s": round(time.time() - state["started"], 1)})
+            if op == "stop":
+                self.send(b"R", {"stopping": True})
+                return threading.Thread(target=self.server.shutdown, daemon=True).start()
+            if op == "complete":
+                return self.complete(message.get("payload") or {})
+            self.send(b"X", f"unknown op {op!r}")
+
+        def complete(self, payload):
+            with port_lock: # One handler thread per connection
+                state["requests"] += 1
+            port, error = resolve_port()
+            if error:
+                return self.send(b"X", error)
+            body = json.dumps(dict(payload, stream=True)).encode()
+            try:
+                conn, response = open_stream(port, body)
+            except (OSError, http.client.HTTPException):
+                # Pooled connection stale or the server went away: re-resolve (restarting it if needed) and retry once
+                port, error = resolve_port(force=True)
+                if error:
+                    return self.send(b"X", error)
+                try:
+                    conn, response = open_stream(port, body)
+                except (OSError, http.client.HTTPException) as e:
+                    return self.send(b"X", f"llama-server on port {port} unreachable: {e}")
+            if response.status != 200:
+                detail = response.read().decode("utf-8", "replace")[:500]
+                retry_after = response.getheader("Retry-After")
+                conn.close()
+                if response.status == 429 and retry_after:
+                    return self.send(b"X", f"server is busy (queue wait over its limit); retry in {retry_after}s")
+                return self.send(b"X", f"llama-server returned {response.status}: {detail}")
+
+            timer = llama_metrics.RequestTimer("daemon", port=port)
+            decoder = llama_sse.SSEDecoder()
+            status, client_gone = "error", False
+            try:
+                while True:
+                    chunk = response.read1(65536)
+                    if not chunk:
+                        break
+                    frames = []
+                    for data in decoder.feed(chunk):
+                        text = data.decode("utf-8")
+                        content = llama_sse.extract_content(text)
+                        if content:
+                            timer.token()
+                            frames.append(b"T" + json.dumps(content).encode() + b"\n")
+                        if llama_sse.is_final(text):
+                            final = json.loads(text)
+                            timer.final(final)
+                            frames.append(b"E" + json.dumps({"timings": final.get("timings")}).encode() + b"\n")
+                            status = "ok"
+                    if frames:
+                        try:
+                            self.wfile.write(b"".join(frames))
+                            self.wfile.flush()
+                        except OSError:
+                            client_gone = True # Dropping the upstream connection stops the generation
+                            break
+                if status != "ok" and not client_gone:
+                    self.send(b"X", "stream ended without a final event")
+            except (OSError, http.client.HTTPException) as e:
+                if not client_gone:
+                    self.send(b"X", f"stream from llama-server failed: {e}")
+            finally:
+                if status == "ok" and response.isclosed() and not response.will_close:
+                    upstream.put(llama_ready.HOST, port, conn)
+                else:
+                    conn.close()
+                record = llama_metrics.record_timer(timer, status) # After the client has its reply
+                if llama_trace.enabled():
+                    llama_trace.record(payload, record)
+
+    class Server(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+        daemon_threads = True
+
+    if connect(path) is not None:
+        raise RuntimeError(f"a daemon is already listening on {path}")
+    if os.path.exists(path):
+        os.remove(path) # Stale socket of a daemon that died
+    server = Server(path, Handler)
+    print(f"llama daemon (PID {os.getpid()}) listening on {path}", flush=True)
+
+    def warm_up():
+        # Requests arriving while the model loads wait on port_lock instead of failing
+        port, error = resolve_port()
+        print(f"Using llama-server on port {port}." if port else f"Warning: {error}", flush=True)
+    threading.Thread(target=warm_up, daemon=True).start()
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+        if stop_server_on_exit:
+            llama_man.stop_llama_server()
+
+
+def start_background(path=None, stop_server_on_exit=False):
+    """
+    Launches `main.py daemon run` detached, logging to DAEMON_LOG, and waits for its socket.
+    Returns tuple (success: bool, message: str).
+    """
+    import time
+    import subprocess
+
+    path = path or DAEMON_SOCKET
+    reply = call("ping", path)
+    if reply:
+        return False, f"Daemon already running (PID {reply['pid']})."
+    main_py = os.path.join(os.path.dirname(os.path.abspath(__file__)), "main.py")
+    command = [sys.executable, main_py, "daemon", "run", "--socket", path]
+    if stop_server_on_exit:
+        command.append("--stop-server-on-exit")
+    with open(DAEMON_LOG, "ab") as log:
+        process = subprocess.Popen(command, stdin=subprocess.DEVNULL, stdout=log, stderr=subprocess.STDOUT,
+                                   start_new_session=True)
+    deadline = time.monotonic() + START_TIMEOUT
+    while time.monotonic() < deadline:
+        reply = call("ping", path)
+        if reply:
+            return True, f"Daemon started (PID {reply['pid']}) on {path}."
+        if process.poll() is not None:
+            return False, f"Daemon exited with code {process.returncode}; see {DAEMON_LOG}."
+        time.sleep(0.02)
+    return False, f"Daemon PID {process.pid} did not open {path} within {START_TIMEOUT:.0f}s; see {DAEMON_LOG}."
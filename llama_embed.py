@@ -0,0 +1,313 @@
+# llama_embed.py
+"""
+Bulk embeddings through llama-server's /embedding endpoint into a memory-mapped .npy file.
+
+The corpus (JSONL records or plain text lines) is streamed twice: once to count the inputs
+and write the id index, once to send them. Inputs are packed into requests of up to
+`batch_tokens` estimated tokens (the server's -b) and MAX_INPUTS inputs, with `concurrency`
+requests in flight on one event loop (llama_client). Every vector is written straight into
+its row of a preallocated float32 array (numpy.lib.format.open_memmap), so memory use does
+not grow with the corpus. A request the server refuses (an input over its -ub) is split in
+halves until only the offending input fails.
+
+Next to OUT.npy, OUT.ids.jsonl holds the id of every row in row order, and OUT.done.npy one
+byte per row, set once that row's vector is on disk (the array is flushed before the marks).
+A rerun skips marked rows, so an interrupted job continues where it stopped; rows that
+failed stay unmarked (and zero) and are retried.
+
+numpy is optional for the rest of the project; this module needs it (the `embed` extra:
+`uv sync --extra embed`).
+"""
+import os
+import json
+import math
+import time
+import asyncio
+
+import requests
+
+import llama_man
+import llama_batch
+import llama_client
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+# --- Embedding Configuration ---
+MAX_INPUTS = 64            # Inputs per /embedding request
+CHARS_PER_TOKEN = 4        # Input length estimate used for packing requests
+REQUEST_TIMEOUT = 300.0    # Seconds for one /embedding request
+CHECKPOINT_INTERVAL = 2.0  # Seconds between flushing vectors to disk and marking their rows done
+DTYPE = "float32"
+REPORTED_ERRORS = 20       # Failed inputs listed (with the server's message) in the summary
+# --- End Configuration ---
+
+# Statuses with which llama-server refuses a batch because of one of its inputs (e.g. longer than -ub)
+SPLIT_STATUSES = {400, 413, 500}
+
+
+def sidecar_paths(output_path):
+    """Paths of the id index and the done marks belonging to `output_path` (OUT.npy)."""
+    base = output_path[:-4] if output_path.endswith(".npy") else output_path
+    return base + ".ids.jsonl", base + ".done.npy"
+
+
+def iter_texts(input_path, text_field="text", id_field=None):
+    """
+    Streams (record_id, text) pairs from `input_path`. A line holding a JSON object is a record
+    (text from `text_field`, id from `id_field`, "id" or "request_id", else the line number);
+    any other non-empty line is the text itself, with its line number as id.
+    Raises ValueError for a JSON record without `text_field`.
+    """
+    id_fields = (id_field,) if id_field else llama_batch.DEFAULT_ID_FIELDS
+    with open(input_path, "r", encoding="utf-8") as f:
+        for line_no, line in enumerate(f, start=1):
+            line = line.rstrip("\r\n")
+            if not line.strip():
+                continue
+            record = None
+            if line.lstrip().startswith("{"):
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    pass
+            if not isinstance(record, dict):
+                yield str(line_no), line
+                continue
+            if text_field not in record:
+                raise ValueError(f"{input_path}:{line_no}: missing text field '{text_field}'")
+            record_id = next((record[k] for k in id_fields if k in record), None)
+            yield (str(record_id) if record_id is not None else str(line_no)), str(record[text_field])
+
+
+def write_index(input_path, ids_path, text_field="text", id_field=None):
+    """Writes the id of every input, one JSON string per line, to `ids_path`. Returns the number of rows."""
+    rows = 0
+    tmp_path = ids_path + ".tmp"
+    with open(tmp_path, "w", encoding="utf-8") as out:
+        for record_id, _ in iter_texts(input_path, text_field, id_field):
+            out.write(json.dumps(record_id) + "\n")
+            rows += 1
+    os.replace(tmp_path, ids_path)
+    return rows
+
+
+def pack_batches(items, batch_tokens, max_inputs=MAX_INPUTS):
+    """
+    Groups (row, text) pairs into lists whose estimated tokens stay within `batch_tokens`
+    and whose length stays within `max_inputs`. A text over the limit on its own is sent alone.
+    """
+    batch, tokens = [], 0
+    for row, text in items:
+        cost = max(1, math.ceil(len(text) / CHARS_PER_TOKEN))
+        if batch and (tokens + cost > batch_tokens or len(batch) >= max_inputs):
+            yield batch
+            batch, tokens = [], 0
+        batch.append((row, text))
+        tokens += cost
+    if batch:
+        yield batch
+
+
+def parse_embeddings(response, count):
+    """
+    Vectors from an /embedding response, in input order: a list of {index, embedding} (the
+    embedding possibly nested one level, as llama-server does for pooled output) or an
+    OpenAI-style {"data": [...]}. Raises ValueError if it does not hold `count` vectors.
+    """
+    items = response.get("data") if isinstance(response, dict) else response
+    if isinstance(items, dict):
+        items = [items]
+    if not isinstance(items, list) or len(items) != count:
+        raise ValueError(f"expected {count} embeddings, got {len(items) if isinstance(items, list) else 'none'}")
+    vectors = [None] * count
+    for position, item in enumerate(items):
+        vector = item.get("embedding") if isinstance(item, dict) else None
+        if isinstance(vector, list) and vector and isinstance(vector[0], list):
+            if len(vector) != 1:
+                raise ValueError("per-token embeddings returned; start llama-server with a pooling type")
+            vector = vector[0]
+        if not isinstance(vector, list) or not vector:
+            raise ValueError("response item without an embedding")
+        index = item.get("index", position)
+        if not isinstance(index, int) or not 0 <= index < count:
+            raise ValueError(f"embedding index {index!r} out of range")
+        vectors[index] = vector
+    return vectors
+
+
+async def _embed_batch(pool, base_url, batch):
+    """
+    Embeds one batch of (row, text). Returns (list of (row, vector), list of (row, error message)).
+    A batch the server refuses is split in halves until only the offending inputs fail.
+    """
+    try:
+        response = await llama_client.post_json(base_url, {"content": [text for _, text in batch]},
+                                                pool=pool, timeout=REQUEST_TIMEOUT)
+        vectors = parse_embeddings(response, len(batch))
+    except llama_client.HTTPStatusError as e:
+        if e.status in SPLIT_STATUSES and len(batch) > 1:
+            middle = len(batch) // 2
+            first, second = await asyncio.gather(_embed_batch(pool, base_url, batch[:middle]),
+                                                 _embed_batch(pool, base_url, batch[middle:]))
+            return first[0] + second[0], first[1] + second[1]
+        return [], [(row, str(e)) for row, _ in batch]
+    except (llama_client.ClientError, ValueError) as e:
+        return [], [(row, str(e)) for row, _ in batch]
+    return [(row, vector) for (row, _), vector in zip(batch, vectors)], []
+
+
+class _Store:
+    """The output array and done marks. The array is created on the first vectors (their length is the dimension)."""
+
+    def __init__(self, output_path, done_path, rows, resume):
+        self.output_path, self.rows = output_path, rows
+        self.array = None
+        if resume and os.path.exists(output_path) and os.path.exists(done_path):
+            self.array = numpy.lib.format.open_memmap(output_path, mode="r+")
+            self.done = numpy.lib.format.open_memmap(done_path, mode="r+")
+            if self.array.shape[0] != rows or self.done.shape != (rows,):
+                raise ValueError(f"'{output_path}' holds {self.array.shape[0]} rows but the input has {rows}; "
+                                 f"rerun without resuming to start over")
+        else:
+            if os.path.exists(output_path):
+                os.remove(output_path)
+            self.done = numpy.lib.format.open_memmap(done_path, mode="w+", dtype=numpy.uint8, shape=(rows,))
+        self.pending = [] # Rows written to the array but not yet flushed and marked
+        self.last_checkpoint = time.monotonic()
+
+    @property
+    def dim(self):
+        return self.array.shape[1] if self.array is not None else None
+
+    def write(self, results):
+        if not results:
+            return
+        rows = [row for row, _ in results]
+        vectors = numpy.asarray([vector for _, vector in results], dtype=DTYPE)
+        if self.array is None:
+            self.array = numpy.lib.format.open_memmap(self.output_path, mode="w+", dtype=DTYPE,
+                                                      shape=(self.rows, vectors.shape[1]))
+        if vectors.shape[1] != self.array.shape[1]:
+            raise ValueError(f"server returned {vectors.shape[1]}-dimensional vectors, "
+                             f"'{self.output_path}' holds {self.array.shape[1]}")
+        self.array[rows] = vectors
+        self.pending.extend(rows)
+        if time.monotonic() - self.last_checkpoint >= CHECKPOINT_INTERVAL:
+            self.checkpoint()
+
+    def checkpoint(self):
+        """Flushes written vectors to disk, then marks their rows done."""
+        if self.pending:
+            self.array.flush()
+            self.done[self.pending] = 1
+            self.done.flush()
+            self.pending = []
+        self.last_checkpoint = time.monotonic()
+
+    def close(self):
+        self.checkpoint()
+        del self.array, self.done # Unmaps the files
+
+
+async def _run(batches, concurrency, base_url, store, on_batch):
+    """Keeps up to `concurrency` /embedding requests in flight, storing the vectors of each as it returns."""
+    pool = llama_client.ConnectionPool(max_idle=concurrency)
+    pending = set()
+
+    async def drain(return_when):
+        nonlocal pending
+        done, pending = await asyncio.wait(pending, return_when=return_when)
+        for task in done:
+            vectors, errors = task.result()
+            store.write(vectors)
+            on_batch(len(vectors), errors)
+
+    try:
+        for batch in batches:
+            pending.add(asyncio.create_task(_embed_batch(pool, base_url, batch)))
+            if len(pending) >= concurrency:
+                await drain(asyncio.FIRST_COMPLETED)
+    except asyncio.CancelledError:
+        for task in pending:
+            task.cancel()
+        await asyncio.gather(*pending, return_exceptions=True)
+        pending = set()
+        raise
+    finally:
+        if pending:
+            await drain(asyncio.ALL_COMPLETED)
+        await pool.close()
+
+
+def run_embed(input_path, output_path, base_url=None, concurrency=None, batch_tokens=None, max_inputs=MAX_INPUTS,
+              text_field="text", id_field=None, resume=True):
+    """
+    Embeds every input of `input_path` into `output_path` (.npy, one float32 row per input,
+    in input order) through llama-server's /embedding at `base_url` (default: the managed server).
+
+    `batch_tokens` caps the estimated tokens per request (default llama_man.BATCH_SIZE, the
+    server's -b); concurrency defaults to the server's slot count. With `resume`, rows
+    finished by an earlier run are skipped. Returns a summary dict with counts, dimension,
+    elapsed seconds, vectors/sec and `errors`, (record_id, message) for the first failed inputs.
+    Raises ImportError without numpy and ValueError for unreadable input or a mismatched output.
+    """
+    if numpy is None:
+        raise ImportError("embed needs numpy (uv sync --extra embed)")
+    base_url = base_url or f"http://127.0.0.1:{llama_man.PORT}"
+    batch_tokens = batch_tokens or llama_man.BATCH_SIZE
+    if not concurrency:
+        session = requests.Session()
+        concurrency = llama_batch.detect_server_slots(session, base_url) or llama_man.PARALLEL
+        session.close()
+    ids_path, done_path = sidecar_paths(output_path)
+
+    rows = write_index(input_path, ids_path, text_field, id_field)
+    summary = {"rows": rows, "embedded": 0, "failed": 0, "skipped": 0, "requests": 0, "dim": None,
+               "concurrency": concurrency, "batch_tokens": batch_tokens, "errors": []}
+    failed = {} # row -> message, for the first REPORTED_ERRORS failures
+    start = time.monotonic()
+    if rows:
+        store = _Store(output_path, done_path, rows, resume)
+
+        def todo():
+            for row, (_, text) in enumerate(iter_texts(input_path, text_field, id_field)):
+                if store.done[row]:
+                    summary["skipped"] += 1
+                else:
+                    yield row, text
+
+        def on_batch(embedded, errors):
+            summary["requests"] += 1
+            summary["embedded"] += embedded
+            summary["failed"] += len(errors)
+            for row, message in errors[:REPORTED_ERRORS - len(failed)]:
+                failed[row] = message
+
+        try:
+            asyncio.run(_run(pack_batches(todo(), batch_tokens, max_inputs), concurrency, base_url, store, on_batch))
+        finally:
+            summary["dim"] = store.dim
+            store.close()
+    if failed:
+        with open(ids_path, "r", encoding="utf-8") as f:
+            summary["errors"] = [(json.loads(line), failed[row]) for row, line in enumerate(f) if row in failed]
+    elapsed = time.monotonic() - start
+    summary["elapsed_s"] = elapsed
+    summary["vectors_per_sec"] = summary["embedded"] / elapsed if elapsed > 0 else 0.0
+    return summary
+
+
+def load_embeddings(output_path):
+    """
+    Opens a finished (or partial) output read-only. Returns (vectors memmap, list of ids,
+    done marks memmap); rows whose mark is 0 were not embedded.
+    """
+    if numpy is None:
+        raise ImportError("embed needs numpy (uv sync --extra embed)")
+    ids_path, done_path = sidecar_paths(output_path)
+    with open(ids_path, "r", encoding="utf-8") as f:
+        ids = [json.loads(line) for line in f]
+    return numpy.load(output_path, mmap_mode="r"), ids, numpy.load(done_path, mmap_mode="r")
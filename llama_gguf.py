@@ -0,0 +1,400 @@
+# llama_gguf.py
+"""
+GGUF header and metadata reader (no tensor data is loaded).
+
+read_gguf() maps the model file and walks the header, the metadata key/values and the
+tensor index with struct.unpack_from, so only the pages holding the header are touched
+even for a multi-GB model. Large arrays (the tokenizer vocabulary) are skipped over and
+returned as GGUFArray spans instead of Python lists.
+
+From the metadata, model_params() extracts what sizes the KV cache (layers, KV heads and
+head dims, trained context), kv_cache_mb() estimates it for a context length, and
+fit_context() checks a launch against the available memory and shrinks the context when
+the full one would not fit. check_draft_vocab() compares the tokenizers of a model and a
+draft model for speculative decoding the way llama.cpp does before it accepts the pair.
+prefetch() reads the file into the page cache in a background
+thread while llama-server starts, so its mmap page faults find the weights already cached.
+"""
+import os
+import mmap
+import struct
+import threading
+from collections import namedtuple
+
+# --- GGUF Configuration ---
+KV_BYTES_PER_ELEMENT = 2    # f16 K/V cache (llama-server default --cache-type-k/-v)
+RUNTIME_OVERHEAD_MB = 256   # Compute buffers, runtime and tokenizer on top of weights and KV cache
+MEMORY_HEADROOM = 0.9       # Fraction of available memory a launch may plan to use
+MIN_CTX_PER_SLOT = 512      # A context shrunk below this per slot is refused instead
+CTX_GRANULARITY = 256       # Shrunk contexts are rounded down to a multiple of this
+INLINE_ARRAY_LIMIT = 64     # Arrays longer than this are returned as GGUFArray spans
+PREFETCH_CHUNK = 8 << 20    # Bytes per read when prefetching the model file
+DRAFT_VOCAB_MAX_SIZE_DIFFERENCE = 128  # llama.cpp refuses a draft whose vocabulary size differs by more
+DRAFT_VOCAB_CHECK_START = 5            # Token texts are compared from this id on (control tokens may differ)
+# --- End Configuration ---
+
+GGUF_MAGIC = b"GGUF"
+DEFAULT_ALIGNMENT = 32
+
+# Metadata value types
+UINT8, INT8, UINT16, INT16, UINT32, INT32, FLOAT32, BOOL, STRING, ARRAY, UINT64, INT64, FLOAT64 = range(13)
+_SCALAR_FORMATS = {UINT8: "<B", INT8: "<b", UINT16: "<H", INT16: "<h", UINT32: "<I", INT32: "<i",
+                   FLOAT32: "<f", BOOL: "<?", UINT64: "<Q", INT64: "<q", FLOAT64: "<d"}
+
+# ggml tensor types: (elements per block, bytes per block)
+GGML_BLOCK_SIZES = {
+    0: (1, 4), 1: (1, 2), 2: (32, 18), 3: (32, 20), 6: (32, 22), 7: (32, 24), 8: (32, 34), 9: (32, 36),
+    10: (256, 84), 11: (256, 110), 12: (256, 144), 13: (256, 176), 14: (256, 210), 15: (256, 292),
+    16: (256, 66), 17: (256, 74), 18: (256, 98), 19: (256, 50), 20: (32, 18), 21: (256, 110),
+    22: (256, 82), 23: (256, 136), 24: (1, 1), 25: (1, 2), 26: (1, 4), 27: (1, 8), 28: (1, 8),
+    29: (256, 56), 30: (1, 2),
+}
+
+_U64 = struct.Struct("<Q")
+
+GGUFArray = namedtuple("GGUFArray", "item_type count start end") # Byte span of a skipped array
+
+
+class GGUFError(ValueError):
+    """The file is not a GGUF model, or it is truncated or corrupt."""
+
+
+class _Reader:
+    def __init__(self, buf):
+        self.buf = buf
+        self.pos = 0
+
+    def unpack(self, fmt):
+        size = struct.calcsize(fmt)
+        if self.pos + size > len(self.buf):
+            raise GGUFError(f"truncated header at byte {self.pos}")
+        value = struct.unpack_from(fmt, self.buf, self.pos)[0]
+        self.pos += size
+        return value
+
+    def string(self):
+        length = self.unpack("<Q")
+        if self.pos + length > len(self.buf):
+            raise GGUFError(f"truncated string at byte {self.pos}")
+        value = bytes(self.buf[self.pos:self.pos + length])
+        self.pos += length
+        return value.decode("utf-8", "replace")
+
+    def value(self, value_type):
+        if value_type == STRING:
+            return self.string()
+        if value_type == ARRAY:
+            item_type, count = self.unpack("<I"), self.unpack("<Q")
+            if count <= INLINE_ARRAY_LIMIT:
+                return [self.value(item_type) for _ in range(count)]
+            start = self.pos
+            if item_type == STRING:
+                # Vocabularies hold 100k+ strings; a local loop keeps skipping them cheap
+                pos, buf, length_at = self.pos, self.buf, _U64.unpack_from
+                try:
+                    for _ in range(count):
+                        pos += 8 + length_at(buf, pos)[0]
+                except struct.error:
+                    raise GGUFError("truncated array in metadata")
+                self.pos = pos
+            elif item_type in _SCALAR_FORMATS:
+                self.pos += count * struct.calcsize(_SCALAR_FORMATS[item_type])
+            else:
+                raise GGUFError(f"unsupported array item type {item_type}")
+            if self.pos > len(self.buf):
+                raise GGUFError("truncated array in metadata")
+            return GGUFArray(item_type, count, start, self.pos)
+        if value_type not in _SCALAR_FORMATS:
+            raise GGUFError(f"unknown metadata value type {value_type} at byte {self.pos}")
+        return self.unpack(_SCALAR_FORMATS[value_type])
+
+
+def read_gguf(path):
+    """
+    Parses the header, metadata and tensor index of a GGUF file.
+    Returns a dict: version, metadata (key -> value), tensors (list of dicts with name,
+    shape, type, offset), data_offset (start of tensor data), file_size.
+    Raises GGUFError for a file that is not GGUF or is cut short, OSError if it cannot be read.
+    """
+    with open(path, "rb") as f:
+        file_size = os.fstat(f.fileno()).st_size
+        if file_size < 24:
+            raise GGUFError(f"file is {file_size} bytes, too small for a GGUF header")
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            if mm[:4] != GGUF_MAGIC:
+                raise GGUFError(f"bad magic {bytes(mm[:4])!r} (not a GGUF file)")
+            reader = _Reader(mm)
+            reader.pos = 4
+            version = reader.unpack("<I")
+            if version not in (2, 3):
+                raise GGUFError(f"unsupported GGUF version {version}")
+            tensor_count, kv_count = reader.unpack("<Q"), reader.unpack("<Q")
+            metadata = {}
+            for _ in range(kv_count):
+                key = reader.string()
+                metadata[key] = reader.value(reader.unpack("<I"))
+            tensors = []
+            for _ in range(tensor_count):
+                name = reader.string()
+                n_dims = reader.unpack("<I")
+                shape = [reader.unpack("<Q") for _ in range(n_dims)]
+                tensors.append({"name": name, "shape": shape, "type": reader.unpack("<I"), "offset": reader.unpack("<Q")})
+            alignment = metadata.get("general.alignment") or DEFAULT_ALIGNMENT
+            data_offset = -(-reader.pos // alignment) * alignment
+    return {"version": version, "metadata": metadata, "tensors": tensors, "data_offset": data_offset,
+            "file_size": file_size}
+
+
+def tensor_nbytes(tensor):
+    """Size of a tensor's data in bytes, or None for a tensor type not in GGML_BLOCK_SIZES."""
+    if tensor["type"] not in GGML_BLOCK_SIZES:
+        return None
+    block_elements, block_bytes = GGML_BLOCK_SIZES[tensor["type"]]
+    elements = 1
+    for dim in tensor["shape"]:
+        elements *= dim
+    return -(-elements // block_elements) * block_bytes
+
+
+def check_complete(info):
+    """Returns an error message if the tensor data extends past the end of the file, else None."""
+    end = info["data_offset"]
+    for tensor in info["tensors"]:
+        size = tensor_nbytes(tensor) or 0
+        end = max(end, info["data_offset"] + tensor["offset"] + size)
+    if end > info["file_size"]:
+        return (f"model file is truncated: tensor data needs {end} bytes, file has {info['file_size']} "
+                f"({(end - info['file_size']) / (1 << 20):.1f} MB missing)")
+    return None
+
+
+def model_params(info):
+    """
+    Architecture parameters relevant to memory: architecture, block_count, context_length,
+    embedding_length, head_count, head_count_kv, key_length, value_length (missing ones None).
+    """
+    meta = info["metadata"]
+    arch = meta.get("general.architecture")
+    get = lambda key: meta.get(f"{arch}.{key}")
+    params = {"architecture": arch, "name": meta.get("general.name"), "block_count": get("block_count"),
+              "context_length": get("context_length"), "embedding_length": get("embedding_length"),
+              "head_count": get("attention.head_count"), "head_count_kv": get("attention.head_count_kv"),
+              "key_length": get("attention.key_length"), "value_length": get("attention.value_length")}
+    # Per-layer head counts (some architectures) are arrays; the largest sizes the cache
+    for key in ("head_count", "head_count_kv"):
+        if isinstance(params[key], list):
+            params[key] = max(params[key]) if params[key] else None
+    if params["head_count_kv"] is None:
+        params["head_count_kv"] = params["head_count"]
+    if params["head_count"] and params["embedding_length"]:
+        head_dim = params["embedding_length"] // params["head_count"]
+        params["key_length"] = params["key_length"] or head_dim
+        params["value_length"] = params["value_length"] or head_dim
+    return params
+
+
+def kv_bytes_per_token(params):
+    """K and V cache bytes per context token over all layers, or None if the metadata lacks the sizes."""
+    needed = ("block_count", "head_count_kv", "key_length", "value_length")
+    if any(not params.get(key) for key in needed):
+        return None
+    return (params["block_count"] * params["head_count_kv"] * (params["key_length"] + params["value_length"])
+            * KV_BYTES_PER_ELEMENT)
+
+
+def kv_cache_mb(params, n_ctx):
+    """Estimated KV cache for `n_ctx` tokens (all slots together) in MB, or None if unknown."""
+    per_token = kv_bytes_per_token(params)
+    return per_token * n_ctx / (1 << 20) if per_token else None
+
+
+def memory_estimate(info, ctx_size=0):
+    """
+    Memory a server for this model needs with --ctx-size `ctx_size` (0: the trained context):
+    dict with n_ctx, weights_mb, kv_mb, overhead_mb and total_mb. An upper bound for models
+    with sliding-window layers, whose cache llama.cpp sizes to the window.
+    """
+    params = model_params(info)
+    n_ctx = ctx_size or params["context_length"] or 0
+    weights_mb = (info["file_size"] - info["data_offset"]) / (1 << 20)
+    kv_mb = kv_cache_mb(params, n_ctx) or 0.0
+    return {"n_ctx": n_ctx, "weights_mb": round(weights_mb, 1), "kv_mb": round(kv_mb, 1),
+            "overhead_mb": RUNTIME_OVERHEAD_MB, "total_mb": round(weights_mb + kv_mb + RUNTIME_OVERHEAD_MB, 1)}
+
+
+def available_memory_mb():
+    """Memory available for a new process (MemAvailable on Linux, free physical pages elsewhere), or None."""
+    try:
+        with open("/proc/meminfo", "r") as f:
+            for line in f:
+                if line.startswith("MemAvailable:"):
+                    return int(line.split()[1]) / 1024
+    except (OSError, ValueError, IndexError):
+        pass
+    try:
+        return os.sysconf("SC_AVPHYS_PAGES") * os.sysconf("SC_PAGE_SIZE") / (1 << 20)
+    except (ValueError, OSError, AttributeError):
+        return None
+
+
+def fit_context(info, ctx_size, parallel=1, available_mb=None):
+    """
+    Checks a launch with --ctx-size `ctx_size` (0: trained context) and --parallel `parallel`
+    against MEMORY_HEADROOM of the available memory. Returns tuple
+    (ctx_size: int, estimate: dict, error: str | None): the context to launch with (the one
+    asked for when it fits, else the largest that does), its memory_estimate, and an error
+    when even MIN_CTX_PER_SLOT per slot would not fit.
+    """
+    estimate = memory_estimate(info, ctx_size)
+    available_mb = available_memory_mb() if available_mb is None else available_mb
+    if available_mb is None:
+        return ctx_size, estimate, None
+    budget = available_mb * MEMORY_HEADROOM
+    if estimate["total_mb"] <= budget:
+        return ctx_size, estimate, None
+    per_token = kv_bytes_per_token(model_params(info))
+    spare_mb = budget - estimate["weights_mb"] - RUNTIME_OVERHEAD_MB
+    min_ctx = MIN_CTX_PER_SLOT * max(1, parallel)
+    fitting = int(spare_mb * (1 << 20) / per_token) // CTX_GRANULARITY * CTX_GRANULARITY if per_token and spare_mb > 0 else 0
+    if fitting < min_ctx:
+        return ctx_size, estimate, (f"needs ~{estimate['total_mb']:.0f} MB (weights {estimate['weights_mb']:.0f} MB, "
+                                    f"KV cache {estimate['kv_mb']:.0f} MB for {estimate['n_ctx']} tokens) but only "
+                                    f"{budget:.0f} MB of {available_mb:.0f} MB available may be used")
+    return fitting, memory_estimate(info, fitting), None
+
+
+def describe(info, estimate=None, parallel=1):
+    """One-line summary: architecture, layers, context and the memory estimate."""
+    params = model_params(info)
+    estimate = estimate or memory_estimate(info)
+    per_slot = estimate["n_ctx"] // max(1, parallel)
+    return (f"{params['architecture']} ({params['block_count']} layers, trained ctx {params['context_length']}): "
+            f"ctx {estimate['n_ctx']} ({per_slot}/slot), weights {estimate['weights_mb']:.0f} MB + "
+            f"KV {estimate['kv_mb']:.0f} MB + {estimate['overhead_mb']} MB = ~{estimate['total_mb']:.0f} MB")
+
+
+# --- Draft Models ---
+
+def read_strings(path, array, start=0, stop=None):
+    """Items `start`..`stop` of a STRING array skipped by read_gguf() (a GGUFArray of file `path`)."""
+    stop = array.count if stop is None else min(stop, array.count)
+    with open(path, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+        reader = _Reader(mm)
+        reader.pos = array.start
+        for _ in range(start):
+            reader.pos += 8 + _U64.unpack_from(mm, reader.pos)[0]
+        return [reader.string() for _ in range(max(0, stop - start))]
+
+
+def _vocab(path, info):
+    meta = info["metadata"]
+    tokens = meta.get("tokenizer.ggml.tokens")
+    if isinstance(tokens, GGUFArray) and tokens.item_type == STRING:
+        texts = lambda start: read_strings(path, tokens, start)
+    elif isinstance(tokens, list):
+        texts = lambda start: tokens[start:]
+    else:
+        return None
+    return {"model": meta.get("tokenizer.ggml.model"), "size": tokens.count if isinstance(tokens, GGUFArray) else len(tokens),
+            "texts": texts, **{key: meta.get(f"tokenizer.ggml.{key}")
+                               for key in ("bos_token_id", "eos_token_id", "add_bos_token", "add_eos_token")}}
+
+
+def check_draft_vocab(path, draft_path, info=None, draft_info=None):
+    """
+    Returns an error message if the draft model `draft_path` cannot draft for the model `path`
+    (llama.cpp's common_speculative_are_compatible: same tokenizer type and BOS/EOS handling,
+    vocabulary sizes within DRAFT_VOCAB_MAX_SIZE_DIFFERENCE and identical token texts from
+    DRAFT_VOCAB_CHECK_START on), else None. `info`/`draft_info` are read_gguf() results if at hand.
+    Raises GGUFError or OSError for a file that cannot be read.
+    """
+    vocab = _vocab(path, info or read_gguf(path))
+    draft = _vocab(draft_path, draft_info or read_gguf(draft_path))
+    if vocab is None or draft is None:
+        return f"{'draft ' if vocab else ''}model has no tokenizer.ggml.tokens vocabulary"
+    for key in ("model", "bos_token_id", "eos_token_id", "add_bos_token", "add_eos_token"):
+        if vocab[key] != draft[key]:
+            return f"tokenizer {key} differs: {vocab[key]!r} (model) vs {draft[key]!r} (draft)"
+    if abs(vocab["size"] - draft["size"]) > DRAFT_VOCAB_MAX_SIZE_DIFFERENCE:
+        return (f"vocabulary sizes differ by more than {DRAFT_VOCAB_MAX_SIZE_DIFFERENCE}: "
+                f"{vocab['size']} (model) vs {draft['size']} (draft)")
+    for token_id, (text, draft_text) in enumerate(zip(vocab["texts"](DRAFT_VOCAB_CHECK_START),
+                                                      draft["texts"](DRAFT_VOCAB_CHECK_START)), DRAFT_VOCAB_CHECK_START):
+        if text != draft_text:
+            return f"token {token_id} differs: {text!r} (model) vs {draft_text!r} (draft)"
+    return None
+
+
+# --- Page Cache ---
+
+def _prefetch(path):
+    # POSIX_FADV_WILLNEED alone returns at once but, on virtio disks, leaves most pages unread;
+    # a sequential read with a large buffer fills the cache at full disk speed
+    with open(path, "rb", buffering=0) as f:
+        if hasattr(os, "posix_fadvise"):
+            os.posix_fadvise(f.fileno(), 0, 0, os.POSIX_FADV_SEQUENTIAL)
+        buf = bytearray(PREFETCH_CHUNK)
+        while f.readinto(buf):
+            pass
+
+def prefetch(path):
+    """
+    Starts reading `path` into the page cache in a daemon thread and returns the thread.
+    Meant to run while llama-server is being spawned; errors are ignored.
+    """
+    def run():
+        try:
+            _prefetch(path)
+        except (OSError, ValueError):
+            pass
+    thread = threading.Thread(target=run, name="gguf-prefetch", daemon=True)
+    thread.start()
+    return thread
+
+
+# --- Writer (test and stand-in models) ---
+
+def _value_type(value):
+    if isinstance(value, bool):
+        return BOOL
+    if isinstance(value, int):
+        return INT32 if value < 0 else (UINT32 if value < 1 << 32 else UINT64)
+    if isinstance(value, float):
+        return FLOAT32
+    if isinstance(value, str):
+        return STRING
+    if isinstance(value, (list, tuple)):
+        return ARRAY
+    raise TypeError(f"unsupported metadata value {value!r}")
+
+def _pack_string(text):
+    data = text.encode("utf-8")
+    return struct.pack("<Q", len(data)) + data
+
+def _pack_value(value_type, value):
+    if value_type == STRING:
+        return _pack_string(value)
+    if value_type == ARRAY:
+        item_type = _value_type(value[0]) if value else UINT32
+        return struct.pack("<IQ", item_type, len(value)) + b"".join(_pack_value(item_type, v) for v in value)
+    return struct.pack(_SCALAR_FORMATS[value_type], value)
+
+def write_gguf(path, metadata, tensors=(), truncate=0):
+    """
+    Writes a GGUF v3 file with `metadata` and zero-filled `tensors` ((name, shape, ggml type)
+    tuples), minus `truncate` bytes at the end. Returns `path`.
+    """
+    header = bytearray(GGUF_MAGIC + struct.pack("<IQQ", 3, len(tensors), len(metadata)))
+    for key, value in metadata.items():
+        value_type = _value_type(value)
+        header += _pack_string(key) + struct.pack("<I", value_type) + _pack_value(value_type, value)
+    offset = 0
+    for name, shape, ggml_type in tensors:
+        header += _pack_string(name) + struct.pack("<I", len(shape)) + struct.pack(f"<{len(shape)}Q", *shape)
+        header += struct.pack("<IQ", ggml_type, offset)
+        size = tensor_nbytes({"shape": shape, "type": ggml_type})
+        offset += -(-size // DEFAULT_ALIGNMENT) * DEFAULT_ALIGNMENT
+    header += b"\0" * (-len(header) % DEFAULT_ALIGNMENT)
+    with open(path, "wb") as f:
+        f.write(bytes(header) + b"\0" * max(0, offset - truncate))
+    return path
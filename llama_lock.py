@@ -0,0 +1,51 @@
+# llama_lock.py
+"""
+Advisory file locks shared by the modules that coordinate several CLI processes.
+Uses flock(2) where available; on platforms without fcntl the locks are no-ops
+(single-process behaviour, as before).
+"""
+import os
+import contextlib
+
+try:
+    import fcntl
+except ImportError: # Windows
+    fcntl = None
+
+
+class LockBusy(Exception):
+    """Raised by file_lock(blocking=False) when another process holds the lock."""
+
+
+@contextlib.contextmanager
+def file_lock(path, shared=False, blocking=True):
+    """
+    Holds an flock on `path` (created if missing) for the duration of the with-block.
+    `shared` takes a reader lock. With blocking=False, raises LockBusy instead of waiting.
+    Yields the open file descriptor.
+    """
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+    try:
+        if fcntl is not None:
+            flags = fcntl.LOCK_SH if shared else fcntl.LOCK_EX
+            if not blocking:
+                flags |= fcntl.LOCK_NB
+            try:
+                fcntl.flock(fd, flags)
+            except BlockingIOError as e:
+                raise LockBusy(path) from e
+        yield fd
+    finally:
+        os.close(fd) # Closing the descriptor releases the lock
+
+
+def is_locked(path):
+    """True if another process currently holds an exclusive lock on `path`."""
+    if fcntl is None or not os.path.exists(path):
+        return False
+    try:
+        with file_lock(path, shared=True, blocking=False):
+            return False
+    except LockBusy:
+        return True
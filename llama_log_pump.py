@@ -0,0 +1,63 @@
+# llama_log_pump.py
+"""
+Log pump: copies llama-server's output (stdin) into a size-rotated log file.
+
+    python -S llama_log_pump.py LOGFILE [MAX_BYTES [BACKUPS]]
+
+Started by llama_logs.start_pump with the server's stdout/stderr pipe as stdin; runs until
+the server closes the pipe. Kept to os/sys/time/signal so it starts in a few milliseconds
+next to the server it serves (llama_logs reads and parses what it writes).
+"""
+import os
+import sys
+import time
+import signal
+
+TIMESTAMP_FORMAT = "%Y-%m-%d %H:%M:%S"
+
+
+def rotate(path, backups):
+    """Shifts LOGFILE.n to LOGFILE.n+1 (dropping the oldest) and LOGFILE to LOGFILE.1."""
+    for index in range(backups - 1, 0, -1):
+        if os.path.exists(f"{path}.{index}"):
+            os.replace(f"{path}.{index}", f"{path}.{index + 1}")
+    if backups and os.path.exists(path):
+        os.replace(path, f"{path}.1")
+    elif os.path.exists(path):
+        os.remove(path)
+
+def pump(source, path, max_bytes, backups):
+    """Copies lines from binary stream `source` to `path` with a timestamp prefix until EOF, rotating by size."""
+    out = open(path, "ab")
+    try:
+        size = out.tell()
+        for line in iter(source.readline, b""):
+            now = time.time()
+            stamp = f"{time.strftime(TIMESTAMP_FORMAT, time.localtime(now))}.{int(now % 1 * 1000):03d} ".encode()
+            record = stamp + line if line.endswith(b"\n") else stamp + line + b"\n"
+            if size and size + len(record) > max_bytes:
+                out.close()
+                rotate(path, backups)
+                out = open(path, "ab")
+                size = 0
+            out.write(record)
+            out.flush() # Readers (tail, startup errors) see every line at once
+            size += len(record)
+    finally:
+        out.close()
+
+
+def main(argv=None):
+    argv = sys.argv[1:] if argv is None else argv
+    if not 1 <= len(argv) <= 3:
+        sys.stderr.write("usage: llama_log_pump.py LOGFILE [MAX_BYTES [BACKUPS]]\n")
+        return 2
+    signal.signal(signal.SIGINT, signal.SIG_IGN) # Ctrl-C stops the server; the pump drains until it exits
+    max_bytes = int(argv[1]) if len(argv) > 1 else 10 << 20
+    backups = int(argv[2]) if len(argv) > 2 else 3
+    pump(sys.stdin.buffer, argv[0], max_bytes, backups)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,195 @@
+# llama_logs.py
+"""
+llama-server log capture and parsing.
+
+spawn_server_process connects llama-server's stdout and stderr to a pipe drained by a small
+detached pump process (llama_log_pump.py). The pump timestamps each line and appends it to
+LOGFILE, rotating it to LOGFILE.1 ... LOGFILE.<LOG_BACKUPS> once it exceeds LOG_MAX_BYTES.
+It is a separate process rather than a thread so the pipe keeps draining after the CLI that
+started the server has exited; it exits itself when the server closes the pipe.
+
+parse_lines() turns the captured lines into structured records: model load time and, per
+request, the slot/task, prompt size, KV cache reuse and the prompt eval / eval timings from
+llama.cpp's print_timing block.
+"""
+import os
+import re
+import sys
+import time
+import subprocess
+
+import llama_log_pump
+
+# --- Log Configuration ---
+LOG_FILENAME = ".llama_server.log" # Log of the managed server; pool instances and models get their own
+LOG_MAX_BYTES = 10 << 20           # Rotate once the log exceeds this size
+LOG_BACKUPS = 3                    # Rotated files kept (LOGFILE.1 is the newest)
+TAIL_LINES = 20                    # Lines quoted in startup-failure messages
+PUMP_EXIT_WAIT = 1.0               # Seconds to wait for the pump to flush a crashed server's last lines
+# --- End Configuration ---
+
+TIMESTAMP_FORMAT = llama_log_pump.TIMESTAMP_FORMAT
+_LINE_RE = re.compile(r"^(\d{4}-\d\d-\d\d \d\d:\d\d:\d\d)\.(\d{3}) (.*)$")
+_TASK = r"id\s+(?P<slot>\d+) \| task (?P<task>\d+) \| "
+_PATTERNS = {
+    "new_prompt": re.compile(_TASK + r"new prompt, n_ctx_slot = (?P<n_ctx_slot>\d+), n_keep = \d+, n_prompt_tokens = (?P<n_prompt_tokens>\d+)"),
+    "kv_rm": re.compile(_TASK + r"kv cache rm \[(?P<n_cached>\d+), end\)"),
+    "reuse": re.compile(_TASK + r"reusing chunk with size (?P<n_reused>\d+)"),
+    "timing": re.compile(r"print_timing: id\s+(?P<slot>\d+) \| task (?P<task>\d+) \|\s*$"),
+    "prompt_eval": re.compile(r"^prompt eval time =\s*(?P<ms>[\d.]+) ms /\s*(?P<n>\d+) tokens"),
+    "eval": re.compile(r"^\s*eval time =\s*(?P<ms>[\d.]+) ms /\s*(?P<n>\d+) tokens"),
+    "total": re.compile(r"^\s*total time =\s*(?P<ms>[\d.]+) ms /\s*(?P<n>\d+) tokens"),
+}
+_LOAD_START = re.compile(r"load_model: loading model")
+_LOAD_DONE = re.compile(r"main: model loaded")
+
+
+def log_path(tag=None):
+    """LOG_FILENAME, or for a pool instance or named model (`tag`) e.g. '.llama_server-8013.log'."""
+    if tag is None:
+        return LOG_FILENAME
+    base, ext = os.path.splitext(LOG_FILENAME)
+    return f"{base}-{tag}{ext}"
+
+
+# --- Pump ---
+
+def start_pump(path):
+    """
+    Starts the pump process for `path`. Returns (pump Popen, write end fd): pass the fd as the
+    server's stdout/stderr and close it in this process after spawning the server.
+    """
+    read_fd, write_fd = os.pipe()
+    try:
+        process = subprocess.Popen(
+            # -S: no site-packages; the pump starts alongside the server and should cost it no CPU
+            [sys.executable, "-S", llama_log_pump.__file__, os.path.abspath(path), str(LOG_MAX_BYTES), str(LOG_BACKUPS)],
+            stdin=read_fd, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, start_new_session=True,
+        )
+    except OSError:
+        os.close(write_fd)
+        raise
+    finally:
+        os.close(read_fd)
+    return process, write_fd
+
+def wait_for_pump(process):
+    """Gives a pump whose server exited time to write the last lines (the pipe is at EOF then)."""
+    pump_process = getattr(process, "log_pump", None)
+    if pump_process is not None:
+        try:
+            pump_process.wait(timeout=PUMP_EXIT_WAIT)
+        except subprocess.TimeoutExpired:
+            pass
+
+
+# --- Reading ---
+
+def log_files(path=None):
+    """The log and its rotated backups, oldest first."""
+    path = path or LOG_FILENAME
+    files = [f"{path}.{index}" for index in range(LOG_BACKUPS, 0, -1)] + [path]
+    return [f for f in files if os.path.exists(f)]
+
+def read_lines(path=None):
+    """All captured lines, oldest first (rotated files included)."""
+    for name in log_files(path):
+        with open(name, "r", encoding="utf-8", errors="replace") as f:
+            for line in f:
+                yield line.rstrip("\n")
+
+def tail(path=None, n=TAIL_LINES):
+    """The last `n` captured lines of the current log file (timestamps stripped)."""
+    try:
+        with open(path or LOG_FILENAME, "rb") as f:
+            f.seek(0, os.SEEK_END)
+            f.seek(max(0, f.tell() - 256 * n))
+            lines = f.read().decode("utf-8", "replace").splitlines()
+    except OSError:
+        return []
+    lines = lines[-n:]
+    return [m.group(3) if (m := _LINE_RE.match(line)) else line for line in lines]
+
+def format_tail(path=None, n=TAIL_LINES):
+    """The last log lines as an indented block for error messages ('' if there are none)."""
+    lines = tail(path, n)
+    if not lines:
+        return ""
+    return f"\nLast {len(lines)} lines of {path or LOG_FILENAME}:\n" + "\n".join(f"  {line}" for line in lines)
+
+
+# --- Parsing ---
+
+def _split(line):
+    """(epoch seconds or None, message) of a captured line."""
+    match = _LINE_RE.match(line)
+    if not match:
+        return None, line
+    at = time.mktime(time.strptime(match.group(1), TIMESTAMP_FORMAT)) + int(match.group(2)) / 1000
+    return at, match.group(3)
+
+def parse_lines(lines):
+    """
+    Structured records from captured log lines, in order:
+      {'type': 'load', 'at', 'load_s'}: model loading to 'model loaded'
+      {'type': 'request', 'at', 'slot', 'task', 'n_prompt_tokens', 'n_cached', 'n_reused',
+       'prompt_ms', 'prompt_n', 'prompt_tps', 'eval_ms', 'eval_n', 'eval_tps', 'total_ms'}
+    where n_cached is the prompt prefix kept in the slot's KV cache and n_reused the tokens
+    moved into place by --cache-reuse.
+    """
+    records, tasks, load_started, timing = [], {}, None, None
+    for line in lines:
+        at, message = _split(line)
+        if _LOAD_START.search(message):
+            load_started = at
+            continue
+        if _LOAD_DONE.search(message):
+            if load_started is not None and at is not None:
+                records.append({"type": "load", "at": at, "load_s": round(at - load_started, 3)})
+            load_started = None
+            continue
+        for kind, pattern in _PATTERNS.items():
+            match = pattern.search(message)
+            if match:
+                break
+        else:
+            continue
+        fields = match.groupdict()
+        if "task" in fields:
+            key = (int(fields["slot"]), int(fields["task"]))
+            task = tasks.setdefault(key, {"type": "request", "slot": key[0], "task": key[1], "n_prompt_tokens": None,
+                                          "n_cached": 0, "n_reused": 0})
+            if kind == "new_prompt":
+                task["n_prompt_tokens"] = int(fields["n_prompt_tokens"])
+                task["n_ctx_slot"] = int(fields["n_ctx_slot"])
+            elif kind == "kv_rm":
+                task["n_cached"] = int(fields["n_cached"])
+            elif kind == "reuse":
+                task["n_reused"] += int(fields["n_reused"])
+            elif kind == "timing":
+                timing = task
+        elif timing is not None:
+            ms, n = float(fields["ms"]), int(fields["n"])
+            if kind == "prompt_eval":
+                timing.update(prompt_ms=ms, prompt_n=n, prompt_tps=round(n / ms * 1000, 2) if ms else None)
+            elif kind == "eval":
+                timing.update(eval_ms=ms, eval_n=n, eval_tps=round(n / ms * 1000, 2) if ms else None)
+            else:
+                timing.update(total_ms=ms, at=at)
+                records.append(tasks.pop((timing["slot"], timing["task"])))
+                timing = None
+    return records
+
+def summarize(records):
+    """Counts and medians over parse_lines() records."""
+    requests = [r for r in records if r["type"] == "request"]
+    loads = [r["load_s"] for r in records if r["type"] == "load"]
+    median = lambda values: sorted(values)[len(values) // 2] if values else None
+    prompt_tokens = sum(r.get("n_prompt_tokens") or 0 for r in requests)
+    return {
+        "requests": len(requests), "loads": len(loads), "last_load_s": loads[-1] if loads else None,
+        "prompt_tps_p50": median([r["prompt_tps"] for r in requests if r.get("prompt_tps")]),
+        "eval_tps_p50": median([r["eval_tps"] for r in requests if r.get("eval_tps")]),
+        "cached_fraction": round(sum(r["n_cached"] for r in requests) / prompt_tokens, 3) if prompt_tokens else None,
+    }
+
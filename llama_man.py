@@ -1,10 +1,16 @@
 # llama_man.py
 import os
 import sys
-import subprocess
+import json
 import time
 import signal
+import threading
+import subprocess
 import llama_pid
+import llama_gguf
+import llama_logs
+import llama_ready
+import llama_slots
 
 # --- Determine Base Directory of this script ---
 # __file__ is the path to the current script (llama_man.py)
@@ -23,66 +29,307 @@ CTX_SIZE = 0
 BATCH_SIZE = 1024
 UB = 1024
 CACHE_REUSE = 256
+PARALLEL = 1 # Number of server slots (--parallel); batch clients size their concurrency to match
+METRICS = True # Expose llama-server's Prometheus /metrics endpoint (--metrics)
+EMBEDDING = False # Serve POST /embedding (--embedding); registered models can set it per model
+DRAFT_MODEL_PATH = None # -md: small model with the same vocabulary for speculative decoding (None: off); registered models can set it per model
+DRAFT_MAX = None # --draft-max: tokens drafted per step (None: llama-server default, 16)
+DRAFT_MIN = None # --draft-min: shortest draft worth verifying (None: llama-server default)
+READY_TIMEOUT = 300.0 # Seconds to wait for /health to report the model is loaded
+STOP_TIMEOUT = 5.0 # Seconds a stopping server gets to exit after SIGINT before --force escalates
+PROFILE_FILENAME = ".llama_profile.json" # Tuned launch parameters written by `tune`; overrides the values above
+SLOT_SAVE_PATH = ".llama_slots" # --slot-save-path: slot KV caches are saved on stop and restored on start (None disables)
+MODEL_CHECK = True # Parse the GGUF header before launching: refuse truncated/non-GGUF files, shrink a context that does not fit in memory
+PREFETCH_MODEL = True # Read the model into the page cache while llama-server starts
+CAPTURE_LOGS = True # Keep llama-server's output in a rotating log (llama_logs.LOG_FILENAME) instead of discarding it
+RPC_GROUP_FILENAME = ".llama_rpc.json" # RPC worker group written by `rpc start` (llama_rpc); while it exists the server offloads to the workers
+RPC_GPU_LAYERS = 999 # -ngl with an RPC group: every layer goes to the workers (a local worker keeps a share on this host)
+SUPERVISOR_FILENAME = ".llama_supervisor.json" # Restart counts written by supervise()
+RESTART_BACKOFF = 0.5 # Seconds before the second restart in a row; doubles per further crash (the first is immediate)
+RESTART_BACKOFF_MAX = 30.0 # Longest wait between restarts
+RESTART_RESET_AFTER = 60.0 # A crash after this much uptime no longer counts as "in a row"
+RESTART_GIVE_UP = 10 # Crashes or failed starts in a row after which supervise() gives up
 # --- End Configuration ---
 
+# Launch parameters a profile (or start_llama_server(params=...)) may set, and their flags
+PROFILE_FLAGS = {
+    'ctx_size': '--ctx-size', 'batch_size': '-b', 'ubatch_size': '-ub', 'cache_reuse': '--cache-reuse',
+    'parallel': '--parallel', 'threads': '-t', 'threads_batch': '-tb',
+    'draft_model': '-md', 'draft_max': '--draft-max', 'draft_min': '--draft-min',
+    'rpc': '--rpc', 'n_gpu_layers': '-ngl',
+}
+# Launch parameters that only apply together with a draft model
+DRAFT_KEYS = ('draft_max', 'draft_min')
+# Launch parameters that are on/off switches, and their flags
+SWITCH_FLAGS = {'embedding': '--embedding'}
+
 # --- Server Management Functions ---
 
-def start_llama_server():
+def load_profile(model_path=None):
+    """
+    Returns the launch parameters of the tuned profile (PROFILE_FILENAME) as a dict, or {}
+    if there is none or it was tuned for a different model file than `model_path` (default MODEL_PATH).
+    """
+    model_path = model_path or MODEL_PATH
+    try:
+        with open(PROFILE_FILENAME, 'r') as f:
+            profile = json.load(f)
+    except (IOError, ValueError):
+        return {}
+    if not isinstance(profile, dict) or not isinstance(profile.get('params'), dict):
+        return {}
+    if profile.get('model') and os.path.basename(profile['model']) != os.path.basename(model_path):
+        if model_path == MODEL_PATH:
+            print(f"Ignoring '{PROFILE_FILENAME}': tuned for {profile['model']}, not {MODEL_PATH}.", file=sys.stderr)
+        return {}
+    return {k: v for k, v in profile['params'].items() if k in PROFILE_FLAGS and v is not None}
+
+def load_rpc_group():
+    """The RPC worker group recorded in RPC_GROUP_FILENAME by llama_rpc (dict with 'workers'), or None."""
+    try:
+        with open(RPC_GROUP_FILENAME, 'r') as f:
+            group = json.load(f)
+    except (IOError, ValueError):
+        return None
+    if not isinstance(group, dict) or not isinstance(group.get('workers'), list) or not group['workers']:
+        return None
+    return group
+
+def rpc_params(group=None):
+    """Launch parameters that spread the managed server's layers over the RPC group's workers ({} without a group)."""
+    group = group or load_rpc_group()
+    if not group:
+        return {}
+    return {'rpc': ','.join(w['endpoint'] for w in group['workers']), 'n_gpu_layers': RPC_GPU_LAYERS}
+
+def slot_save_dir(model_path=None):
+    """--slot-save-path for a model: SLOT_SAVE_PATH for MODEL_PATH, a subdirectory of it for any other model file."""
+    if not SLOT_SAVE_PATH:
+        return None
+    if not model_path or model_path == MODEL_PATH:
+        return SLOT_SAVE_PATH
+    return os.path.join(SLOT_SAVE_PATH, os.path.splitext(os.path.basename(model_path))[0])
+
+def launch_settings(params=None, model_path=None, threads=None):
+    """Launch parameters (keys of PROFILE_FLAGS and SWITCH_FLAGS): the module configuration, overridden by the tuned profile, `threads` and `params`."""
+    settings = {'ctx_size': CTX_SIZE, 'batch_size': BATCH_SIZE, 'ubatch_size': UB,
+                'cache_reuse': CACHE_REUSE, 'parallel': PARALLEL, 'embedding': EMBEDDING,
+                'draft_model': DRAFT_MODEL_PATH, 'draft_max': DRAFT_MAX, 'draft_min': DRAFT_MIN}
+    settings.update(load_profile(model_path))
+    if threads:
+        settings['threads'] = threads
+    settings.update(params or {})
+    return settings
+
+def build_server_command(port=None, threads=None, params=None, model_path=None):
+    """
+    Builds the llama-server command line from launch_settings(params, model_path, threads).
+    `port` defaults to PORT and `model_path` to MODEL_PATH; `threads` adds '-t'
+    (llama-server picks a default otherwise).
+    """
+    model_path = model_path or MODEL_PATH
+    settings = launch_settings(params, model_path, threads)
+    if settings.get('draft_model'):
+        settings['draft_model'] = os.path.abspath(settings['draft_model'])
+    command = [SERVER_PATH, '-m', model_path, '--port', str(port or PORT)]
+    for key, flag in PROFILE_FLAGS.items():
+        if key in DRAFT_KEYS and not settings.get('draft_model'):
+            continue
+        if settings.get(key) is not None:
+            command += [flag, str(settings[key])]
+    command += [flag for key, flag in SWITCH_FLAGS.items() if settings.get(key)]
+    if METRICS:
+        command.append('--metrics')
+    slot_dir = slot_save_dir(model_path)
+    if slot_dir:
+        command += ['--slot-save-path', os.path.abspath(slot_dir)]
+    return command
+
+def check_paths():
+    """Returns an error message if the server executable or model is missing, else None."""
+    if not SERVER_PATH or not os.path.exists(SERVER_PATH):
+       return f"Server executable path not found: '{SERVER_PATH}'. Ensure it exists relative to llama_man.py."
+    if not MODEL_PATH or not os.path.exists(MODEL_PATH):
+       return f"Model file path not found: '{MODEL_PATH}'. Ensure it exists relative to llama_man.py."
+    return None
+
+def check_model(model_path=None, params=None, remote_mb=0.0):
+    """
+    Reads the model's GGUF header (llama_gguf) and checks that the launch fits in memory.
+    With a draft model (draft_model), checks that file too and that its vocabulary matches,
+    and counts its weights and KV cache against the memory. `remote_mb` is memory available
+    on other hosts (RPC workers) on top of this host's.
+    Returns tuple (params: dict | None, message: str): `params` with ctx_size lowered if the
+    configured context would not fit, and a summary; params None (and the reason) when the
+    file is not a complete GGUF model, the draft cannot draft for it, or it does not fit even
+    with a small context.
+    """
+    model_path = model_path or MODEL_PATH
+    try:
+        info = llama_gguf.read_gguf(model_path)
+    except (llama_gguf.GGUFError, OSError) as e:
+        return None, f"Model file '{model_path}' is not usable: {e}"
+    error = llama_gguf.check_complete(info)
+    if error:
+        return None, f"Model file '{model_path}': {error}"
+    settings = launch_settings(params, model_path)
+    requested = settings.get('ctx_size') or 0
+    draft_path, available_mb = settings.get('draft_model'), None
+    if draft_path or remote_mb:
+        available_mb = llama_gguf.available_memory_mb()
+    if draft_path:
+        draft_info, error = check_draft(model_path, draft_path, info)
+        if error:
+            return None, error
+        # The draft context defaults to the model's; a draft trained on less is capped by llama-server anyway
+        draft_estimate = llama_gguf.memory_estimate(draft_info, requested)
+        if available_mb is not None:
+            available_mb -= draft_estimate['total_mb']
+    if available_mb is not None:
+        available_mb += remote_mb
+    ctx_size, estimate, error = llama_gguf.fit_context(info, requested, settings.get('parallel') or 1, available_mb)
+    if error:
+        return None, f"Model '{os.path.basename(model_path)}' does not fit in memory: {error}. Lower --ctx-size or free memory."
+    message = f"Model {llama_gguf.describe(info, estimate, settings.get('parallel') or 1)}"
+    if remote_mb:
+        message += f"; {remote_mb:.0f} MB free on RPC workers counted"
+    if draft_path:
+        message += f"; draft '{os.path.basename(draft_path)}' ~{draft_estimate['total_mb']:.0f} MB"
+    params = dict(params or {})
+    if ctx_size != requested:
+        params['ctx_size'] = ctx_size
+        message += f" (context lowered from {requested or 'trained'} to fit in memory)"
+    return params, message
+
+def check_draft(model_path, draft_path, info=None):
+    """
+    Checks that `draft_path` is a complete GGUF model that can draft for `model_path`
+    (llama_gguf.check_draft_vocab). Returns tuple (draft info: dict | None, error: str | None).
+    """
+    try:
+        draft_info = llama_gguf.read_gguf(draft_path)
+        error = llama_gguf.check_complete(draft_info) or llama_gguf.check_draft_vocab(model_path, draft_path, info, draft_info)
+    except (llama_gguf.GGUFError, OSError) as e:
+        return None, f"Draft model '{draft_path}' is not usable: {e}"
+    if error:
+        return None, f"Draft model '{os.path.basename(draft_path)}' cannot draft for '{os.path.basename(model_path)}': {error}"
+    return draft_info, None
+
+def spawn_server_process(command, cpus=None, log_path=None):
+    """
+    Launches a llama-server command detached from the console.
+    `cpus` (iterable of CPU ids) pins the process on platforms with sched_setaffinity (Linux).
+    With `log_path` (and CAPTURE_LOGS), stdout and stderr go through a llama_logs pump into
+    that rotating log; the pump's Popen is attached as `process.log_pump`. Otherwise they are discarded.
+    Returns the subprocess.Popen object; raises the usual Popen exceptions.
+    """
+    startupinfo = None
+    if sys.platform == 'win32':
+        startupinfo = subprocess.STARTUPINFO()
+        startupinfo.dwFlags |= subprocess.STARTF_USESHOWWINDOW
+        startupinfo.wShowWindow = subprocess.SW_HIDE
+
+    preexec_fn = None
+    if cpus:
+        if hasattr(os, 'sched_setaffinity'):
+            cpu_set = set(cpus)
+            preexec_fn = lambda: os.sched_setaffinity(0, cpu_set)
+        else:
+            print(f"Warning: CPU affinity is not supported on {sys.platform}; ignoring.", file=sys.stderr)
+
+    log_pump, output = None, subprocess.DEVNULL
+    if log_path and CAPTURE_LOGS:
+        log_pump, output = llama_logs.start_pump(log_path)
+    try:
+        process = subprocess.Popen(
+            command,
+            stdout=output,
+            stderr=output,
+            startupinfo=startupinfo,
+            preexec_fn=preexec_fn
+            # Add creationflags=subprocess.CREATE_NO_WINDOW on Windows if STARTUPINFO isn't enough
+            # creationflags=subprocess.CREATE_NO_WINDOW if sys.platform == 'win32' else 0
+        )
+    finally:
+        if log_pump is not None:
+            os.close(output) # The server holds the only write end now; the pump exits when it does
+    process.log_pump = log_pump
+    return process
+
+def start_llama_server(params=None, warm=True):
     """
     Starts the llama-server process using paths relative to this script's location.
+    `params` overrides launch parameters for this start only (see build_server_command).
+    While an RPC worker group is recorded (RPC_GROUP_FILENAME), the model is spread over its
+    workers (rpc_params()), also when supervise() restarts the server.
+    With `warm`, slots saved by the last stop are restored and the warm-up prompts prefilled
+    before returning (see llama_slots).
+    Holds llama_pid.state_lock() until the server is ready, so a concurrent start finds it running.
     Returns tuple (success: bool, message: str, pid: int | None).
     """
+    with llama_pid.state_lock(wait_message="Another process is starting the server; waiting for it..."):
+        return _start_locked(params, warm)
+
+def _start_locked(params, warm):
     pid = llama_pid.read_pid()
-    if pid and llama_pid.is_process_running(pid):
+    if pid and is_server_process(pid):
         return False, f"Server already running with PID {pid}.", pid
-    if pid and not llama_pid.is_process_running(pid):
+    if pid:
         llama_pid.delete_pid_file()
         print(f"Cleaned up stale PID file for PID {pid}.")
 
     # Check the constructed absolute paths
-    if not SERVER_PATH or not os.path.exists(SERVER_PATH):
-       # The path is now absolute or relative to this file, error is more direct
-       return False, f"Server executable path not found: '{SERVER_PATH}'. Ensure it exists relative to llama_man.py.", None
-    if not MODEL_PATH or not os.path.exists(MODEL_PATH):
-       return False, f"Model file path not found: '{MODEL_PATH}'. Ensure it exists relative to llama_man.py.", None
+    path_error = check_paths()
+    if path_error:
+       return False, path_error, None
+
+    group = load_rpc_group()
+    if group:
+        params = dict(rpc_params(group), **(params or {}))
+    if MODEL_CHECK:
+        remote_mb = (group or {}).get('remote_free_mb', 0.0) if (params or {}).get('rpc') else 0.0
+        params, model_message = check_model(MODEL_PATH, params, remote_mb)
+        if params is None:
+            return False, model_message, None
+        print(model_message)
+
+    if SLOT_SAVE_PATH:
+        os.makedirs(SLOT_SAVE_PATH, exist_ok=True)
 
     # Command uses the calculated absolute paths
-    command = [
-        SERVER_PATH, '-m', MODEL_PATH, '--port', str(PORT),
-        '--ctx-size', str(CTX_SIZE), '-b', str(BATCH_SIZE),
-        '-ub', str(UB), '--cache-reuse', str(CACHE_REUSE)
-    ]
+    command = build_server_command(params=params)
     cmd_str = ' '.join(command)
     print(f"Attempting to start server with command: {cmd_str}")
 
     try:
-        startupinfo = None
-        if sys.platform == 'win32':
-            startupinfo = subprocess.STARTUPINFO()
-            startupinfo.dwFlags |= subprocess.STARTF_USESHOWWINDOW
-            startupinfo.wShowWindow = subprocess.SW_HIDE
+        if PREFETCH_MODEL:
+            llama_gguf.prefetch(MODEL_PATH) # Overlaps reading the weights with process start-up
+        process = spawn_server_process(command, log_path=llama_logs.log_path())
+        print(f"Launched process with PID: {process.pid}. Waiting for server to become ready...")
 
-        process = subprocess.Popen(
-            command,
-            stdout=subprocess.DEVNULL,
-            stderr=subprocess.DEVNULL,
-            startupinfo=startupinfo
-            # Add creationflags=subprocess.CREATE_NO_WINDOW on Windows if STARTUPINFO isn't enough
-            # creationflags=subprocess.CREATE_NO_WINDOW if sys.platform == 'win32' else 0
+        # Write the state record straight away so `stop` can reach a server that is still loading
+        pid_written = llama_pid.write_pid(process.pid, port=PORT, command=command)
+
+        ready_status, ready_message, elapsed = llama_ready.wait_for_ready(
+            PORT, process=process, timeout=READY_TIMEOUT
         )
-        print(f"Launched process with PID: {process.pid}. Waiting briefly...")
-        time.sleep(2.0)
+        if ready_status == llama_ready.CRASHED:
+            llama_pid.delete_pid_file()
+            llama_logs.wait_for_pump(process)
+            return False, f"Server process failed on startup (exit code {process.poll()}). Command: {cmd_str}{log_tail(process)}", None
+        if ready_status == llama_ready.TIMEOUT:
+            # Leave the process running: a large model may simply need longer to load.
+            return False, f"Server PID {process.pid} launched but not ready: {ready_message}{log_tail(process)}", process.pid
 
-        if process.poll() is not None:
-             llama_pid.delete_pid_file()
-             return False, f"Server process failed on startup (exit code {process.poll()}). Check server logs if possible. Command: {cmd_str}", None
+        if warm and SLOT_SAVE_PATH:
+            print(llama_slots.warm_start(PORT, MODEL_PATH, SLOT_SAVE_PATH))
 
-        if not llama_pid.write_pid(process.pid):
+        if not pid_written:
              print(f"Warning: Server started (PID {process.pid}) but failed to write PID file.", file=sys.stderr)
-             return True, f"Server started (PID {process.pid}) but failed to write PID file.", process.pid
+             return True, f"Server started (PID {process.pid}, ready in {elapsed:.3f}s) but failed to write PID file.", process.pid
         else:
-            print(f"Server started successfully with PID {process.pid} and PID file written.")
-            return True, f"Server started successfully with PID {process.pid}.", process.pid
+            print(f"Server started successfully with PID {process.pid} and PID file written (ready in {elapsed:.3f}s).")
+            return True, f"Server started successfully with PID {process.pid} (ready in {elapsed:.3f}s).", process.pid
 
     except FileNotFoundError:
         return False, f"Failed to start server: Executable not found at path '{SERVER_PATH}'. Check path and permissions.", None
@@ -92,46 +339,79 @@ def start_llama_server():
         llama_pid.delete_pid_file()
         return False, f"Failed to start server process: {e}. Command: {cmd_str}", None
 
-# stop_llama_server and status_llama_server remain unchanged from previous correct versions
-def stop_llama_server(force=False):
-    # ... (implementation unchanged) ...
-    pid = llama_pid.read_pid()
-    if not pid: return True, "Server not running (no PID file)."
-    if not llama_pid.is_process_running(pid):
-        msg = f"Stale PID {pid} found. Cleaning up PID file."
-        llama_pid.delete_pid_file(); return True, msg
-    stopped_gracefully = False
+def log_tail(process, path=None):
+    """The last lines of a spawned server's log for an error message ('' when output was not captured)."""
+    if getattr(process, 'log_pump', None) is None:
+        return ""
+    return llama_logs.format_tail(path or llama_logs.log_path())
+
+def is_server_process(pid):
+    """True if `pid` is alive and is the process the state record was written for (not a reused PID)."""
+    return llama_pid.is_process_running(pid, llama_pid.recorded_start_time(pid))
+
+def stop_process(pid, force=False, start_time=None):
+    """
+    Stops a running llama-server process: SIGINT (SIGBREAK on Windows) and up to STOP_TIMEOUT
+    for it to exit, then with `force` SIGTERM/SIGKILL (taskkill on Windows). Each wait returns
+    as soon as the process exits (llama_pid.wait_for_exit). Does not touch the PID file.
+    Returns tuple (success: bool, message: str).
+    """
     try:
         sig = signal.SIGINT if sys.platform != 'win32' else signal.SIGBREAK
         os.kill(pid, sig)
-        for _ in range(5):
-            time.sleep(1);
-            if not llama_pid.is_process_running(pid): stopped_gracefully = True; break
     except Exception as e:
-        if not llama_pid.is_process_running(pid): stopped_gracefully = True
-        elif not force: return False, f"Stop signal failed: {e}. Try --force."
-    if stopped_gracefully:
-        llama_pid.delete_pid_file(); return True, f"Server PID {pid} stopped gracefully."
+        if not llama_pid.is_process_running(pid, start_time):
+            return True, f"Server PID {pid} stopped gracefully."
+        if not force: return False, f"Stop signal failed: {e}. Try --force."
+    else:
+        if llama_pid.wait_for_exit(pid, STOP_TIMEOUT, start_time):
+            return True, f"Server PID {pid} stopped gracefully."
     if not force: return False, f"Server PID {pid} did not stop gracefully. Use --force."
     try:
         if sys.platform == 'win32':
             subprocess.run(['taskkill', '/F', '/PID', str(pid)], check=True, capture_output=True)
         else:
-            os.kill(pid, signal.SIGTERM); time.sleep(1)
-            if llama_pid.is_process_running(pid): os.kill(pid, signal.SIGKILL); time.sleep(0.5)
-        if not llama_pid.is_process_running(pid):
-             llama_pid.delete_pid_file(); return True, f"Server PID {pid} terminated forcefully."
+            os.kill(pid, signal.SIGTERM)
+            if not llama_pid.wait_for_exit(pid, 1.0, start_time):
+                os.kill(pid, signal.SIGKILL)
+                llama_pid.wait_for_exit(pid, 1.0, start_time)
+        if not llama_pid.is_process_running(pid, start_time):
+             return True, f"Server PID {pid} terminated forcefully."
         else: return False, "Failed to force kill process."
     except Exception as e:
-         if not llama_pid.is_process_running(pid):
-             llama_pid.delete_pid_file(); return True, f"Force stop error but process died: {e}"
+         if not llama_pid.is_process_running(pid, start_time):
+             return True, f"Force stop error but process died: {e}"
          return False, f"Force stop error: {e}"
 
+def stop_llama_server(force=False, save_slots=True):
+    """
+    Stops the managed server. With `save_slots` (and SLOT_SAVE_PATH set), the idle slots' KV
+    caches are saved first so the next start can restore them.
+    Returns tuple (success: bool, message: str).
+    """
+    state = llama_pid.read_state() or {}
+    pid = llama_pid.read_pid()
+    if not pid: return True, "Server not running (no PID file)."
+    start_time = llama_pid.recorded_start_time(pid)
+    if not llama_pid.is_process_running(pid, start_time):
+        msg = f"Stale PID {pid} found. Cleaning up PID file."
+        llama_pid.delete_pid_file(); return True, msg
+    if save_slots and SLOT_SAVE_PATH and state.get('pid') == pid:
+        _, save_message = llama_slots.save_slots(state.get('port') or PORT, MODEL_PATH, SLOT_SAVE_PATH)
+        print(save_message)
+    llama_pid.mark_stopping(pid) # A running supervisor must not restart it
+    success, message = stop_process(pid, force=force, start_time=start_time)
+    if success:
+        llama_pid.delete_pid_file()
+    else:
+        llama_pid.mark_stopping(pid, False)
+    return success, message
+
 def status_llama_server():
     # ... (implementation unchanged) ...
     pid = llama_pid.read_pid()
     if pid:
-        if llama_pid.is_process_running(pid):
+        if is_server_process(pid):
             return "RUNNING", f"Server is RUNNING with PID {pid}."
         else:
             llama_pid.delete_pid_file() # Clean up stale PID
@@ -140,25 +420,146 @@ def status_llama_server():
         return "STOPPED", f"Server is STOPPED (No PID file '{llama_pid.PID_FILENAME}' found)."
 
 
-# ensure_server_running_or_fail remains unchanged (uses the modified start_llama_server)
-def ensure_server_running_or_fail():
+# ensure_server_running_or_fail: at most one concurrent caller launches the server
+def ensure_server_running_or_fail(params=None):
     """
-    Checks server status, starts if needed using configured settings.
+    Checks server status, starts if needed using configured settings (with `params` overriding
+    launch parameters for that start, see start_llama_server).
     Returns: Tuple (status_code: str, message: str)
     status_code can be "RUNNING", "FAILED_START"
+    While an on-demand listener (llama_activate) runs, it starts the server itself: nothing is
+    launched here. On PORT the listener is "RUNNING" (requests to PORT reach it); on another
+    port this fails, as a server started here would sit outside the listener's control.
     """
-    status_code, initial_message = status_llama_server()
+    import llama_activate # Imported here: llama_activate builds on this module
+    listener_port = llama_activate.running_activate_port()
+    if listener_port == PORT:
+        return "RUNNING", f"On-demand listener on port {PORT} starts llama-server on the first request."
+    if listener_port is not None:
+        return "FAILED_START", (f"An on-demand listener on port {listener_port} manages llama-server; "
+                                f"send requests through it instead of starting another server.")
+    # The caller that finds the server stopped starts it under the lock; the others wait on
+    # the lock until it is ready and then find it RUNNING instead of launching a duplicate.
+    with llama_pid.state_lock(wait_message="Another process is starting the server; waiting for it..."):
+        status_code, initial_message = status_llama_server()
+        if status_code != "RUNNING":
+            print("Server not running or PID stale. Attempting auto-start...")
+            success, start_message, pid = start_llama_server(params) # Uses new path logic
 
-    if status_code == "RUNNING":
-        return "RUNNING", initial_message
+            if success:
+                print(f"Auto-start successful: {start_message}")
+                return "RUNNING", f"Auto-start successful: {start_message}"
+            else:
+                print(f"Error: Auto-start failed: {start_message}", file=sys.stderr)
+                return "FAILED_START", f"Auto-start failed: {start_message}"
 
-    print("Server not running or PID stale. Attempting auto-start...")
-    success, start_message, pid = start_llama_server() # Uses new path logic
+    # The process exists, but a start that timed out may have left it still loading.
+    pid = llama_pid.read_pid()
+    ready_status, ready_message, _ = llama_ready.wait_for_ready(
+        PORT, is_alive=lambda: is_server_process(pid), timeout=READY_TIMEOUT
+    )
+    if ready_status == llama_ready.READY:
+        return "RUNNING", f"{initial_message} {ready_message}"
+    print(f"Error: Server PID {pid} is not ready: {ready_message}", file=sys.stderr)
+    return "FAILED_START", f"Server PID {pid} is not ready: {ready_message}"
 
-    if success:
-        print(f"Auto-start successful: {start_message}")
-        time.sleep(2.5)
-        return "RUNNING", f"Auto-start successful: {start_message}"
-    else:
-        print(f"Error: Auto-start failed: {start_message}", file=sys.stderr)
-        return "FAILED_START", f"Auto-start failed: {start_message}"
\ No newline at end of file
+
+# --- Supervisor ---
+
+def read_supervisor_state():
+    """The record written by supervise() (dict, with 'running' telling whether it is still active), or None."""
+    try:
+        with open(SUPERVISOR_FILENAME, 'r') as f:
+            state = json.load(f)
+    except (IOError, ValueError):
+        return None
+    if not isinstance(state, dict):
+        return None
+    state['running'] = state.get('state') != 'stopped' and llama_pid.is_process_running(state.get('pid'), state.get('start_time'))
+    return state
+
+def _write_supervisor_state(state):
+    tmp_path = f"{SUPERVISOR_FILENAME}.tmp"
+    try:
+        with open(tmp_path, 'w') as f:
+            json.dump(state, f)
+        os.replace(tmp_path, SUPERVISOR_FILENAME)
+    except (IOError, OSError) as e:
+        print(f"Warning: could not write '{SUPERVISOR_FILENAME}': {e}", file=sys.stderr)
+
+def restart_delay(consecutive):
+    """Seconds to wait before restarting after `consecutive` crashes or failed starts in a row."""
+    if consecutive <= 1:
+        return 0.0
+    return min(RESTART_BACKOFF_MAX, RESTART_BACKOFF * 2 ** (consecutive - 2))
+
+def supervise(stop_event=None):
+    """
+    Keeps the managed server running until `stop_event` (threading.Event) is set.
+    Starts it (or adopts the one running), then blocks on its exit (llama_pid.wait_for_exit,
+    a pidfd on Linux, so a crash is noticed at once) and restarts it: immediately the first
+    time, then after restart_delay(). A crash after RESTART_RESET_AFTER seconds of uptime
+    starts the count again; RESTART_GIVE_UP in a row end supervision, and so does a deliberate
+    stop (stop_llama_server). Counts are kept in SUPERVISOR_FILENAME for `supervisor status`.
+    Returns tuple (success: bool, message: str).
+    """
+    stop_event = stop_event or threading.Event()
+    me = os.getpid()
+    record = {'pid': me, 'start_time': llama_pid.process_start_time(me), 'started_at': time.time(), 'state': 'starting',
+              'server_pid': None, 'restarts': 0, 'crashes': 0, 'failed_starts': 0, 'last_crash': None, 'last_restart_s': None}
+    consecutive = 0
+    result = (True, "Supervisor stopped.")
+    try:
+        while not stop_event.is_set():
+            pid = llama_pid.read_pid()
+            if not (pid and is_server_process(pid)):
+                delay = restart_delay(consecutive)
+                if delay:
+                    record['state'] = 'backoff'
+                    _write_supervisor_state(record)
+                    print(f"Restarting in {delay:.1f}s...")
+                    if stop_event.wait(delay):
+                        break
+                record['state'] = 'starting'
+                _write_supervisor_state(record)
+                started = time.monotonic()
+                success, message, pid = start_llama_server()
+                if not success and not (pid and is_server_process(pid)): # "Already running": adopt it
+                    consecutive += 1
+                    record['failed_starts'] += 1
+                    print(f"Start failed ({consecutive} in a row): {message}", file=sys.stderr)
+                    if consecutive >= RESTART_GIVE_UP:
+                        result = (False, f"Giving up after {consecutive} failures in a row: {message}")
+                        break
+                    continue
+                if record['server_pid'] is not None:
+                    record['restarts'] += 1
+                    record['last_restart_s'] = round(time.monotonic() - started, 3)
+                    print(f"Restart {record['restarts']}: server PID {pid} ready in {record['last_restart_s']:.2f}s.")
+            record.update(state='running', server_pid=pid)
+            _write_supervisor_state(record)
+            up_since = time.monotonic()
+            start_time = llama_pid.recorded_start_time(pid)
+            while not llama_pid.wait_for_exit(pid, 0.5, start_time): # Short waits only so stop_event is seen
+                if stop_event.is_set():
+                    return result
+            state = llama_pid.read_state()
+            if state is None or (state['pid'] == pid and state.get('stopping')):
+                result = (True, f"Server PID {pid} was stopped; supervisor exiting.")
+                break
+            if state['pid'] != pid:
+                continue # Restarted by another process meanwhile; watch that one
+            uptime = time.monotonic() - up_since
+            consecutive = 1 if uptime >= RESTART_RESET_AFTER else consecutive + 1
+            record['crashes'] += 1
+            record['last_crash'] = {'at': time.time(), 'pid': pid, 'uptime_s': round(uptime, 3)}
+            llama_pid.delete_pid_file()
+            tail = llama_logs.format_tail(llama_logs.log_path(), 5) if CAPTURE_LOGS else ""
+            print(f"Server PID {pid} exited unexpectedly after {uptime:.1f}s ({consecutive} in a row).{tail}", file=sys.stderr)
+            if consecutive >= RESTART_GIVE_UP:
+                result = (False, f"Giving up after {consecutive} crashes in a row.")
+                break
+        return result
+    finally:
+        record['state'] = 'stopped'
+        _write_supervisor_state(record)
@@ -0,0 +1,403 @@
+# llama_metrics.py
+"""
+Per-request timing instrumentation and a Prometheus exporter.
+
+Every completion the CLI runs is timed with a RequestTimer: wall-clock time to first token,
+inter-token gaps, and the server-reported `timings` and cache counts from the final event,
+including the draft counts of a server doing speculative decoding (-md). speculation_stats()
+compares draft acceptance and generation speed of speculative and plain requests per model.
+Records go into a ring buffer (the last RING_SIZE requests) and cumulative counters and
+histograms in an SQLite index, so short-lived CLI processes add up to one set of series.
+prometheus_text() renders those together with the scraped /metrics of every llama-server.
+"""
+import json
+import time
+import sqlite3
+import contextlib
+import http.client
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import llama_man
+import llama_pool
+import llama_ready
+
+# --- Metrics Configuration ---
+METRICS_DB = ".llama_metrics.db"
+RING_SIZE = 10000   # Per-request records kept for `metrics recent`
+EXPORT_PORT = 9101  # `metrics serve` listens here
+TTFT_BUCKETS = (0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+ITL_BUCKETS = (0.005, 0.01, 0.02, 0.04, 0.08, 0.15, 0.3, 0.6, 1.0)
+DURATION_BUCKETS = (0.1, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0, 300.0)
+SPEC_MIN_SPEEDUP = 1.1  # Speculation is reported as worth keeping from this generation speedup on
+# --- End Configuration ---
+
+# Exported client series: name -> (type, help)
+_FAMILIES = {
+    "llama_client_requests_total": ("counter", "Completion requests by source and status."),
+    "llama_client_ttft_seconds": ("histogram", "Wall-clock time from request to first streamed token."),
+    "llama_client_inter_token_seconds": ("histogram", "Wall-clock gaps between streamed tokens."),
+    "llama_client_request_seconds": ("histogram", "Wall-clock duration of completion requests."),
+    "llama_client_tokens_predicted_total": ("counter", "Generated tokens reported by the server (predicted_n)."),
+    "llama_client_prompt_tokens_total": ("counter", "Prompt tokens of the requests (tokens_evaluated)."),
+    "llama_client_prompt_tokens_processed_total": ("counter", "Prompt tokens the server had to evaluate (prompt_n)."),
+    "llama_client_prompt_tokens_reused_total": ("counter", "Prompt tokens served from the slot's KV cache."),
+    "llama_client_prompt_eval_seconds_total": ("counter", "Server-reported prompt evaluation time (prompt_ms)."),
+    "llama_client_generation_seconds_total": ("counter", "Server-reported generation time (predicted_ms)."),
+    "llama_client_draft_tokens_total": ("counter", "Tokens drafted by the draft model (draft_n)."),
+    "llama_client_draft_tokens_accepted_total": ("counter", "Drafted tokens the model accepted (draft_n_accepted)."),
+}
+
+
+class RequestTimer:
+    """
+    Times one completion from the client's side. Call token() when a streamed token arrives
+    and final() with the last event (or the non-streaming response); finish() returns the record.
+    """
+
+    __slots__ = ("source", "port", "stream", "started_at", "_start", "_first", "_last", "gaps", "tokens", "final_event")
+
+    def __init__(self, source, port=None, stream=True):
+        self.source = source
+        self.port = port
+        self.stream = stream
+        self.started_at = time.time()
+        self._start = time.perf_counter()
+        self._first = None
+        self._last = None
+        self.gaps = []
+        self.tokens = 0
+        self.final_event = None
+
+    def token(self):
+        now = time.perf_counter()
+        if self._first is None:
+            self._first = now
+        else:
+            self.gaps.append(now - self._last)
+        self._last = now
+        self.tokens += 1
+
+    def final(self, event):
+        """Keeps the final event (dict) for its timings and cache counts."""
+        self.final_event = event if isinstance(event, dict) else None
+
+    def finish(self, status="ok"):
+        """Returns the per-request record (a JSON-serialisable dict)."""
+        elapsed = time.perf_counter() - self._start
+        record = {
+            "ts": round(self.started_at, 3), "source": self.source, "port": self.port, "status": status,
+            "stream": self.stream, "elapsed_s": round(elapsed, 6),
+            "ttft_s": round(self._first - self._start, 6) if self._first is not None else None,
+            "tokens": self.tokens,
+        }
+        if self.gaps:
+            gaps = sorted(self.gaps)
+            record["itl_p50_s"] = round(gaps[len(gaps) // 2], 6)
+            record["itl_p99_s"] = round(gaps[min(len(gaps) - 1, int(len(gaps) * 0.99))], 6)
+            record["itl_max_s"] = round(gaps[-1], 6)
+        record.update(server_fields(self.final_event))
+        return record
+
+
+def server_fields(event):
+    """
+    Extracts prompt_n/prompt_ms/predicted_n/predicted_ms, the draft counts (only reported when
+    the server drafted), cache counts and the model from a final event or response.
+    """
+    if not event:
+        return {}
+    timings = event.get("timings") or {}
+    fields = {k: timings[k] for k in ("prompt_n", "prompt_ms", "predicted_n", "predicted_ms", "draft_n", "draft_n_accepted")
+              if k in timings}
+    for k in ("tokens_evaluated", "tokens_cached", "model"):
+        if event.get(k) is not None:
+            fields[k] = event[k]
+    if "prompt_n" in fields and "tokens_evaluated" in fields:
+        fields["prompt_reused"] = max(0, fields["tokens_evaluated"] - fields["prompt_n"])
+    return fields
+
+
+def batch_record(result, port=None):
+    """Record for a llama_batch result dict (non-streaming, so no TTFT or gaps)."""
+    record = {"ts": round(time.time() - result.get("elapsed_s", 0), 3), "source": "batch", "port": port,
+              "status": "error" if "error" in result else "ok", "stream": False,
+              "elapsed_s": result.get("elapsed_s"), "ttft_s": None, "tokens": result.get("tokens_predicted", 0)}
+    record.update(server_fields({"timings": result.get("timings"), "tokens_evaluated": result.get("tokens_evaluated")}))
+    return record
+
+
+def speculation_stats(records):
+    """
+    Draft acceptance and effective generation speed (server-reported predicted_n per
+    predicted_ms, draft model time included) per model, from request records. Returns a list
+    of dicts: model, requests, speculative (requests with draft counts), draft_n, accepted,
+    acceptance, spec_tok_s, plain_tok_s, speedup (None without both kinds of requests) and
+    verdict ('keep' from SPEC_MIN_SPEEDUP on, 'off' below 1.0, else 'marginal' or None).
+    """
+    groups = {}
+    for record in records:
+        if record.get("status") != "ok" or not record.get("predicted_ms"):
+            continue
+        key = record.get("model") or f"port {record.get('port')}"
+        group = groups.setdefault(key, {"model": key, "requests": 0, "speculative": 0, "draft_n": 0, "accepted": 0,
+                                        "spec": [0, 0.0], "plain": [0, 0.0]})
+        group["requests"] += 1
+        kind = "spec" if record.get("draft_n") else "plain"
+        if kind == "spec":
+            group["speculative"] += 1
+            group["draft_n"] += record["draft_n"]
+            group["accepted"] += record.get("draft_n_accepted") or 0
+        group[kind][0] += record.get("predicted_n") or 0
+        group[kind][1] += record["predicted_ms"]
+    stats = []
+    for group in groups.values():
+        spec_n, spec_ms = group.pop("spec")
+        plain_n, plain_ms = group.pop("plain")
+        group["acceptance"] = round(group["accepted"] / group["draft_n"], 3) if group["draft_n"] else None
+        group["spec_tok_s"] = round(spec_n / spec_ms * 1000, 2) if spec_ms else None
+        group["plain_tok_s"] = round(plain_n / plain_ms * 1000, 2) if plain_ms else None
+        group["speedup"] = round(group["spec_tok_s"] / group["plain_tok_s"], 3) if group["spec_tok_s"] and group["plain_tok_s"] else None
+        group["verdict"] = None if group["speedup"] is None else (
+            "keep" if group["speedup"] >= SPEC_MIN_SPEEDUP else "off" if group["speedup"] < 1.0 else "marginal")
+        stats.append(group)
+    return stats
+
+
+# --- Storage ---
+
+@contextlib.contextmanager
+def _db():
+    """Opens the metrics database (WAL mode, safe for concurrent CLI processes)."""
+    conn = sqlite3.connect(METRICS_DB, timeout=30, isolation_level=None)
+    try:
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL") # No fsync per request; losing the last few records on power loss is fine
+        conn.execute("CREATE TABLE IF NOT EXISTS requests (id INTEGER PRIMARY KEY AUTOINCREMENT, record TEXT)")
+        conn.execute("CREATE TABLE IF NOT EXISTS series (name TEXT PRIMARY KEY, value REAL)")
+        yield conn
+    finally:
+        conn.close()
+
+
+def _observe(deltas, name, labels, value, buckets):
+    """Adds one histogram observation to `deltas` (cumulative buckets, _sum and _count)."""
+    increments = [(f'_bucket{{{labels},le="{le}"}}', 1) for le in buckets if value <= le]
+    increments += [(f'_bucket{{{labels},le="+Inf"}}', 1), (f"_sum{{{labels}}}", value), (f"_count{{{labels}}}", 1)]
+    for suffix, amount in increments:
+        deltas[name + suffix] = deltas.get(name + suffix, 0) + amount
+
+
+def series_deltas(record, gaps=()):
+    """The counter and histogram increments one request contributes."""
+    labels = f'source="{record["source"]}"'
+    deltas = {f'llama_client_requests_total{{{labels},status="{record["status"]}"}}': 1}
+    if record["status"] != "ok":
+        return deltas
+    if record.get("elapsed_s") is not None:
+        _observe(deltas, "llama_client_request_seconds", labels, record["elapsed_s"], DURATION_BUCKETS)
+    if record.get("ttft_s") is not None:
+        _observe(deltas, "llama_client_ttft_seconds", labels, record["ttft_s"], TTFT_BUCKETS)
+    for gap in gaps:
+        _observe(deltas, "llama_client_inter_token_seconds", labels, gap, ITL_BUCKETS)
+    for field, name, scale in (("predicted_n", "llama_client_tokens_predicted_total", 1),
+                               ("tokens_evaluated", "llama_client_prompt_tokens_total", 1),
+                               ("prompt_n", "llama_client_prompt_tokens_processed_total", 1),
+                               ("prompt_reused", "llama_client_prompt_tokens_reused_total", 1),
+                               ("prompt_ms", "llama_client_prompt_eval_seconds_total", 0.001),
+                               ("predicted_ms", "llama_client_generation_seconds_total", 0.001),
+                               ("draft_n", "llama_client_draft_tokens_total", 1),
+                               ("draft_n_accepted", "llama_client_draft_tokens_accepted_total", 1)):
+        if record.get(field) is not None:
+            deltas[f"{name}{{{labels}}}"] = record[field] * scale
+    return deltas
+
+
+def record_request(record, gaps=()):
+    """
+    Appends a record to the ring buffer and adds it to the cumulative series.
+    `gaps` are the raw inter-token gaps for the histogram. Metrics must never break a
+    request, so storage errors are swallowed; returns False if the record was dropped.
+    """
+    try:
+        with _db() as conn:
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                cursor = conn.execute("INSERT INTO requests (record) VALUES (?)", (json.dumps(record),))
+                conn.execute("DELETE FROM requests WHERE id <= ?", (cursor.lastrowid - RING_SIZE,))
+                conn.executemany(
+                    "INSERT INTO series (name, value) VALUES (?, ?) ON CONFLICT(name) DO UPDATE SET value = value + excluded.value",
+                    series_deltas(record, gaps).items())
+                conn.execute("COMMIT")
+            except Exception:
+                conn.execute("ROLLBACK")
+                raise
+        return True
+    except (sqlite3.Error, OSError):
+        return False
+
+
+def record_timer(timer, status="ok"):
+    """Finishes a RequestTimer and records it. Returns the record."""
+    record = timer.finish(status)
+    record_request(record, timer.gaps)
+    return record
+
+
+def recent(limit=20):
+    """The last `limit` request records, oldest first."""
+    with _db() as conn:
+        rows = conn.execute("SELECT record FROM requests ORDER BY id DESC LIMIT ?", (limit,)).fetchall()
+    return [json.loads(row[0]) for row in reversed(rows)]
+
+
+def series():
+    """Current cumulative client series: {series name with labels: value}."""
+    with _db() as conn:
+        return dict(conn.execute("SELECT name, value FROM series").fetchall())
+
+
+# --- Server Metrics ---
+
+def parse_prometheus(text):
+    """Parses Prometheus text exposition into {metric name (with labels): float}."""
+    metrics = {}
+    for line in text.splitlines():
+        line = line.strip()
+        if not line or line.startswith("#"):
+            continue
+        name, _, value = line.rpartition(" ")
+        try:
+            metrics[name] = float(value)
+        except ValueError:
+            continue
+    return metrics
+
+
+def fetch_metrics_text(port, host=llama_ready.HOST, timeout=5):
+    """Raw /metrics text of a llama-server, or None if unavailable (it needs --metrics)."""
+    conn = http.client.HTTPConnection(host, port, timeout=timeout)
+    try:
+        conn.request("GET", "/metrics")
+        response = conn.getresponse()
+        body = response.read()
+        return body.decode("utf-8", "replace") if response.status == 200 else None
+    except (OSError, http.client.HTTPException):
+        return None
+    finally:
+        conn.close()
+
+
+def scrape_metrics(port, host=llama_ready.HOST, timeout=5):
+    """Returns the server's /metrics as a dict, or None if unavailable."""
+    text = fetch_metrics_text(port, host, timeout)
+    return parse_prometheus(text) if text is not None else None
+
+
+def server_ports():
+    """Ports to scrape: the pool instances if a pool is configured, else the single server."""
+    instances = llama_pool.read_pool_state()['instances']
+    return [i['port'] for i in instances] if instances else [llama_man.PORT]
+
+
+def _sample_key(name):
+    """Orders a histogram's samples per label set: buckets by increasing `le`, then _sum, _count."""
+    base, _, labels = name.partition("{")
+    le = float("inf")
+    rest = []
+    for label in labels.rstrip("}").split(","):
+        if label.startswith("le="):
+            value = label[4:-1]
+            le = float(value) if value != "+Inf" else float("inf")
+        else:
+            rest.append(label)
+    rank = 1 if base.endswith("_sum") else 2 if base.endswith("_count") else 0
+    return (",".join(rest), rank, le)
+
+
+def _format_value(value):
+    """A sample value at full precision (`:g` would round counters past 1e6): integers as such, floats by repr."""
+    value = float(value)
+    if value.is_integer() and abs(value) < 2 ** 53:
+        return str(int(value))
+    return repr(value)
+
+
+def _add_label(sample, label):
+    """Inserts `label` (e.g. 'port="8012"') into a sample line's label set."""
+    name, _, value = sample.rpartition(" ")
+    if name.endswith("}"):
+        return f"{name[:-1]},{label}}} {value}"
+    return f"{name}{{{label}}} {value}"
+
+
+# --- Exposition ---
+
+def prometheus_text(ports=None, client_series=None):
+    """
+    Prometheus text exposition of the client series plus the /metrics of every server in
+    `ports` (default server_ports()), each sample labelled with its port. Servers that do not
+    answer are reported through llama_server_up.
+    """
+    client_series = series() if client_series is None else client_series
+    lines = []
+    for family, (kind, help_text) in _FAMILIES.items():
+        samples = sorted(((name, value) for name, value in client_series.items()
+                          if name.split("{")[0] in (family, f"{family}_bucket", f"{family}_sum", f"{family}_count")),
+                         key=lambda item: _sample_key(item[0]))
+        if not samples:
+            continue
+        lines += [f"# HELP {family} {help_text}", f"# TYPE {family} {kind}"]
+        lines += [f"{name} {_format_value(value)}" for name, value in samples]
+
+    families, order, up = {}, [], []
+    for port in server_ports() if ports is None else ports:
+        text = fetch_metrics_text(port)
+        up.append(f'llama_server_up{{port="{port}"}} {0 if text is None else 1}')
+        for line in (text or "").splitlines():
+            line = line.strip()
+            if not line:
+                continue
+            if line.startswith("#"):
+                parts = line.split(None, 3)
+                if len(parts) >= 3 and parts[1] in ("HELP", "TYPE"):
+                    family = families.setdefault(parts[2], {"meta": {}, "samples": []})
+                    family["meta"].setdefault(parts[1], line)
+                    if parts[2] not in order:
+                        order.append(parts[2])
+                continue
+            name = line.split("{")[0].split(" ")[0]
+            base = next((f for f in (name, name.rsplit("_", 1)[0]) if f in families), name)
+            if base not in families:
+                families[base] = {"meta": {}, "samples": []}
+                order.append(base)
+            families[base]["samples"].append(_add_label(line, f'port="{port}"'))
+
+    lines += ["# HELP llama_server_up Whether the llama-server /metrics endpoint answered the scrape.",
+              "# TYPE llama_server_up gauge"] + up
+    for name in order:
+        family = families[name]
+        lines += [family["meta"][k] for k in ("HELP", "TYPE") if k in family["meta"]]
+        lines += family["samples"]
+    return "\n".join(lines) + "\n"
+
+
+def make_server(port=EXPORT_PORT, host=llama_ready.HOST, ports=None):
+    """Creates (but does not start) an HTTP server exporting prometheus_text() on /metrics."""
+    class Handler(BaseHTTPRequestHandler):
+        def log_message(self, format, *args):
+            pass
+
+        def do_GET(self):
+            if self.path != "/metrics":
+                self.send_error(404)
+                return
+            payload = prometheus_text(ports).encode()
+            self.send_response(200)
+            self.send_header("Content-Type", "text/plain; version=0.0.4")
+            self.send_header("Content-Length", str(len(payload)))
+            self.end_headers()
+            self.wfile.write(payload)
+
+    httpd = ThreadingHTTPServer((host, port), Handler)
+    httpd.daemon_threads = True
+    return httpd
@@ -0,0 +1,361 @@
+# llama_models.py
+"""
+Several GGUF models, each served by its own llama-server process, within a memory budget.
+
+Models are registered by name in MODELS_FILENAME (path plus optional ctx_size, parallel,
+mem_mb, embedding, for a server that answers /embedding, and draft_model/draft_max/draft_min,
+a launch profile pairing the model with a small draft model for speculative decoding).
+ensure_model(name) returns the port of that model's server, starting it when it is not
+resident. Before a start, the memory the new process needs is estimated from the GGUF header
+(weights plus KV cache for its context settings, see llama_gguf); while the resident models
+plus the new one would exceed the budget, the least recently used idle model is stopped (its
+slots saved first). The single server managed by llama_man counts against the budget but is
+never evicted.
+
+Resident processes, last use and hit/load/eviction counters live in MODELS_STATE_FILENAME,
+updated under an flock so concurrent CLI processes agree on what is loaded.
+"""
+import os
+import json
+import time
+import socket
+
+import llama_man
+import llama_pid
+import llama_lock
+import llama_gguf
+import llama_logs
+import llama_pool
+import llama_ready
+import llama_slots
+
+# --- Model Registry Configuration ---
+MODELS_FILENAME = ".llama_models.json"              # name -> {path, ctx_size, parallel, mem_mb, embedding, draft_model, ...}
+MODELS_STATE_FILENAME = ".llama_models_state.json"  # Resident processes and counters
+MODELS_BASE_PORT = 8200      # Model servers get the first free port from here on
+MEMORY_BUDGET_MB = None      # None: BUDGET_FRACTION of physical memory
+BUDGET_FRACTION = 0.8
+DEFAULT_CTX_ESTIMATE = 4096  # Context assumed for ctx_size 0 when the GGUF header cannot be read
+KV_KB_PER_TOKEN_PER_GB = 32  # Rough f16 KV cache per context token, per GB of weights (same fallback)
+# --- End Configuration ---
+
+
+# --- Registry ---
+
+def read_registry():
+    """Registered models as a dict name -> entry dict (with at least 'path')."""
+    try:
+        with open(MODELS_FILENAME, 'r') as f:
+            registry = json.load(f)
+    except (IOError, ValueError):
+        return {}
+    models = registry.get('models') if isinstance(registry, dict) else None
+    if not isinstance(models, dict):
+        return {}
+    return {name: entry for name, entry in models.items() if isinstance(entry, dict) and entry.get('path')}
+
+def write_registry(models):
+    """Atomically replaces the registry. Returns True on success, False on error."""
+    tmp_path = f"{MODELS_FILENAME}.tmp"
+    try:
+        with open(tmp_path, 'w') as f:
+            json.dump({'models': models}, f, indent=2)
+        os.replace(tmp_path, MODELS_FILENAME)
+        return True
+    except OSError:
+        return False
+
+def add_model(name, path, ctx_size=None, parallel=None, mem_mb=None, embedding=False, draft=None, draft_max=None, draft_min=None):
+    """
+    Registers (or updates) a model; with `embedding` its server is started with --embedding.
+    With `draft` (a GGUF path) its server drafts with that model (-md, --draft-max/--draft-min);
+    the pair is refused unless the vocabularies match (llama_man.check_draft).
+    Returns tuple (success: bool, message: str).
+    """
+    if not os.path.exists(path):
+        return False, f"Model file not found: '{path}'."
+    if draft:
+        if not os.path.exists(draft):
+            return False, f"Draft model file not found: '{draft}'."
+        _, error = llama_man.check_draft(path, draft)
+        if error:
+            return False, error
+        draft = os.path.abspath(draft)
+    models = read_registry()
+    entry = {'path': os.path.abspath(path)}
+    for key, value in (('ctx_size', ctx_size), ('parallel', parallel), ('mem_mb', mem_mb),
+                       ('draft_model', draft), ('draft_max', draft_max if draft else None),
+                       ('draft_min', draft_min if draft else None)):
+        if value is not None:
+            entry[key] = value
+    if embedding:
+        entry['embedding'] = True
+    models[name] = entry
+    if not write_registry(models):
+        return False, f"Could not write '{MODELS_FILENAME}'."
+    return True, f"Registered '{name}' ({estimate_mb(entry):.0f} MB estimated)."
+
+def remove_model(name):
+    """Unloads and unregisters a model. Returns tuple (success: bool, message: str)."""
+    models = read_registry()
+    if name not in models:
+        return False, f"Unknown model '{name}'."
+    success, message = unload_model(name)
+    if not success:
+        return False, message
+    del models[name]
+    write_registry(models)
+    return True, f"Removed '{name}'."
+
+
+# --- Memory Estimate ---
+
+def estimate_mb(entry):
+    """
+    Memory a model's server needs: the entry's mem_mb if set, else llama_gguf.memory_estimate
+    for its ctx_size (plus that of its draft model). Files whose header cannot be read are estimated from their size, with a
+    KV cache proportional to context length and model size.
+    """
+    if entry.get('mem_mb'):
+        return float(entry['mem_mb'])
+    draft_mb = estimate_mb({'path': entry['draft_model'], 'ctx_size': entry.get('ctx_size')}) if entry.get('draft_model') else 0.0
+    try:
+        return llama_gguf.memory_estimate(llama_gguf.read_gguf(entry['path']), entry.get('ctx_size') or 0)['total_mb'] + draft_mb
+    except (llama_gguf.GGUFError, OSError):
+        pass
+    try:
+        weights_mb = os.path.getsize(entry['path']) / (1 << 20)
+    except OSError:
+        weights_mb = 0.0
+    ctx = entry.get('ctx_size') or DEFAULT_CTX_ESTIMATE
+    kv_mb = ctx * KV_KB_PER_TOKEN_PER_GB * (weights_mb / 1024) / 1024
+    return weights_mb + kv_mb + llama_gguf.RUNTIME_OVERHEAD_MB + draft_mb
+
+def memory_budget_mb():
+    """MEMORY_BUDGET_MB, or BUDGET_FRACTION of physical memory."""
+    if MEMORY_BUDGET_MB:
+        return float(MEMORY_BUDGET_MB)
+    try:
+        total = os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES')
+    except (ValueError, OSError, AttributeError):
+        total = 8 << 30
+    return total / (1 << 20) * BUDGET_FRACTION
+
+def single_server_mb():
+    """Estimate for the single llama_man server if it is running (it is never evicted)."""
+    if llama_man.status_llama_server()[0] != "RUNNING":
+        return 0.0
+    return estimate_mb({'path': llama_man.MODEL_PATH, 'ctx_size': llama_man.CTX_SIZE})
+
+
+# --- Resident State ---
+
+def read_state():
+    """{'resident': {name: {pid, start_time, port, mem_mb, last_used}}, 'counters': {name: {...}}}"""
+    try:
+        with open(MODELS_STATE_FILENAME, 'r') as f:
+            state = json.load(f)
+        if isinstance(state, dict):
+            state.setdefault('resident', {})
+            state.setdefault('counters', {})
+            return state
+    except (IOError, ValueError):
+        pass
+    return {'resident': {}, 'counters': {}}
+
+def write_state(state):
+    tmp_path = f"{MODELS_STATE_FILENAME}.tmp"
+    try:
+        with open(tmp_path, 'w') as f:
+            json.dump(state, f, indent=2)
+        os.replace(tmp_path, MODELS_STATE_FILENAME)
+        return True
+    except OSError:
+        return False
+
+def _count(state, name, counter):
+    counters = state['counters'].setdefault(name, {'hits': 0, 'loads': 0, 'evictions': 0})
+    counters[counter] += 1
+
+def _alive(resident):
+    return llama_pid.is_process_running(resident.get('pid'), resident.get('start_time'))
+
+def _prune(state):
+    """Drops resident entries whose process has exited."""
+    for name in [n for n, r in state['resident'].items() if not _alive(r)]:
+        del state['resident'][name]
+
+def _free_port(used):
+    port = MODELS_BASE_PORT
+    while True:
+        if port not in used and port != llama_man.PORT:
+            with socket.socket() as probe:
+                try:
+                    probe.bind((llama_ready.HOST, port))
+                    return port
+                except OSError:
+                    pass
+        port += 1
+
+def _stop(name, resident):
+    """Saves the slots of a resident model and stops it. Returns tuple (success, message)."""
+    slot_dir = llama_man.slot_save_dir(resident.get('path'))
+    if slot_dir:
+        llama_slots.save_slots(resident['port'], resident.get('path'), slot_dir)
+    return llama_man.stop_process(resident['pid'], force=True, start_time=resident.get('start_time'))
+
+
+# --- Lifecycle ---
+
+def ensure_model(name):
+    """
+    Returns tuple (success: bool, message: str, port: int | None) for a registered model,
+    starting its server (and evicting least recently used models to fit the budget) if needed.
+    Waits until the server is ready. The state lock is only held to pick and launch: the model
+    loads outside it, so requests for resident models are not held up by a cold load.
+    """
+    entry = read_registry().get(name)
+    if entry is None:
+        return False, f"Unknown model '{name}'. Register it with `models add`.", None
+    if not os.path.exists(entry['path']):
+        return False, f"Model file not found: '{entry['path']}'.", None
+
+    process = None
+    with llama_lock.file_lock(MODELS_STATE_FILENAME + ".lock"):
+        state = read_state()
+        _prune(state)
+        resident = state['resident'].get(name)
+        if resident:
+            resident['last_used'] = time.time()
+            _count(state, name, 'hits')
+            write_state(state)
+            message = f"Model '{name}' resident on port {resident['port']}."
+        else:
+            success, message, resident, process = _load(name, entry, state)
+            write_state(state)
+            if not success:
+                return False, message, None
+    # A model another caller just launched may still be loading
+    ready_status, ready_message, elapsed = llama_ready.wait_for_ready(
+        resident['port'], process=process, is_alive=lambda: _alive(resident), timeout=llama_man.READY_TIMEOUT
+    )
+    if ready_status == llama_ready.CRASHED and process is not None:
+        _forget(name, resident)
+        llama_logs.wait_for_pump(process)
+        return False, (f"Model '{name}' failed on startup (exit code {process.poll()})."
+                       f"{llama_man.log_tail(process, llama_logs.log_path(name))}"), None
+    if ready_status != llama_ready.READY:
+        return False, f"Model '{name}' (PID {resident['pid']}) is not ready: {ready_message}", None
+    if process is not None:
+        slot_dir = llama_man.slot_save_dir(entry['path'])
+        if slot_dir:
+            llama_slots.restore_slots(resident['port'], entry['path'], slot_dir)
+        message += f" Ready in {elapsed:.2f}s."
+    return True, message, resident['port']
+
+def _forget(name, resident):
+    """Drops a resident entry that crashed while loading (unless the model was started again meanwhile)."""
+    with llama_lock.file_lock(MODELS_STATE_FILENAME + ".lock"):
+        state = read_state()
+        if state['resident'].get(name, {}).get('pid') == resident['pid']:
+            del state['resident'][name]
+            write_state(state)
+
+def _load(name, entry, state):
+    """
+    Evicts as needed and launches a model without waiting for it; records it in `state`.
+    Returns (success, message, resident entry, process).
+    """
+    needed = estimate_mb(entry)
+    budget = memory_budget_mb()
+    pinned = single_server_mb()
+    if needed + pinned > budget:
+        return False, f"Model '{name}' needs ~{needed:.0f} MB, over the {budget:.0f} MB budget.", None, None
+    evicted = []
+    for victim in sorted(state['resident'], key=lambda n: state['resident'][n].get('last_used', 0)):
+        if pinned + needed + sum(r['mem_mb'] for r in state['resident'].values()) <= budget:
+            break
+        resident = state['resident'][victim]
+        if llama_pool.busy_slots(resident['port']) or llama_ready.probe_health(resident['port'])[0] == llama_ready.LOADING:
+            continue # Generating for someone right now, or still loading for another caller
+        success, _ = _stop(victim, resident)
+        if success:
+            del state['resident'][victim]
+            _count(state, victim, 'evictions')
+            evicted.append(victim)
+    in_use = pinned + sum(r['mem_mb'] for r in state['resident'].values())
+    if in_use + needed > budget:
+        return False, (f"Model '{name}' needs ~{needed:.0f} MB but only {budget - in_use:.0f} MB of the "
+                       f"{budget:.0f} MB budget can be freed (resident models are busy)."), None, None
+
+    port = _free_port({r['port'] for r in state['resident'].values()})
+    params = {k: entry[k] for k in ('ctx_size', 'parallel', 'embedding', 'draft_model', 'draft_max', 'draft_min')
+              if entry.get(k) is not None}
+    if llama_man.MODEL_CHECK:
+        params, model_message = llama_man.check_model(entry['path'], params)
+        if params is None:
+            return False, model_message, None, None
+    command = llama_man.build_server_command(port=port, params=params, model_path=entry['path'])
+    slot_dir = llama_man.slot_save_dir(entry['path'])
+    if slot_dir:
+        os.makedirs(slot_dir, exist_ok=True)
+    try:
+        if llama_man.PREFETCH_MODEL:
+            llama_gguf.prefetch(entry['path'])
+        process = llama_man.spawn_server_process(command, log_path=llama_logs.log_path(name))
+    except OSError as e:
+        return False, f"Failed to start model '{name}': {e}", None, None
+    resident = {'pid': process.pid, 'start_time': llama_pid.process_start_time(process.pid), 'port': port,
+                'path': entry['path'], 'mem_mb': round(needed, 1), 'last_used': time.time(), 'started_at': time.time()}
+    state['resident'][name] = resident
+    _count(state, name, 'loads')
+    message = f"Loaded model '{name}' on port {port} (~{needed:.0f} MB)."
+    if evicted:
+        message += f" Evicted: {', '.join(evicted)}."
+    return True, message, resident, process
+
+def unload_model(name):
+    """Stops a resident model. Returns tuple (success: bool, message: str)."""
+    with llama_lock.file_lock(MODELS_STATE_FILENAME + ".lock"):
+        state = read_state()
+        _prune(state)
+        resident = state['resident'].get(name)
+        if not resident:
+            write_state(state)
+            return True, f"Model '{name}' is not resident."
+        success, message = _stop(name, resident)
+        if success:
+            del state['resident'][name]
+        write_state(state)
+    return success, f"Model '{name}': {message}"
+
+def unload_all():
+    """Stops every resident model. Returns tuple (success: bool, messages: list[str])."""
+    ok, messages = True, []
+    for name in list(read_state()['resident']):
+        success, message = unload_model(name)
+        ok = ok and success
+        messages.append(message)
+    return ok, messages
+
+def status_models():
+    """
+    One row per registered (or still resident) model: name, path, resident, port, pid,
+    estimated and actual (RSS) MB, last use and hit/load/eviction counters.
+    """
+    registry = read_registry()
+    state = read_state()
+    _prune(state)
+    rows = []
+    for name in sorted(set(registry) | set(state['resident'])):
+        resident = state['resident'].get(name)
+        entry = registry.get(name) or {'path': resident['path']}
+        rows.append({
+            'name': name, 'path': entry['path'], 'resident': bool(resident),
+            'port': resident['port'] if resident else None, 'pid': resident['pid'] if resident else None,
+            'estimate_mb': round(resident['mem_mb'] if resident else estimate_mb(entry), 1),
+            'rss_mb': llama_pid.resident_mb(resident['pid']) if resident else None,
+            'last_used': resident['last_used'] if resident else None,
+            **state['counters'].get(name, {'hits': 0, 'loads': 0, 'evictions': 0}),
+        })
+    return rows
@@ -1,34 +1,95 @@
 # llama_pid.py
+"""
+State record of the managed llama-server process.
+
+PID_FILENAME holds one JSON record (PID, process start time, port, launch command, wall-clock
+start) replaced atomically, so readers never see a half-written file. The process start time
+as the OS reports it lets is_process_running tell the server from an unrelated process that
+later got the same PID. Plain-integer files from older versions are still read.
+
+Starting the server happens under state_lock(), an flock on PID_FILENAME + '.lock', so when
+several CLI processes find the server stopped only one of them launches it. wait_for_exit
+blocks on a pidfd (Linux) or kqueue (macOS/BSD) instead of polling.
+"""
 import os
 import sys
-import subprocess
+import json
+import time
 import errno
+import select
+import threading
+import contextlib
+import subprocess
+
+import llama_lock
 
 PID_FILENAME = ".llama_server.pid"
+LOCK_SUFFIX = ".lock"
 
-def read_pid():
-    """Reads the PID from the PID file. Returns integer PID or None."""
+# --- State Record ---
+
+def read_state():
+    """Reads the state record. Returns a dict with at least 'pid', or None."""
     try:
-        if os.path.exists(PID_FILENAME):
-            with open(PID_FILENAME, 'r') as f:
-                pid_str = f.read().strip()
-                if pid_str:
-                    return int(pid_str)
-    except (IOError, ValueError):
-        pass
+        with open(PID_FILENAME, 'r') as f:
+            content = f.read().strip()
+    except (IOError, OSError):
+        return None
+    if not content:
+        return None
+    try:
+        state = json.loads(content)
+    except ValueError:
+        return None
+    if isinstance(state, int): # Plain PID written by older versions
+        state = {'pid': state}
+    if not isinstance(state, dict) or not isinstance(state.get('pid'), int):
+        return None
+    return state
+
+def read_pid():
+    """Reads the PID from the state record. Returns integer PID or None."""
+    state = read_state()
+    return state['pid'] if state else None
+
+def recorded_start_time(pid):
+    """The process start time recorded with `pid`, or None if the record is for another PID or has none."""
+    state = read_state()
+    if state and state['pid'] == pid:
+        return state.get('start_time')
     return None
 
-def write_pid(pid):
-    """Writes the PID to the PID file. Returns True on success, False on error."""
+def write_pid(pid, port=None, command=None):
+    """Atomically writes the state record for a launched server. Returns True on success, False on error."""
+    return _write_state({'pid': pid, 'start_time': process_start_time(pid), 'port': port, 'command': command,
+                         'started_at': time.time()})
+
+def mark_stopping(pid, stopping=True):
+    """
+    Flags the record of `pid` as being stopped on purpose (or clears the flag), so a
+    supervisor watching the process does not restart it. Returns True if the record was updated.
+    """
+    state = read_state()
+    if not state or state['pid'] != pid:
+        return False
+    if stopping:
+        state['stopping'] = True
+    else:
+        state.pop('stopping', None)
+    return _write_state(state)
+
+def _write_state(state):
+    tmp_path = f"{PID_FILENAME}.tmp"
     try:
-        with open(PID_FILENAME, 'w') as f:
-            f.write(str(pid))
+        with open(tmp_path, 'w') as f:
+            json.dump(state, f)
+        os.replace(tmp_path, PID_FILENAME)
         return True
-    except IOError:
+    except (IOError, OSError):
         return False
 
 def delete_pid_file():
-    """Deletes the PID file if it exists. Returns True if deleted or not found, False on error."""
+    """Deletes the state record if it exists. Returns True if deleted or not found, False on error."""
     try:
         if os.path.exists(PID_FILENAME):
             os.remove(PID_FILENAME)
@@ -36,8 +97,77 @@ def delete_pid_file():
     except OSError:
         return False
 
-def is_process_running(pid):
-    """Checks if a process with the given PID is running. Returns True/False."""
+_held = threading.local()
+
+@contextlib.contextmanager
+def state_lock(wait_message=None):
+    """
+    Exclusive lock serialising server starts across processes and threads. Re-entrant within
+    a thread. `wait_message` is printed if another holder makes this caller wait.
+    """
+    if getattr(_held, 'depth', 0):
+        _held.depth += 1
+        try:
+            yield
+        finally:
+            _held.depth -= 1
+        return
+    lock_path = PID_FILENAME + LOCK_SUFFIX
+    with contextlib.ExitStack() as stack:
+        try:
+            stack.enter_context(llama_lock.file_lock(lock_path, blocking=False))
+        except llama_lock.LockBusy:
+            if wait_message:
+                print(wait_message)
+            stack.enter_context(llama_lock.file_lock(lock_path))
+        _held.depth = 1
+        try:
+            yield
+        finally:
+            _held.depth = 0
+
+# --- Processes ---
+
+def process_start_time(pid):
+    """
+    When the OS says process `pid` started, as an opaque comparable value (clock ticks since
+    boot on Linux, `ps` lstart text elsewhere). None if unknown or the process is gone.
+    """
+    if pid is None or sys.platform == 'win32':
+        return None
+    try:
+        with open(f"/proc/{pid}/stat", 'rb') as f:
+            stat = f.read()
+        # Field 22; the command name (field 2) may contain spaces, so count from its closing ')'
+        return int(stat[stat.rindex(b')') + 2:].split()[19])
+    except FileNotFoundError:
+        if os.path.isdir("/proc/self"):
+            return None # Linux without this PID: not running
+    except (OSError, ValueError, IndexError):
+        return None
+    try:
+        output = subprocess.run(['ps', '-o', 'lstart=', '-p', str(pid)], capture_output=True, text=True, timeout=5)
+    except (OSError, subprocess.SubprocessError):
+        return None
+    return output.stdout.strip() or None
+
+def resident_mb(pid):
+    """Resident memory of a process in MB (Linux /proc), or None."""
+    try:
+        with open(f"/proc/{pid}/status", 'r') as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    return round(int(line.split()[1]) / 1024, 1)
+    except (OSError, ValueError, IndexError):
+        pass
+    return None
+
+def is_process_running(pid, start_time=None):
+    """
+    Checks if a process with the given PID is running. Returns True/False.
+    With `start_time` (from process_start_time), a process that started at another time, i.e.
+    a reuse of the PID, does not count.
+    """
     if pid is None:
         return False
     if sys.platform == 'win32':
@@ -53,11 +183,70 @@ def is_process_running(pid):
         except Exception:
             return False
     else: # Linux, macOS, other Unix-like
+        try:
+            # An exited child of this process stays a zombie (and answers kill 0) until reaped.
+            # WNOWAIT leaves it to be reaped by its owner, so a Popen still sees the exit code.
+            if hasattr(os, 'waitid') and os.waitid(os.P_PID, pid, os.WEXITED | os.WNOHANG | os.WNOWAIT):
+                return False
+        except ChildProcessError:
+            pass # Not our child; fall through to the signal probe
+        except OSError:
+            pass
         try:
             os.kill(pid, 0)
         except OSError as err:
-            if err.errno == errno.EPERM:
-                return True
-            return False
-        else:
-            return True
\ No newline at end of file
+            if err.errno != errno.EPERM:
+                return False
+        if start_time is not None:
+            current = process_start_time(pid)
+            if current is not None and current != start_time:
+                return False # PID reused by another process
+        return True
+
+def _wait_exit_event(pid, timeout):
+    """
+    Blocks until the kernel reports that `pid` exited or `timeout` passes.
+    Returns False when the platform has no exit notification.
+    """
+    if hasattr(os, 'pidfd_open'): # Linux 5.3+
+        try:
+            fd = os.pidfd_open(pid)
+        except ProcessLookupError:
+            return True
+        except OSError:
+            fd = None # Kernel without pidfd
+        if fd is not None:
+            try:
+                select.select([fd], [], [], timeout) # Readable once the process has exited
+            finally:
+                os.close(fd)
+            return True
+    if hasattr(select, 'kqueue'): # macOS, BSD
+        kq = select.kqueue()
+        try:
+            event = select.kevent(pid, filter=select.KQ_FILTER_PROC,
+                                  flags=select.KQ_EV_ADD | select.KQ_EV_ONESHOT, fflags=select.KQ_NOTE_EXIT)
+            kq.control([event], 1, timeout)
+        except ProcessLookupError:
+            pass
+        finally:
+            kq.close()
+        return True
+    return False
+
+def wait_for_exit(pid, timeout, start_time=None):
+    """
+    Waits up to `timeout` seconds for process `pid` to exit, returning as soon as it does.
+    Returns True if the process is gone (see is_process_running for `start_time`).
+    """
+    if not is_process_running(pid, start_time):
+        return True
+    deadline = time.monotonic() + timeout
+    while True:
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            return not is_process_running(pid, start_time)
+        if not _wait_exit_event(pid, remaining):
+            time.sleep(min(0.05, remaining)) # Windows: no exit notification for arbitrary PIDs
+        if not is_process_running(pid, start_time): # Also reaps a child of this process
+            return True
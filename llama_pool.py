@@ -0,0 +1,283 @@
+# llama_pool.py
+import os
+import json
+import time
+import random
+import threading
+import http.client
+
+import llama_man
+import llama_pid
+import llama_logs
+import llama_ready
+
+POOL_STATE_FILENAME = ".llama_pool.json"
+SLOTS_TIMEOUT = 1.0 # Seconds allowed for each instance's /slots query when picking a target
+
+# --- Pool State File ---
+
+def read_pool_state():
+    """Reads the pool state file. Returns a dict with an 'instances' list (empty if no pool)."""
+    try:
+        with open(POOL_STATE_FILENAME, 'r') as f:
+            state = json.load(f)
+        if isinstance(state, dict) and isinstance(state.get('instances'), list):
+            return state
+    except (IOError, ValueError):
+        pass
+    return {'instances': []}
+
+def write_pool_state(state):
+    """Atomically replaces the pool state file. Returns True on success, False on error."""
+    tmp_path = f"{POOL_STATE_FILENAME}.tmp"
+    try:
+        with open(tmp_path, 'w') as f:
+            json.dump(state, f, indent=2)
+        os.replace(tmp_path, POOL_STATE_FILENAME)
+        return True
+    except OSError:
+        return False
+
+def delete_pool_state():
+    try:
+        if os.path.exists(POOL_STATE_FILENAME):
+            os.remove(POOL_STATE_FILENAME)
+        return True
+    except OSError:
+        return False
+
+# --- Planning ---
+
+def available_cpus():
+    """CPU ids this process may run on (honours an existing affinity mask on Linux)."""
+    if hasattr(os, 'sched_getaffinity'):
+        return sorted(os.sched_getaffinity(0))
+    return list(range(os.cpu_count() or 1))
+
+def plan_instances(count, base_port=None, threads=None, pin_cpus=False):
+    """
+    Plans `count` instances on consecutive ports starting at `base_port` (default llama_man.PORT).
+    Threads default to an even share of the available CPUs. With `pin_cpus`, each instance gets
+    its own contiguous block of CPUs. Returns a list of instance dicts (no processes started).
+    """
+    base_port = base_port or llama_man.PORT
+    cpus = available_cpus()
+    share = max(1, len(cpus) // count)
+    instances = []
+    for index in range(count):
+        instance = {'index': index, 'port': base_port + index, 'threads': threads or share, 'cpus': None}
+        if pin_cpus:
+            block = cpus[index * share:(index + 1) * share] or cpus
+            instance['cpus'] = block
+        instances.append(instance)
+    return instances
+
+# --- Lifecycle ---
+
+def _launch(instance):
+    """Spawns one instance. Returns (True, Popen) on success, (False, error message) otherwise."""
+    command = llama_man.build_server_command(port=instance['port'], threads=instance['threads'])
+    try:
+        process = llama_man.spawn_server_process(command, cpus=instance.get('cpus'),
+                                                 log_path=llama_logs.log_path(instance['port']))
+    except OSError as e:
+        return False, f"instance {instance['index']} (port {instance['port']}): failed to launch: {e}"
+    instance['pid'] = process.pid
+    instance['start_time'] = llama_pid.process_start_time(process.pid) # Lets a reused PID be told apart
+    instance['started_at'] = time.time()
+    return True, process
+
+def _wait(instance, process):
+    """Waits for a spawned instance to be ready. Returns tuple (success: bool, message: str)."""
+    status, message, elapsed = llama_ready.wait_for_ready(
+        instance['port'], process=process, timeout=llama_man.READY_TIMEOUT
+    )
+    label = f"instance {instance['index']} (port {instance['port']}, PID {instance['pid']})"
+    if status == llama_ready.READY:
+        instance['time_to_ready'] = round(elapsed, 3)
+        return True, f"{label}: ready in {elapsed:.3f}s"
+    if status == llama_ready.CRASHED:
+        llama_logs.wait_for_pump(process)
+    return False, f"{label}: {message}{llama_man.log_tail(process, llama_logs.log_path(instance['port']))}"
+
+def live_instances(state=None):
+    """Instances from the state file whose process is still alive."""
+    state = state or read_pool_state()
+    return [i for i in state['instances'] if llama_pid.is_process_running(i.get('pid'), i.get('start_time'))]
+
+def start_pool(count, base_port=None, threads=None, pin_cpus=False):
+    """
+    Starts `count` llama-server instances on consecutive ports and records them in the state file.
+    All instances load in parallel; the call returns once every instance is ready or has failed.
+    Returns tuple (success: bool, messages: list[str]).
+    """
+    if live_instances():
+        return False, ["Pool already running. Stop it first or use restart."]
+    path_error = llama_man.check_paths()
+    if path_error:
+        return False, [path_error]
+
+    instances = plan_instances(count, base_port=base_port, threads=threads, pin_cpus=pin_cpus)
+    single_pid = llama_pid.read_pid()
+    if single_pid and llama_man.is_server_process(single_pid) and any(i['port'] == llama_man.PORT for i in instances):
+        return False, [f"Single server PID {single_pid} already uses port {llama_man.PORT}. Stop it or pick another --base-port."]
+
+    launched, messages, ok = [], [], True
+    for instance in instances:
+        success, result = _launch(instance)
+        if success:
+            launched.append((instance, result))
+        else:
+            ok = False
+            messages.append(result)
+    # Record PIDs before waiting so a concurrent 'pool stop' can find loading instances
+    write_pool_state({'instances': [i for i, _ in launched]})
+
+    ready = []
+    for instance, process in launched:
+        success, message = _wait(instance, process)
+        messages.append(message)
+        if success:
+            ready.append(instance)
+        else:
+            ok = False
+            if process.poll() is None:
+                ready.append(instance) # Still loading; keep tracking it so stop can reach it
+    write_pool_state({'instances': ready})
+    return ok, messages
+
+def stop_pool(force=False):
+    """Stops every pool instance. Returns tuple (success: bool, messages: list[str])."""
+    state = read_pool_state()
+    if not state['instances']:
+        return True, ["No pool running (no pool state file)."]
+    ok, messages, remaining = True, [], []
+    for instance in state['instances']:
+        pid, start_time = instance.get('pid'), instance.get('start_time')
+        if not llama_pid.is_process_running(pid, start_time):
+            messages.append(f"instance {instance['index']}: stale PID {pid} cleaned up.")
+            continue
+        success, message = llama_man.stop_process(pid, force=force, start_time=start_time)
+        messages.append(f"instance {instance['index']} (port {instance['port']}): {message}")
+        if not success:
+            ok = False
+            remaining.append(instance)
+    if remaining:
+        write_pool_state({'instances': remaining})
+    else:
+        delete_pool_state()
+    return ok, messages
+
+def restart_pool(force=False):
+    """
+    Rolling restart: each instance is stopped, relaunched with the same settings and must be
+    ready before the next one is touched, so the rest of the pool keeps serving.
+    Returns tuple (success: bool, messages: list[str]).
+    """
+    state = read_pool_state()
+    if not state['instances']:
+        return False, ["No pool running (no pool state file)."]
+    messages = []
+    for instance in state['instances']:
+        pid, start_time = instance.get('pid'), instance.get('start_time')
+        if llama_pid.is_process_running(pid, start_time):
+            success, message = llama_man.stop_process(pid, force=force, start_time=start_time)
+            if not success:
+                messages.append(f"instance {instance['index']}: {message}")
+                return False, messages
+        success, result = _launch(instance)
+        if not success:
+            messages.append(result)
+            write_pool_state(state)
+            return False, messages
+        write_pool_state(state)
+        success, message = _wait(instance, result)
+        messages.append(message)
+        if not success:
+            return False, messages
+    write_pool_state(state)
+    return True, messages
+
+def status_pool():
+    """
+    Returns a list of instance dicts, each with 'state' set to READY, LOADING,
+    UNREACHABLE (process alive, HTTP not answering) or DEAD.
+    """
+    instances = []
+    for instance in read_pool_state()['instances']:
+        instance = dict(instance)
+        if not llama_pid.is_process_running(instance.get('pid'), instance.get('start_time')):
+            instance['state'] = 'DEAD'
+        else:
+            instance['state'], instance['detail'] = llama_ready.probe_health(instance['port'])
+        instances.append(instance)
+    return instances
+
+def healthy_ports():
+    """Ports of pool instances that answer /health with ready."""
+    return [i['port'] for i in status_pool() if i['state'] == llama_ready.READY]
+
+# --- Client-side Balancing ---
+
+class LeastOutstandingBalancer:
+    """
+    Picks the endpoint with the fewest requests outstanding from this process.
+    Ties are broken randomly so independent clients spread out. Endpoints that fail
+    are skipped for `cooldown` seconds. Thread-safe.
+    """
+
+    def __init__(self, endpoints, cooldown=5.0):
+        if not endpoints:
+            raise ValueError("LeastOutstandingBalancer needs at least one endpoint")
+        self.outstanding = {endpoint: 0 for endpoint in endpoints}
+        self.cooldown = cooldown
+        self._down_until = {}
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        """Reserves and returns the least loaded healthy endpoint (or the least loaded of all if none are)."""
+        with self._lock:
+            now = time.monotonic()
+            candidates = [e for e in self.outstanding if self._down_until.get(e, 0) <= now] or list(self.outstanding)
+            fewest = min(self.outstanding[e] for e in candidates)
+            endpoint = random.choice([e for e in candidates if self.outstanding[e] == fewest])
+            self.outstanding[endpoint] += 1
+            return endpoint
+
+    def release(self, endpoint, failed=False):
+        with self._lock:
+            self.outstanding[endpoint] -= 1
+            if failed:
+                self._down_until[endpoint] = time.monotonic() + self.cooldown
+
+def busy_slots(port, host=llama_ready.HOST):
+    """Number of slots currently processing on an instance (from /slots), or None if unavailable."""
+    conn = http.client.HTTPConnection(host, port, timeout=SLOTS_TIMEOUT)
+    try:
+        conn.request("GET", "/slots")
+        response = conn.getresponse()
+        body = response.read()
+        if response.status != 200:
+            return None
+        slots = json.loads(body)
+        return sum(1 for slot in slots if slot.get('is_processing') or slot.get('state', 0) != 0)
+    except (OSError, http.client.HTTPException, ValueError, AttributeError, TypeError):
+        return None
+    finally:
+        conn.close()
+
+def pick_instance_port():
+    """
+    Chooses a port for a one-shot request: the healthy instance with the fewest busy slots
+    as reported by the servers themselves (outstanding work from all clients).
+    Returns int port, or None when no pool instance is ready.
+    """
+    ports = healthy_ports()
+    if not ports:
+        return None
+    loads = {port: busy_slots(port) for port in ports}
+    known = {port: load for port, load in loads.items() if load is not None}
+    if not known:
+        return random.choice(ports)
+    fewest = min(known.values())
+    return random.choice([port for port, load in known.items() if load == fewest])
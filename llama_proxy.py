@@ -0,0 +1,139 @@
+# llama_proxy.py
+"""
+Small HTTP relay helpers shared by the local proxies (router, scheduler, ...).
+Upstream connections are kept alive and reused; response bodies are streamed
+through unchanged so SSE tokens reach the client as soon as llama-server sends them.
+"""
+import json
+import queue
+import http.client
+
+UPSTREAM_TIMEOUT = 600 # Seconds of upstream silence before a relayed request is abandoned
+HOP_BY_HOP = {"connection", "keep-alive", "transfer-encoding", "te", "trailer", "upgrade",
+              "proxy-authorization", "proxy-authenticate", "content-length"}
+TAIL_BYTES = 16384 # How much of each response body relay() keeps for inspection
+
+
+class UpstreamPool:
+    """Per-(host, port) pool of idle keep-alive HTTPConnections. Thread-safe."""
+
+    def __init__(self, max_idle=32, timeout=UPSTREAM_TIMEOUT):
+        self.max_idle = max_idle
+        self.timeout = timeout
+        self._idle = {}
+
+    def get(self, host, port):
+        idle = self._idle.get((host, port)) or self._idle.setdefault((host, port), queue.LifoQueue(self.max_idle))
+        try:
+            return idle.get_nowait()
+        except queue.Empty:
+            return http.client.HTTPConnection(host, port, timeout=self.timeout)
+
+    def put(self, host, port, conn):
+        try:
+            self._idle[(host, port)].put_nowait(conn)
+        except queue.Full:
+            conn.close()
+
+
+def read_body(handler):
+    """Reads the request body of a BaseHTTPRequestHandler (Content-Length only)."""
+    length = int(handler.headers.get("Content-Length", 0) or 0)
+    return handler.rfile.read(length) if length else b""
+
+
+def send_json(handler, status, data, headers=None):
+    """Writes a complete JSON response on a BaseHTTPRequestHandler."""
+    payload = json.dumps(data).encode()
+    handler.send_response(status)
+    handler.send_header("Content-Type", "application/json")
+    handler.send_header("Content-Length", str(len(payload)))
+    for name, value in (headers or {}).items():
+        handler.send_header(name, value)
+    handler.end_headers()
+    handler.wfile.write(payload)
+
+
+def relay(handler, pool, host, port, method, path, body=b"", extra_headers=None):
+    """
+    Forwards a request to host:port and streams the response back through `handler`.
+    `extra_headers` are added to the response sent to the client.
+    Returns tuple (status: int | None, tail: bytes) where tail is the end of the response
+    body (for reading llama-server's final SSE event), or status None if upstream failed
+    before answering (a 502 has been sent to the client in that case).
+    """
+    headers = {k: v for k, v in handler.headers.items() if k.lower() not in HOP_BY_HOP and k.lower() != "host"}
+    headers["Content-Length"] = str(len(body))
+    conn = pool.get(host, port)
+    try:
+        try:
+            conn.request(method, path, body=body, headers=headers)
+            response = conn.getresponse()
+        except (OSError, http.client.HTTPException):
+            # A pooled connection may have been closed by the server; retry once on a fresh one
+            conn.close()
+            conn = http.client.HTTPConnection(host, port, timeout=pool.timeout)
+            conn.request(method, path, body=body, headers=headers)
+            response = conn.getresponse()
+    except (OSError, http.client.HTTPException) as e:
+        conn.close()
+        send_json(handler, 502, {"error": {"code": 502, "message": f"upstream {host}:{port} failed: {e}", "type": "unavailable_error"}})
+        return None, b""
+
+    handler.send_response(response.status, response.reason)
+    for name, value in response.getheaders():
+        if name.lower() not in HOP_BY_HOP:
+            handler.send_header(name, value)
+    for name, value in (extra_headers or {}).items():
+        handler.send_header(name, value)
+    handler.send_header("Transfer-Encoding", "chunked")
+    handler.end_headers()
+
+    tail = b""
+    client_gone = False
+    try:
+        while True:
+            chunk = response.read1(65536)
+            if not chunk:
+                break
+            tail = (tail + chunk)[-TAIL_BYTES:]
+            try:
+                handler.wfile.write(b"%x\r\n%s\r\n" % (len(chunk), chunk))
+                handler.wfile.flush()
+            except OSError:
+                # Client went away: drop the upstream connection so llama-server stops generating
+                client_gone = True
+                break
+        if not client_gone:
+            handler.wfile.write(b"0\r\n\r\n")
+            handler.wfile.flush()
+    except (OSError, http.client.HTTPException):
+        client_gone = True
+    finally:
+        if client_gone:
+            handler.close_connection = True
+        if client_gone or response.will_close or not response.isclosed():
+            conn.close()
+        else:
+            pool.put(host, port, conn)
+    return response.status, tail
+
+
+def last_sse_event(tail):
+    """Parses the last complete `data:` JSON event (or a plain JSON body) from a response tail. Returns dict or None."""
+    text = tail.decode("utf-8", "replace").strip()
+    if not text.startswith("data:") and "\ndata:" not in text:
+        try:
+            data = json.loads(text)
+            return data if isinstance(data, dict) else None
+        except ValueError:
+            return None
+    for line in reversed(text.splitlines()):
+        line = line.strip()
+        if line.startswith("data:"):
+            try:
+                data = json.loads(line[5:].strip())
+                return data if isinstance(data, dict) else None
+            except ValueError:
+                continue
+    return None
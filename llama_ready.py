@@ -0,0 +1,113 @@
+# llama_ready.py
+import time
+import json
+import http.client
+
+# --- Readiness Configuration ---
+HOST = "127.0.0.1"
+READY_TIMEOUT = 300.0   # Overall deadline (seconds) for the server to become ready
+INITIAL_BACKOFF = 0.005 # First delay between /health probes (seconds)
+MAX_BACKOFF = 0.25      # Upper bound for the exponential backoff (seconds)
+PROBE_TIMEOUT = 2.0     # Socket timeout for a single /health request (seconds)
+# --- End Configuration ---
+
+# Probe states returned by probe_health()
+READY = "READY"               # /health answered 200, server accepts traffic
+LOADING = "LOADING"           # /health answered 503 (llama-server is loading the model)
+UNREACHABLE = "UNREACHABLE"   # Nothing listening yet (or connection dropped)
+
+# Final states returned by wait_for_ready()
+CRASHED = "CRASHED"
+TIMEOUT = "TIMEOUT"
+
+
+def probe_health(port, host=HOST, timeout=PROBE_TIMEOUT, conn=None):
+    """
+    Sends a single GET /health to llama-server.
+    Returns tuple (state: str, detail: str) where state is READY, LOADING or UNREACHABLE.
+    An existing http.client.HTTPConnection may be passed in to reuse the socket.
+    """
+    own_conn = conn is None
+    if own_conn:
+        conn = http.client.HTTPConnection(host, port, timeout=timeout)
+    try:
+        conn.request("GET", "/health")
+        response = conn.getresponse()
+        body = response.read()
+    except (OSError, http.client.HTTPException) as e:
+        conn.close()
+        return UNREACHABLE, str(e) or e.__class__.__name__
+    finally:
+        if own_conn:
+            conn.close()
+
+    detail = _health_detail(body)
+    if response.status == 200:
+        return READY, detail or "ok"
+    if response.status == 503:
+        return LOADING, detail or "loading model"
+    return UNREACHABLE, f"unexpected /health status {response.status}: {detail}"
+
+
+def _health_detail(body):
+    """Extracts a human readable status from a /health response body."""
+    try:
+        data = json.loads(body)
+    except (ValueError, UnicodeDecodeError):
+        return body.decode("utf-8", "replace").strip()
+    if isinstance(data, dict):
+        error = data.get("error")
+        if isinstance(error, dict) and error.get("message"):
+            return str(error["message"])
+        if data.get("status"):
+            return str(data["status"])
+    return ""
+
+
+def wait_for_ready(port, process=None, is_alive=None, host=HOST, timeout=READY_TIMEOUT):
+    """
+    Polls /health with exponential backoff until llama-server is ready, the process dies,
+    or the deadline passes.
+
+    Liveness is taken from `process.poll()` when a Popen object is given, otherwise from the
+    optional `is_alive()` callable (e.g. a PID check for a server started by another process).
+
+    Returns tuple (status: str, message: str, elapsed: float) where status is
+    READY, CRASHED or TIMEOUT and elapsed is the measured time-to-ready in seconds.
+    """
+    start = time.monotonic()
+    deadline = start + timeout
+    backoff = INITIAL_BACKOFF
+    last_state, last_detail = UNREACHABLE, "no probe sent"
+    conn = http.client.HTTPConnection(host, port, timeout=PROBE_TIMEOUT)
+
+    try:
+        while True:
+            exit_code = _exit_code(process, is_alive)
+            if exit_code is not None:
+                elapsed = time.monotonic() - start
+                return CRASHED, f"Server process exited during startup (exit code {exit_code}) after {elapsed:.2f}s.", elapsed
+
+            last_state, last_detail = probe_health(port, host=host, conn=conn)
+            elapsed = time.monotonic() - start
+            if last_state == READY:
+                return READY, f"Server ready on port {port} after {elapsed:.3f}s.", elapsed
+
+            now = time.monotonic()
+            if now >= deadline:
+                phase = "still loading model" if last_state == LOADING else "not reachable"
+                return TIMEOUT, f"Server not ready after {elapsed:.1f}s ({phase}: {last_detail}).", elapsed
+
+            time.sleep(min(backoff, deadline - now))
+            backoff = min(backoff * 2, MAX_BACKOFF)
+    finally:
+        conn.close()
+
+
+def _exit_code(process, is_alive):
+    """Returns the exit code if the watched process has died, otherwise None."""
+    if process is not None:
+        return process.poll()
+    if is_alive is not None and not is_alive():
+        return "unknown"
+    return None
@@ -0,0 +1,302 @@
+# llama_router.py
+"""
+Prefix-affinity routing proxy for one or more llama-server instances.
+
+Prompts are cut into fixed-size chunks and hashed as a chain, so two prompts that share
+their first k chunks share their first k hashes. The router remembers which (instance, slot)
+last processed each chain hash and pins a request to the slot holding its longest known prefix,
+with `cache_prompt` set, so llama-server only evaluates the new suffix. When that slot is busy
+the request falls back to the least loaded instance.
+"""
+import os
+import json
+import time
+import hashlib
+import threading
+import collections
+import http.client
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import llama_man
+import llama_pid
+import llama_pool
+import llama_proxy
+import llama_ready
+
+# --- Router Configuration ---
+ROUTER_PORT = 8090
+ROUTER_STATE_FILENAME = ".llama_router.json"
+CHUNK_CHARS = 256   # Prefix granularity for text prompts (roughly 64 tokens)
+CHUNK_TOKENS = 64   # Prefix granularity for token-array prompts
+STATS_WINDOW = 1000 # Per-request records kept for /router/stats
+# --- End Configuration ---
+
+
+def prefix_hashes(prompt):
+    """
+    Chained chunk digests of a prompt: hashes[i] identifies the prefix made of chunks 0..i.
+    Text prompts are chunked by CHUNK_CHARS characters, token arrays by CHUNK_TOKENS tokens.
+    The final partial chunk is included so identical short prompts still match.
+    """
+    if isinstance(prompt, list):
+        data = [json.dumps(prompt[i:i + CHUNK_TOKENS]).encode() for i in range(0, len(prompt), CHUNK_TOKENS)]
+    else:
+        text = str(prompt)
+        data = [text[i:i + CHUNK_CHARS].encode("utf-8") for i in range(0, len(text), CHUNK_CHARS)]
+    hashes, previous = [], b""
+    for chunk in data:
+        previous = hashlib.blake2b(previous + chunk, digest_size=16).digest()
+        hashes.append(previous)
+    return hashes
+
+
+class Route:
+    """Routing decision for one request."""
+    __slots__ = ("target", "slot", "matched", "total", "reason")
+
+    def __init__(self, target, slot, matched, total, reason):
+        self.target, self.slot, self.matched, self.total, self.reason = target, slot, matched, total, reason
+
+    @property
+    def hit_ratio(self):
+        return self.matched / self.total if self.total else 0.0
+
+
+class PrefixRouter:
+    """
+    Tracks which prompt prefix each llama-server slot holds and picks targets.
+    `targets` is a list of (host, port, n_slots). Thread-safe.
+    """
+
+    def __init__(self, targets):
+        if not targets:
+            raise ValueError("PrefixRouter needs at least one target")
+        self.targets = [(host, port) for host, port, _ in targets]
+        self.n_slots = [max(1, n) for _, _, n in targets]
+        self.outstanding = [0] * len(targets)
+        self.busy = set()           # (target, slot) pairs with a request in flight
+        self.slot_hashes = {}       # (target, slot) -> prefix hashes of the prompt it last processed
+        self.slot_last_used = {}    # (target, slot) -> monotonic time of last assignment
+        self.index = {}             # prefix hash -> (target, slot) holding it
+        self.counters = collections.Counter()
+        self.recent = collections.deque(maxlen=STATS_WINDOW)
+        self._lock = threading.Lock()
+
+    def route(self, prompt):
+        """Chooses and reserves a (target, slot) for `prompt`. Returns a Route; call release() when done."""
+        hashes = prefix_hashes(prompt)
+        with self._lock:
+            preferred, matched = None, 0
+            for depth in range(len(hashes), 0, -1):
+                holder = self.index.get(hashes[depth - 1])
+                if holder is not None:
+                    preferred, matched = holder, depth
+                    break
+
+            if preferred is not None and preferred not in self.busy:
+                route = Route(preferred[0], preferred[1], matched, len(hashes), "affinity")
+            else:
+                reason = "saturated" if preferred is not None else "miss"
+                route = self._least_loaded(len(hashes), reason)
+
+            self.outstanding[route.target] += 1
+            if route.slot >= 0:
+                key = (route.target, route.slot)
+                self.busy.add(key)
+                self._assign(key, hashes)
+            self.counters["requests"] += 1
+            self.counters[route.reason] += 1
+            self.counters["chunks_total"] += route.total
+            self.counters["chunks_matched"] += route.matched
+            return route
+
+    def _least_loaded(self, total, reason):
+        """Fallback: the least loaded target and its least recently used free slot (or -1 if all busy)."""
+        target = min(range(len(self.targets)), key=lambda t: self.outstanding[t] / self.n_slots[t])
+        free = [s for s in range(self.n_slots[target]) if (target, s) not in self.busy]
+        if not free:
+            return Route(target, -1, 0, total, reason) # Let llama-server queue it on any slot
+        slot = min(free, key=lambda s: self.slot_last_used.get((target, s), 0.0))
+        return Route(target, slot, 0, total, reason)
+
+    def _assign(self, key, hashes):
+        """Records that slot `key` now holds the prompt with `hashes`, forgetting its previous prefix."""
+        new = set(hashes)
+        for old in self.slot_hashes.get(key, ()):
+            if old not in new and self.index.get(old) == key:
+                del self.index[old]
+        for h in hashes:
+            self.index[h] = key
+        self.slot_hashes[key] = hashes
+        self.slot_last_used[key] = time.monotonic()
+
+    def release(self, route, final_event=None):
+        """Frees the reservation and records server-reported cache use from the final event."""
+        record = {"port": self.targets[route.target][1], "slot": route.slot, "reason": route.reason,
+                  "prompt_chunks": route.total, "matched_chunks": route.matched,
+                  "prefix_hit_ratio": round(route.hit_ratio, 4)}
+        timings = (final_event or {}).get("timings") or {}
+        evaluated = (final_event or {}).get("tokens_evaluated")
+        if evaluated and "prompt_n" in timings:
+            # prompt_n counts the tokens actually processed; the rest came from the slot's KV cache
+            record["tokens_evaluated"] = evaluated
+            record["prompt_n"] = timings["prompt_n"]
+            record["server_reuse_ratio"] = round(max(0.0, 1 - timings["prompt_n"] / evaluated), 4)
+        with self._lock:
+            self.outstanding[route.target] -= 1
+            self.busy.discard((route.target, route.slot))
+            if "tokens_evaluated" in record:
+                self.counters["server_tokens_evaluated"] += record["tokens_evaluated"]
+                self.counters["server_prompt_n"] += record["prompt_n"]
+            self.recent.append(record)
+
+    def stats(self):
+        """Aggregate counters plus the most recent per-request records."""
+        with self._lock:
+            c = dict(self.counters)
+            recent = list(self.recent)
+            outstanding = list(self.outstanding)
+        total, matched = c.get("chunks_total", 0), c.get("chunks_matched", 0)
+        evaluated, processed = c.get("server_tokens_evaluated", 0), c.get("server_prompt_n", 0)
+        return {
+            "requests": c.get("requests", 0),
+            "affinity": c.get("affinity", 0),
+            "saturated_fallbacks": c.get("saturated", 0),
+            "misses": c.get("miss", 0),
+            "prefix_hit_ratio": round(matched / total, 4) if total else 0.0,
+            "server_reuse_ratio": round(1 - processed / evaluated, 4) if evaluated else None,
+            "targets": [{"port": port, "slots": n, "outstanding": o}
+                        for (_, port), n, o in zip(self.targets, self.n_slots, outstanding)],
+            "recent": recent,
+        }
+
+
+# --- HTTP Front End ---
+
+def _make_handler(router, upstream):
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def log_message(self, format, *args):
+            pass
+
+        def do_GET(self):
+            if self.path == "/router/stats":
+                return llama_proxy.send_json(self, 200, router.stats())
+            if self.path == "/props":
+                return self._props()
+            host, port = router.targets[0]
+            llama_proxy.relay(self, upstream, host, port, "GET", self.path)
+
+        def do_POST(self):
+            body = llama_proxy.read_body(self)
+            if self.path not in ("/completion", "/completions"):
+                host, port = router.targets[0]
+                return llama_proxy.relay(self, upstream, host, port, "POST", self.path, body)
+            try:
+                payload = json.loads(body or b"{}")
+            except ValueError:
+                return llama_proxy.send_json(self, 400, {"error": {"code": 400, "message": "Invalid JSON", "type": "invalid_request_error"}})
+            if not isinstance(payload, dict):
+                return llama_proxy.send_json(self, 400, {"error": {"code": 400, "message": "Expected a JSON object", "type": "invalid_request_error"}})
+
+            route = router.route(payload.get("prompt", ""))
+            payload["cache_prompt"] = True
+            if route.slot >= 0:
+                payload["id_slot"] = route.slot
+            host, port = router.targets[route.target]
+            final_event = None
+            try:
+                status, tail = llama_proxy.relay(
+                    self, upstream, host, port, "POST", self.path, json.dumps(payload).encode(),
+                    extra_headers={"X-Prefix-Hit-Ratio": f"{route.hit_ratio:.4f}",
+                                   "X-Routed-To": f"{port}/{route.slot}"},
+                )
+                if status == 200:
+                    final_event = llama_proxy.last_sse_event(tail)
+            finally:
+                router.release(route, final_event)
+
+        def _props(self):
+            """The first target's /props with total_slots summed over all targets."""
+            host, port = router.targets[0]
+            conn = http.client.HTTPConnection(host, port, timeout=5)
+            try:
+                conn.request("GET", "/props")
+                props = json.loads(conn.getresponse().read())
+            except (OSError, http.client.HTTPException, ValueError):
+                props = {}
+            finally:
+                conn.close()
+            props["total_slots"] = sum(router.n_slots)
+            llama_proxy.send_json(self, 200, props)
+
+    return Handler
+
+
+def make_server(router, port=ROUTER_PORT, host=llama_ready.HOST):
+    """Creates (but does not start) the router's ThreadingHTTPServer."""
+    httpd = ThreadingHTTPServer((host, port), _make_handler(router, llama_proxy.UpstreamPool()))
+    httpd.daemon_threads = True
+    return httpd
+
+
+def discover_targets():
+    """
+    Targets to route to: the ready pool instances if a pool is running, else the single server.
+    Slot counts come from each server's /props, falling back to llama_man.PARALLEL.
+    Returns a list of (host, port, n_slots).
+    """
+    ports = llama_pool.healthy_ports() if llama_pool.read_pool_state()['instances'] else [llama_man.PORT]
+    targets = []
+    for port in ports:
+        n_slots = llama_man.PARALLEL
+        conn = http.client.HTTPConnection(llama_ready.HOST, port, timeout=5)
+        try:
+            conn.request("GET", "/props")
+            n_slots = int(json.loads(conn.getresponse().read()).get("total_slots") or n_slots)
+        except (OSError, http.client.HTTPException, ValueError, TypeError):
+            pass
+        finally:
+            conn.close()
+        targets.append((llama_ready.HOST, port, n_slots))
+    return targets
+
+
+def read_router_state():
+    """Returns the running router's state dict ({'pid', 'port', ...}) or None."""
+    try:
+        with open(ROUTER_STATE_FILENAME, 'r') as f:
+            state = json.load(f)
+    except (IOError, ValueError):
+        return None
+    if isinstance(state, dict) and llama_pid.is_process_running(state.get('pid')):
+        return state
+    return None
+
+
+def running_router_port():
+    """Port of a running, responsive router, or None."""
+    state = read_router_state()
+    if state and llama_ready.probe_health(state['port'])[0] == llama_ready.READY:
+        return state['port']
+    return None
+
+
+def serve(port=ROUTER_PORT, targets=None):
+    """Runs the router in the foreground until interrupted."""
+    targets = targets or discover_targets()
+    router = PrefixRouter(targets)
+    httpd = make_server(router, port=port)
+    with open(ROUTER_STATE_FILENAME, 'w') as f:
+        json.dump({'pid': os.getpid(), 'port': port, 'targets': [t[1] for t in targets]}, f)
+    try:
+        httpd.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        httpd.server_close()
+        try:
+            os.remove(ROUTER_STATE_FILENAME)
+        except OSError:
+            pass
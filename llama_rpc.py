@@ -0,0 +1,310 @@
+# llama_rpc.py
+"""
+Distributed inference over ggml's RPC backend: a group of rpc-server workers holding the
+model's layers, with the managed llama-server launched with --rpc across them.
+
+Workers are local (spawned here on consecutive ports, like pool instances) or remote
+endpoints started on other hosts (host:port). start_group() starts the local ones,
+health-checks every worker and records the group in llama_man.RPC_GROUP_FILENAME; llama_man
+then launches the server (and supervise() relaunches it) with --rpc and -ngl over the group,
+counting the remote workers' free memory when it checks that the model fits. stop_group()
+stops the server before the workers it depends on, and status_group() probes every worker.
+
+The probe speaks the RPC protocol: GET_DEVICE_MEMORY returns a worker's free and total
+memory, and its round trip is the worker's latency. rpc-server serves one client at a time,
+so a worker the server is connected to accepts the connection but does not answer; it is
+reported BUSY, with the connect latency only.
+"""
+import os
+import json
+import time
+import socket
+import struct
+import threading
+
+import llama_man
+import llama_pid
+import llama_pool
+import llama_logs
+
+# --- RPC Configuration ---
+RPC_SERVER_PATH = os.path.join(os.path.dirname(llama_man.SERVER_PATH), "rpc-server")
+RPC_BASE_PORT = 50052       # rpc-server's default port; local workers take consecutive ports from here
+RPC_HOST = "127.0.0.1"      # Interface local workers listen on (rpc-server has no authentication; keep it private)
+PROBE_TIMEOUT = 2.0         # Seconds a worker gets to accept and answer a probe
+PROBE_SAMPLES = 3           # Round trips per probe; the median is reported
+WORKER_READY_TIMEOUT = 30.0 # Seconds a local worker gets to start answering
+# --- End Configuration ---
+
+RPC_CMD_GET_DEVICE_MEMORY = 11 # ggml-rpc command id (llama.cpp b5061)
+_LOCAL_HOSTS = ("127.0.0.1", "localhost", "::1")
+
+# Worker states
+READY = "READY"   # Answered GET_DEVICE_MEMORY
+BUSY = "BUSY"     # Accepted the connection but did not answer: serving another client (the server)
+DOWN = "DOWN"     # Connection refused or unreachable, or not speaking the RPC protocol
+DEAD = "DEAD"     # Local worker whose process has exited
+
+
+def parse_endpoint(endpoint):
+    """Splits 'host:port' (IPv6 hosts in brackets). Raises ValueError for anything else."""
+    host, _, port = endpoint.strip().rpartition(":")
+    host = host.strip("[]")
+    if not host or not port.isdigit() or not 0 < int(port) < 65536:
+        raise ValueError(f"Invalid RPC endpoint '{endpoint}' (expected HOST:PORT).")
+    return host, int(port)
+
+
+def is_local_host(host):
+    return host in _LOCAL_HOSTS or host == socket.gethostname()
+
+
+# --- Probing ---
+
+def _recv_exact(conn, size):
+    data = b""
+    while len(data) < size:
+        chunk = conn.recv(size - len(data))
+        if not chunk:
+            raise ConnectionError("connection closed by the worker")
+        data += chunk
+    return data
+
+def probe_worker(endpoint, timeout=PROBE_TIMEOUT, samples=PROBE_SAMPLES):
+    """
+    Health-checks one worker. Returns a dict: endpoint, state (READY, BUSY or DOWN),
+    connect_ms, rtt_ms (median GET_DEVICE_MEMORY round trip), free_mb, total_mb, detail.
+    """
+    result = {'endpoint': endpoint, 'state': DOWN, 'connect_ms': None, 'rtt_ms': None,
+              'free_mb': None, 'total_mb': None, 'detail': ''}
+    host, port = parse_endpoint(endpoint)
+    start = time.perf_counter()
+    try:
+        conn = socket.create_connection((host, port), timeout=timeout)
+    except OSError as e:
+        result['detail'] = str(e)
+        return result
+    with conn:
+        result['connect_ms'] = round((time.perf_counter() - start) * 1000, 3)
+        rtts = []
+        try:
+            for _ in range(max(1, samples)):
+                sent = time.perf_counter()
+                conn.sendall(struct.pack("<BQ", RPC_CMD_GET_DEVICE_MEMORY, 0))
+                size = struct.unpack("<Q", _recv_exact(conn, 8))[0]
+                free, total = struct.unpack("<QQ", _recv_exact(conn, size)[:16])
+                rtts.append((time.perf_counter() - sent) * 1000)
+        except socket.timeout:
+            result.update(state=BUSY, detail="accepted the connection but is serving another client")
+            return result
+        except (OSError, struct.error) as e:
+            result['detail'] = f"no RPC reply: {e}"
+            return result
+    result.update(state=READY, rtt_ms=round(sorted(rtts)[len(rtts) // 2], 3),
+                  free_mb=round(free / (1 << 20), 1), total_mb=round(total / (1 << 20), 1))
+    return result
+
+def probe_workers(endpoints, timeout=PROBE_TIMEOUT, samples=PROBE_SAMPLES):
+    """probe_worker() for every endpoint, in parallel (a BUSY worker costs a full timeout). Returns the results in order."""
+    results = [None] * len(endpoints)
+    def run(index):
+        results[index] = probe_worker(endpoints[index], timeout, samples)
+    threads = [threading.Thread(target=run, args=(i,), daemon=True) for i in range(len(endpoints))]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return results
+
+
+# --- Group State ---
+
+def write_group(group):
+    """Atomically replaces the group file. Returns True on success, False on error."""
+    tmp_path = f"{llama_man.RPC_GROUP_FILENAME}.tmp"
+    try:
+        with open(tmp_path, 'w') as f:
+            json.dump(group, f, indent=2)
+        os.replace(tmp_path, llama_man.RPC_GROUP_FILENAME)
+        return True
+    except OSError:
+        return False
+
+def delete_group():
+    try:
+        if os.path.exists(llama_man.RPC_GROUP_FILENAME):
+            os.remove(llama_man.RPC_GROUP_FILENAME)
+        return True
+    except OSError:
+        return False
+
+def remote_free_mb(workers):
+    """Free memory on other hosts: per remote host the largest free_mb any of its workers reported (they share it)."""
+    hosts = {}
+    for worker in workers:
+        host = parse_endpoint(worker['endpoint'])[0]
+        if not worker.get('local') and not is_local_host(host) and worker.get('free_mb'):
+            hosts[host] = max(hosts.get(host, 0.0), worker['free_mb'])
+    return round(sum(hosts.values()), 1)
+
+
+# --- Lifecycle ---
+
+def plan_workers(local=0, remote=(), base_port=None, threads=None, mem_mb=None, host=None):
+    """
+    Worker dicts for `local` workers on consecutive ports from `base_port` (default RPC_BASE_PORT),
+    each with an even share of the CPUs unless `threads` is given, plus the `remote` endpoints.
+    Raises ValueError for an invalid endpoint.
+    """
+    host, base_port = host or RPC_HOST, base_port or RPC_BASE_PORT
+    share = max(1, len(llama_pool.available_cpus()) // max(1, local))
+    workers = [{'endpoint': f"{host}:{base_port + i}", 'local': True, 'port': base_port + i,
+                'threads': threads or share, 'mem_mb': mem_mb} for i in range(local)]
+    for endpoint in remote:
+        parse_endpoint(endpoint)
+        workers.append({'endpoint': endpoint.strip(), 'local': False})
+    return workers
+
+def _launch(worker):
+    """Spawns a local worker. Returns (True, Popen) on success, (False, error message) otherwise."""
+    host, port = parse_endpoint(worker['endpoint'])
+    command = [RPC_SERVER_PATH, '-H', host, '-p', str(port), '-t', str(worker['threads'])]
+    if worker.get('mem_mb'):
+        command += ['-m', str(worker['mem_mb'])]
+    try:
+        process = llama_man.spawn_server_process(command, log_path=llama_logs.log_path(f"rpc-{port}"))
+    except OSError as e:
+        return False, f"worker {worker['endpoint']}: failed to launch: {e}"
+    worker['pid'] = process.pid
+    worker['start_time'] = llama_pid.process_start_time(process.pid)
+    worker['started_at'] = time.time()
+    return True, process
+
+def _wait(worker, process):
+    """Waits until a spawned worker answers a probe. Returns tuple (success: bool, message: str)."""
+    deadline = time.monotonic() + WORKER_READY_TIMEOUT
+    while True:
+        probe = probe_worker(worker['endpoint'], samples=1)
+        if probe['state'] == READY:
+            return True, f"worker {worker['endpoint']} (PID {worker['pid']}): ready"
+        if process.poll() is not None:
+            llama_logs.wait_for_pump(process)
+            log = llama_man.log_tail(process, llama_logs.log_path(f"rpc-{worker['port']}"))
+            return False, f"worker {worker['endpoint']}: exited on startup (exit code {process.poll()}).{log}"
+        if time.monotonic() > deadline:
+            return False, f"worker {worker['endpoint']} (PID {worker['pid']}): not answering after {WORKER_READY_TIMEOUT:.0f}s"
+        time.sleep(0.1)
+
+def start_group(local=0, remote=(), base_port=None, threads=None, mem_mb=None, host=None, start_server=True):
+    """
+    Starts `local` rpc-server workers, health-checks them and the `remote` endpoints, records
+    the group, then (with `start_server`) starts the managed server over it. A server already
+    running is stopped first so it comes back with --rpc. When a worker fails its check, the
+    local workers are stopped again and no group is recorded.
+    Returns tuple (success: bool, messages: list[str]).
+    """
+    if llama_man.load_rpc_group():
+        return False, ["RPC group already running. Stop it first (rpc stop)."]
+    try:
+        workers = plan_workers(local, remote, base_port, threads, mem_mb, host)
+    except ValueError as e:
+        return False, [str(e)]
+    if not workers:
+        return False, ["No workers: give a number of local workers and/or remote HOST:PORT endpoints."]
+    if local and not os.path.exists(RPC_SERVER_PATH):
+        return False, [f"rpc-server executable not found: '{RPC_SERVER_PATH}'. It ships with llama.cpp builds made with -DGGML_RPC=ON."]
+
+    messages, ok = [], True
+    if llama_man.status_llama_server()[0] == "RUNNING":
+        success, message = llama_man.stop_llama_server()
+        messages.append(f"Stopping the running server to relaunch it over the workers: {message}")
+        if not success:
+            return False, messages
+
+    launched = []
+    for worker in (w for w in workers if w['local']):
+        success, result = _launch(worker)
+        if success:
+            launched.append((worker, result))
+        else:
+            ok = False
+            messages.append(result)
+    # Record PIDs before waiting so a concurrent 'rpc stop' can find starting workers
+    write_group({'workers': [w for w in workers if not w['local'] or w.get('pid')], 'started_at': time.time()})
+    for worker, process in launched:
+        success, message = _wait(worker, process)
+        ok = ok and success
+        messages.append(message)
+
+    for worker, probe in zip(workers, probe_workers([w['endpoint'] for w in workers])):
+        worker.update({k: probe[k] for k in ('free_mb', 'total_mb', 'rtt_ms', 'connect_ms')})
+        if probe['state'] != READY:
+            ok = False
+            messages.append(f"worker {worker['endpoint']}: {probe['state']} ({probe['detail']})")
+        elif not worker['local']:
+            messages.append(f"worker {worker['endpoint']}: ready, {probe['free_mb']:.0f} MB free, {probe['rtt_ms']:.2f} ms round trip")
+    if not ok:
+        for worker, _ in launched:
+            llama_man.stop_process(worker['pid'], force=True, start_time=worker['start_time'])
+        delete_group()
+        messages.append("Group not started; local workers stopped again.")
+        return False, messages
+    write_group({'workers': workers, 'started_at': time.time(), 'remote_free_mb': remote_free_mb(workers)})
+    if start_server:
+        success, message, _ = llama_man.start_llama_server()
+        messages.append(message)
+        ok = success
+    return ok, messages
+
+def stop_group(force=False):
+    """
+    Stops the managed server (it holds the workers), then the local workers, and forgets the
+    group. Remote workers are left running. Returns tuple (success: bool, messages: list[str]).
+    """
+    group = llama_man.load_rpc_group()
+    if not group:
+        return True, ["No RPC group running (no group file)."]
+    messages = []
+    if llama_man.status_llama_server()[0] == "RUNNING":
+        success, message = llama_man.stop_llama_server(force=force)
+        messages.append(f"llama-server: {message}")
+        if not success:
+            return False, messages
+    ok, remaining = True, []
+    for worker in group['workers']:
+        if not worker.get('local'):
+            messages.append(f"worker {worker['endpoint']}: remote, left running.")
+            continue
+        pid, start_time = worker.get('pid'), worker.get('start_time')
+        if not llama_pid.is_process_running(pid, start_time):
+            messages.append(f"worker {worker['endpoint']}: stale PID {pid} cleaned up.")
+            continue
+        success, message = llama_man.stop_process(pid, force=force, start_time=start_time)
+        messages.append(f"worker {worker['endpoint']}: {message}")
+        if not success:
+            ok = False
+            remaining.append(worker)
+    if remaining:
+        write_group(dict(group, workers=remaining))
+    else:
+        delete_group()
+    return ok, messages
+
+def status_group():
+    """
+    The group's workers with a fresh probe each (state READY, BUSY, DOWN or DEAD, latency and
+    memory), and the managed server's status. Returns dict (workers, server, server_message), or None without a group.
+    """
+    group = llama_man.load_rpc_group()
+    if not group:
+        return None
+    probes = probe_workers([w['endpoint'] for w in group['workers']])
+    workers = []
+    for worker, probe in zip(group['workers'], probes):
+        worker = dict(worker, **probe)
+        if worker.get('local') and not llama_pid.is_process_running(worker.get('pid'), worker.get('start_time')):
+            worker['state'] = DEAD
+        workers.append(worker)
+    server, server_message = llama_man.status_llama_server()
+    return {'workers': workers, 'server': server, 'server_message': server_message,
+            'remote_free_mb': group.get('remote_free_mb', 0.0)}
@@ -0,0 +1,331 @@
+# llama_sched.py
+"""
+Priority scheduler in front of the managed llama-server.
+
+Completion requests are queued per class, interactive before batch, and forwarded only as
+slots free up: at most one request per server slot is in flight, and batch work only starts
+while more than INTERACTIVE_RESERVED_SLOTS slots are free, so a prompt typed at the CLI
+never waits behind a full set of batch jobs. llama-server cannot preempt a running
+request, so holding the queue here is what lets priorities take effect.
+
+Admission is also token-aware: each request costs its estimated prompt tokens plus
+n_predict (the slot context if unbounded), and a request is forwarded only while the
+tokens in flight stay within the budget (a request always runs when nothing else does).
+
+Every class has a queue-time SLO. A request that would wait longer, by the current service
+time estimate, or that is still queued when its SLO expires, is answered with 429 and a
+Retry-After header instead of being left to time out. Clients pick the class with the
+X-Priority header (interactive by default; llama_batch sends batch).
+"""
+import os
+import json
+import math
+import time
+import threading
+import collections
+import http.client
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import llama_man
+import llama_pid
+import llama_proxy
+import llama_ready
+
+# --- Scheduler Configuration ---
+SCHED_PORT = 8094
+SCHED_STATE_FILENAME = ".llama_sched.json"
+QUEUE_SLO = {"interactive": 5.0, "batch": 120.0} # Longest queue wait per class before 429 (seconds)
+MAX_QUEUE = 256                # Queued requests per class; more are rejected at once
+INTERACTIVE_RESERVED_SLOTS = 1 # Slots kept free of batch requests (when the server has more than one)
+CHARS_PER_TOKEN = 4            # Prompt length estimate for text prompts
+SERVICE_EWMA = 0.2             # Weight of the newest request in the service time estimate
+STATS_WINDOW = 1000            # Queue waits kept per class for percentiles
+# --- End Configuration ---
+
+PRIORITY_HEADER = "X-Priority"
+INTERACTIVE = "interactive"
+BATCH = "batch"
+CLASSES = (INTERACTIVE, BATCH) # Highest priority first
+SCHEDULED_PATHS = {"/completion", "/completions", "/v1/completions", "/chat/completions", "/v1/chat/completions"}
+
+
+class Rejected(Exception):
+    """A request was not admitted. `reason` is 'queue_full', 'overloaded' or 'queue_timeout'."""
+
+    def __init__(self, reason, retry_after):
+        super().__init__(f"{reason}; retry after {retry_after}s")
+        self.reason = reason
+        self.retry_after = retry_after
+
+
+class Ticket:
+    """One queued or running request."""
+    __slots__ = ("cls", "cost", "enqueued", "granted")
+
+    def __init__(self, cls, cost):
+        self.cls, self.cost = cls, cost
+        self.enqueued = time.monotonic()
+        self.granted = None
+
+    @property
+    def wait(self):
+        return (self.granted or time.monotonic()) - self.enqueued
+
+
+def estimate_cost(payload, slot_ctx=None):
+    """
+    Tokens a request will occupy: its prompt (token arrays counted, text estimated at
+    CHARS_PER_TOKEN) plus n_predict / max_tokens. An unbounded n_predict counts as the
+    whole slot context; the total is capped at `slot_ctx` when that is known.
+    """
+    prompt = payload.get("prompt", "")
+    if "messages" in payload:
+        prompt = "".join(str(m.get("content") or "") for m in payload["messages"] if isinstance(m, dict))
+    if isinstance(prompt, list) and all(isinstance(t, int) for t in prompt):
+        prompt_tokens = len(prompt)
+    else:
+        prompt_tokens = math.ceil(len(str(prompt)) / CHARS_PER_TOKEN)
+    n_predict = payload.get("n_predict", payload.get("max_tokens", -1))
+    if not isinstance(n_predict, int) or n_predict < 0:
+        n_predict = slot_ctx or 0
+    cost = max(1, prompt_tokens + n_predict)
+    return min(cost, slot_ctx) if slot_ctx else cost
+
+
+class PriorityScheduler:
+    """
+    Admission control for `slots` concurrent requests and `token_budget` tokens in flight.
+    acquire() blocks until the request may run (or raises Rejected); release() ends it.
+    Thread-safe.
+    """
+
+    def __init__(self, slots, token_budget=None, slo=None, max_queue=MAX_QUEUE,
+                 reserved=INTERACTIVE_RESERVED_SLOTS):
+        self.slots = max(1, slots)
+        self.batch_slots = max(1, self.slots - reserved)
+        self.token_budget = token_budget
+        self.slo = dict(QUEUE_SLO, **(slo or {}))
+        self.max_queue = max_queue
+        self.queues = {cls: collections.deque() for cls in CLASSES}
+        self.running = 0
+        self.tokens_in_flight = 0
+        self.service_s = None # Moving average of request run time, for wait estimates
+        self.counters = {cls: collections.Counter() for cls in CLASSES}
+        self.waits = {cls: collections.deque(maxlen=STATS_WINDOW) for cls in CLASSES}
+        self._cond = threading.Condition()
+
+    def acquire(self, cls, cost):
+        """Queues a request of class `cls` costing `cost` tokens and waits for its turn. Returns a Ticket."""
+        ticket = Ticket(cls, cost)
+        with self._cond:
+            queue = self.queues[cls]
+            if len(queue) >= self.max_queue:
+                self._reject(ticket, "queue_full")
+            estimate = self._estimated_wait(cls)
+            if estimate is not None and estimate > self.slo[cls]:
+                self._reject(ticket, "overloaded", estimate)
+            queue.append(ticket)
+            self._dispatch()
+            deadline = ticket.enqueued + self.slo[cls]
+            while ticket.granted is None:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    queue.remove(ticket)
+                    self._dispatch() # The head may have been all that blocked others
+                    self._reject(ticket, "queue_timeout")
+                self._cond.wait(remaining)
+            self.counters[cls]["admitted"] += 1
+            self.waits[cls].append(ticket.wait)
+        return ticket
+
+    def release(self, ticket):
+        """Ends a request started by acquire() and lets the next ones in."""
+        elapsed = time.monotonic() - ticket.granted
+        with self._cond:
+            self.running -= 1
+            self.tokens_in_flight -= ticket.cost
+            self.counters[ticket.cls]["completed"] += 1
+            self.service_s = elapsed if self.service_s is None else \
+                SERVICE_EWMA * elapsed + (1 - SERVICE_EWMA) * self.service_s
+            self._dispatch()
+
+    def _dispatch(self):
+        """Grants queue heads in priority order while slots and tokens allow. Caller holds the lock."""
+        granted = False
+        while self.running < self.slots:
+            cls = next((c for c in CLASSES if self.queues[c]), None)
+            if cls is None:
+                break
+            head = self.queues[cls][0]
+            if cls == BATCH and self.running >= self.batch_slots:
+                break # Keep the reserved slots free for interactive arrivals
+            if self.running and self.token_budget and self.tokens_in_flight + head.cost > self.token_budget:
+                break # Lower classes do not overtake a head that is waiting for tokens
+            self.queues[cls].popleft()
+            head.granted = time.monotonic()
+            self.running += 1
+            self.tokens_in_flight += head.cost
+            granted = True
+        if granted:
+            self._cond.notify_all()
+
+    def _estimated_wait(self, cls):
+        """Expected queue wait for a new request of class `cls`, or None before any request has finished."""
+        ahead = sum(len(self.queues[c]) for c in CLASSES[:CLASSES.index(cls) + 1])
+        capacity = self.batch_slots if cls == BATCH else self.slots
+        if not ahead and self.running < capacity:
+            return 0.0
+        if self.service_s is None:
+            return None
+        return (ahead + 1) * self.service_s / capacity
+
+    def _reject(self, ticket, reason, estimate=None):
+        """Counts and raises Rejected for `ticket`. Caller holds the lock."""
+        self.counters[ticket.cls][reason] += 1
+        if estimate is None:
+            estimate = self._estimated_wait(ticket.cls)
+        raise Rejected(reason, max(1, math.ceil(estimate if estimate is not None else self.slo[ticket.cls])))
+
+    def stats(self):
+        """Queue depths, counters and queue-wait percentiles (ms) per class."""
+        with self._cond:
+            classes = {}
+            for cls in CLASSES:
+                waits = sorted(self.waits[cls])
+                c = self.counters[cls]
+                classes[cls] = {
+                    "queued": len(self.queues[cls]),
+                    "admitted": c["admitted"],
+                    "completed": c["completed"],
+                    "rejected": {r: c[r] for r in ("queue_full", "overloaded", "queue_timeout")},
+                    "slo_s": self.slo[cls],
+                    "wait_p50_ms": round(waits[len(waits) // 2] * 1000, 1) if waits else None,
+                    "wait_p95_ms": round(waits[min(len(waits) - 1, int(len(waits) * 0.95))] * 1000, 1) if waits else None,
+                    "wait_max_ms": round(waits[-1] * 1000, 1) if waits else None,
+                }
+            return {
+                "slots": self.slots,
+                "batch_slots": self.batch_slots,
+                "running": self.running,
+                "token_budget": self.token_budget,
+                "tokens_in_flight": self.tokens_in_flight,
+                "service_s": round(self.service_s, 4) if self.service_s is not None else None,
+                "classes": classes,
+            }
+
+
+# --- HTTP Front End ---
+
+def _make_handler(sched, upstream, host, port, slot_ctx):
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def log_message(self, format, *args):
+            pass
+
+        def do_GET(self):
+            if self.path == "/sched/stats":
+                return llama_proxy.send_json(self, 200, sched.stats())
+            llama_proxy.relay(self, upstream, host, port, "GET", self.path)
+
+        def do_POST(self):
+            body = llama_proxy.read_body(self)
+            if self.path not in SCHEDULED_PATHS:
+                return llama_proxy.relay(self, upstream, host, port, "POST", self.path, body)
+            cls = (self.headers.get(PRIORITY_HEADER) or INTERACTIVE).strip().lower()
+            if cls not in CLASSES:
+                return llama_proxy.send_json(self, 400, {"error": {"code": 400, "type": "invalid_request_error",
+                                                                   "message": f"{PRIORITY_HEADER} must be one of {', '.join(CLASSES)}"}})
+            try:
+                payload = json.loads(body or b"{}")
+            except ValueError:
+                payload = None
+            cost = estimate_cost(payload, slot_ctx) if isinstance(payload, dict) else max(1, len(body) // CHARS_PER_TOKEN)
+            try:
+                ticket = sched.acquire(cls, cost)
+            except Rejected as e:
+                return llama_proxy.send_json(
+                    self, 429, {"error": {"code": 429, "message": f"{cls} queue: {e}", "type": "unavailable_error"}},
+                    headers={"Retry-After": str(e.retry_after)})
+            try:
+                llama_proxy.relay(self, upstream, host, port, "POST", self.path, body,
+                                  extra_headers={"X-Queue-Wait-Ms": f"{ticket.wait * 1000:.1f}"})
+            finally:
+                sched.release(ticket)
+
+    return Handler
+
+
+def make_server(sched, port=SCHED_PORT, target_port=None, host=llama_ready.HOST, slot_ctx=None):
+    """Creates (but does not start) the scheduler's ThreadingHTTPServer, forwarding to `target_port`."""
+    handler = _make_handler(sched, llama_proxy.UpstreamPool(), llama_ready.HOST, target_port or llama_man.PORT, slot_ctx)
+    httpd = ThreadingHTTPServer((host, port), handler)
+    httpd.daemon_threads = True
+    return httpd
+
+
+def discover_limits(port=None):
+    """
+    Slot count and per-slot context of the server on `port` (default llama_man.PORT) from /props,
+    falling back to llama_man.PARALLEL and None. Returns (slots, slot_ctx).
+    """
+    slots, slot_ctx = llama_man.PARALLEL, None
+    conn = http.client.HTTPConnection(llama_ready.HOST, port or llama_man.PORT, timeout=5)
+    try:
+        conn.request("GET", "/props")
+        props = json.loads(conn.getresponse().read())
+        slots = int(props.get("total_slots") or slots)
+        slot_ctx = int((props.get("default_generation_settings") or {}).get("n_ctx") or 0) or None
+    except (OSError, http.client.HTTPException, ValueError, TypeError, AttributeError):
+        pass
+    finally:
+        conn.close()
+    return slots, slot_ctx
+
+
+def read_sched_state():
+    """Returns the running scheduler's state dict ({'pid', 'port', ...}) or None."""
+    try:
+        with open(SCHED_STATE_FILENAME, 'r') as f:
+            state = json.load(f)
+    except (IOError, ValueError):
+        return None
+    if isinstance(state, dict) and llama_pid.is_process_running(state.get('pid')):
+        return state
+    return None
+
+
+def running_sched_port():
+    """Port of a running, responsive scheduler, or None."""
+    state = read_sched_state()
+    if state and llama_ready.probe_health(state['port'])[0] == llama_ready.READY:
+        return state['port']
+    return None
+
+
+def serve(port=SCHED_PORT, target_port=None, slots=None, slot_ctx=None, token_budget=None, slo=None):
+    """
+    Runs the scheduler in the foreground until interrupted. The token budget defaults to
+    the server's whole context (slots x per-slot context) when that is known.
+    """
+    target_port = target_port or llama_man.PORT
+    if slots is None:
+        slots, discovered_ctx = discover_limits(target_port)
+        slot_ctx = slot_ctx or discovered_ctx
+    if token_budget is None and slot_ctx:
+        token_budget = slots * slot_ctx
+    sched = PriorityScheduler(slots, token_budget=token_budget, slo=slo)
+    httpd = make_server(sched, port=port, target_port=target_port, slot_ctx=slot_ctx)
+    with open(SCHED_STATE_FILENAME, 'w') as f:
+        json.dump({'pid': os.getpid(), 'port': port, 'target': target_port, 'slots': slots,
+                   'token_budget': token_budget}, f)
+    try:
+        httpd.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        httpd.server_close()
+        try:
+            os.remove(SCHED_STATE_FILENAME)
+        except OSError:
+            pass
@@ -0,0 +1,221 @@
+# llama_session.py
+"""
+Multi-turn chat sessions that reuse the server's KV cache from turn to turn.
+
+A session is a system prompt plus a list of (user, assistant) turns, kept in
+SESSIONS_DIR/<name>.json so it can be resumed later. Every turn sends the whole transcript
+to /completion, but pinned to the session's slot (id_slot) with cache_prompt, and the
+transcript of turn N+1 starts with exactly the text the slot holds after turn N (prompt plus
+the generated answer, unchanged). llama-server therefore only evaluates the new user
+message; timings.prompt_n of each turn shows how many tokens were actually processed.
+
+When the next turn would take the transcript past TRIM_AT of the slot context, the oldest
+turns are dropped (the newest KEEP_TURNS stay), optionally folded into a running summary.
+The parts are measured with the server's /tokenize. The system prompt and summary stay at
+the front, so that part of the cache survives the trim; only the remaining turns are
+evaluated again, once.
+"""
+import os
+import re
+import json
+import math
+import time
+import asyncio
+
+import llama_sse
+import llama_client
+
+# --- Session Configuration ---
+SESSIONS_DIR = ".llama_sessions"
+USER_TAG = "User:"
+ASSISTANT_TAG = "Assistant:"
+SUMMARY_TAG = "Summary of the earlier conversation:"
+STOP = ["\nUser:"]    # Ends the answer where the model would start the next user turn
+N_PREDICT = 512       # Answer length limit per turn (also the room kept free for it in the context)
+TRIM_AT = 0.85        # Fraction of the slot context at which old turns are dropped
+TRIM_TO = 0.5         # ... down to this fraction
+KEEP_TURNS = 2        # Most recent turns never dropped (unless they alone do not fit)
+CHARS_PER_TOKEN = 4   # Token estimate when the server cannot count (/tokenize unavailable)
+SUMMARY_TOKENS = 128  # Length of a summary of dropped turns
+# --- End Configuration ---
+
+
+def session_path(name):
+    return os.path.join(SESSIONS_DIR, f"{name}.json")
+
+
+def estimate_tokens(text):
+    return math.ceil(len(text) / CHARS_PER_TOKEN)
+
+
+def tokenizer(base_url):
+    """A token counting function using the server's /tokenize, falling back to estimate_tokens()."""
+    def count_tokens(text):
+        try:
+            result = asyncio.run(llama_client.post_json(base_url, {"content": text}, path="/tokenize", timeout=30))
+            return len(result["tokens"])
+        except (llama_client.ClientError, KeyError, TypeError):
+            return estimate_tokens(text)
+    return count_tokens
+
+
+# --- Persistence ---
+
+def new_session(name, system="", slot=0):
+    """A new, empty session dict pinned to `slot`. Raises ValueError for an unusable name."""
+    if not re.fullmatch(r"[\w.-]+", name) or name.startswith("."):
+        raise ValueError(f"Invalid session name '{name}' (letters, digits, '_', '-', '.').")
+    now = time.time()
+    return {"name": name, "system": system or "", "slot": slot, "summary": "", "turns": [],
+            "context_tokens": 0, "trimmed_turns": 0, "created_at": now, "updated_at": now}
+
+
+def load_session(name):
+    """The saved session `name`, or None."""
+    try:
+        with open(session_path(name), 'r', encoding="utf-8") as f:
+            session = json.load(f)
+    except (IOError, ValueError):
+        return None
+    return session if isinstance(session, dict) and isinstance(session.get("turns"), list) else None
+
+
+def save_session(session):
+    """Atomically writes the session file. Returns True on success, False on error."""
+    session["updated_at"] = time.time()
+    path = session_path(session["name"])
+    try:
+        os.makedirs(SESSIONS_DIR, exist_ok=True)
+        with open(path + ".tmp", 'w', encoding="utf-8") as f:
+            json.dump(session, f, indent=1)
+        os.replace(path + ".tmp", path)
+        return True
+    except OSError:
+        return False
+
+
+def list_sessions():
+    """Saved sessions, most recently used first."""
+    try:
+        names = [f[:-5] for f in os.listdir(SESSIONS_DIR) if f.endswith(".json")]
+    except OSError:
+        return []
+    sessions = [s for s in map(load_session, names) if s]
+    return sorted(sessions, key=lambda s: s.get("updated_at", 0), reverse=True)
+
+
+def delete_session(name):
+    """Deletes a saved session. Returns True if it existed."""
+    try:
+        os.remove(session_path(name))
+        return True
+    except OSError:
+        return False
+
+
+def pick_slot(n_slots):
+    """The slot with the fewest saved sessions pinned to it, so sessions evict each other's cache least."""
+    pinned = [0] * max(1, n_slots)
+    for session in list_sessions():
+        pinned[session.get("slot", 0) % len(pinned)] += 1
+    return pinned.index(min(pinned))
+
+
+# --- Prompt ---
+
+def render(session, turns=None):
+    """The transcript of `session` (or of `turns` in it): system prompt, summary, then each turn."""
+    parts = []
+    if session["system"]:
+        parts.append(session["system"].rstrip() + "\n\n")
+    if session["summary"]:
+        parts.append(f"{SUMMARY_TAG} {session['summary'].strip()}\n\n")
+    parts += map(_render_turn, session["turns"] if turns is None else turns)
+    return "".join(parts)
+
+
+def _render_turn(turn):
+    return f"{USER_TAG} {turn['user']}\n{ASSISTANT_TAG}{turn['assistant']}\n"
+
+
+def build_prompt(session, user_text):
+    """Prompt for the next turn. It extends exactly what the slot cached after the previous turn."""
+    return render(session) + f"{USER_TAG} {user_text}\n{ASSISTANT_TAG}"
+
+
+def trim(session, user_text, n_ctx, n_predict=N_PREDICT, summarize=None, count_tokens=estimate_tokens):
+    """
+    Drops the oldest turns when the next turn would take the context past TRIM_AT of `n_ctx`,
+    until it is under TRIM_TO (keeping the newest KEEP_TURNS if possible). With `summarize`
+    (a function text -> summary), the dropped turns and any earlier summary are replaced by
+    a new summary. `count_tokens` measures text (see tokenizer()). Returns the number of turns dropped.
+    """
+    reserve = count_tokens(f"{USER_TAG} {user_text}\n{ASSISTANT_TAG}") + (n_predict if n_predict > 0 else N_PREDICT)
+    if not n_ctx or session["context_tokens"] + reserve <= TRIM_AT * n_ctx:
+        return 0
+    turns = session["turns"]
+    sizes = [count_tokens(_render_turn(t)) for t in turns]
+    context = count_tokens(render(session, [])) + sum(sizes)
+    dropped = 0
+    while dropped < len(turns) and context + reserve > TRIM_TO * n_ctx:
+        if len(turns) - dropped <= KEEP_TURNS and context + reserve <= TRIM_AT * n_ctx:
+            break
+        context -= sizes[dropped]
+        dropped += 1
+    if not dropped:
+        return 0
+    if summarize:
+        earlier = (f"{SUMMARY_TAG} {session['summary']}\n" if session["summary"] else "") + \
+            "".join(map(_render_turn, turns[:dropped]))
+        session["summary"] = summarize(earlier).strip()
+    session["turns"] = turns[dropped:]
+    session["context_tokens"] = count_tokens(render(session))
+    session["trimmed_turns"] = session.get("trimmed_turns", 0) + dropped
+    return dropped
+
+
+# --- Turns ---
+
+def run_turn(session, user_text, base_url, n_ctx=None, n_predict=N_PREDICT, summarize=None, on_text=None, **request):
+    """
+    Sends one user message in `session` (trimming first, see trim()) and streams the answer,
+    calling `on_text(chunk)` as it arrives. Appends the turn and saves the session.
+    Returns the turn dict: user, assistant, prompt_n (tokens evaluated this turn),
+    tokens_evaluated (prompt length), tokens_predicted, predicted_per_second and trimmed
+    (turns dropped before it).
+    Raises llama_client.ClientError; a cancelled turn (KeyboardInterrupt) is not recorded.
+    """
+    trimmed = trim(session, user_text, n_ctx, n_predict, summarize, tokenizer(base_url))
+    payload = dict(request, prompt=build_prompt(session, user_text), n_predict=n_predict, stream=True,
+                   cache_prompt=True, id_slot=session["slot"])
+    payload.setdefault("stop", STOP)
+    parts, final = [], {}
+    for data in llama_client.iter_completion(base_url, payload):
+        chunk = llama_sse.extract_content(data)
+        if chunk:
+            parts.append(chunk)
+            if on_text:
+                on_text(chunk)
+        if llama_sse.is_final(data):
+            final = json.loads(data)
+    timings = final.get("timings") or {}
+    evaluated, predicted = final.get("tokens_evaluated", 0), final.get("tokens_predicted", len(parts))
+    turn = {"user": user_text, "assistant": "".join(parts),
+            "prompt_n": timings.get("prompt_n", evaluated), "tokens_evaluated": evaluated,
+            "tokens_predicted": predicted,
+            "predicted_per_second": round(timings.get("predicted_per_second") or 0.0, 2), "trimmed": trimmed}
+    session["turns"].append(turn)
+    session["context_tokens"] = evaluated + predicted
+    save_session(session)
+    return turn
+
+
+def summarizer(base_url, system=""):
+    """A `summarize` function for trim() that asks the server (on any slot) to condense dropped turns."""
+    def summarize(text):
+        prompt = ((system.rstrip() + "\n\n") if system else "") + \
+            f"Summarize the following conversation in a few sentences.\n\n{text}\nSummary:"
+        result = asyncio.run(llama_client.complete(base_url, {"prompt": prompt, "n_predict": SUMMARY_TOKENS,
+                                                              "cache_prompt": False, "stop": STOP}))
+        return result.get("content", "")
+    return summarize
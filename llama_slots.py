@@ -0,0 +1,229 @@
+# llama_slots.py
+"""
+KV-cache slot persistence across llama-server restarts.
+
+With --slot-save-path, llama-server can write a slot's KV cache to a file and load it back
+(POST /slots/{id}?action=save|restore). save_slots() does that for every idle slot before a
+graceful stop; warm_start() restores them after the next start and then prefills the
+configured system prompts into the slots that are still empty, so the first requests after a
+restart reuse cached prefixes instead of paying full prompt processing.
+
+The save directory holds a manifest recording which model the files were produced by
+(model_fingerprint). Files from another model are deleted instead of restored.
+"""
+import os
+import json
+import time
+import sqlite3
+import http.client
+
+import llama_cache
+import llama_ready
+
+# --- Slot Persistence Configuration ---
+MANIFEST_FILENAME = "manifest.json"            # Inside the --slot-save-path directory
+WARM_PROMPTS_FILE = ".llama_warm_prompts.json" # JSON list of system prompts prefilled at startup
+MIN_SAVE_TOKENS = 16        # Slots caching fewer tokens are not worth a file
+ACTION_TIMEOUT = 120.0      # Seconds per save/restore/prefill request (large contexts move hundreds of MB)
+# --- End Configuration ---
+
+
+def model_fingerprint(model_path):
+    """
+    Identifies a model file: llama_cache.model_fingerprint (sha256 of the whole file, memoised
+    by path, size and mtime). Returns a hex string, or None if the file cannot be read.
+    """
+    try:
+        return llama_cache.model_fingerprint(model_path)
+    except (OSError, sqlite3.Error):
+        return None
+
+
+# --- Manifest ---
+
+def read_manifest(save_dir):
+    """Reads the manifest. Returns a dict with a 'slots' list (empty if there is none)."""
+    try:
+        with open(os.path.join(save_dir, MANIFEST_FILENAME), 'r') as f:
+            manifest = json.load(f)
+        if isinstance(manifest, dict) and isinstance(manifest.get('slots'), list):
+            return manifest
+    except (IOError, ValueError):
+        pass
+    return {'slots': []}
+
+def write_manifest(save_dir, manifest):
+    """Atomically replaces the manifest. Returns True on success, False on error."""
+    path = os.path.join(save_dir, MANIFEST_FILENAME)
+    try:
+        with open(f"{path}.tmp", 'w') as f:
+            json.dump(manifest, f, indent=2)
+        os.replace(f"{path}.tmp", path)
+        return True
+    except OSError:
+        return False
+
+def discard_saved(save_dir, manifest):
+    """Deletes the slot files listed in `manifest` and the manifest itself."""
+    for entry in manifest['slots']:
+        try:
+            os.remove(os.path.join(save_dir, entry['filename']))
+        except (OSError, KeyError, TypeError):
+            pass
+    try:
+        os.remove(os.path.join(save_dir, MANIFEST_FILENAME))
+    except OSError:
+        pass
+
+def load_warm_prompts(path=None):
+    """System prompts listed in WARM_PROMPTS_FILE (a JSON list of strings); [] if none."""
+    try:
+        with open(path or WARM_PROMPTS_FILE, 'r') as f:
+            prompts = json.load(f)
+    except (IOError, ValueError):
+        return []
+    if not isinstance(prompts, list):
+        return []
+    return [p for p in prompts if isinstance(p, str) and p]
+
+
+# --- Server Requests ---
+
+def _request(port, method, path, body=None, timeout=ACTION_TIMEOUT):
+    """Sends one JSON request. Returns (status, parsed body); status 0 if the server is unreachable."""
+    conn = http.client.HTTPConnection(llama_ready.HOST, port, timeout=timeout)
+    try:
+        payload = json.dumps(body).encode() if body is not None else None
+        conn.request(method, path, body=payload, headers={"Content-Type": "application/json"} if payload else {})
+        response = conn.getresponse()
+        data = response.read()
+    except (OSError, http.client.HTTPException) as e:
+        return 0, str(e) or e.__class__.__name__
+    finally:
+        conn.close()
+    try:
+        return response.status, json.loads(data)
+    except ValueError:
+        return response.status, data.decode("utf-8", "replace")
+
+def _error(status, data):
+    if isinstance(data, dict) and isinstance(data.get('error'), dict):
+        return f"HTTP {status}: {data['error'].get('message')}"
+    return f"HTTP {status}: {data}" if status else f"unreachable: {data}"
+
+def list_slots(port):
+    """Slots as reported by GET /slots (dicts with 'id' and 'is_processing'), or None if unavailable."""
+    status, data = _request(port, "GET", "/slots", timeout=llama_ready.PROBE_TIMEOUT)
+    if status != 200 or not isinstance(data, list):
+        return None
+    return [slot for slot in data if isinstance(slot, dict) and isinstance(slot.get('id'), int)]
+
+def slot_action(port, id_slot, action, filename=None):
+    """POST /slots/{id}?action=... Returns tuple (success: bool, response dict or error message)."""
+    body = {"filename": filename} if filename else {}
+    status, data = _request(port, "POST", f"/slots/{id_slot}?action={action}", body)
+    if status == 200 and isinstance(data, dict):
+        return True, data
+    return False, _error(status, data)
+
+
+# --- Save / Restore ---
+
+def slot_filename(id_slot):
+    return f"slot-{id_slot}.bin"
+
+def save_slots(port, model_path, save_dir):
+    """
+    Saves the KV cache of every idle slot holding at least MIN_SAVE_TOKENS tokens and records
+    them in the manifest with the model fingerprint. Busy slots are skipped.
+    Returns tuple (saved: int, message: str).
+    """
+    slots = list_slots(port)
+    if slots is None:
+        return 0, f"Slots not saved: server on port {port} did not list its slots."
+    previous = read_manifest(save_dir)
+    entries, skipped = [], 0
+    for slot in slots:
+        if slot.get('is_processing'):
+            skipped += 1
+            continue
+        filename = slot_filename(slot['id'])
+        success, result = slot_action(port, slot['id'], "save", filename)
+        if not success:
+            if "--slot-save-path" in result:
+                return 0, "Slots not saved: llama-server was started without --slot-save-path."
+            skipped += 1
+            continue
+        if result.get('n_saved', 0) < MIN_SAVE_TOKENS:
+            try:
+                os.remove(os.path.join(save_dir, filename))
+            except OSError:
+                pass
+            continue
+        entries.append({'id_slot': slot['id'], 'filename': filename, 'n_tokens': result['n_saved'],
+                        'bytes': result.get('n_written'), 'saved_at': time.time()})
+    # Files of slots that are empty now would restore an outdated cache
+    saved_names = {entry['filename'] for entry in entries}
+    discard_saved(save_dir, {'slots': [e for e in previous['slots'] if e.get('filename') not in saved_names]})
+    if entries:
+        write_manifest(save_dir, {'model': model_path, 'model_hash': model_fingerprint(model_path), 'slots': entries})
+    message = f"Saved {len(entries)} slot(s), {sum(e['n_tokens'] for e in entries)} tokens."
+    if skipped:
+        message += f" {skipped} busy or failed slot(s) skipped."
+    return len(entries), message
+
+def restore_slots(port, model_path, save_dir):
+    """
+    Restores the slots recorded in the manifest if they were saved with the same model.
+    Returns tuple (restored slot ids: list[int], message: str).
+    """
+    manifest = read_manifest(save_dir)
+    if not manifest['slots']:
+        return [], "No saved slots."
+    if manifest.get('model_hash') != model_fingerprint(model_path):
+        discard_saved(save_dir, manifest)
+        return [], f"Discarded saved slots: produced by a different model ({manifest.get('model')})."
+    slots = list_slots(port)
+    known = {slot['id'] for slot in slots} if slots is not None else set()
+    restored, failed = [], 0
+    for entry in manifest['slots']:
+        if entry.get('id_slot') not in known:
+            continue # The server now runs with fewer slots
+        success, result = slot_action(port, entry['id_slot'], "restore", entry['filename'])
+        if success:
+            restored.append(entry['id_slot'])
+        else:
+            failed += 1
+    message = f"Restored {len(restored)} slot(s)."
+    if failed:
+        message += f" {failed} slot file(s) could not be restored (context size changed?)."
+    return restored, message
+
+def prefill(port, prompts, skip_slots=()):
+    """
+    Processes each system prompt into its own slot (n_predict 0, cache_prompt), using the
+    slots not in `skip_slots` in order. Returns tuple (prefilled: int, message: str).
+    """
+    if not prompts:
+        return 0, "No warm-up prompts."
+    slots = list_slots(port)
+    if slots is None:
+        return 0, f"Warm-up skipped: server on port {port} did not list its slots."
+    free = [slot['id'] for slot in slots if slot['id'] not in skip_slots]
+    done = 0
+    for id_slot, prompt in zip(free, prompts):
+        status, data = _request(port, "POST", "/completion",
+                                {"prompt": prompt, "n_predict": 0, "id_slot": id_slot, "cache_prompt": True})
+        if status == 200:
+            done += 1
+    message = f"Prefilled {done} of {len(prompts)} warm-up prompt(s)."
+    if len(prompts) > len(free):
+        message += f" {len(prompts) - len(free)} had no free slot."
+    return done, message
+
+def warm_start(port, model_path, save_dir, prompts=None):
+    """Restores saved slots, then prefills the warm-up prompts into the remaining ones. Returns a summary message."""
+    restored, restore_message = restore_slots(port, model_path, save_dir)
+    prompts = load_warm_prompts() if prompts is None else prompts
+    _, prefill_message = prefill(port, prompts, skip_slots=restored)
+    return f"{restore_message} {prefill_message}"
@@ -0,0 +1,125 @@
+# llama_sse.py
+"""
+Incremental Server-Sent Events decoding for llama-server streams.
+
+SSEDecoder works on raw byte chunks as they come off the socket: events may be split
+across reads, lines may end in LF, CRLF or CR, and multi-line `data:` fields are joined
+with newlines as the SSE spec requires. extract_content() pulls just the `content`
+string out of a token event without building the whole JSON object, and only the final
+event (stop: true) is fully parsed. OutputBuffer batches terminal writes.
+"""
+import json
+import time
+from json.decoder import scanstring
+
+FLUSH_INTERVAL = 0.05 # Seconds between terminal flushes while streaming
+FLUSH_BYTES = 4096    # Flush early once this many characters are buffered
+
+_CONTENT_KEY = '"content":'
+_STOP_MARKERS = ('"stop":true', '"stop": true')
+
+
+class SSEDecoder:
+    """Turns a byte stream into SSE event payloads (the joined `data:` lines, as bytes)."""
+
+    __slots__ = ("_buf", "_data")
+
+    def __init__(self):
+        self._buf = b""
+        self._data = []
+
+    def feed(self, chunk):
+        """Consumes a chunk of bytes and returns the list of events it completed."""
+        buf = self._buf + chunk if self._buf else chunk
+        if b"\r" in buf:
+            if buf.endswith(b"\r"):
+                # A CRLF may be split across reads; wait for the next byte before deciding
+                self._buf = buf
+                return []
+            buf = buf.replace(b"\r\n", b"\n").replace(b"\r", b"\n")
+        lines = buf.split(b"\n")
+        self._buf = lines.pop() # Incomplete last line (b"" if the chunk ended on a newline)
+
+        events = []
+        data = self._data
+        for line in lines:
+            if not line:
+                if data:
+                    events.append(data[0] if len(data) == 1 else b"\n".join(data))
+                    data = self._data = []
+            elif line.startswith(b"data:"):
+                value = line[5:]
+                data.append(value[1:] if value.startswith(b" ") else value)
+            # Comments (":...") and other fields (event:, id:, retry:) are not needed here
+        return events
+
+    def close(self):
+        """Flushes an event left without a trailing blank line at end of stream. Returns list of events."""
+        events = self.feed(b"\n\n") if self._buf or self._data else []
+        self._buf, self._data = b"", []
+        return events
+
+
+def iter_events(chunks):
+    """Yields SSE event payloads (bytes) from an iterable of raw byte chunks."""
+    decoder = SSEDecoder()
+    for chunk in chunks:
+        if chunk:
+            yield from decoder.feed(chunk)
+    yield from decoder.close()
+
+
+def is_final(data):
+    """True if a llama-server event payload (str) is the last one of a completion (stop: true)."""
+    return any(marker in data for marker in _STOP_MARKERS)
+
+
+def extract_content(data):
+    """
+    Returns the `content` string of a llama-server event payload (str) without decoding
+    the rest of the object, or None if the event has no content field.
+    Falls back to a full json.loads for unusual formatting.
+    """
+    start = data.find(_CONTENT_KEY)
+    if start == -1:
+        return None
+    pos = start + len(_CONTENT_KEY)
+    if pos < len(data) and data[pos] == " ":
+        pos += 1
+    if pos < len(data) and data[pos] == '"':
+        try:
+            return scanstring(data, pos + 1)[0]
+        except ValueError:
+            pass
+    obj = json.loads(data)
+    return obj.get("content") if isinstance(obj, dict) else None
+
+
+class OutputBuffer:
+    """
+    Collects streamed text and hands it to `write` at most every `interval` seconds
+    or once `max_chars` are pending, instead of one write+flush per token.
+    """
+
+    __slots__ = ("_write", "_parts", "_size", "_last", "interval", "max_chars")
+
+    def __init__(self, write, interval=FLUSH_INTERVAL, max_chars=FLUSH_BYTES):
+        self._write = write
+        self._parts = []
+        self._size = 0
+        self._last = time.monotonic()
+        self.interval = interval
+        self.max_chars = max_chars
+
+    def add(self, text):
+        self._parts.append(text)
+        self._size += len(text)
+        if self._size >= self.max_chars or time.monotonic() - self._last >= self.interval:
+            self.flush()
+
+    def flush(self):
+        if self._parts:
+            self._write("".join(self._parts))
+            self._parts.clear()
+            self._size = 0
+        self._last = time.monotonic()
@@ -0,0 +1,352 @@
+# llama_trace.py
+"""
+Request traces and open-loop replay.
+
+Recording: with TRACE_REQUESTS on (or `chat-message --trace`), every completion made by
+chat-message and the daemon appends one JSON line to TRACE_FILENAME: arrival time, prompt,
+sampling parameters, prompt and generated token counts, and the TTFT and duration the
+client observed. With ANONYMIZE (the default) each prompt word is replaced by a word of
+VOCABULARY picked by a keyed hash of it (key in TRACE_KEY_FILENAME, created on first use),
+so prompts that share a prefix still do. Those words are about one token each, and on replay
+the prompt is padded or cut to the recorded prompt token count (replay_payload()). Replayed
+prompts therefore load the server and its prompt cache about as the originals did, without
+the text being stored.
+
+Replay: the trace is sent to a server open-loop. Each request starts at its scheduled time
+whether or not earlier ones have finished. A closed-loop benchmark (N clients, each waiting
+for its answer) slows down when the server does and never shows a growing queue; open-loop
+arrivals keep coming and expose it. Arrivals follow the trace's own timestamps (sped up or
+slowed down by `speed`) or a seeded Poisson process at a given rate. Requests share one
+llama_client ConnectionPool on one event loop.
+
+sweep() replays the trace at several load levels. For each level it reports TTFT and
+end-to-end latency percentiles against the offered rate. find_knee() names the first
+level where the server stops keeping up.
+"""
+import os
+import json
+import random
+import asyncio
+import hashlib
+import threading
+
+import llama_client
+import llama_sse
+from llama_bench import summarize
+
+# --- Trace Configuration ---
+TRACE_FILENAME = ".llama_trace.jsonl"
+TRACE_KEY_FILENAME = ".llama_trace.key"
+TRACE_REQUESTS = False      # Record chat-message and daemon completions (chat-message --trace does it per request)
+ANONYMIZE = True            # Store keyed stand-in words instead of the prompt text
+TRACE_PARAMS = ("n_predict", "temperature", "top_k", "top_p", "min_p", "seed", "repeat_penalty",
+                "cache_prompt", "ignore_eos") # Payload fields kept with each request
+REPLAY_FIRST_TOKEN_TIMEOUT = 300.0 # Seconds a replayed request may queue before it counts as an error
+KNEE_LATENCY_FACTOR = 2.0   # Saturated once TTFT p90 is this many times the lightest level's...
+KNEE_MIN_DELTA_MS = 100.0   # ...and at least this much above it
+KNEE_GOODPUT = 0.9          # ...or completions per second fall below this fraction of the offered rate
+# --- End Configuration ---
+
+MODES = ("original", "poisson")
+
+# Common English words that are a single token (with their leading space) in the usual
+# LLaMA/GPT vocabularies: anonymised prompts are about as many tokens as they have words
+VOCABULARY = tuple("""
+the of and to in is you that it he was for on are as with his they at be this have from or one
+had by word but not what all were we when your can said there use an each which she do how their
+if will up other about out many then them these so some her would make like him into time has
+look two more write go see number no way could people my than first water been call who its now
+find long down day did get come made may part over new sound take only little work know place
+year live me back give most very after thing our just name good sentence man think say great
+where help through much before line right too mean old any same tell boy follow came want show
+also around form three small set put end does another well large must big even such because turn
+here why ask went men read need land different home us move try kind hand picture again change
+off play spell air away animal house point page letter mother answer found study still learn
+should world high every near add food between own below country plant last school father keep
+tree never start city earth eye light thought head under story saw left few while along might
+close something seem next hard open example begin life always those both paper together got
+group often run important until children side feet car mile night walk white sea began grow
+""".split())
+
+_write_lock = threading.Lock() # The daemon records from one thread per request
+
+
+# --- Recording ---
+
+def enabled(flag=None):
+    """Whether to record: `flag` (a per-request override) if given, else TRACE_REQUESTS."""
+    return TRACE_REQUESTS if flag is None else flag
+
+
+def trace_key(path=None):
+    """The anonymisation key (bytes), created with a random value on first use."""
+    path = path or TRACE_KEY_FILENAME
+    try:
+        with open(path) as f:
+            return bytes.fromhex(f.read().strip())
+    except (OSError, ValueError):
+        pass
+    key = os.urandom(16)
+    fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+    with os.fdopen(fd, "w") as f:
+        f.write(key.hex() + "\n")
+    return key
+
+
+def _vocabulary_word(data, key=b""):
+    return VOCABULARY[int.from_bytes(hashlib.blake2b(data, key=key, digest_size=4).digest(), "big") % len(VOCABULARY)]
+
+
+def anonymize(text, key):
+    """Replaces every whitespace-separated word by a VOCABULARY word picked by its keyed hash."""
+    return " ".join(_vocabulary_word(word.encode(), key) for word in text.split())
+
+
+def trace_entry(payload, record, key=None):
+    """
+    Trace line for a /completion `payload` and its llama_metrics record (ts, status, ttft_s,
+    elapsed_s, tokens_evaluated, predicted_n / tokens). The prompt is anonymised when `key` is given. Returns None for
+    prompts that are not text (token id lists are not traced).
+    """
+    prompt = payload.get("prompt")
+    if not isinstance(prompt, str):
+        return None
+    return {
+        "ts": record.get("ts"),
+        "prompt": anonymize(prompt, key) if key else prompt,
+        "anonymized": key is not None,
+        "params": {k: payload[k] for k in TRACE_PARAMS if k in payload},
+        "status": record.get("status"),
+        "ttft_s": record.get("ttft_s"),
+        "elapsed_s": record.get("elapsed_s"),
+        "prompt_tokens": record.get("tokens_evaluated", record.get("prompt_n")),
+        "tokens": record.get("predicted_n", record.get("tokens")),
+    }
+
+
+def record(payload, metrics_record, path=None, anonymized=None):
+    """
+    Appends the trace line for one finished request. Like metrics, tracing must never break
+    a request: storage errors are swallowed. Returns the entry, or None if not traced.
+    """
+    anonymized = ANONYMIZE if anonymized is None else anonymized
+    try:
+        entry = trace_entry(payload, metrics_record, key=trace_key() if anonymized else None)
+        if entry is None:
+            return None
+        line = json.dumps(entry, separators=(",", ":")) + "\n"
+        with _write_lock, open(path or TRACE_FILENAME, "a", encoding="utf-8") as f:
+            f.write(line)
+    except OSError:
+        return None
+    return entry
+
+
+def load_trace(path=None):
+    """Trace entries sorted by arrival time. Torn or malformed lines are skipped."""
+    entries = []
+    with open(path or TRACE_FILENAME, encoding="utf-8") as f:
+        for line in f:
+            try:
+                entry = json.loads(line)
+            except ValueError:
+                continue
+            if isinstance(entry, dict) and isinstance(entry.get("prompt"), str) and entry.get("ts") is not None:
+                entries.append(entry)
+    entries.sort(key=lambda e: e["ts"])
+    return entries
+
+
+def trace_stats(entries):
+    """Request count, time span, mean arrival rate and the recorded latency percentiles of a trace."""
+    span = entries[-1]["ts"] - entries[0]["ts"] if entries else 0.0
+    return {
+        "requests": len(entries),
+        "span_s": span,
+        "rate_rps": (len(entries) - 1) / span if span > 0 else None,
+        "ttft_ms": summarize([e["ttft_s"] for e in entries if e.get("ttft_s") is not None], 1000),
+        "elapsed_ms": summarize([e["elapsed_s"] for e in entries if e.get("elapsed_s") is not None], 1000),
+    }
+
+
+# --- Arrival Schedules ---
+
+def schedule(entries, mode="original", speed=1.0, rate=None, count=None, seed=0):
+    """
+    Returns [(offset_s, entry)] sorted by offset, the first request at 0.
+    'original': the trace's own spacing divided by `speed` (2.0 = twice the recorded rate).
+    'poisson': `count` (default: the trace length) arrivals with exponential gaps at `rate`
+    requests/sec, cycling through the trace's requests.
+    """
+    if not entries:
+        return []
+    if mode == "original":
+        if speed <= 0:
+            raise ValueError("speed must be positive")
+        start = entries[0]["ts"]
+        return [((e["ts"] - start) / speed, e) for e in entries[:count]]
+    if mode == "poisson":
+        if not rate or rate <= 0:
+            raise ValueError("poisson arrivals need a positive rate")
+        rng = random.Random(seed)
+        offset, planned = 0.0, []
+        for i in range(count or len(entries)):
+            planned.append((offset, entries[i % len(entries)]))
+            offset += rng.expovariate(rate)
+        return planned
+    raise ValueError(f"unknown arrival mode '{mode}' (expected one of {', '.join(MODES)})")
+
+
+def replay_prompt(entry):
+    """
+    The prompt to replay. An anonymised one is cut or padded to the recorded prompt token
+    count, one VOCABULARY word per token. The padding is derived from the prompt itself, so
+    prompts that were identical stay identical.
+    """
+    prompt, target = entry["prompt"], entry.get("prompt_tokens")
+    if not entry.get("anonymized") or not target:
+        return prompt
+    words = prompt.split()[:target]
+    words += [_vocabulary_word(f"{prompt}\0{i}".encode()) for i in range(len(words), target)]
+    return " ".join(words)
+
+
+def replay_payload(entry):
+    """The /completion body for a trace entry, as long as the original prompt and generating as many tokens."""
+    payload = dict(entry.get("params") or {}, prompt=replay_prompt(entry), stream=True)
+    if entry.get("tokens"):
+        payload["n_predict"] = entry["tokens"]
+    return payload
+
+
+# --- Replay ---
+
+async def _send(pool, base_url, payload, due, lag):
+    """One replayed request; times it from its scheduled arrival, so client-side delays are not hidden."""
+    loop = asyncio.get_running_loop()
+    first, tokens = None, 0
+    result = {"lag_s": lag}
+    try:
+        async for data in llama_client.stream_completion(base_url, payload, pool=pool,
+                                                         first_token_timeout=REPLAY_FIRST_TOKEN_TIMEOUT):
+            if llama_sse.extract_content(data):
+                tokens += 1
+                if first is None:
+                    first = loop.time()
+        result["status"] = "ok"
+    except llama_client.HTTPStatusError as e:
+        result.update(status="error", error=f"HTTP {e.status}")
+    except llama_client.ClientError as e:
+        result.update(status="error", error=str(e))
+    result["done"] = loop.time()
+    result["ttft_s"] = first - due if first is not None else None
+    result["elapsed_s"] = result["done"] - due
+    result["tokens"] = tokens
+    return result
+
+
+async def _replay(base_url, planned, max_idle):
+    loop = asyncio.get_running_loop()
+    tasks = []
+    async with llama_client.ConnectionPool(max_idle=max_idle) as pool:
+        start = loop.time()
+        try:
+            for offset, entry in planned:
+                due = start + offset
+                delay = due - loop.time()
+                if delay > 0:
+                    await asyncio.sleep(delay)
+                # Launched on schedule, however many requests are still in flight
+                tasks.append(asyncio.create_task(_send(pool, base_url, replay_payload(entry), due, loop.time() - due)))
+            results = await asyncio.gather(*tasks)
+        except asyncio.CancelledError:
+            for task in tasks:
+                task.cancel() # Drop the open streams so the server stops generating
+            await asyncio.gather(*tasks, return_exceptions=True)
+            raise
+    for result in results:
+        result["done"] -= start
+    return results
+
+
+def _rate(times):
+    """Events per second over a sorted list of event times."""
+    span = times[-1] - times[0] if len(times) > 1 else 0.0
+    return (len(times) - 1) / span if span > 0 else None
+
+
+def summarize_level(planned, results):
+    """
+    Aggregates one replay: offered and completed rates (both measured between the first and
+    last event, so the last request's duration does not dilute either), error count, and
+    TTFT / end-to-end latency and launch lag summaries in milliseconds.
+    """
+    ok = [r for r in results if r["status"] == "ok"]
+    errors = [r["error"] for r in results if r["status"] != "ok"]
+    wall = max((r["done"] for r in results), default=0.0)
+    tokens = sum(r["tokens"] for r in ok)
+    return {
+        "requests": len(results),
+        "ok": len(ok),
+        "errors": len(errors),
+        "error_samples": errors[:3],
+        "offered_rps": _rate([offset for offset, _ in planned]),
+        "completed_rps": _rate(sorted(r["done"] for r in ok)),
+        "tokens_per_sec": tokens / wall if wall else 0.0,
+        "wall_s": wall,
+        "ttft_ms": summarize([r["ttft_s"] for r in ok if r["ttft_s"] is not None], 1000),
+        "e2e_ms": summarize([r["elapsed_s"] for r in ok], 1000),
+        "lag_ms": summarize([r["lag_s"] for r in results], 1000),
+    }
+
+
+def replay(base_url, planned, max_idle=llama_client.POOL_MAX_IDLE):
+    """Sends a schedule (see schedule()) to `base_url` open-loop. Returns summarize_level()'s dict."""
+    return summarize_level(planned, asyncio.run(_replay(base_url, planned, max_idle)))
+
+
+def find_knee(levels, latency_factor=KNEE_LATENCY_FACTOR, min_delta_ms=KNEE_MIN_DELTA_MS, goodput=KNEE_GOODPUT):
+    """
+    First saturated level, by offered rate: TTFT p90 above both `latency_factor` times and
+    `min_delta_ms` more than the lightest level's, completions per second under `goodput`
+    times the offered rate, or any failed request. Returns {'index', 'offered_rps', 'reason',
+    'sustained_rps'} (sustained_rps: the offered rate of the level before, None if the lightest
+    level is already saturated), or None if every level kept up.
+    """
+    ordered = sorted(range(len(levels)), key=lambda i: levels[i]["offered_rps"] or 0.0)
+    base = None
+    for position, i in enumerate(ordered):
+        level = levels[i]
+        ttft = (level["ttft_ms"] or {}).get("p90")
+        if base is None:
+            base = ttft
+        reason = None
+        if level["errors"]:
+            reason = f"{level['errors']} failed requests"
+        elif level["offered_rps"] and (level["completed_rps"] or 0.0) < goodput * level["offered_rps"]:
+            reason = f"completed {level['completed_rps'] or 0.0:.2f}/s of {level['offered_rps']:.2f}/s offered"
+        elif base is not None and ttft is not None and ttft > max(latency_factor * base, base + min_delta_ms):
+            reason = f"TTFT p90 {ttft:.0f} ms vs {base:.0f} ms at the lightest load"
+        if reason:
+            previous = levels[ordered[position - 1]]["offered_rps"] if position else None
+            return {"index": i, "offered_rps": level["offered_rps"], "reason": reason, "sustained_rps": previous}
+    return None
+
+
+def sweep(base_url, entries, mode="original", levels=(1.0,), count=None, seed=0, on_level=None):
+    """
+    Replays the trace once per load level: speed factors for 'original', rates (requests/sec)
+    for 'poisson'. `on_level(summary)` is called after each. Returns {'mode', 'levels', 'knee'};
+    each level summary carries its 'level' value.
+    """
+    summaries = []
+    for value in levels:
+        if mode == "poisson":
+            planned = schedule(entries, mode, rate=value, count=count, seed=seed)
+        else:
+            planned = schedule(entries, mode, speed=value, count=count)
+        summary = dict(replay(base_url, planned), level=value)
+        summaries.append(summary)
+        if on_level:
+            on_level(summary)
+    return {"mode": mode, "levels": summaries, "knee": find_knee(summaries)}
@@ -0,0 +1,221 @@
+# llama_tune.py
+"""
+Benchmark-driven tuning of llama-server launch parameters.
+
+tune() restarts the managed server once per candidate configuration (-b, -ub, -t, -tb,
+--parallel, --ctx-size), replays a workload through llama_bench and measures TTFT p50 and
+aggregate tokens/sec. Each candidate first gets a short probe; if the probe is clearly worse
+(by `margin` on both metrics) than a configuration already measured, the full run is skipped.
+The Pareto frontier and one chosen point are saved to llama_man.PROFILE_FILENAME, which
+start_llama_server and the pool apply automatically.
+"""
+import os
+import json
+import time
+import itertools
+
+import llama_man
+import llama_pool
+import llama_batch
+import llama_bench
+import llama_ready
+
+# --- Tuning Configuration ---
+BATCH_SIZES = (512, 1024, 2048)
+UBATCH_SIZES = (256, 512, 1024)
+PARALLEL_SLOTS = (1, 2, 4)
+REQUESTS_PER_CONFIG = 16  # Full measurement per candidate
+PROBE_REQUESTS = 4        # Probe run that decides whether the full measurement is worth it
+MARGIN = 0.2              # Probe this much worse on both TTFT and tokens/sec than a measured config -> pruned
+N_PREDICT = 64            # Tokens per request when the workload does not set n_predict
+PREFERENCES = ("balanced", "throughput", "latency")
+# --- End Configuration ---
+
+
+def default_threads():
+    """Thread counts worth trying: half and all of the available CPUs."""
+    cpus = len(llama_pool.available_cpus())
+    return sorted({max(1, cpus // 2), cpus})
+
+
+def current_params():
+    """The launch parameters start_llama_server uses today (configuration plus any saved profile)."""
+    params = {'ctx_size': llama_man.CTX_SIZE, 'batch_size': llama_man.BATCH_SIZE, 'ubatch_size': llama_man.UB,
+              'parallel': llama_man.PARALLEL}
+    params.update({k: v for k, v in llama_man.load_profile().items() if k != 'cache_reuse'})
+    return params
+
+
+def candidate_grid(batch_sizes=BATCH_SIZES, ubatch_sizes=UBATCH_SIZES, threads=None, threads_batch=None,
+                   parallel=PARALLEL_SLOTS, ctx_sizes=None):
+    """
+    Cartesian product of the candidate values as a list of params dicts (keys of
+    llama_man.PROFILE_FLAGS), skipping ubatch > batch. The current configuration goes first
+    so every other candidate is compared against it.
+    """
+    threads = threads or default_threads()
+    threads_batch = threads_batch or [None] # None: llama-server uses -t for batch processing too
+    ctx_sizes = ctx_sizes or [llama_man.CTX_SIZE]
+    grid = []
+    for b, ub, t, tb, n, ctx in itertools.product(batch_sizes, ubatch_sizes, threads, threads_batch, parallel, ctx_sizes):
+        if ub > b:
+            continue
+        params = {'ctx_size': ctx, 'batch_size': b, 'ubatch_size': ub, 'threads': t, 'parallel': n}
+        if tb is not None:
+            params['threads_batch'] = tb
+        grid.append(params)
+    current = current_params()
+    grid.sort(key=lambda p: any(current.get(k) != v for k, v in p.items() if k in current))
+    return grid
+
+
+def load_workload(path, prompt_field="prompt", n_predict=N_PREDICT, limit=None):
+    """/completion payloads from a JSONL prompt file (see llama_batch.iter_prompts); unbounded n_predict is capped."""
+    payloads = []
+    for _, payload in llama_batch.iter_prompts(path, prompt_field=prompt_field):
+        if payload.get("n_predict", -1) < 0:
+            payload["n_predict"] = n_predict
+        payloads.append(payload)
+        if limit and len(payloads) >= limit:
+            break
+    return payloads
+
+
+def describe(params):
+    """Command-line style summary of a params dict."""
+    return " ".join(f"{llama_man.PROFILE_FLAGS[k]} {v}" for k, v in params.items() if k in llama_man.PROFILE_FLAGS)
+
+
+# --- Pareto Selection ---
+
+def clearly_worse(candidate, reference, margin=MARGIN):
+    """True if `candidate` is worse than `reference` by more than `margin` on both tokens/sec and TTFT."""
+    return (candidate['tokens_per_sec'] * (1 + margin) < reference['tokens_per_sec']
+            and candidate['ttft_ms'] > reference['ttft_ms'] * (1 + margin))
+
+
+def dominates(a, b):
+    """a is at least as good as b on both metrics and better on one."""
+    return (a['tokens_per_sec'] >= b['tokens_per_sec'] and a['ttft_ms'] <= b['ttft_ms']
+            and (a['tokens_per_sec'] > b['tokens_per_sec'] or a['ttft_ms'] < b['ttft_ms']))
+
+
+def pareto_front(results):
+    """Measured results not dominated by any other, fastest TTFT first."""
+    measured = [r for r in results if r['status'] == 'ok']
+    front = [r for r in measured if not any(dominates(o['metrics'], r['metrics']) for o in measured)]
+    return sorted(front, key=lambda r: r['metrics']['ttft_ms'])
+
+
+def choose(front, prefer="balanced"):
+    """
+    Picks one point of the frontier: 'throughput' (most tokens/sec), 'latency' (lowest TTFT)
+    or 'balanced' (best product of both, each relative to the best value on the frontier).
+    """
+    if prefer == "throughput":
+        return max(front, key=lambda r: r['metrics']['tokens_per_sec'])
+    if prefer == "latency":
+        return min(front, key=lambda r: r['metrics']['ttft_ms'])
+    best_tps = max(r['metrics']['tokens_per_sec'] for r in front) or 1.0
+    best_ttft = min(r['metrics']['ttft_ms'] for r in front) or 1.0
+    return max(front, key=lambda r: (r['metrics']['tokens_per_sec'] / best_tps) * (best_ttft / r['metrics']['ttft_ms']))
+
+
+# --- Measurement ---
+
+def _metrics(level):
+    if level['errors'] or not level['ttft_ms']:
+        return None
+    return {'tokens_per_sec': level['tokens_per_sec'], 'ttft_ms': level['ttft_ms']['p50'],
+            'ttft_p99_ms': level['ttft_ms']['p99'], 'itl_p50_ms': (level['itl_ms'] or {}).get('p50')}
+
+
+def measure(params, payloads, concurrency, requests=REQUESTS_PER_CONFIG, probe_requests=PROBE_REQUESTS,
+            references=(), margin=MARGIN, n_predict=N_PREDICT):
+    """
+    Restarts the managed server with `params` and measures it. Returns a result dict with
+    'status' ok / pruned / failed, 'metrics' and 'elapsed_s'.
+    """
+    start = time.monotonic()
+    result = {'params': params, 'status': 'failed', 'metrics': None}
+    llama_man.stop_llama_server(force=True, save_slots=False)
+    # Thread settings left out of a candidate must not be inherited from a previously saved profile
+    launch = {'threads': None, 'threads_batch': None}
+    launch.update(params)
+    success, message, _ = llama_man.start_llama_server(params=launch, warm=False) # Cold, like every candidate
+    if not success:
+        result['error'] = message
+    else:
+        url = f"http://{llama_ready.HOST}:{llama_man.PORT}"
+        probe = _metrics(llama_bench.run_level(url, concurrency, probe_requests, n_predict=n_predict, payloads=payloads))
+        if probe is None:
+            result['error'] = "probe requests failed"
+        elif any(clearly_worse(probe, r['metrics'], margin) for r in references):
+            result.update(status='pruned', metrics=probe)
+        else:
+            full = _metrics(llama_bench.run_level(url, concurrency, requests, n_predict=n_predict, payloads=payloads))
+            if full is None:
+                result['error'] = "requests failed"
+            else:
+                result.update(status='ok', metrics=full)
+    result['elapsed_s'] = round(time.monotonic() - start, 3)
+    return result
+
+
+def save_profile(profile):
+    """Atomically writes the profile file. Returns True on success."""
+    tmp_path = f"{llama_man.PROFILE_FILENAME}.tmp"
+    try:
+        with open(tmp_path, 'w') as f:
+            json.dump(profile, f, indent=2)
+        os.replace(tmp_path, llama_man.PROFILE_FILENAME)
+        return True
+    except OSError:
+        return False
+
+
+def tune(grid, payloads=None, concurrency=None, requests=REQUESTS_PER_CONFIG, probe_requests=PROBE_REQUESTS,
+         margin=MARGIN, prefer="balanced", n_predict=N_PREDICT, on_result=None):
+    """
+    Measures every candidate in `grid`, saves the Pareto-best profile and returns
+    (profile or None, list of results). `concurrency` defaults to the largest --parallel in
+    the grid. `on_result(index, result)` is called after each candidate. A server that was
+    running before is restarted afterwards with the new profile.
+    """
+    concurrency = concurrency or max(p.get('parallel') or llama_man.PARALLEL for p in grid)
+    was_running = llama_man.status_llama_server()[0] == "RUNNING"
+    if was_running:
+        llama_man.stop_llama_server(force=True) # Saves its slots; restored by the restart below
+    results = []
+    try:
+        for index, params in enumerate(grid):
+            references = [r for r in results if r['status'] == 'ok']
+            result = measure(params, payloads, concurrency, requests, probe_requests, references, margin, n_predict)
+            results.append(result)
+            if on_result:
+                on_result(index, result)
+    finally:
+        llama_man.stop_llama_server(force=True, save_slots=False)
+
+    front = pareto_front(results)
+    if not front:
+        return None, results
+    best = choose(front, prefer)
+    profile = {
+        'model': llama_man.MODEL_PATH,
+        'created': time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+        'prefer': prefer,
+        'concurrency': concurrency,
+        'workload_requests': requests,
+        'params': best['params'],
+        'metrics': best['metrics'],
+        'pareto': [{'params': r['params'], 'metrics': r['metrics']} for r in front],
+        'tried': len(results),
+        'pruned': sum(r['status'] == 'pruned' for r in results),
+        'failed': sum(r['status'] == 'failed' for r in results),
+    }
+    if not save_profile(profile):
+        profile['error'] = f"could not write {llama_man.PROFILE_FILENAME}"
+    if was_running:
+        llama_man.start_llama_server()
+    return profile, results
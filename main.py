@@ -1,7 +1,15 @@
 # main.py
-# Import the command function exported from clitest_server.py
-from clitest_server import cli
+import sys
 
 if __name__ == '__main__':
+    # Fast path: a plain `--prompt` is answered by the resident daemon, when one is running,
+    # before click and requests are imported (see llama_daemon.py)
+    import llama_daemon
+    exit_code = llama_daemon.fast_main(sys.argv[1:])
+    if exit_code is not None:
+        sys.exit(exit_code)
+
+    # Import the command function exported from clitest_server.py
+    from clitest_server import cli
     # Execute the Click command function
-    cli()
\ No newline at end of file
+    cli()
@@ -0,0 +1,63 @@
+# tests/conftest.py
+
+import os
+import sys
+import socket
+
+import pytest
+
+import llama_gguf
+
+FAKE_SERVER = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "fake_llama_server.py")
+
+# A two-layer llama-style model small enough to write in every test
+TINY_MODEL_METADATA = {
+    "general.architecture": "llama", "general.name": "tiny", "llama.block_count": 2, "llama.context_length": 2048,
+    "llama.embedding_length": 64, "llama.attention.head_count": 4, "llama.attention.head_count_kv": 2,
+}
+TINY_MODEL_TENSORS = [("token_embd.weight", [64, 32], 1), ("blk.0.attn_q.weight", [64, 64], 8)]
+
+
+def write_tiny_model(path, truncate=0):
+    """Writes a valid (or, with `truncate`, cut short) GGUF file for TINY_MODEL_METADATA. Returns the path as str."""
+    return str(llama_gguf.write_gguf(str(path), TINY_MODEL_METADATA, TINY_MODEL_TENSORS, truncate=truncate))
+
+
+def free_port_range(count):
+    """Returns the first port of `count` consecutive ports that are currently free."""
+    for _ in range(50):
+        with socket.socket() as probe:
+            probe.bind(("127.0.0.1", 0))
+            base = probe.getsockname()[1]
+        if base + count > 65535:
+            continue
+        socks = []
+        try:
+            for port in range(base, base + count):
+                s = socket.socket()
+                socks.append(s)
+                s.bind(("127.0.0.1", port))
+            return base
+        except OSError:
+            continue
+        finally:
+            for s in socks:
+                s.close()
+    raise RuntimeError(f"no {count} consecutive free ports found")
+
+
+@pytest.fixture
+def fake_llama_install(tmp_path, mocker, monkeypatch):
+    """
+    Points llama_man at an executable wrapper around fake_llama_server.py and a dummy model,
+    and keeps every state file inside tmp_path. Returns the wrapper script path.
+    """
+    server = tmp_path / "llama-server"
+    server.write_text(f'#!/bin/sh\nexec "{sys.executable}" "{FAKE_SERVER}" "$@"\n')
+    server.chmod(0o755)
+    model = write_tiny_model(tmp_path / "model.gguf")
+    mocker.patch('llama_man.SERVER_PATH', str(server))
+    mocker.patch('llama_man.MODEL_PATH', model)
+    mocker.patch('llama_man.PORT', free_port_range(1))
+    monkeypatch.chdir(tmp_path) # PID and state files are relative to the working directory
+    return server
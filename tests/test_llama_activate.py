@@ -0,0 +1,118 @@
+# tests/test_llama_activate.py
+
+import os
+import json
+import time
+import threading
+
+import pytest
+import requests
+
+import llama_activate
+import llama_man
+from conftest import free_port_range
+
+
+@pytest.fixture
+def listener(fake_llama_install, mocker, tmp_path):
+    """On-demand listener in front of the fake server; llama_man.PORT becomes the private backend port."""
+    mocker.patch('llama_man.SLOT_SAVE_PATH', None)
+    mocker.patch('llama_activate.ACTIVATE_EVENTS', str(tmp_path / "events.jsonl"))
+    listen_port = free_port_range(1)
+    backend = llama_activate.Backend(idle_timeout=60)
+    httpd = llama_activate.make_server(backend, port=listen_port)
+    thread = threading.Thread(target=httpd.serve_forever, kwargs={"poll_interval": 0.05}, daemon=True)
+    thread.start()
+    try:
+        yield backend, f"http://127.0.0.1:{listen_port}"
+    finally:
+        httpd.shutdown()
+        httpd.server_close()
+        llama_man.stop_llama_server(force=True)
+
+
+def wait_idle(backend):
+    """The handler releases the backend just after the client has its response."""
+    deadline = time.monotonic() + 5
+    while backend.stats()["inflight"] and time.monotonic() < deadline:
+        time.sleep(0.01)
+
+
+def complete(url, prompt="a b c"):
+    return requests.post(f"{url}/completion", json={"prompt": prompt, "n_predict": 3}, timeout=30)
+
+
+def test_first_requests_start_one_server_and_wait_for_it(listener, mocker):
+    backend, url = listener
+    spawn = mocker.spy(llama_man, 'spawn_server_process')
+    responses = []
+    threads = [threading.Thread(target=lambda: responses.append(complete(url))) for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join(timeout=30)
+
+    assert [r.status_code for r in responses] == [200] * 4
+    assert all(r.json()["tokens_predicted"] == 3 for r in responses)
+    assert spawn.call_count == 1
+    events = llama_activate.read_events()
+    assert [e["event"] for e in events] == ["cold_start"]
+    assert events[0]["ok"] and events[0]["ready_s"] > 0
+
+
+def test_passive_requests_neither_start_nor_keep_alive(listener):
+    backend, url = listener
+    assert requests.get(f"{url}/health", timeout=5).status_code == 503 # Not ready while scaled to zero
+    assert requests.get(f"{url}/metrics", timeout=5).status_code == 503
+    assert backend.stats()["state"] == llama_activate.STOPPED
+
+    assert complete(url).status_code == 200
+    assert requests.get(f"{url}/health", timeout=5).status_code == 200
+    assert requests.get(f"{url}/slots", timeout=5).status_code == 200 # Relayed while running
+    assert requests.get(f"{url}/activate/stats", timeout=5).json()["state"] == llama_activate.RUNNING
+
+
+def test_ensure_server_defers_to_listener(listener, mocker, tmp_path):
+    backend, url = listener
+    listen_port = int(url.rsplit(":", 1)[1])
+    state_path = tmp_path / "activate.json"
+    state_path.write_text(json.dumps({"pid": os.getpid(), "port": listen_port}))
+    mocker.patch('llama_activate.ACTIVATE_STATE_FILENAME', str(state_path))
+    spawn = mocker.spy(llama_man, 'spawn_server_process')
+    assert llama_activate.running_activate_port() == listen_port # Found while scaled to zero
+
+    # The listener holds another port: starting a server next to it is refused
+    assert llama_man.ensure_server_running_or_fail()[0] == "FAILED_START"
+    # The listener holds PORT: requests to PORT reach it, so nothing needs starting
+    mocker.patch('llama_man.PORT', listen_port)
+    assert llama_man.ensure_server_running_or_fail()[0] == "RUNNING"
+    assert spawn.call_count == 0 and backend.stats()["state"] == llama_activate.STOPPED
+
+
+def test_idle_server_is_stopped_and_restarted_on_demand(listener):
+    backend, url = listener
+    assert complete(url).status_code == 200
+    wait_idle(backend)
+    assert not backend.reap() # Not idle yet
+
+    assert backend.reap(now=backend.last_active + backend.idle_timeout)
+    assert llama_man.status_llama_server()[0] != "RUNNING"
+
+    assert complete(url).status_code == 200
+    assert [e["event"] for e in llama_activate.read_events()] == ["cold_start", "idle_stop", "cold_start"]
+
+
+def test_summarize_events_weighs_resident_time():
+    events = [
+        {"event": "cold_start", "ok": True, "ready_s": 2.0, "at": 102.0},
+        {"event": "idle_stop", "ok": True, "idle_s": 600, "resident_s": 900.0, "rss_mb": 1024.0, "at": 1002.0},
+        {"event": "cold_start", "ok": True, "ready_s": 4.0, "at": 4602.0},
+        {"event": "idle_stop", "ok": True, "idle_s": 600, "resident_s": 700.0, "rss_mb": 1024.0, "at": 5300.0},
+    ]
+    summary = llama_activate.summarize_events(events)
+
+    assert (summary["cold_starts"], summary["idle_stops"]) == (2, 2)
+    assert summary["cold_start_s"]["max"] == 4.0 and summary["cold_start_s"]["mean"] == 3.0
+    assert summary["resident_s"] == 1600.0
+    assert summary["unloaded_s"] == 3600.0 # 100 .. 5300 minus resident time
+    assert summary["reclaimed_mb_hours"] == 1024.0
@@ -0,0 +1,91 @@
+# tests/test_llama_batch.py
+
+import json
+
+import pytest
+
+import llama_batch
+from fake_llama_server import FakeLlamaServer
+
+
+@pytest.fixture
+def fake_server():
+    with FakeLlamaServer(n_slots=2, token_delay=0.001) as server:
+        yield server
+
+
+def write_jsonl(path, records):
+    path.write_text("".join(json.dumps(r) + "\n" for r in records))
+
+
+def read_jsonl(path):
+    return [json.loads(line) for line in path.read_text().splitlines() if line.strip()]
+
+
+def test_iter_prompts_fields_and_ids(tmp_path):
+    src = tmp_path / "in.jsonl"
+    write_jsonl(src, [
+        {"request_id": "a", "body": "first prompt", "n_predict": 4, "title": "ignored"},
+        {"body": "second prompt"},
+    ])
+
+    items = list(llama_batch.iter_prompts(src, prompt_field="body"))
+
+    assert items == [
+        ("a", {"prompt": "first prompt", "n_predict": 4}),
+        ("2", {"prompt": "second prompt", "n_predict": -1}),
+    ]
+
+
+def test_iter_prompts_missing_field_raises(tmp_path):
+    src = tmp_path / "in.jsonl"
+    write_jsonl(src, [{"text": "no prompt here"}])
+    with pytest.raises(ValueError, match="missing prompt field"):
+        list(llama_batch.iter_prompts(src))
+
+
+def test_run_batch_writes_results_and_reports_throughput(tmp_path, fake_server):
+    src, out = tmp_path / "in.jsonl", tmp_path / "out.jsonl"
+    write_jsonl(src, [{"id": i, "prompt": f"prompt number {i}", "n_predict": 3} for i in range(10)])
+
+    summary = llama_batch.run_batch(src, out, base_url=fake_server.url)
+
+    results = read_jsonl(out)
+    assert sorted(r["id"] for r in results) == sorted(str(i) for i in range(10))
+    assert all(r["tokens_predicted"] == 3 for r in results)
+    assert summary["completed"] == 10
+    assert summary["concurrency"] == 2 # Taken from the server's slot count
+    assert summary["tokens_predicted"] == 30
+    assert summary["prompts_per_sec"] > 0
+
+
+def test_run_batch_resumes_from_checkpoint(tmp_path, fake_server):
+    src, out = tmp_path / "in.jsonl", tmp_path / "out.jsonl"
+    write_jsonl(src, [{"id": i, "prompt": f"p {i}", "n_predict": 2} for i in range(5)])
+    # Ids 0 and 1 finished before the interruption, 2 failed, the last line was torn mid-write
+    out.write_text(
+        json.dumps({"id": "0", "content": "x"}) + "\n"
+        + json.dumps({"id": "1", "content": "y"}) + "\n"
+        + json.dumps({"id": "2", "error": "boom"}) + "\n"
+        + '{"id": "3", "cont'
+    )
+
+    summary = llama_batch.run_batch(src, out, base_url=fake_server.url, concurrency=1)
+
+    assert summary["skipped"] == 2
+    assert summary["completed"] == 3
+    assert fake_server.requests_served == 3
+    assert llama_batch.load_completed_ids(out) == {"0", "1", "2", "3", "4"}
+
+
+def test_run_batch_counts_only_skipped_inputs(tmp_path, fake_server):
+    src, out = tmp_path / "in.jsonl", tmp_path / "out.jsonl"
+    write_jsonl(src, [{"id": i, "prompt": f"p {i}", "n_predict": 2} for i in range(3)])
+    # Ids from another input file are in the checkpoint but not among these prompts
+    out.write_text("".join(json.dumps({"id": i, "content": "x"}) + "\n" for i in ("0", "a", "b")))
+
+    summary = llama_batch.run_batch(src, out, base_url=fake_server.url, concurrency=1)
+
+    assert summary["skipped"] == 1 and summary["completed"] == 2
+    with pytest.raises(ValueError):
+        llama_batch.run_batch(src, out, base_url=fake_server.url, concurrency=0)
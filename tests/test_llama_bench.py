@@ -0,0 +1,114 @@
+# tests/test_llama_bench.py
+
+import json
+
+import pytest
+import requests
+
+import llama_bench
+import llama_man
+import llama_metrics
+import llama_pid
+from conftest import free_port_range
+from fake_llama_server import FakeLlamaServer
+
+
+def test_percentile_interpolates():
+    data = [1.0, 2.0, 3.0, 4.0]
+    assert llama_bench.percentile(data, 0) == 1.0
+    assert llama_bench.percentile(data, 50) == 2.5
+    assert llama_bench.percentile(data, 100) == 4.0
+    assert llama_bench.percentile([], 50) is None
+
+
+def test_summarize_scales_and_handles_empty():
+    summary = llama_bench.summarize([0.001, 0.003, 0.002], scale=1000)
+    assert summary["p50"] == pytest.approx(2.0)
+    assert summary["max"] == pytest.approx(3.0)
+    assert summary["n"] == 3
+    assert llama_bench.summarize([]) is None
+
+
+def test_fake_metrics_disabled_by_default():
+    with FakeLlamaServer() as server:
+        response = requests.get(f"{server.url}/metrics", timeout=5)
+        assert response.status_code == 501
+        assert llama_metrics.scrape_metrics(server.port) is None
+
+
+def test_fake_metrics_count_tokens():
+    with FakeLlamaServer(metrics=True) as server:
+        requests.post(f"{server.url}/completion", json={"prompt": "a b c", "n_predict": 5}, timeout=5)
+        metrics = llama_metrics.scrape_metrics(server.port)
+
+    assert metrics["llamacpp:tokens_predicted_total"] == 5
+    assert metrics["llamacpp:prompt_tokens_total"] == 3
+    assert metrics["llamacpp:requests_processing"] == 0
+
+
+def test_fake_jitter_stays_within_bounds():
+    server = FakeLlamaServer(token_delay=0.01, jitter=0.5, seed=3)
+    try:
+        delays = [server.next_token_delay() for _ in range(200)]
+    finally:
+        server.httpd.server_close()
+    assert all(0.005 <= d <= 0.015 for d in delays)
+    assert len(set(delays)) > 1
+
+
+def test_run_level_measures_streams():
+    with FakeLlamaServer(token_delay=0.002, n_slots=2) as server:
+        level = llama_bench.run_level(server.url, streams=2, requests_total=4, n_predict=6, prompt_words=4)
+
+    assert level["requests"] == 4 and level["errors"] == 0
+    assert level["tokens"] == 24
+    assert level["ttft_ms"]["n"] == 4
+    assert level["itl_ms"]["n"] == 4 * 5
+    assert level["tokens_per_sec"] > 0
+    assert level["client_cpu_us_per_token"] > 0
+
+
+def test_compare_flags_regressions_in_the_bad_direction():
+    baseline = {"time_to_ready_s": {"p50": 1.0},
+                "levels": [{"streams": 1, "tokens_per_sec": 100.0, "ttft_ms": {"p50": 10.0, "p99": 20.0}}]}
+    current = {"time_to_ready_s": {"p50": 0.5},
+               "levels": [{"streams": 1, "tokens_per_sec": 80.0, "ttft_ms": {"p50": 10.5, "p99": 30.0}}]}
+
+    rows = {row["metric"]: row for row in llama_bench.compare(baseline, current, tolerance=0.1)}
+
+    assert not rows["time_to_ready_s.p50"]["regression"]  # Faster start
+    assert rows["streams=1.tokens_per_sec"]["regression"] # 20% fewer tokens/sec
+    assert not rows["streams=1.ttft_ms.p50"]["regression"] # Within tolerance
+    assert rows["streams=1.ttft_ms.p99"]["regression"]
+    assert "streams=1.itl_ms.p50" not in rows              # Missing on both sides
+
+
+def test_run_benchmark_with_fake_server_is_offline_and_isolated(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    server_path, pid_filename = llama_man.SERVER_PATH, llama_pid.PID_FILENAME
+
+    result = llama_bench.run_benchmark(concurrency=(2, 1), requests_per_level=2, n_predict=4, prompt_words=4,
+                                       ready_runs=1, startup_delay=0.1, token_rate=500, jitter=0.1)
+
+    assert "error" not in result
+    assert result["time_to_ready_s"]["n"] == 1
+    assert result["time_to_ready_s"]["p50"] >= 0.1
+    assert [level["streams"] for level in result["levels"]] == [1, 2]
+    assert all(level["tokens"] == 8 for level in result["levels"])
+    assert result["server_metrics"]["llamacpp:tokens_predicted_total"] == 16
+    # Configuration restored and no state left in the working directory
+    assert (llama_man.SERVER_PATH, llama_pid.PID_FILENAME) == (server_path, pid_filename)
+    assert list(tmp_path.iterdir()) == []
+
+
+def test_fake_benchmark_ignores_the_real_rpc_group(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    # A real RPC group whose worker is not reachable: the stand-in would fail to connect to it
+    group = {"workers": [{"endpoint": f"127.0.0.1:{free_port_range(1)}"}], "remote_free_mb": 1e6}
+    (tmp_path / llama_man.RPC_GROUP_FILENAME).write_text(json.dumps(group))
+
+    result = llama_bench.run_benchmark(concurrency=(1,), requests_per_level=1, n_predict=2, prompt_words=2,
+                                       ready_runs=1, startup_delay=0.0, token_rate=500)
+
+    assert "error" not in result
+    assert json.loads((tmp_path / llama_man.RPC_GROUP_FILENAME).read_text()) == group
@@ -0,0 +1,113 @@
+# tests/test_llama_cache.py
+
+import os
+import json
+import threading
+import time
+
+import pytest
+
+import llama_cache
+
+
+@pytest.fixture(autouse=True)
+def cache_dir(tmp_path, monkeypatch):
+    monkeypatch.setattr(llama_cache, "CACHE_DIR", str(tmp_path / "cache"))
+    return tmp_path / "cache"
+
+
+def fake_stream(text="hello world", delay=0.0, complete=True, calls=None):
+    """Returns a generate() callable producing llama-server style data payloads."""
+    def generate():
+        if calls is not None:
+            calls.append(1)
+        for word in text.split():
+            if delay:
+                time.sleep(delay)
+            yield json.dumps({"content": word + " ", "stop": False})
+        if complete:
+            yield json.dumps({"content": "", "stop": True, "tokens_predicted": len(text.split())})
+    return generate
+
+
+def test_cache_key_is_canonical():
+    a = llama_cache.cache_key("m", {"prompt": "p", "temperature": 0, "n_predict": 8, "stream": True})
+    b = llama_cache.cache_key("m", {"n_predict": 8, "temperature": 0, "prompt": "p", "id_slot": 1})
+    assert a == b
+    assert a != llama_cache.cache_key("m2", {"prompt": "p", "temperature": 0, "n_predict": 8})
+    assert a != llama_cache.cache_key("m", {"prompt": "p", "temperature": 0, "n_predict": 9})
+
+
+def test_is_cacheable():
+    assert llama_cache.is_cacheable({"temperature": 0})
+    assert llama_cache.is_cacheable({"seed": 42})
+    assert not llama_cache.is_cacheable({"seed": -1})
+    assert not llama_cache.is_cacheable({})
+
+
+def test_miss_then_hit_replays_identical_stream():
+    calls = []
+    first = list(llama_cache.stream("k1", fake_stream(calls=calls)))
+    second = list(llama_cache.stream("k1", fake_stream(calls=calls)))
+
+    assert first == second
+    assert len(calls) == 1
+    stats = llama_cache.stats()
+    assert (stats["hits"], stats["misses"], stats["entries"]) == (1, 1, 1)
+    assert stats["bytes_served"] == sum(len(d) for d in second)
+
+
+def test_incomplete_stream_is_not_stored():
+    list(llama_cache.stream("k2", fake_stream(complete=False)))
+    assert not llama_cache.contains("k2")
+    assert llama_cache.stats()["entries"] == 0
+
+
+def test_paced_replay_follows_original_timing():
+    list(llama_cache.stream("k3", fake_stream("a b c d", delay=0.02)))
+    start = time.monotonic()
+    list(llama_cache.stream("k3", fake_stream(), pace=1.0))
+    assert time.monotonic() - start >= 0.06
+
+
+def test_lru_eviction_keeps_recently_used():
+    for key in ("old", "used", "new"):
+        list(llama_cache.stream(key, fake_stream("x " * 50)))
+        time.sleep(0.01)
+    llama_cache.lookup("used") # Touch so "old" is least recently used
+    total = llama_cache.stats()["size_bytes"]
+    old_size = os.path.getsize(llama_cache._entry_path("old"))
+
+    evicted = llama_cache.evict(max_bytes=total - old_size)
+
+    assert evicted == 1
+    assert not llama_cache.contains("old")
+    assert llama_cache.contains("used") and llama_cache.contains("new")
+
+
+def test_concurrent_identical_requests_are_coalesced():
+    calls, results = [], [None] * 4
+
+    def worker(i):
+        results[i] = list(llama_cache.stream("k4", fake_stream("one two three four five", delay=0.02, calls=calls)))
+
+    threads = [threading.Thread(target=worker, args=(i,)) for i in range(4)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+
+    assert len(calls) == 1
+    assert all(r == results[0] for r in results)
+    stats = llama_cache.stats()
+    assert stats["misses"] == 1
+    assert stats["coalesced"] + stats["hits"] == 3
+
+
+def test_model_fingerprint_is_memoised(tmp_path, mocker):
+    model = tmp_path / "m.gguf"
+    model.write_bytes(b"GGUF" + b"\0" * 1000)
+    first = llama_cache.model_fingerprint(str(model))
+    spy = mocker.spy(llama_cache.hashlib, "sha256")
+    assert llama_cache.model_fingerprint(str(model)) == first
+    spy.assert_not_called()
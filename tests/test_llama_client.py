@@ -0,0 +1,124 @@
+# tests/test_llama_client.py
+
+import time
+import asyncio
+
+import pytest
+
+import llama_client
+from conftest import free_port_range
+from fake_llama_server import FakeLlamaServer, reply_tokens
+
+
+def test_streams_and_reuses_connection():
+    async def run(url):
+        async with llama_client.ConnectionPool() as pool:
+            results = [await llama_client.complete(url, {"prompt": "a b c", "n_predict": 4}, pool=pool) for _ in range(3)]
+            return results, pool.opened
+
+    with FakeLlamaServer() as server:
+        results, opened = asyncio.run(run(server.url))
+    assert [r["content"] for r in results] == ["".join(reply_tokens("a b c", 4))] * 3
+    assert results[0]["tokens_predicted"] == 4 and results[0]["timings"]["predicted_n"] == 4
+    assert opened == 1 # Keep-alive: one TCP connection for all three
+
+
+def test_complete_keeps_final_event_content_once(monkeypatch):
+    async def events(*args, **kwargs):
+        yield '{"content": "Hello"}'
+        yield '{"content": " wor"}'
+        yield '{"content": "ld", "stop": true, "tokens_predicted": 3}'
+
+    monkeypatch.setattr(llama_client, "stream_completion", events)
+    final = asyncio.run(llama_client.complete("http://127.0.0.1:1", {"prompt": "hi"}))
+    assert final["content"] == "Hello world" and final["tokens_predicted"] == 3
+
+
+def test_cancelled_stream_frees_the_slot():
+    async def run(server):
+        events = llama_client.stream_completion(server.url, {"prompt": "long", "n_predict": 1000})
+        received = []
+        async for event in events:
+            received.append(event)
+            if len(received) == 3: # Stop after 3 of 1000 tokens
+                break
+        await events.aclose()
+        start = time.monotonic()
+        # The only slot must be free long before the 1000 tokens (20s) would have been generated
+        second = await llama_client.complete(server.url, {"prompt": "next", "n_predict": 2}, first_token_timeout=2)
+        return received, second, time.monotonic() - start
+
+    with FakeLlamaServer(n_slots=1, token_delay=0.02) as server:
+        received, second, elapsed = asyncio.run(run(server))
+        assert not server.busy_slots
+    assert len(received) == 3 and second["tokens_predicted"] == 2 and elapsed < 1.0
+
+
+def test_task_cancellation_closes_concurrent_streams():
+    async def run(server):
+        tasks = [asyncio.create_task(llama_client.complete(server.url, {"prompt": f"p {i}", "n_predict": 1000}))
+                 for i in range(4)]
+        while len(server.busy_slots) < 4:
+            await asyncio.sleep(0.01)
+        for task in tasks:
+            task.cancel()
+        results = await asyncio.gather(*tasks, return_exceptions=True)
+        deadline = time.monotonic() + 1.0
+        while server.busy_slots and time.monotonic() < deadline:
+            await asyncio.sleep(0.01)
+        return results
+
+    with FakeLlamaServer(n_slots=4, token_delay=0.02) as server:
+        results = asyncio.run(run(server))
+        assert all(isinstance(r, asyncio.CancelledError) for r in results)
+        assert not server.busy_slots
+
+
+def test_separate_timeouts_and_errors():
+    async def run(url, **kwargs):
+        return await llama_client.complete(url, {"prompt": "a b", "n_predict": 5}, **kwargs)
+
+    # Prompt processing (2 tokens x 0.5s) exceeds the first-token limit
+    with FakeLlamaServer(prompt_delay=0.5) as server:
+        with pytest.raises(llama_client.ClientTimeout) as error:
+            asyncio.run(run(server.url, first_token_timeout=0.2))
+        assert error.value.phase == "first_token"
+    # The first token is in time, the gaps between tokens are not
+    with FakeLlamaServer(token_delay=0.3) as server:
+        with pytest.raises(llama_client.ClientTimeout) as error:
+            asyncio.run(run(server.url, first_token_timeout=5, idle_timeout=0.1))
+        assert error.value.phase == "idle"
+        with pytest.raises(llama_client.HTTPStatusError) as error:
+            asyncio.run(llama_client.complete(server.url, {"prompt": "x"}, path="/nope"))
+        assert error.value.status == 404
+    with pytest.raises(llama_client.ConnectError):
+        asyncio.run(run(f"http://127.0.0.1:{free_port_range(1)}"))
+
+
+def test_iter_completion_is_a_blocking_iterator():
+    with FakeLlamaServer(n_slots=1, token_delay=0.02) as server:
+        events = llama_client.iter_completion(server.url, {"prompt": "a", "n_predict": 3})
+        assert len(list(events)) == 4 # Three tokens and the final event
+        events = llama_client.iter_completion(server.url, {"prompt": "a", "n_predict": 1000})
+        next(events)
+        events.close()
+        deadline = time.monotonic() + 1.0
+        while server.busy_slots and time.monotonic() < deadline:
+            time.sleep(0.01)
+        assert not server.busy_slots
+
+
+def test_resume_after_crash_generates_only_missing_tokens():
+    async def run(url, **kwargs):
+        # The resumed prompt is this prompt plus the text received so far, as the model would see it
+        return await llama_client.complete(url, {"prompt": "a b c ", "n_predict": 12}, **kwargs)
+
+    with FakeLlamaServer(crash_after=5) as server:
+        with pytest.raises(llama_client.ConnectError):
+            asyncio.run(run(server.url))
+        server.tokens_streamed = 0
+        result = asyncio.run(run(server.url, resume=3))
+        assert server.crashes == 3 # Once without resuming, twice while resuming
+    assert result["content"] == "".join(reply_tokens("a b c ", 12)) # As if never interrupted
+    assert result["resumed"] == 2 and result["tokens_predicted"] == 12
+    assert result["timings"]["predicted_n"] == 2 # The last request only had the final two left
@@ -0,0 +1,91 @@
+# tests/test_llama_daemon.py
+
+import io
+import time
+import threading
+
+import pytest
+
+import llama_daemon
+import llama_metrics
+from fake_llama_server import FakeLlamaServer
+
+SOCKET = "daemon.sock" # Relative: tmp_path can exceed the AF_UNIX path limit
+
+
+def test_parse_fast_args_accepts_plain_prompts():
+    assert llama_daemon.parse_fast_args(["--prompt", "hi"]) == {"prompt": "hi", "n_predict": -1, "stream": True}
+    payload = llama_daemon.parse_fast_args(["chat-message", "--prompt=a b", "--n-predict", "8", "--seed=3"])
+    assert payload == {"prompt": "a b", "n_predict": 8, "seed": 3, "stream": True}
+
+
+@pytest.mark.parametrize("argv", [
+    [],
+    ["--n-predict", "8"],                 # No prompt
+    ["--prompt"],                         # Missing value
+    ["--prompt", "a", "--no-cache"],      # Option only the full CLI knows
+    ["--prompt", "a", "--prompt", "b"],   # Let click report duplicates
+    ["--prompt", "a", "--n-predict", "x"],
+    ["batch", "in.jsonl"],
+])
+def test_parse_fast_args_falls_back_to_full_cli(argv):
+    assert llama_daemon.parse_fast_args(argv) is None
+
+
+def test_fast_main_falls_back_without_daemon(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    assert llama_daemon.fast_main(["--prompt", "hi"], path=SOCKET) is None
+    assert llama_daemon.call("ping", SOCKET) is None
+
+
+def test_daemon_serves_prompts_over_socket(fake_llama_install, mocker, tmp_path):
+    mocker.patch('llama_metrics.METRICS_DB', str(tmp_path / "metrics.db"))
+    thread = threading.Thread(target=llama_daemon.serve, args=(SOCKET,), kwargs={"stop_server_on_exit": True})
+    thread.start()
+    try:
+        deadline = time.monotonic() + 10
+        while llama_daemon.call("ping", SOCKET) is None and time.monotonic() < deadline:
+            time.sleep(0.02)
+
+        for _ in range(2): # Second request reuses the warm upstream connection
+            out, err = io.StringIO(), io.StringIO()
+            code = llama_daemon.fast_main(["--prompt", "a b c", "--n-predict", "4"], path=SOCKET, out=out, err=err)
+            assert code == 0, err.getvalue()
+            assert out.getvalue().endswith("\n") and len(out.getvalue().split()) == 4
+
+        reply = llama_daemon.call("ping", SOCKET)
+        assert reply["requests"] == 2 and reply["port"]
+    finally:
+        llama_daemon.call("stop", SOCKET)
+        thread.join(timeout=10)
+
+    assert not thread.is_alive()
+    assert not (tmp_path / SOCKET).exists()
+    deadline = time.monotonic() + 5
+    while len(llama_metrics.recent(10)) < 2 and time.monotonic() < deadline:
+        time.sleep(0.02) # Metrics are written after the reply
+    records = llama_metrics.recent(10)
+    assert [r["source"] for r in records] == ["daemon", "daemon"]
+    assert all(r["status"] == "ok" and r["tokens"] == 4 for r in records)
+
+
+def test_daemon_picks_up_scheduler_started_later(fake_llama_install, mocker, tmp_path):
+    mocker.patch('llama_metrics.METRICS_DB', str(tmp_path / "metrics.db"))
+    mocker.patch('llama_daemon.PORT_TTL', 0.0)
+    thread = threading.Thread(target=llama_daemon.serve, args=(SOCKET,), kwargs={"stop_server_on_exit": True})
+    thread.start()
+    try:
+        deadline = time.monotonic() + 10
+        while llama_daemon.call("ping", SOCKET) is None and time.monotonic() < deadline:
+            time.sleep(0.02)
+        prompt = ["--prompt", "a b c", "--n-predict", "2"]
+        assert llama_daemon.fast_main(prompt, path=SOCKET, out=io.StringIO(), err=io.StringIO()) == 0
+
+        with FakeLlamaServer() as sched:
+            mocker.patch('llama_sched.running_sched_port', return_value=sched.port)
+            assert llama_daemon.fast_main(prompt, path=SOCKET, out=io.StringIO(), err=io.StringIO()) == 0
+            assert sched.requests_served == 1
+            assert llama_daemon.call("ping", SOCKET)["port"] == sched.port
+    finally:
+        llama_daemon.call("stop", SOCKET)
+        thread.join(timeout=10)
@@ -0,0 +1,77 @@
+# tests/test_llama_embed.py
+
+import json
+import asyncio
+
+import pytest
+
+import llama_client
+import llama_embed
+from fake_llama_server import FakeLlamaServer, embedding_vector
+
+
+def write_corpus(path):
+    lines = [json.dumps({"id": f"doc{i}", "text": f"document number {i} " * (i % 5 + 1)}) for i in range(40)]
+    lines.insert(7, json.dumps({"id": "huge", "text": "w " * 60})) # Over the fake's -ub of 50 tokens
+    lines.append("")
+    lines.append("a plain text line")
+    path.write_text("\n".join(lines) + "\n")
+    return str(path)
+
+
+def test_iter_texts_and_pack_batches(tmp_path):
+    corpus = write_corpus(tmp_path / "corpus.jsonl")
+    texts = list(llama_embed.iter_texts(corpus))
+    assert len(texts) == 42
+    assert texts[0] == ("doc0", "document number 0 ")
+    assert texts[-1] == ("43", "a plain text line") # Plain lines are their own text, id = line number
+
+    batches = list(llama_embed.pack_batches(enumerate(t for _, t in texts), batch_tokens=40, max_inputs=8))
+    assert [row for batch in batches for row, _ in batch] == list(range(42)) # Order kept, nothing lost
+    for batch in batches:
+        assert len(batch) <= 8
+        estimated = sum(-(-len(text) // llama_embed.CHARS_PER_TOKEN) for _, text in batch)
+        assert estimated <= 40 or len(batch) == 1
+
+
+def test_parse_embeddings_and_unsupported_server():
+    assert llama_embed.parse_embeddings([{"index": 1, "embedding": [[3.0]]}, {"index": 0, "embedding": [[1.0, 2.0]]}], 2) \
+        == [[1.0, 2.0], [3.0]]
+    assert llama_embed.parse_embeddings({"data": [{"index": 0, "embedding": [0.5]}]}, 1) == [[0.5]]
+    with pytest.raises(ValueError):
+        llama_embed.parse_embeddings([{"index": 0, "embedding": [[1.0], [2.0]]}], 1) # Pooling "none"
+
+    with FakeLlamaServer() as server: # Started without --embedding
+        with pytest.raises(llama_client.HTTPStatusError) as error:
+            asyncio.run(llama_client.post_json(server.url, {"content": ["x"]}))
+    assert error.value.status == 501 and "--embeddings" in error.value.body
+
+
+def test_embed_writes_memmap_and_resumes(tmp_path):
+    numpy = pytest.importorskip("numpy")
+    corpus = write_corpus(tmp_path / "corpus.jsonl")
+    output = str(tmp_path / "vectors.npy")
+
+    with FakeLlamaServer(embedding=True, n_ubatch=50, n_slots=2) as server:
+        first = llama_embed.run_embed(corpus, output, base_url=server.url, concurrency=3, batch_tokens=64)
+
+        # Interrupted run: the marks of the last 10 rows never made it to disk
+        ids_path, done_path = llama_embed.sidecar_paths(output)
+        done = numpy.lib.format.open_memmap(done_path, mode="r+")
+        done[-10:] = 0
+        done.flush()
+        del done
+        second = llama_embed.run_embed(corpus, output, base_url=server.url, concurrency=3, batch_tokens=64)
+
+    # The batch holding "huge" was split, so only that input failed
+    assert first["rows"] == 42 and first["embedded"] == 41 and first["failed"] == 1 and first["dim"] == 16
+    assert first["errors"][0][0] == "huge" and "too large" in first["errors"][0][1]
+    assert second["skipped"] == 31 and second["embedded"] == 10 and second["failed"] == 1 # "huge" is retried
+
+    vectors, ids, done = llama_embed.load_embeddings(output)
+    texts = dict(llama_embed.iter_texts(corpus))
+    assert vectors.shape == (42, 16) and vectors.dtype == numpy.float32
+    assert ids[7] == "huge" and not done[7] and not vectors[7].any()
+    for row in (0, 20, 41):
+        assert done[row]
+        assert numpy.allclose(vectors[row], embedding_vector(texts[ids[row]]), atol=1e-6)
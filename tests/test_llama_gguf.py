@@ -0,0 +1,133 @@
+# tests/test_llama_gguf.py
+
+import pytest
+
+import llama_gguf
+import llama_man
+from conftest import write_tiny_model, TINY_MODEL_METADATA, TINY_MODEL_TENSORS
+
+
+def test_reads_metadata_and_tensor_index(tmp_path):
+    metadata = dict(TINY_MODEL_METADATA, **{"tokenizer.ggml.tokens": [f"tok{i}" for i in range(1000)],
+                                            "tokenizer.ggml.model": "llama", "llama.rope.freq_base": 10000.0})
+    path = llama_gguf.write_gguf(str(tmp_path / "m.gguf"), metadata, [("output.weight", [64, 256], 12)])
+    info = llama_gguf.read_gguf(path)
+
+    assert info["version"] == 3
+    assert info["metadata"]["llama.block_count"] == 2
+    assert info["metadata"]["tokenizer.ggml.model"] == "llama"
+    assert info["metadata"]["llama.rope.freq_base"] == pytest.approx(10000.0)
+    tokens = info["metadata"]["tokenizer.ggml.tokens"]
+    assert isinstance(tokens, llama_gguf.GGUFArray) and tokens.count == 1000 # Skipped, not decoded
+    assert info["tensors"] == [{"name": "output.weight", "shape": [64, 256], "type": 12, "offset": 0}]
+    assert info["data_offset"] % llama_gguf.DEFAULT_ALIGNMENT == 0
+    assert llama_gguf.check_complete(info) is None
+
+
+def test_kv_cache_estimate_uses_head_dims():
+    info = {"metadata": TINY_MODEL_METADATA, "tensors": [], "data_offset": 0, "file_size": 0}
+    params = llama_gguf.model_params(info)
+    assert (params["key_length"], params["value_length"], params["head_count_kv"]) == (16, 16, 2)
+    # 2 layers x 2 KV heads x (16 + 16) dims x 2 bytes
+    assert llama_gguf.kv_bytes_per_token(params) == 256
+    estimate = llama_gguf.memory_estimate(info, ctx_size=0) # Trained context
+    assert estimate["n_ctx"] == 2048 and estimate["kv_mb"] == 0.5
+
+
+def test_bad_and_truncated_files_are_rejected(tmp_path):
+    not_gguf = tmp_path / "x.gguf"
+    not_gguf.write_bytes(b"PK\x03\x04" + b"\0" * 100)
+    with pytest.raises(llama_gguf.GGUFError, match="magic"):
+        llama_gguf.read_gguf(str(not_gguf))
+
+    truncated = write_tiny_model(tmp_path / "t.gguf", truncate=1024)
+    assert "truncated" in llama_gguf.check_complete(llama_gguf.read_gguf(truncated))
+
+    header_only = tmp_path / "h.gguf"
+    header_only.write_bytes(open(truncated, "rb").read()[:40])
+    with pytest.raises(llama_gguf.GGUFError, match="truncated"):
+        llama_gguf.read_gguf(str(header_only))
+
+
+def test_fit_context_shrinks_then_refuses(tmp_path, mocker):
+    mocker.patch('llama_gguf.RUNTIME_OVERHEAD_MB', 0)
+    mocker.patch('llama_gguf.MEMORY_HEADROOM', 1.0)
+    info = llama_gguf.read_gguf(write_tiny_model(tmp_path / "m.gguf"))
+    weights = info["file_size"] - info["data_offset"]
+
+    assert llama_gguf.fit_context(info, 0, available_mb=100)[0] == 0 # Trained context fits
+    # Room for the weights plus 1024 tokens of KV cache (256 bytes each)
+    available_mb = (weights + 1024 * 256) / (1 << 20)
+    ctx_size, estimate, error = llama_gguf.fit_context(info, 0, parallel=2, available_mb=available_mb)
+    assert error is None and ctx_size == 1024 and estimate["n_ctx"] == 1024
+    # 1024 tokens cannot give four slots MIN_CTX_PER_SLOT each
+    assert llama_gguf.fit_context(info, 0, parallel=4, available_mb=available_mb)[2]
+
+
+def test_start_refuses_truncated_model(fake_llama_install, mocker, tmp_path):
+    mocker.patch('llama_man.MODEL_PATH', write_tiny_model(tmp_path / "cut.gguf", truncate=1024))
+    spawn = mocker.spy(llama_man, 'spawn_server_process')
+    success, message, pid = llama_man.start_llama_server()
+    assert not success and pid is None and "truncated" in message
+    assert spawn.call_count == 0
+
+
+def test_start_lowers_context_that_does_not_fit(fake_llama_install, mocker):
+    mocker.patch('llama_gguf.available_memory_mb', return_value=0.2) # 90% of it: room for ~700 tokens of KV cache
+    mocker.patch('llama_gguf.RUNTIME_OVERHEAD_MB', 0)
+    mocker.patch('llama_man.SLOT_SAVE_PATH', None)
+    mocker.patch('llama_man.PARALLEL', 1)
+    spawn = mocker.spy(llama_man, 'spawn_server_process')
+    try:
+        success, _, _ = llama_man.start_llama_server()
+        assert success
+        command = spawn.call_args.args[0]
+        assert command[command.index('--ctx-size') + 1] == '512'
+    finally:
+        llama_man.stop_llama_server(force=True)
+
+
+def write_vocab_model(path, tokens, **metadata):
+    vocab = {"tokenizer.ggml.model": "llama", "tokenizer.ggml.tokens": tokens,
+             "tokenizer.ggml.bos_token_id": 1, "tokenizer.ggml.eos_token_id": 2}
+    return llama_gguf.write_gguf(str(path), {**TINY_MODEL_METADATA, **vocab, **metadata}, TINY_MODEL_TENSORS)
+
+
+def test_draft_vocab_must_match(tmp_path):
+    tokens = [f"tok{i}" for i in range(1000)] # Longer than INLINE_ARRAY_LIMIT: compared from the file
+    model = write_vocab_model(tmp_path / "model.gguf", tokens)
+    assert llama_gguf.read_strings(model, llama_gguf.read_gguf(model)["metadata"]["tokenizer.ggml.tokens"], 998) == ["tok998", "tok999"]
+
+    # Control tokens below DRAFT_VOCAB_CHECK_START and a few extra tokens at the end may differ
+    similar = ["<x>"] + tokens[1:] + [f"extra{i}" for i in range(100)]
+    assert llama_gguf.check_draft_vocab(model, write_vocab_model(tmp_path / "similar.gguf", similar)) is None
+    changed = tokens[:500] + ["other"] + tokens[501:]
+    assert "token 500 differs" in llama_gguf.check_draft_vocab(model, write_vocab_model(tmp_path / "changed.gguf", changed))
+    longer = tokens + [f"extra{i}" for i in range(200)]
+    assert "sizes differ" in llama_gguf.check_draft_vocab(model, write_vocab_model(tmp_path / "longer.gguf", longer))
+    eos = write_vocab_model(tmp_path / "eos.gguf", tokens, **{"tokenizer.ggml.eos_token_id": 3})
+    assert "eos_token_id" in llama_gguf.check_draft_vocab(model, eos)
+    assert "no tokenizer" in llama_gguf.check_draft_vocab(model, write_tiny_model(tmp_path / "bare.gguf"))
+
+
+def test_start_with_draft_model(fake_llama_install, mocker, tmp_path):
+    tokens = [f"tok{i}" for i in range(100)]
+    mocker.patch('llama_man.MODEL_PATH', write_vocab_model(tmp_path / "model.gguf", tokens))
+    mocker.patch('llama_man.SLOT_SAVE_PATH', None)
+    mocker.patch('llama_man.DRAFT_MODEL_PATH', write_vocab_model(tmp_path / "wrong.gguf", tokens[::-1]))
+    spawn = mocker.spy(llama_man, 'spawn_server_process')
+    success, message, _ = llama_man.start_llama_server()
+    assert not success and "cannot draft" in message and spawn.call_count == 0
+
+    mocker.patch('llama_man.DRAFT_MODEL_PATH', write_vocab_model(tmp_path / "draft.gguf", tokens))
+    mocker.patch('llama_man.DRAFT_MAX', 8)
+    try:
+        success, message, _ = llama_man.start_llama_server()
+        assert success
+        command = spawn.call_args.args[0]
+        assert command[command.index('-md') + 1] == str(tmp_path / "draft.gguf")
+        assert command[command.index('--draft-max') + 1] == '8' and '--draft-min' not in command
+    finally:
+        llama_man.stop_llama_server(force=True)
+    # Without a draft model the draft settings are left out
+    assert '--draft-max' not in llama_man.build_server_command(params={'draft_model': None})
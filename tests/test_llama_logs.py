@@ -0,0 +1,77 @@
+# tests/test_llama_logs.py
+
+import io
+import sys
+import time
+
+import requests
+
+import llama_logs
+import llama_log_pump
+import llama_man
+from conftest import FAKE_SERVER
+
+SAMPLE = """\
+2026-10-17 10:00:00.000 srv    load_model: loading model 'model.gguf'
+2026-10-17 10:00:01.250 main: model loaded
+2026-10-17 10:00:05.000 slot launch_slot_: id  1 | task 7 | processing task
+2026-10-17 10:00:05.001 slot update_slots: id  1 | task 7 | new prompt, n_ctx_slot = 2048, n_keep = 0, n_prompt_tokens = 120
+2026-10-17 10:00:05.001 slot update_slots: id  1 | task 7 | reusing chunk with size 30, shifting KV cache [50, 80) -> [40, 70)
+2026-10-17 10:00:05.002 slot update_slots: id  1 | task 7 | kv cache rm [100, end)
+2026-10-17 10:00:05.400 slot print_timing: id  1 | task 7 |
+2026-10-17 10:00:05.400 prompt eval time =      40.00 ms /    20 tokens (    2.00 ms per token,   500.00 tokens per second)
+2026-10-17 10:00:05.400        eval time =     400.00 ms /    16 tokens (   25.00 ms per token,    40.00 tokens per second)
+2026-10-17 10:00:05.400       total time =     440.00 ms /    36 tokens
+"""
+
+
+def test_parses_load_time_and_request_timings():
+    records = llama_logs.parse_lines(SAMPLE.splitlines())
+    assert records[0] == {"type": "load", "at": records[0]["at"], "load_s": 1.25}
+    request = records[1]
+    assert (request["slot"], request["task"], request["n_prompt_tokens"]) == (1, 7, 120)
+    assert (request["n_cached"], request["n_reused"]) == (100, 30)
+    assert (request["prompt_n"], request["prompt_tps"], request["eval_n"], request["eval_tps"]) == (20, 500.0, 16, 40.0)
+    assert request["total_ms"] == 440.0
+    summary = llama_logs.summarize(records)
+    assert summary["requests"] == 1 and summary["last_load_s"] == 1.25 and summary["cached_fraction"] == 0.833
+
+
+def test_pump_timestamps_and_rotates(tmp_path):
+    path = str(tmp_path / "server.log")
+    source = io.BytesIO(b"".join(f"line {i:03d}\n".encode() for i in range(100)))
+    llama_log_pump.pump(source, path, max_bytes=1000, backups=2)
+    files = llama_logs.log_files(path)
+    assert files == [f"{path}.2", f"{path}.1", path] # Older output beyond two backups is dropped
+    lines = list(llama_logs.read_lines(path))
+    assert lines[-1].endswith(" line 099") and all(len(open(f).read()) <= 1000 for f in files)
+    assert [int(line[-3:]) for line in lines] == list(range(100 - len(lines), 100))
+    assert llama_logs.tail(path, 2) == ["line 098", "line 099"]
+
+
+def test_server_output_is_captured_and_parsed(fake_llama_install, mocker):
+    mocker.patch('llama_man.SLOT_SAVE_PATH', None)
+    try:
+        assert llama_man.start_llama_server()[0]
+        for prompt in ("a b c d", "a b c d e f"):
+            requests.post(f"http://127.0.0.1:{llama_man.PORT}/completion", json={"prompt": prompt, "n_predict": 4}, timeout=30)
+        deadline = time.monotonic() + 5
+        records = []
+        while len(records) < 2 and time.monotonic() < deadline: # The pump writes asynchronously
+            records = [r for r in llama_logs.parse_lines(llama_logs.read_lines()) if r["type"] == "request"]
+            time.sleep(0.02)
+    finally:
+        llama_man.stop_llama_server(force=True)
+    assert [(r["n_prompt_tokens"], r["eval_n"]) for r in records] == [(4, 4), (6, 4)]
+    assert records[1]["n_cached"] == 4 # The second prompt extends the first
+
+
+def test_startup_failure_quotes_log_tail(fake_llama_install, tmp_path, mocker):
+    server = tmp_path / "failing-server"
+    server.write_text(f'#!/bin/sh\nexec "{sys.executable}" "{FAKE_SERVER}" --fail-load "$@"\n')
+    server.chmod(0o755)
+    mocker.patch('llama_man.SERVER_PATH', str(server))
+    mocker.patch('llama_man.SLOT_SAVE_PATH', None)
+    success, message, pid = llama_man.start_llama_server()
+    assert not success and pid is None
+    assert "error loading model" in message and "exiting due to model loading error" in message
@@ -0,0 +1,138 @@
+# tests/test_llama_metrics.py
+
+import pytest
+import requests
+from click.testing import CliRunner
+
+import llama_man
+import llama_metrics
+from clitest_server import cli
+from fake_llama_server import FakeLlamaServer
+from conftest import free_port_range
+
+FINAL_EVENT = {"content": "", "stop": True, "tokens_evaluated": 10, "tokens_cached": 14,
+               "timings": {"prompt_n": 3, "prompt_ms": 1.5, "predicted_n": 4, "predicted_ms": 40.0}}
+
+
+@pytest.fixture(autouse=True)
+def metrics_db(tmp_path, mocker):
+    mocker.patch('llama_metrics.METRICS_DB', str(tmp_path / "metrics.db"))
+
+
+def test_request_timer_records_client_and_server_timings():
+    timer = llama_metrics.RequestTimer("chat", port=8012)
+    for _ in range(4):
+        timer.token()
+    timer.final(FINAL_EVENT)
+
+    record = timer.finish()
+
+    assert record["source"] == "chat" and record["status"] == "ok" and record["port"] == 8012
+    assert record["tokens"] == 4 and len(timer.gaps) == 3
+    assert 0 <= record["ttft_s"] <= record["elapsed_s"]
+    assert record["itl_p50_s"] >= 0
+    assert (record["prompt_n"], record["predicted_n"], record["predicted_ms"]) == (3, 4, 40.0)
+    assert record["prompt_reused"] == 7 # 10 prompt tokens, 3 evaluated
+
+
+def test_ring_buffer_keeps_last_records(mocker):
+    mocker.patch('llama_metrics.RING_SIZE', 3)
+    for i in range(5):
+        assert llama_metrics.record_request({"source": "chat", "status": "ok", "elapsed_s": i, "ttft_s": None})
+
+    assert [r["elapsed_s"] for r in llama_metrics.recent(10)] == [2, 3, 4]
+    # The cumulative series still count every request
+    assert llama_metrics.series()['llama_client_requests_total{source="chat",status="ok"}'] == 5
+
+
+def test_histograms_are_cumulative_and_ordered():
+    record = {"source": "chat", "status": "ok", "elapsed_s": 0.3, "ttft_s": 0.07, **llama_metrics.server_fields(FINAL_EVENT)}
+    llama_metrics.record_request(record, gaps=[0.004, 0.03])
+
+    text = llama_metrics.prometheus_text(ports=[])
+    lines = text.splitlines()
+
+    assert lines.count("# TYPE llama_client_ttft_seconds histogram") == 1
+    assert 'llama_client_ttft_seconds_bucket{source="chat",le="0.05"} 0' not in text # Only incremented buckets exist
+    assert 'llama_client_ttft_seconds_bucket{source="chat",le="0.1"} 1' in lines
+    assert 'llama_client_ttft_seconds_bucket{source="chat",le="+Inf"} 1' in lines
+    assert 'llama_client_inter_token_seconds_count{source="chat"} 2' in lines
+    assert 'llama_client_inter_token_seconds_bucket{source="chat",le="0.005"} 1' in lines
+    assert 'llama_client_inter_token_seconds_bucket{source="chat",le="0.04"} 2' in lines
+    assert 'llama_client_prompt_tokens_reused_total{source="chat"} 7' in lines
+    assert 'llama_client_generation_seconds_total{source="chat"} 0.04' in lines
+    ttft = [l for l in lines if l.startswith("llama_client_ttft_seconds_bucket")]
+    les = [l.split('le="')[1].split('"')[0] for l in ttft]
+    assert les[-1] == "+Inf" and les[:-1] == sorted(les[:-1], key=float)
+
+
+def test_large_counters_keep_full_precision():
+    fields = {"predicted_n": 1234567, "predicted_ms": 1234567891.0}
+    llama_metrics.record_request({"source": "cli", "status": "ok", "elapsed_s": 0.5, "ttft_s": None, **fields})
+    lines = llama_metrics.prometheus_text(ports=[]).splitlines()
+    assert 'llama_client_tokens_predicted_total{source="cli"} 1234567' in lines
+    sample = next(l for l in lines if l.startswith("llama_client_generation_seconds_total"))
+    assert float(sample.split()[-1]) == 1234567891.0 * 0.001
+
+
+def test_errors_only_count_requests():
+    llama_metrics.record_request({"source": "batch", "status": "error", "elapsed_s": 1.0, "ttft_s": None})
+    assert llama_metrics.series() == {'llama_client_requests_total{source="batch",status="error"}': 1}
+
+
+def test_prometheus_text_merges_server_metrics_with_port_labels():
+    down = free_port_range(1)
+    with FakeLlamaServer(metrics=True) as a, FakeLlamaServer(metrics=True) as b:
+        requests.post(f"{a.url}/completion", json={"prompt": "x y", "n_predict": 2}, timeout=5)
+        text = llama_metrics.prometheus_text(ports=[a.port, b.port, down])
+
+    lines = text.splitlines()
+    assert lines.count("# TYPE llamacpp:tokens_predicted_total counter") == 1
+    assert f'llamacpp:tokens_predicted_total{{port="{a.port}"}} 2' in lines
+    assert f'llamacpp:tokens_predicted_total{{port="{b.port}"}} 0' in lines
+    assert f'llama_server_up{{port="{down}"}} 0' in lines
+    assert f'llama_server_up{{port="{a.port}"}} 1' in lines
+
+
+def test_chat_message_records_timings(fake_llama_install):
+    runner = CliRunner()
+    try:
+        result = runner.invoke(cli, ['chat-message', '--prompt', 'one two three', '--n-predict', '5'])
+        assert result.exit_code == 0, result.output
+
+        [record] = llama_metrics.recent()
+        assert record["source"] == "chat" and record["port"] == llama_man.PORT
+        assert record["tokens"] == 5 and record["predicted_n"] == 5
+        assert record["prompt_n"] == 3 and record["ttft_s"] is not None
+
+        exported = runner.invoke(cli, ['metrics', 'export']).output
+        assert 'llama_client_tokens_predicted_total{source="chat"} 5' in exported
+        assert f'llamacpp:tokens_predicted_total{{port="{llama_man.PORT}"}} 5' in exported # Launched with --metrics
+        assert 'chat' in runner.invoke(cli, ['metrics', 'recent']).output
+    finally:
+        llama_man.stop_llama_server(force=True)
+
+
+def test_speculation_stats_compare_draft_and_plain_generation():
+    def records(server, n=3):
+        payload = {"prompt": "a b c", "n_predict": 20}
+        return [{"source": "chat", "status": "ok", "port": server.port,
+                 **llama_metrics.server_fields(requests.post(f"{server.url}/completion", json=payload, timeout=10).json())}
+                for _ in range(n)]
+
+    with FakeLlamaServer(token_delay=0.01) as plain, \
+            FakeLlamaServer(token_delay=0.01, draft_max=8, draft_p_accept=0.8) as good, \
+            FakeLlamaServer(token_delay=0.01, draft_max=8, draft_p_accept=0.1) as poor:
+        plain_records, good_records, poor_records = records(plain), records(good), records(poor)
+
+    assert "draft_n" not in plain_records[0] and good_records[0]["draft_n"] >= good_records[0]["draft_n_accepted"] > 0
+    [keep] = llama_metrics.speculation_stats(plain_records + good_records)
+    assert keep["model"] == "fake-llama" and (keep["requests"], keep["speculative"]) == (6, 3)
+    assert keep["acceptance"] > 0.3 and keep["speedup"] > llama_metrics.SPEC_MIN_SPEEDUP and keep["verdict"] == "keep"
+    [off] = llama_metrics.speculation_stats(plain_records + poor_records)
+    assert off["acceptance"] < 0.1 and off["verdict"] == "off"
+    # Only plain requests: nothing to compare
+    assert llama_metrics.speculation_stats(plain_records)[0]["speedup"] is None
+
+    llama_metrics.record_request(good_records[0])
+    assert llama_metrics.series()['llama_client_draft_tokens_total{source="chat"}'] == good_records[0]["draft_n"]
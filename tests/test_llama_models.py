@@ -0,0 +1,100 @@
+# tests/test_llama_models.py
+
+import sys
+import time
+import threading
+
+import pytest
+import requests
+
+import llama_man
+import llama_models
+from conftest import FAKE_SERVER, free_port_range, write_tiny_model
+
+
+@pytest.fixture
+def models(fake_llama_install, mocker, tmp_path):
+    """Three registered copies of the dummy model, 100 MB each, under a 250 MB budget (two fit)."""
+    mocker.patch('llama_man.SLOT_SAVE_PATH', None)
+    mocker.patch('llama_models.MODELS_BASE_PORT', free_port_range(4))
+    mocker.patch('llama_models.MEMORY_BUDGET_MB', 250)
+    for name in ("a", "b", "c"):
+        path = write_tiny_model(tmp_path / f"{name}.gguf")
+        assert llama_models.add_model(name, path, mem_mb=100)[0]
+    try:
+        yield
+    finally:
+        llama_models.unload_all()
+
+
+def complete(port):
+    return requests.post(f"http://127.0.0.1:{port}/completion", json={"prompt": "a b", "n_predict": 2}, timeout=30)
+
+
+def test_estimate_grows_with_file_size_and_context(tmp_path):
+    small, large = tmp_path / "small.gguf", tmp_path / "large.gguf"
+    small.write_bytes(b"\0" * (1 << 20))
+    large.write_bytes(b"\0" * (4 << 20))
+    assert llama_models.estimate_mb({'path': str(small)}) < llama_models.estimate_mb({'path': str(large)})
+    assert (llama_models.estimate_mb({'path': str(large), 'ctx_size': 2048})
+            < llama_models.estimate_mb({'path': str(large), 'ctx_size': 32768}))
+    assert llama_models.estimate_mb({'path': str(large), 'mem_mb': 42}) == 42.0
+
+
+def test_each_model_runs_in_its_own_server(models, mocker):
+    spawn = mocker.spy(llama_man, 'spawn_server_process')
+    ok_a, _, port_a = llama_models.ensure_model("a")
+    ok_b, _, port_b = llama_models.ensure_model("b")
+    assert ok_a and ok_b and port_a != port_b
+    assert complete(port_a).status_code == 200 and complete(port_b).status_code == 200
+    commands = [call.args[0] for call in spawn.call_args_list]
+    assert [c[c.index('-m') + 1].rsplit('/', 1)[-1] for c in commands] == ["a.gguf", "b.gguf"]
+
+    # Already resident: same server, counted as a hit
+    assert llama_models.ensure_model("a")[2] == port_a
+    assert spawn.call_count == 2
+    rows = {row['name']: row for row in llama_models.status_models()}
+    assert rows['a']['resident'] and rows['a']['hits'] == 1 and rows['a']['loads'] == 1
+    assert not rows['c']['resident']
+
+
+def test_cold_load_does_not_block_resident_models(models, mocker, tmp_path):
+    port_a = llama_models.ensure_model("a")[2]
+    slow = tmp_path / "slow-server"
+    slow.write_text(f'#!/bin/sh\nexec "{sys.executable}" "{FAKE_SERVER}" --startup-delay 1.5 "$@"\n')
+    slow.chmod(0o755)
+    mocker.patch('llama_man.SERVER_PATH', str(slow))
+    loading = []
+    thread = threading.Thread(target=lambda: loading.append(llama_models.ensure_model("b")))
+    thread.start()
+    try:
+        deadline = time.monotonic() + 10
+        while "b" not in llama_models.read_state()['resident'] and time.monotonic() < deadline:
+            time.sleep(0.02)
+        start = time.monotonic()
+        assert llama_models.ensure_model("a")[2] == port_a # Served while b is still loading
+        assert time.monotonic() - start < 1.0 and thread.is_alive()
+    finally:
+        thread.join(30)
+    assert loading and loading[0][0] and "Ready in" in loading[0][1]
+
+
+def test_least_recently_used_model_is_evicted_over_budget(models):
+    port_a = llama_models.ensure_model("a")[2]
+    llama_models.ensure_model("b")
+    llama_models.ensure_model("a") # b is now the least recently used
+
+    ok, message, port_c = llama_models.ensure_model("c")
+    assert ok and "Evicted: b" in message
+    rows = {row['name']: row for row in llama_models.status_models()}
+    assert rows['a']['resident'] and rows['c']['resident'] and not rows['b']['resident']
+    assert rows['b']['evictions'] == 1
+    assert complete(port_a).status_code == 200 and complete(port_c).status_code == 200
+
+
+def test_model_over_budget_is_refused(models, tmp_path):
+    path = write_tiny_model(tmp_path / "huge.gguf")
+    llama_models.add_model("huge", path, mem_mb=1000)
+    ok, message, port = llama_models.ensure_model("huge")
+    assert not ok and port is None and "budget" in message
+    assert llama_models.ensure_model("missing")[0] is False
@@ -0,0 +1,97 @@
+# tests/test_llama_pid.py
+
+import os
+import sys
+import time
+import subprocess
+import threading
+
+import llama_man
+import llama_pid
+
+
+def test_state_record_round_trip(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    assert llama_pid.write_pid(os.getpid(), port=8099, command=["llama-server", "-m", "m.gguf"])
+
+    state = llama_pid.read_state()
+
+    assert state["pid"] == llama_pid.read_pid() == os.getpid()
+    assert state["port"] == 8099 and state["command"] == ["llama-server", "-m", "m.gguf"]
+    assert state["start_time"] == llama_pid.process_start_time(os.getpid()) is not None
+    assert llama_pid.recorded_start_time(os.getpid()) == state["start_time"]
+    assert llama_pid.recorded_start_time(os.getpid() + 1) is None
+
+
+def test_plain_pid_file_from_older_versions_is_read(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    (tmp_path / llama_pid.PID_FILENAME).write_text("4242\n")
+    assert llama_pid.read_pid() == 4242
+    assert llama_pid.recorded_start_time(4242) is None
+    (tmp_path / llama_pid.PID_FILENAME).write_text("not a pid")
+    assert llama_pid.read_pid() is None
+
+
+def test_reused_pid_is_not_running():
+    start_time = llama_pid.process_start_time(os.getpid())
+    assert llama_pid.is_process_running(os.getpid(), start_time)
+    assert not llama_pid.is_process_running(os.getpid(), start_time=f"{start_time}-other")
+
+
+def test_wait_for_exit_returns_when_process_exits():
+    process = subprocess.Popen([sys.executable, "-c", "import time; time.sleep(0.2)"])
+    assert not llama_pid.wait_for_exit(process.pid, 0.01)
+
+    start = time.monotonic()
+    assert llama_pid.wait_for_exit(process.pid, 10)
+    assert time.monotonic() - start < 2 # Woken by the exit, not by the timeout
+    assert not llama_pid.is_process_running(process.pid)
+
+
+def test_exited_child_is_not_reaped():
+    process = subprocess.Popen([sys.executable, "-c", "import sys; sys.exit(3)"])
+    deadline = time.monotonic() + 10
+    while llama_pid.is_process_running(process.pid) and time.monotonic() < deadline:
+        time.sleep(0.01)
+    assert not llama_pid.is_process_running(process.pid)
+    assert process.wait(5) == 3 # The exit status is still there for the owning Popen
+
+
+def test_state_lock_is_reentrant_and_exclusive(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    entered = threading.Event()
+
+    def contender():
+        with llama_pid.state_lock():
+            entered.set()
+
+    with llama_pid.state_lock():
+        with llama_pid.state_lock(): # Same thread: no deadlock
+            thread = threading.Thread(target=contender)
+            thread.start()
+            assert not entered.wait(0.2)
+    thread.join(timeout=5)
+    assert entered.is_set()
+
+
+def test_concurrent_callers_start_one_server(fake_llama_install, mocker):
+    spawn = mocker.spy(llama_man, 'spawn_server_process')
+    results = []
+    threads = [threading.Thread(target=lambda: results.append(llama_man.ensure_server_running_or_fail()))
+               for _ in range(3)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join(timeout=30)
+    try:
+        assert [status for status, _ in results] == ["RUNNING"] * 3
+        assert spawn.call_count == 1
+        assert llama_pid.read_state()["port"] == llama_man.PORT
+    finally:
+        start = time.monotonic()
+        success, message = llama_man.stop_llama_server()
+        elapsed = time.monotonic() - start
+
+    assert success, message
+    assert elapsed < 1.0 # Returns when the process exits, not after a fixed sleep
+    assert llama_pid.read_pid() is None
@@ -0,0 +1,96 @@
+# tests/test_llama_pool.py
+
+import json
+
+import llama_batch
+import llama_pool
+import llama_ready
+from fake_llama_server import FakeLlamaServer
+from conftest import free_port_range
+
+
+def test_plan_instances_splits_cpus(mocker):
+    mocker.patch('llama_pool.available_cpus', return_value=list(range(8)))
+
+    plan = llama_pool.plan_instances(3, base_port=9000, pin_cpus=True)
+
+    assert [i['port'] for i in plan] == [9000, 9001, 9002]
+    assert [i['threads'] for i in plan] == [2, 2, 2]
+    assert [i['cpus'] for i in plan] == [[0, 1], [2, 3], [4, 5]]
+
+
+def test_plan_instances_explicit_threads_no_pinning(mocker):
+    mocker.patch('llama_pool.available_cpus', return_value=list(range(4)))
+
+    plan = llama_pool.plan_instances(2, base_port=9000, threads=6)
+
+    assert [i['threads'] for i in plan] == [6, 6]
+    assert all(i['cpus'] is None for i in plan)
+
+
+def test_balancer_prefers_least_outstanding():
+    balancer = llama_pool.LeastOutstandingBalancer(["a", "b", "c"])
+    first = [balancer.acquire() for _ in range(3)]
+    assert sorted(first) == ["a", "b", "c"] # One each before anyone gets a second
+
+    balancer.release("b")
+    assert balancer.acquire() == "b"
+
+
+def test_balancer_skips_failed_endpoint_during_cooldown():
+    balancer = llama_pool.LeastOutstandingBalancer(["a", "b"], cooldown=60)
+    endpoint = balancer.acquire()
+    balancer.release(endpoint, failed=True)
+    other = "b" if endpoint == "a" else "a"
+    assert {balancer.acquire() for _ in range(3)} == {other}
+
+
+def test_pick_instance_port_uses_server_reported_load(mocker):
+    with FakeLlamaServer(n_slots=2) as busy, FakeLlamaServer(n_slots=2) as idle:
+        busy.busy_slots.update({0, 1})
+        mocker.patch('llama_pool.healthy_ports', return_value=[busy.port, idle.port])
+        assert {llama_pool.pick_instance_port() for _ in range(5)} == {idle.port}
+
+
+def test_pool_lifecycle_against_stand_in_servers(fake_llama_install, mocker):
+    base_port = free_port_range(3)
+
+    success, messages = llama_pool.start_pool(3, base_port=base_port, threads=1)
+    try:
+        assert success, messages
+        status = llama_pool.status_pool()
+        assert [i['port'] for i in status] == [base_port, base_port + 1, base_port + 2]
+        assert all(i['state'] == llama_ready.READY for i in status)
+        assert len({i['pid'] for i in status}) == 3
+
+        again, messages = llama_pool.start_pool(3, base_port=base_port)
+        assert not again and "already running" in messages[0]
+
+        old_pids = [i['pid'] for i in status]
+        success, messages = llama_pool.restart_pool()
+        assert success, messages
+        new_status = llama_pool.status_pool()
+        assert all(i['state'] == llama_ready.READY for i in new_status)
+        assert not set(old_pids) & {i['pid'] for i in new_status}
+    finally:
+        success, messages = llama_pool.stop_pool(force=True)
+
+    assert success, messages
+    assert llama_pool.read_pool_state() == {'instances': []}
+
+
+def test_batch_spreads_requests_across_instances(tmp_path):
+    servers = [FakeLlamaServer(n_slots=1, token_delay=0.002).start() for _ in range(3)]
+    try:
+        src, out = tmp_path / "in.jsonl", tmp_path / "out.jsonl"
+        src.write_text("".join(json.dumps({"id": i, "prompt": "p", "n_predict": 4}) + "\n" for i in range(30)))
+
+        summary = llama_batch.run_batch(src, out, base_urls=[s.url for s in servers])
+
+        assert summary["completed"] == 30
+        assert summary["concurrency"] == 3
+        served = [s.requests_served for s in servers]
+        assert sum(served) == 30 and min(served) >= 5
+    finally:
+        for s in servers:
+            s.stop()
@@ -0,0 +1,112 @@
+# tests/test_llama_ready.py
+
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from unittest.mock import MagicMock
+
+import pytest
+
+import llama_ready
+
+
+class _HealthHandler(BaseHTTPRequestHandler):
+    """Answers /health with 503 until the server's ready_at time has passed."""
+
+    def do_GET(self):
+        if time.monotonic() >= self.server.ready_at:
+            status, body = 200, {"status": "ok"}
+        else:
+            status, body = 503, {"error": {"code": 503, "message": "Loading model", "type": "unavailable_error"}}
+        payload = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def log_message(self, format, *args):
+        pass
+
+
+@pytest.fixture
+def health_server():
+    """Starts a stand-in /health endpoint; returns (server, port)."""
+    server = ThreadingHTTPServer(("127.0.0.1", 0), _HealthHandler)
+    server.ready_at = 0.0
+    thread = threading.Thread(target=server.serve_forever, kwargs={"poll_interval": 0.05}, daemon=True)
+    thread.start()
+    yield server, server.server_address[1]
+    server.shutdown()
+    server.server_close()
+
+
+def test_probe_health_ready(health_server):
+    server, port = health_server
+    state, detail = llama_ready.probe_health(port)
+    assert state == llama_ready.READY
+    assert detail == "ok"
+
+
+def test_probe_health_loading(health_server):
+    server, port = health_server
+    server.ready_at = time.monotonic() + 60
+    state, detail = llama_ready.probe_health(port)
+    assert state == llama_ready.LOADING
+    assert detail == "Loading model"
+
+
+def test_probe_health_unreachable(health_server):
+    server, port = health_server
+    server.shutdown()
+    server.server_close()
+    state, _ = llama_ready.probe_health(port)
+    assert state == llama_ready.UNREACHABLE
+
+
+def test_wait_for_ready_returns_quickly_when_already_loaded(health_server):
+    _, port = health_server
+    process = MagicMock()
+    process.poll.return_value = None
+
+    status, message, elapsed = llama_ready.wait_for_ready(port, process=process, timeout=5)
+
+    assert status == llama_ready.READY
+    assert elapsed < 0.5
+    assert f"port {port}" in message
+
+
+def test_wait_for_ready_waits_through_loading(health_server):
+    server, port = health_server
+    server.ready_at = time.monotonic() + 0.3
+    process = MagicMock()
+    process.poll.return_value = None
+
+    status, _, elapsed = llama_ready.wait_for_ready(port, process=process, timeout=5)
+
+    assert status == llama_ready.READY
+    assert 0.25 <= elapsed < 2.0
+
+
+def test_wait_for_ready_detects_crash(health_server):
+    server, port = health_server
+    server.ready_at = time.monotonic() + 60
+    process = MagicMock()
+    process.poll.side_effect = [None, None, 1, 1]
+
+    status, message, _ = llama_ready.wait_for_ready(port, process=process, timeout=5)
+
+    assert status == llama_ready.CRASHED
+    assert "exit code 1" in message
+
+
+def test_wait_for_ready_times_out_while_loading(health_server):
+    server, port = health_server
+    server.ready_at = time.monotonic() + 60
+
+    status, message, elapsed = llama_ready.wait_for_ready(port, is_alive=lambda: True, timeout=0.2)
+
+    assert status == llama_ready.TIMEOUT
+    assert "still loading model" in message
+    assert elapsed >= 0.2
@@ -0,0 +1,108 @@
+# tests/test_llama_router.py
+
+import threading
+
+import pytest
+import requests
+
+import llama_router
+from fake_llama_server import FakeLlamaServer
+
+SYSTEM = "You are a helpful assistant. " * 80 # Long shared prefix (> several chunks)
+
+
+def test_prefix_hashes_share_common_prefix():
+    a = llama_router.prefix_hashes(SYSTEM + "Question one?")
+    b = llama_router.prefix_hashes(SYSTEM + "A different question entirely?")
+    shared = len(SYSTEM.encode()) // llama_router.CHUNK_CHARS
+    assert a[:shared] == b[:shared]
+    assert a[-1] != b[-1]
+
+
+def test_prefix_hashes_token_arrays():
+    tokens = list(range(200))
+    hashes = llama_router.prefix_hashes(tokens)
+    assert len(hashes) == 4 # 64 + 64 + 64 + 8
+    assert llama_router.prefix_hashes(tokens[:128]) == hashes[:2]
+
+
+def test_router_pins_shared_prefix_to_same_slot():
+    router = llama_router.PrefixRouter([("h", 1, 2), ("h", 2, 2)])
+    first = router.route(SYSTEM + "q1")
+    router.release(first)
+    second = router.route(SYSTEM + "q2")
+    router.release(second)
+
+    assert first.reason == "miss"
+    assert second.reason == "affinity"
+    assert (second.target, second.slot) == (first.target, first.slot)
+    assert second.hit_ratio > 0.8
+
+
+def test_router_falls_back_when_preferred_slot_busy():
+    router = llama_router.PrefixRouter([("h", 1, 1), ("h", 2, 1)])
+    warm = router.route(SYSTEM + "q1")
+    router.release(warm)
+
+    holder = router.route(SYSTEM + "q2") # Occupies the slot holding the prefix
+    other = router.route(SYSTEM + "q3")
+
+    assert holder.reason == "affinity"
+    assert other.reason == "saturated"
+    assert other.target != holder.target
+    assert other.hit_ratio == 0.0
+
+
+def test_router_forgets_prefix_when_slot_is_reused():
+    router = llama_router.PrefixRouter([("h", 1, 1)])
+    router.release(router.route(SYSTEM + "q1"))
+    router.release(router.route("completely unrelated prompt " * 30))
+
+    again = router.route(SYSTEM + "q2")
+    assert again.reason == "miss" # The only slot was overwritten
+
+
+@pytest.fixture
+def routed_pool():
+    servers = [FakeLlamaServer(n_slots=2).start() for _ in range(2)]
+    router = llama_router.PrefixRouter([("127.0.0.1", s.port, 2) for s in servers])
+    httpd = llama_router.make_server(router, port=0)
+    thread = threading.Thread(target=httpd.serve_forever, kwargs={"poll_interval": 0.05}, daemon=True)
+    thread.start()
+    yield f"http://127.0.0.1:{httpd.server_address[1]}", router, servers
+    httpd.shutdown()
+    httpd.server_close()
+    for s in servers:
+        s.stop()
+
+
+def test_router_end_to_end_prefix_reuse(routed_pool):
+    url, router, servers = routed_pool
+    session = requests.Session()
+    ratios = []
+    for i in range(4):
+        response = session.post(f"{url}/completion", json={"prompt": SYSTEM + f"question {i}", "n_predict": 3, "stream": True}, stream=True)
+        body = b"".join(response.iter_content(None))
+        assert response.status_code == 200
+        assert body.count(b"data: ") == 4 # 3 tokens + final event
+        ratios.append(float(response.headers["X-Prefix-Hit-Ratio"]))
+
+    assert ratios[0] == 0.0 and all(r > 0.8 for r in ratios[1:])
+    stats = session.get(f"{url}/router/stats").json()
+    assert stats["requests"] == 4 and stats["affinity"] == 3
+    # The fake server only re-evaluated the differing suffix for the pinned requests
+    assert all(r["server_reuse_ratio"] > 0.9 for r in stats["recent"][1:])
+    assert sum(s.requests_served for s in servers) == 4
+
+
+def test_router_props_sums_slots(routed_pool):
+    url, _, _ = routed_pool
+    assert requests.get(f"{url}/props").json()["total_slots"] == 4
+
+
+def test_router_rejects_non_object_body(routed_pool):
+    url, router, _ = routed_pool
+    for body in ([1, 2, 3], "prompt"):
+        response = requests.post(f"{url}/completion", json=body)
+        assert response.status_code == 400
+    assert router.stats()["requests"] == 0
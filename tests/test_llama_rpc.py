@@ -0,0 +1,87 @@
+# tests/test_llama_rpc.py
+
+import os
+import sys
+import socket
+
+import pytest
+
+import llama_man
+import llama_pid
+import llama_rpc
+from fake_rpc_server import FakeRpcServer
+from conftest import free_port_range
+
+FAKE_RPC_SERVER = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "fake_rpc_server.py")
+
+
+@pytest.fixture
+def fake_rpc_install(fake_llama_install, tmp_path, mocker):
+    """fake_llama_install plus an rpc-server wrapper around fake_rpc_server.py."""
+    server = tmp_path / "rpc-server"
+    server.write_text(f'#!/bin/sh\nexec "{sys.executable}" "{FAKE_RPC_SERVER}" "$@"\n')
+    server.chmod(0o755)
+    mocker.patch('llama_rpc.RPC_SERVER_PATH', str(server))
+    mocker.patch('llama_rpc.PROBE_TIMEOUT', 0.5)
+    mocker.patch('llama_man.SLOT_SAVE_PATH', None)
+    return server
+
+
+def test_probe_reports_memory_latency_and_busy_workers():
+    with FakeRpcServer(total_mb=2048, free_mb=1500, delay=0.01) as worker:
+        probe = llama_rpc.probe_worker(worker.endpoint)
+        assert probe["state"] == llama_rpc.READY
+        assert (probe["free_mb"], probe["total_mb"]) == (1500, 2048)
+        assert probe["rtt_ms"] >= 10 and probe["connect_ms"] is not None
+
+        # rpc-server serves one client at a time: while one is connected, others wait unanswered
+        with socket.create_connection(("127.0.0.1", worker.port)):
+            busy = llama_rpc.probe_worker(worker.endpoint, timeout=0.3)
+        assert busy["state"] == llama_rpc.BUSY and busy["connect_ms"] is not None and busy["rtt_ms"] is None
+
+    down = llama_rpc.probe_worker(f"127.0.0.1:{free_port_range(1)}", timeout=0.3)
+    assert down["state"] == llama_rpc.DOWN and down["connect_ms"] is None
+    with pytest.raises(ValueError):
+        llama_rpc.parse_endpoint("no-port")
+    assert llama_rpc.remote_free_mb([{"endpoint": "10.0.0.2:50052", "free_mb": 900.0},
+                                     {"endpoint": "10.0.0.2:50053", "free_mb": 800.0}, # Same host: counted once
+                                     {"endpoint": "127.0.0.1:50052", "local": True, "free_mb": 500.0}]) == 900.0
+
+
+def test_group_start_status_stop(fake_rpc_install, mocker):
+    spawn = mocker.spy(llama_man, 'spawn_server_process')
+    with FakeRpcServer() as remote:
+        try:
+            success, messages = llama_rpc.start_group(local=2, remote=[remote.endpoint], base_port=free_port_range(2))
+            assert success, messages
+            group = llama_man.load_rpc_group()
+            endpoints = [w['endpoint'] for w in group['workers']]
+            assert len(endpoints) == 3 and endpoints[2] == remote.endpoint
+
+            command = spawn.call_args.args[0] # llama-server comes last, over every worker
+            assert command[0] == llama_man.SERVER_PATH
+            assert command[command.index('--rpc') + 1] == ",".join(endpoints) and '-ngl' in command
+            assert remote.clients >= 2 # Probed, then held by the server
+
+            # The server holds every worker's only connection
+            status = llama_rpc.status_group()
+            assert status['server'] == "RUNNING"
+            assert [w['state'] for w in status['workers']] == [llama_rpc.BUSY] * 3
+            assert llama_rpc.start_group(local=1)[0] is False # One group at a time
+        finally:
+            success, messages = llama_rpc.stop_group(force=True)
+        assert success, messages
+        assert llama_man.load_rpc_group() is None and llama_man.status_llama_server()[0] != "RUNNING"
+        assert not any(llama_pid.is_process_running(w['pid'], w['start_time']) for w in group['workers'] if w['local'])
+        assert any("left running" in m for m in messages)
+        assert llama_rpc.probe_worker(remote.endpoint)['state'] == llama_rpc.READY # Free again
+
+
+def test_unreachable_worker_starts_nothing(fake_rpc_install, mocker):
+    spawn = mocker.spy(llama_man, 'spawn_server_process')
+    success, messages = llama_rpc.start_group(local=1, remote=[f"127.0.0.1:{free_port_range(1)}"],
+                                              base_port=free_port_range(1))
+    assert not success and any(llama_rpc.DOWN in m for m in messages)
+    assert spawn.call_count == 1 # The local worker only, and it was stopped again
+    assert llama_man.load_rpc_group() is None and llama_man.status_llama_server()[0] != "RUNNING"
+    assert not llama_pid.is_process_running(spawn.spy_return.pid)
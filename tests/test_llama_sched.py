@@ -0,0 +1,133 @@
+# tests/test_llama_sched.py
+
+import time
+import asyncio
+import threading
+
+import pytest
+import requests
+
+import llama_batch
+import llama_client
+import llama_sched
+from fake_llama_server import FakeLlamaServer
+
+
+def acquire_in_thread(sched, cls, cost, order, results):
+    def run():
+        try:
+            ticket = sched.acquire(cls, cost)
+        except llama_sched.Rejected as e:
+            results[(cls, cost)] = e
+            return
+        order.append((cls, cost))
+        results[(cls, cost)] = ticket
+    thread = threading.Thread(target=run, daemon=True)
+    thread.start()
+    return thread
+
+
+def wait_queued(sched, count):
+    deadline = time.monotonic() + 2
+    while sum(len(q) for q in sched.queues.values()) < count and time.monotonic() < deadline:
+        time.sleep(0.005)
+
+
+def test_estimate_cost():
+    assert llama_sched.estimate_cost({"prompt": "x" * 40, "n_predict": 10}) == 20
+    assert llama_sched.estimate_cost({"prompt": [1, 2, 3], "n_predict": 5}) == 8
+    assert llama_sched.estimate_cost({"messages": [{"role": "user", "content": "abcd" * 5}], "max_tokens": 3}) == 8
+    # Unbounded generation counts as the whole slot, and nothing costs more than a slot
+    assert llama_sched.estimate_cost({"prompt": "hi"}, slot_ctx=512) == 512
+    assert llama_sched.estimate_cost({"prompt": "x" * 4000, "n_predict": 10}, slot_ctx=512) == 512
+
+
+def test_interactive_overtakes_queued_batch():
+    sched = llama_sched.PriorityScheduler(2)
+    running = sched.acquire(llama_sched.INTERACTIVE, 1)
+    # One slot is free, but it is reserved for interactive requests
+    order, results = [], {}
+    threads = [acquire_in_thread(sched, llama_sched.BATCH, 1, order, results)]
+    wait_queued(sched, 1)
+    threads.append(acquire_in_thread(sched, llama_sched.INTERACTIVE, 2, order, results))
+    threads[-1].join(1)
+    assert order == [(llama_sched.INTERACTIVE, 2)] # Ran at once on the reserved slot
+    sched.release(running)
+    threads[0].join(0.2)
+    assert order == [(llama_sched.INTERACTIVE, 2)] # Batch never takes the last free slot
+    sched.release(results[(llama_sched.INTERACTIVE, 2)])
+    threads[0].join(1)
+    assert order == [(llama_sched.INTERACTIVE, 2), (llama_sched.BATCH, 1)]
+    sched.release(results[(llama_sched.BATCH, 1)])
+    stats = sched.stats()
+    assert stats["running"] == 0 and stats["tokens_in_flight"] == 0
+    assert stats["classes"]["batch"]["admitted"] == 1 and stats["classes"]["batch"]["wait_max_ms"] > 0
+
+
+def test_token_budget_holds_back_large_requests():
+    sched = llama_sched.PriorityScheduler(4, token_budget=100, reserved=0)
+    first = sched.acquire(llama_sched.BATCH, 60)
+    order, results = [], {}
+    big = acquire_in_thread(sched, llama_sched.BATCH, 50, order, results)
+    wait_queued(sched, 1)
+    assert order == [] # 60 + 50 tokens would exceed the budget although slots are free
+    sched.release(first)
+    big.join(1)
+    assert order == [(llama_sched.BATCH, 50)]
+    # Alone, a request over the budget still runs
+    sched.release(results[(llama_sched.BATCH, 50)])
+    sched.release(sched.acquire(llama_sched.BATCH, 500))
+
+
+def test_queue_slo_rejects_with_retry_after():
+    sched = llama_sched.PriorityScheduler(1, slo={"interactive": 0.1})
+    ticket = sched.acquire(llama_sched.INTERACTIVE, 1)
+    start = time.monotonic()
+    with pytest.raises(llama_sched.Rejected) as error:
+        sched.acquire(llama_sched.INTERACTIVE, 1)
+    assert error.value.reason == "queue_timeout" and error.value.retry_after >= 1
+    assert time.monotonic() - start < 1
+    # With a service time on record, a hopeless wait is refused without queueing at all
+    sched.service_s = 5.0
+    with pytest.raises(llama_sched.Rejected) as error:
+        sched.acquire(llama_sched.INTERACTIVE, 1)
+    assert error.value.reason == "overloaded" and error.value.retry_after == 5
+    sched.release(ticket)
+    rejected = sched.stats()["classes"]["interactive"]["rejected"]
+    assert rejected == {"queue_full": 0, "overloaded": 1, "queue_timeout": 1}
+
+
+@pytest.fixture
+def scheduled_server():
+    server = FakeLlamaServer(n_slots=1, token_delay=0.05).start()
+    sched = llama_sched.PriorityScheduler(1, slo={"interactive": 0.2, "batch": 30})
+    httpd = llama_sched.make_server(sched, port=0, target_port=server.port, slot_ctx=2048)
+    thread = threading.Thread(target=httpd.serve_forever, kwargs={"poll_interval": 0.05}, daemon=True)
+    thread.start()
+    yield f"http://127.0.0.1:{httpd.server_address[1]}", sched, server
+    httpd.shutdown()
+    httpd.server_close()
+    server.stop()
+
+
+def test_http_front_end_sheds_interactive_and_queues_batch(scheduled_server):
+    url, sched, server = scheduled_server
+    long = {"prompt": "a", "n_predict": 20} # About 1s on the only slot
+
+    async def run():
+        first = asyncio.create_task(llama_client.complete(url, long))
+        while not sched.running:
+            await asyncio.sleep(0.01)
+        with pytest.raises(llama_client.HTTPStatusError) as error:
+            await llama_client.complete(url, {"prompt": "b", "n_predict": 1})
+        batch = await llama_client.complete(url, {"prompt": "c", "n_predict": 2}, headers=llama_batch.REQUEST_HEADERS)
+        return await first, error.value, batch
+
+    first, rejected, batch = asyncio.run(run())
+    assert rejected.status == 429 and rejected.retry_after >= 1
+    assert first["tokens_predicted"] == 20 and batch["tokens_predicted"] == 2 # Batch waited for the slot instead
+    stats = requests.get(f"{url}/sched/stats").json()
+    assert stats["classes"]["interactive"]["rejected"]["queue_timeout"] == 1
+    assert stats["classes"]["batch"]["wait_p50_ms"] > 200
+    assert server.requests_served == 2
+    assert requests.post(f"{url}/completion", json={}, headers={"X-Priority": "urgent"}).status_code == 400
@@ -0,0 +1,67 @@
+# tests/test_llama_session.py
+
+import pytest
+
+import llama_session
+from fake_llama_server import FakeLlamaServer, reply_tokens
+
+SYSTEM = "You are a terse assistant. " * 20
+
+
+@pytest.fixture(autouse=True)
+def sessions_dir(tmp_path, monkeypatch):
+    monkeypatch.setattr(llama_session, "SESSIONS_DIR", str(tmp_path / "sessions"))
+
+
+def test_turns_only_evaluate_new_tokens_and_resume_from_disk(monkeypatch):
+    # The fake splits tokens on whitespace and its answers have no leading space (a real
+    # tokenizer keeps the answer's own leading space), so keep the tag a word of its own
+    monkeypatch.setattr(llama_session, "ASSISTANT_TAG", "Assistant: ")
+    with FakeLlamaServer(n_slots=2) as server:
+        session = llama_session.new_session("work", SYSTEM, slot=1)
+        first = llama_session.run_turn(session, "first question", server.url, n_predict=4)
+        second = llama_session.run_turn(session, "second question", server.url, n_predict=4)
+
+        # Another client uses the other slot meanwhile; the session's slot keeps its cache
+        llama_session.run_turn(llama_session.new_session("other", "unrelated", slot=0), "hi", server.url, n_predict=2)
+        resumed = llama_session.load_session("work")
+        third = llama_session.run_turn(resumed, "third question", server.url, n_predict=4)
+
+    assert first["prompt_n"] == first["tokens_evaluated"] # Nothing cached yet
+    assert first["assistant"] == "".join(reply_tokens(llama_session.build_prompt(
+        llama_session.new_session("x", SYSTEM), "first question"), 4))
+    # Only "User: second question Assistant:" (4 fake tokens) is evaluated, not the system prompt
+    assert second["prompt_n"] == 4 and second["tokens_evaluated"] > 100
+    assert third["prompt_n"] == 4
+    assert [t["user"] for t in llama_session.load_session("work")["turns"]] == ["first question", "second question", "third question"]
+    assert llama_session.pick_slot(2) in (0, 1) and len(llama_session.list_sessions()) == 2
+
+
+def test_trim_keeps_system_prompt_and_newest_turns():
+    summaries = []
+
+    def summarize(text):
+        summaries.append(text)
+        return "they talked about questions"
+
+    with FakeLlamaServer() as server:
+        session = llama_session.new_session("long", SYSTEM, slot=0)
+        turns = [llama_session.run_turn(session, f"question {i} " + "detail " * 10, server.url, n_ctx=300,
+                                        n_predict=8, summarize=summarize) for i in range(10)]
+
+    assert any(t["trimmed"] for t in turns)
+    assert session["context_tokens"] <= 300 and session["trimmed_turns"] + len(session["turns"]) == 10
+    assert len(session["turns"]) >= llama_session.KEEP_TURNS
+    assert session["turns"][-1]["user"].startswith("question 9")
+    assert "question 0" in summaries[0] and session["summary"] == "they talked about questions"
+    prompt = llama_session.build_prompt(session, "next")
+    assert prompt.startswith(SYSTEM.rstrip() + "\n\n" + llama_session.SUMMARY_TAG) # Prefix kept in front
+    # The turn after a trim re-evaluates the shortened transcript once; the next one reuses it again
+    after = turns.index(next(t for t in turns if t["trimmed"]))
+    assert after + 1 < len(turns) and not turns[after + 1]["trimmed"]
+    assert turns[after + 1]["prompt_n"] < turns[after]["prompt_n"]
+
+
+def test_invalid_session_name():
+    with pytest.raises(ValueError):
+        llama_session.new_session("../escape")
@@ -0,0 +1,115 @@
+# tests/test_llama_slots.py
+
+import json
+
+import pytest
+import requests
+
+import llama_man
+import llama_slots
+from fake_llama_server import FakeLlamaServer
+
+SYSTEM_PROMPT = " ".join(f"rule{i}" for i in range(40))
+
+
+@pytest.fixture(autouse=True)
+def fingerprint_index(tmp_path, mocker):
+    """Model fingerprints are memoised in the completion cache's index; keep it out of the repo."""
+    mocker.patch('llama_cache.CACHE_DIR', str(tmp_path / ".llama_cache"))
+
+
+@pytest.fixture
+def model(tmp_path):
+    path = tmp_path / "model.gguf"
+    path.write_bytes(b"GGUF" + bytes(range(256)) * 64)
+    return str(path)
+
+
+def complete(server, prompt, **fields):
+    response = requests.post(f"{server.url}/completion", json=dict(fields, prompt=prompt, n_predict=2), timeout=5)
+    return response.json()["timings"]["prompt_n"]
+
+
+def test_model_fingerprint_tracks_content(model, tmp_path):
+    other = tmp_path / "other.gguf"
+    other.write_bytes(b"GGUF" + bytes(range(255, -1, -1)) * 64)
+    assert llama_slots.model_fingerprint(model) == llama_slots.model_fingerprint(model)
+    assert llama_slots.model_fingerprint(model) != llama_slots.model_fingerprint(str(other))
+    assert llama_slots.model_fingerprint(str(tmp_path / "missing.gguf")) is None
+
+    # Same size, header and tail: only the middle differs (a patched or re-quantised tensor)
+    ends = b"\0" * (1 << 20)
+    (tmp_path / "a.gguf").write_bytes(ends + b"a" * 4096 + ends)
+    (tmp_path / "b.gguf").write_bytes(ends + b"b" * 4096 + ends)
+    assert llama_slots.model_fingerprint(str(tmp_path / "a.gguf")) != llama_slots.model_fingerprint(str(tmp_path / "b.gguf"))
+
+
+def test_save_and_restore_across_servers(model, tmp_path):
+    save_dir = str(tmp_path)
+    with FakeLlamaServer(n_slots=2, slot_save_path=save_dir) as server:
+        complete(server, SYSTEM_PROMPT + " question one", id_slot=0)
+        complete(server, "short", id_slot=1) # Below MIN_SAVE_TOKENS
+        saved, message = llama_slots.save_slots(server.port, model, save_dir)
+
+    assert saved == 1, message
+    manifest = llama_slots.read_manifest(save_dir)
+    assert [e["id_slot"] for e in manifest["slots"]] == [0]
+    assert manifest["model_hash"] == llama_slots.model_fingerprint(model)
+    assert not (tmp_path / llama_slots.slot_filename(1)).exists()
+
+    with FakeLlamaServer(n_slots=2, slot_save_path=save_dir) as server:
+        restored, message = llama_slots.restore_slots(server.port, model, save_dir)
+        assert restored == [0], message
+        assert complete(server, SYSTEM_PROMPT + " another question", id_slot=0) == 2 # Only the new suffix
+
+
+def test_slots_from_another_model_are_discarded(model, tmp_path):
+    save_dir = str(tmp_path)
+    with FakeLlamaServer(slot_save_path=save_dir) as server:
+        complete(server, SYSTEM_PROMPT)
+        assert llama_slots.save_slots(server.port, model, save_dir)[0] == 1
+    with open(model, "ab") as f:
+        f.write(b"retrained")
+
+    with FakeLlamaServer(slot_save_path=save_dir) as server:
+        restored, message = llama_slots.restore_slots(server.port, model, save_dir)
+        assert restored == [] and "different model" in message
+        assert server.slot_cache == {}
+    assert list(tmp_path.glob("slot-*")) == []
+    assert llama_slots.read_manifest(save_dir) == {"slots": []}
+
+
+def test_save_without_slot_save_path_reports_it(model, tmp_path):
+    with FakeLlamaServer() as server:
+        complete(server, SYSTEM_PROMPT)
+        saved, message = llama_slots.save_slots(server.port, model, str(tmp_path))
+    assert saved == 0 and "--slot-save-path" in message
+
+
+def test_warm_start_prefills_prompts_into_free_slots(model, tmp_path):
+    with FakeLlamaServer(n_slots=2, slot_save_path=str(tmp_path)) as server:
+        message = llama_slots.warm_start(server.port, model, str(tmp_path), prompts=[SYSTEM_PROMPT, "a b", "c d"])
+        assert "Prefilled 2 of 3" in message and "1 had no free slot" in message
+        assert complete(server, SYSTEM_PROMPT + " question", id_slot=0) == 1
+
+
+def test_restart_through_llama_man_keeps_the_prefix_warm(fake_llama_install, mocker, tmp_path):
+    mocker.patch('llama_man.SLOT_SAVE_PATH', str(tmp_path / "slots"))
+    mocker.patch('llama_slots.WARM_PROMPTS_FILE', str(tmp_path / "warm.json"))
+    (tmp_path / "warm.json").write_text(json.dumps(["warm up " * 20]))
+    url = f"http://127.0.0.1:{llama_man.PORT}/completion"
+
+    def prompt_n(prompt):
+        body = {"prompt": prompt, "n_predict": 1, "id_slot": 0}
+        return requests.post(url, json=body, timeout=5).json()["timings"]["prompt_n"]
+
+    assert llama_man.start_llama_server()[0]
+    try:
+        assert prompt_n("warm up " * 20 + "hello") == 1 # Prefilled at boot
+        assert prompt_n(SYSTEM_PROMPT + " first") > 40
+        assert llama_man.stop_llama_server()[0]
+
+        assert llama_man.start_llama_server()[0]
+        assert prompt_n(SYSTEM_PROMPT + " second") == 1 # Restored from the saved slot
+    finally:
+        llama_man.stop_llama_server(force=True)
@@ -0,0 +1,96 @@
+# tests/test_llama_sse.py
+
+import json
+import random
+
+import pytest
+
+import llama_sse
+
+EVENTS = [
+    {"index": 0, "content": "Hello", "tokens": [], "stop": False, "id_slot": -1},
+    {"index": 0, "content": " \"quoted\"\n", "tokens": [], "stop": False, "id_slot": -1},
+    {"index": 0, "content": " café ☃", "tokens": [], "stop": False, "id_slot": -1},
+    {"index": 0, "content": "", "stop": True, "timings": {"predicted_n": 3}},
+]
+
+
+def sse_body(events, newline=b"\n"):
+    return b"".join(b"data: " + json.dumps(e, separators=(",", ":")).encode() + newline * 2 for e in events)
+
+
+def decode_all(chunks):
+    return [json.loads(e) for e in llama_sse.iter_events(chunks)]
+
+
+def test_decoder_single_chunk():
+    assert decode_all([sse_body(EVENTS)]) == EVENTS
+
+
+@pytest.mark.parametrize("newline", [b"\n", b"\r\n", b"\r"])
+def test_decoder_handles_arbitrary_splits(newline):
+    body = sse_body(EVENTS, newline)
+    rng = random.Random(1)
+    for _ in range(50):
+        cuts = sorted(rng.sample(range(1, len(body)), 12))
+        chunks = [body[a:b] for a, b in zip([0] + cuts, cuts + [len(body)])]
+        assert decode_all(chunks) == EVENTS
+
+
+def test_decoder_byte_at_a_time():
+    body = sse_body(EVENTS, b"\r\n")
+    assert decode_all([body[i:i + 1] for i in range(len(body))]) == EVENTS
+
+
+def test_decoder_multiline_data_comments_and_other_fields():
+    body = b": keep-alive\n\nevent: message\nid: 7\ndata: line one\ndata:line two\n\n"
+    assert list(llama_sse.iter_events([body])) == [b"line one\nline two"]
+
+
+def test_decoder_flushes_unterminated_event_on_close():
+    decoder = llama_sse.SSEDecoder()
+    assert decoder.feed(b'data: {"content":"x"}') == []
+    assert decoder.close() == [b'{"content":"x"}']
+
+
+def test_extract_content_fast_path_matches_json():
+    for event in EVENTS:
+        text = json.dumps(event, separators=(",", ":"))
+        assert llama_sse.extract_content(text) == event["content"]
+        assert llama_sse.extract_content(json.dumps(event)) == event["content"] # Spaced formatting
+
+
+def test_extract_content_missing_and_invalid():
+    assert llama_sse.extract_content('{"index":0,"stop":false}') is None
+    with pytest.raises(json.JSONDecodeError):
+        llama_sse.extract_content('{"content":broken')
+
+
+def test_is_final():
+    assert llama_sse.is_final('{"content":"","stop":true}')
+    assert llama_sse.is_final('{"content": "", "stop": true}')
+    assert not llama_sse.is_final('{"content":"stop true","stop":false}')
+
+
+def test_output_buffer_batches_by_size_and_flush(mocker):
+    writes = []
+    buffer = llama_sse.OutputBuffer(writes.append, interval=3600, max_chars=10)
+    for token in ["abc", "def", "ghi"]:
+        buffer.add(token)
+    assert writes == []
+    buffer.add("jk") # Reaches max_chars
+    assert writes == ["abcdefghijk"]
+    buffer.add("z")
+    buffer.flush()
+    assert writes == ["abcdefghijk", "z"]
+
+
+def test_output_buffer_flushes_after_interval(mocker):
+    clock = mocker.patch("llama_sse.time.monotonic", return_value=100.0)
+    writes = []
+    buffer = llama_sse.OutputBuffer(writes.append, interval=0.05)
+    buffer.add("a")
+    assert writes == []
+    clock.return_value = 100.06
+    buffer.add("b")
+    assert writes == ["ab"]
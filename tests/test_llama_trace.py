@@ -0,0 +1,70 @@
+# tests/test_llama_trace.py
+
+import json
+
+import pytest
+
+import llama_trace
+from fake_llama_server import FakeLlamaServer
+
+
+def make_trace(n, spacing, n_predict=5):
+    return [{"ts": 1000.0 + i * spacing, "prompt": f"shared system prompt request {i}", "params": {"n_predict": 64},
+             "tokens": n_predict} for i in range(n)]
+
+
+def test_record_anonymizes_and_loads(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    payload = {"prompt": "You are terse. What is 2+2?", "n_predict": 16, "temperature": 0, "stream": True,
+               "grammar": "root ::= [0-9]+"}
+    metrics_record = {"ts": 20.0, "status": "ok", "ttft_s": 0.05, "elapsed_s": 0.4, "tokens": 3, "predicted_n": 3,
+                      "tokens_evaluated": 9}
+    entry = llama_trace.record(payload, metrics_record)
+    llama_trace.record(dict(payload, prompt="You are terse. Hello"), dict(metrics_record, ts=10.0))
+    llama_trace.record({"prompt": [1, 2, 3]}, metrics_record) # Token ids are not traced
+    llama_trace.record(payload, dict(metrics_record, ts=30.0), anonymized=False)
+
+    words = entry["prompt"].split()
+    assert entry["anonymized"] and len(words) == 6 and "terse" not in entry["prompt"]
+    assert all(word in llama_trace.VOCABULARY for word in words) and entry["prompt_tokens"] == 9
+    assert entry["params"] == {"n_predict": 16, "temperature": 0} # Free text such as grammars is dropped
+    assert (entry["ttft_s"], entry["elapsed_s"], entry["tokens"]) == (0.05, 0.4, 3)
+
+    entries = llama_trace.load_trace()
+    assert [e["ts"] for e in entries] == [10.0, 20.0, 30.0]
+    assert entries[0]["prompt"].split()[:3] == words[:3] # A shared prefix stays shared
+    assert entries[2]["prompt"] == payload["prompt"] and not entries[2]["anonymized"]
+    assert llama_trace.trace_key() == bytes.fromhex((tmp_path / llama_trace.TRACE_KEY_FILENAME).read_text().strip())
+    replayed = llama_trace.replay_payload(entries[1])
+    assert replayed["n_predict"] == 3 # As long as the original answer
+    # As long as the original prompt (9 tokens), one single-token word each, starting with the anonymised words
+    assert replayed["prompt"].split()[:6] == words and len(replayed["prompt"].split()) == 9
+    assert llama_trace.replay_prompt(dict(entries[1], prompt_tokens=2)) == " ".join(words[:2])
+    assert llama_trace.replay_payload(entries[2])["prompt"] == payload["prompt"] # Raw prompts are sent as recorded
+
+
+def test_schedules():
+    entries = make_trace(5, 0.5)
+    assert [offset for offset, _ in llama_trace.schedule(entries, speed=2.0)] == [0.0, 0.25, 0.5, 0.75, 1.0]
+    poisson = llama_trace.schedule(entries, "poisson", rate=50.0, count=2000, seed=1)
+    assert poisson == llama_trace.schedule(entries, "poisson", rate=50.0, count=2000, seed=1)
+    assert poisson[7][1] is entries[2] # Cycles through the trace
+    assert 45 < (len(poisson) - 1) / poisson[-1][0] < 55
+    with pytest.raises(ValueError):
+        llama_trace.schedule(entries, "poisson")
+
+
+def test_open_loop_replay_finds_knee():
+    # One slot at ~100 ms per request: 5 req/s keeps up, 40 req/s queues
+    entries = make_trace(8, 0.2)
+    with FakeLlamaServer(n_slots=1, token_delay=0.02) as server:
+        result = llama_trace.sweep(server.url, entries, levels=[1.0, 8.0])
+    light, heavy = result["levels"]
+    assert light["ok"] == heavy["ok"] == 8 and light["errors"] == 0
+    assert light["offered_rps"] == pytest.approx(5.0) and heavy["offered_rps"] == pytest.approx(40.0)
+    # Open loop: requests were sent on schedule even while the server was busy
+    assert heavy["lag_ms"]["max"] < 50
+    assert heavy["completed_rps"] < 15 and heavy["ttft_ms"]["p90"] > 3 * light["ttft_ms"]["p90"]
+    knee = result["knee"]
+    assert knee["index"] == 1 and knee["sustained_rps"] == pytest.approx(5.0)
+    json.dumps(result)
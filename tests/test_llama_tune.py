@@ -0,0 +1,107 @@
+# tests/test_llama_tune.py
+
+import json
+
+import pytest
+import requests
+
+import llama_man
+import llama_tune
+
+
+def level(tokens_per_sec, ttft_ms, errors=0):
+    """A llama_bench.run_level result reduced to what the tuner reads."""
+    return {"errors": errors, "tokens_per_sec": tokens_per_sec,
+            "ttft_ms": {"p50": ttft_ms, "p99": ttft_ms * 2}, "itl_ms": {"p50": 1.0}}
+
+
+def result(tps, ttft, status="ok", **params):
+    return {"params": params, "status": status, "metrics": {"tokens_per_sec": tps, "ttft_ms": ttft}}
+
+
+@pytest.fixture
+def no_profile(tmp_path, mocker):
+    mocker.patch('llama_man.PROFILE_FILENAME', str(tmp_path / ".llama_profile.json"))
+    return tmp_path / ".llama_profile.json"
+
+
+def test_candidate_grid_skips_large_ubatch_and_puts_current_first(mocker, no_profile):
+    mocker.patch('llama_man.BATCH_SIZE', 1024)
+    mocker.patch('llama_man.UB', 512)
+    mocker.patch('llama_man.PARALLEL', 2)
+
+    grid = llama_tune.candidate_grid(batch_sizes=[512, 1024], ubatch_sizes=[512, 1024], threads=[4], parallel=[1, 2])
+
+    assert all(p["ubatch_size"] <= p["batch_size"] for p in grid)
+    assert len(grid) == 6 # (512,512) (1024,512) (1024,1024) x 2 parallel
+    assert (grid[0]["batch_size"], grid[0]["ubatch_size"], grid[0]["parallel"]) == (1024, 512, 2)
+
+
+def test_pareto_front_and_choice():
+    results = [result(100, 50, b=1), result(200, 80, b=2), result(90, 90, b=3), result(300, 200, b=4),
+               result(1000, 1, status="pruned", b=5)]
+
+    front = llama_tune.pareto_front(results)
+
+    assert [r["params"]["b"] for r in front] == [1, 2, 4] # b=3 dominated, pruned results never count
+    assert llama_tune.choose(front, "latency")["params"]["b"] == 1
+    assert llama_tune.choose(front, "throughput")["params"]["b"] == 4
+    assert llama_tune.choose(front, "balanced")["params"]["b"] == 2 # 0.67 * 0.625 beats 0.33 * 1 and 1 * 0.25
+
+
+def test_clearly_worse_needs_both_metrics():
+    reference = {"tokens_per_sec": 100, "ttft_ms": 10}
+    assert llama_tune.clearly_worse({"tokens_per_sec": 50, "ttft_ms": 20}, reference, margin=0.2)
+    assert not llama_tune.clearly_worse({"tokens_per_sec": 50, "ttft_ms": 10}, reference, margin=0.2)
+    assert not llama_tune.clearly_worse({"tokens_per_sec": 90, "ttft_ms": 20}, reference, margin=0.2)
+
+
+def test_tune_prunes_clearly_worse_candidates_and_saves_profile(mocker, no_profile):
+    speeds = {1: level(100, 50), 2: level(180, 30), 4: level(40, 200)} # --parallel 4 is much worse
+    launched = []
+    mocker.patch('llama_man.status_llama_server', return_value=("STOPPED", ""))
+    mocker.patch('llama_man.stop_llama_server', return_value=(True, ""))
+    mocker.patch('llama_man.start_llama_server', side_effect=lambda params, warm=True: launched.append(params) or (True, "", 1))
+    run_level = mocker.patch('llama_tune.llama_bench.run_level',
+                             side_effect=lambda url, c, n, **kw: speeds[launched[-1]["parallel"]])
+    grid = [{"batch_size": 512, "parallel": n} for n in (1, 2, 4)]
+
+    profile, results = llama_tune.tune(grid, requests=8, probe_requests=2)
+
+    assert [r["status"] for r in results] == ["ok", "ok", "pruned"]
+    assert run_level.call_count == 5 # Probe + full for two candidates, probe only for the pruned one
+    assert launched[0] == {"threads": None, "threads_batch": None, "batch_size": 512, "parallel": 1}
+    assert profile["params"] == {"batch_size": 512, "parallel": 2}
+    assert (profile["pruned"], profile["concurrency"]) == (1, 4)
+    assert json.loads(no_profile.read_text())["params"] == {"batch_size": 512, "parallel": 2}
+
+
+def test_build_server_command_applies_profile(mocker, no_profile):
+    mocker.patch('llama_man.MODEL_PATH', '/models/a.gguf')
+    no_profile.write_text(json.dumps({"model": "/models/a.gguf", "params": {"batch_size": 2048, "threads_batch": 8}}))
+
+    command = llama_man.build_server_command(params={"parallel": 3})
+
+    assert command[command.index('-b') + 1] == '2048'
+    assert command[command.index('-tb') + 1] == '8'
+    assert command[command.index('--parallel') + 1] == '3'
+
+    mocker.patch('llama_man.MODEL_PATH', '/models/other.gguf') # Profile tuned for another model is ignored
+    command = llama_man.build_server_command()
+    assert command[command.index('-b') + 1] == str(llama_man.BATCH_SIZE)
+    assert '-tb' not in command
+
+
+def test_tune_with_fake_server_profile_used_on_next_start(fake_llama_install):
+    grid = [{"batch_size": 512, "ubatch_size": 512, "parallel": n} for n in (1, 3)]
+    try:
+        profile, results = llama_tune.tune(grid, requests=3, probe_requests=1, n_predict=4, prefer="throughput")
+        assert all(r["status"] in ("ok", "pruned") for r in results)
+        assert profile["params"] in grid
+
+        success, _, _ = llama_man.start_llama_server()
+        assert success
+        props = requests.get(f"http://127.0.0.1:{llama_man.PORT}/props", timeout=5).json()
+        assert props["total_slots"] == profile["params"]["parallel"]
+    finally:
+        llama_man.stop_llama_server(force=True)
@@ -3,17 +3,17 @@
 import pytest
 import subprocess
 import time
-import os
 import sys
 import signal
+import threading
 from unittest.mock import MagicMock # Useful for creating mock objects like Popen return
 
 # Modules to test and mock
 import llama_man
-import llama_pid
-# Import config_loader only to potentially mock its variables if needed,
-# but we prefer patching the variable where it's used (in man_llama)
-# import config_loader
+import llama_ready
+import llama_client
+from conftest import FAKE_SERVER
+from fake_llama_server import reply_tokens
 
 # --- Mock Configuration ---
 # Create a dictionary representing the config loaded from config_loader
@@ -25,14 +25,33 @@ MOCK_LLAMA_CONFIG = {
     'batch_size': 512,
     'ub': 512,
     'cache_reuse': 128,
+    'parallel': 2,
+    'metrics': True,
 }
 
+def patch_config(mocker):
+    """Patches the llama_man module constants with MOCK_LLAMA_CONFIG."""
+    mocker.patch('llama_man.SERVER_PATH', MOCK_LLAMA_CONFIG['server_path'])
+    mocker.patch('llama_man.MODEL_PATH', MOCK_LLAMA_CONFIG['model_path'])
+    mocker.patch('llama_man.PORT', MOCK_LLAMA_CONFIG['port'])
+    mocker.patch('llama_man.CTX_SIZE', MOCK_LLAMA_CONFIG['ctx_size'])
+    mocker.patch('llama_man.BATCH_SIZE', MOCK_LLAMA_CONFIG['batch_size'])
+    mocker.patch('llama_man.UB', MOCK_LLAMA_CONFIG['ub'])
+    mocker.patch('llama_man.CACHE_REUSE', MOCK_LLAMA_CONFIG['cache_reuse'])
+    mocker.patch('llama_man.PARALLEL', MOCK_LLAMA_CONFIG['parallel'])
+    mocker.patch('llama_man.METRICS', MOCK_LLAMA_CONFIG['metrics'])
+    mocker.patch('llama_man.PROFILE_FILENAME', '/nonexistent/.llama_profile.json')
+    mocker.patch('llama_man.SLOT_SAVE_PATH', None)
+    mocker.patch('llama_man.MODEL_CHECK', False)
+    mocker.patch('llama_man.PREFETCH_MODEL', False)
+    mocker.patch('llama_man.CAPTURE_LOGS', False)
+
 # --- Tests for status_llama_server ---
 
 def test_status_server_running(mocker):
     """Test status when server is running."""
-    mocker.patch('man_llama.pid_llama.read_pid', return_value=123)
-    mocker.patch('man_llama.pid_llama.is_process_running', return_value=True)
+    mocker.patch('llama_man.llama_pid.read_pid', return_value=123)
+    mocker.patch('llama_man.llama_pid.is_process_running', return_value=True)
 
     status, message = llama_man.status_llama_server()
 
@@ -41,9 +60,9 @@ def test_status_server_running(mocker):
 
 def test_status_server_stopped_no_pid(mocker):
     """Test status when server stopped (no PID file)."""
-    mocker.patch('man_llama.pid_llama.read_pid', return_value=None)
+    mocker.patch('llama_man.llama_pid.read_pid', return_value=None)
     # Mock is_process_running to ensure it's not called if read_pid is None
-    mock_is_running = mocker.patch('man_llama.pid_llama.is_process_running')
+    mock_is_running = mocker.patch('llama_man.llama_pid.is_process_running')
 
     status, message = llama_man.status_llama_server()
 
@@ -53,22 +72,24 @@ def test_status_server_stopped_no_pid(mocker):
 
 def test_status_server_stale_pid(mocker):
     """Test status when PID file exists but process is not running."""
-    mocker.patch('man_llama.pid_llama.read_pid', return_value=456)
-    mocker.patch('man_llama.pid_llama.is_process_running', return_value=False)
+    mocker.patch('llama_man.llama_pid.read_pid', return_value=456)
+    mocker.patch('llama_man.llama_pid.is_process_running', return_value=False)
+    mock_delete_pid = mocker.patch('llama_man.llama_pid.delete_pid_file') # Keep the real PID file
 
-    status, message = man_llama.status_llama_server()
+    status, message = llama_man.status_llama_server()
 
     assert status == "STALE_PID"
     assert "Stale PID 456" in message
+    mock_delete_pid.assert_called_once()
 
 # --- Tests for start_llama_server ---
 
 def test_start_server_already_running(mocker):
     """Test start when server is already running."""
     # Patch the imported config directly within the man_llama module's namespace
-    mocker.patch('man_llama.LLAMA_CONFIG', MOCK_LLAMA_CONFIG)
-    mocker.patch('man_llama.pid_llama.read_pid', return_value=123)
-    mocker.patch('man_llama.pid_llama.is_process_running', return_value=True)
+    patch_config(mocker)
+    mocker.patch('llama_man.llama_pid.read_pid', return_value=123)
+    mocker.patch('llama_man.llama_pid.is_process_running', return_value=True)
     mock_popen = mocker.patch('subprocess.Popen') # Check it's not called
 
     success, message, pid = llama_man.start_llama_server()
@@ -81,9 +102,9 @@ def test_start_server_already_running(mocker):
 def test_start_server_success(mocker):
     """Test successful server start."""
     # Patch config used by the function
-    mocker.patch('man_llama.LLAMA_CONFIG', MOCK_LLAMA_CONFIG)
+    patch_config(mocker)
     # Mock PID checks to indicate not running initially
-    mocker.patch('man_llama.pid_llama.read_pid', return_value=None)
+    mocker.patch('llama_man.llama_pid.read_pid', return_value=None)
     # Mock filesystem checks
     mocker.patch('os.path.exists', return_value=True)
     # Mock subprocess.Popen
@@ -91,10 +112,11 @@ def test_start_server_success(mocker):
     mock_process.pid = 789
     mock_process.poll.return_value = None # Indicate process is running after sleep
     mock_popen = mocker.patch('subprocess.Popen', return_value=mock_process)
-    # Mock time.sleep to avoid actual waiting
-    mocker.patch('time.sleep')
+    # Mock the readiness probe to report the server ready
+    mock_wait = mocker.patch('llama_man.llama_ready.wait_for_ready',
+                             return_value=(llama_ready.READY, "Server ready", 0.05))
     # Mock successful PID write
-    mock_write_pid = mocker.patch('man_llama.pid_llama.write_pid', return_value=True)
+    mock_write_pid = mocker.patch('llama_man.llama_pid.write_pid', return_value=True)
 
     success, message, pid = llama_man.start_llama_server()
 
@@ -106,20 +128,25 @@ def test_start_server_success(mocker):
         MOCK_LLAMA_CONFIG['server_path'], '-m', MOCK_LLAMA_CONFIG['model_path'],
         '--port', str(MOCK_LLAMA_CONFIG['port']), '--ctx-size', str(MOCK_LLAMA_CONFIG['ctx_size']),
         '-b', str(MOCK_LLAMA_CONFIG['batch_size']), '-ub', str(MOCK_LLAMA_CONFIG['ub']),
-        '--cache-reuse', str(MOCK_LLAMA_CONFIG['cache_reuse'])
+        '--cache-reuse', str(MOCK_LLAMA_CONFIG['cache_reuse']),
+        '--parallel', str(MOCK_LLAMA_CONFIG['parallel']), '--metrics'
     ]
     mock_popen.assert_called_once()
     call_args, call_kwargs = mock_popen.call_args
     assert call_args[0] == expected_cmd # Check command list
     assert call_kwargs.get('stdout') == subprocess.DEVNULL
     assert call_kwargs.get('stderr') == subprocess.DEVNULL
-    # Verify PID write was called
-    mock_write_pid.assert_called_once_with(789)
+    # Verify the state record was written with the port and launch command
+    mock_write_pid.assert_called_once_with(789, port=MOCK_LLAMA_CONFIG['port'], command=expected_cmd)
+    # Verify readiness was awaited on the configured port instead of a fixed sleep
+    mock_wait.assert_called_once()
+    assert mock_wait.call_args.args[0] == MOCK_LLAMA_CONFIG['port']
+    assert "ready in 0.050s" in message
 
 def test_start_server_path_not_found(mocker):
     """Test start when server executable path doesn't exist."""
-    mocker.patch('man_llama.LLAMA_CONFIG', MOCK_LLAMA_CONFIG)
-    mocker.patch('man_llama.pid_llama.read_pid', return_value=None)
+    patch_config(mocker)
+    mocker.patch('llama_man.llama_pid.read_pid', return_value=None)
     # Mock os.path.exists: return False only for server_path
     # Note: This side_effect needs careful checking if more paths were added
     mocker.patch('os.path.exists', side_effect=lambda path: path != MOCK_LLAMA_CONFIG['server_path'])
@@ -128,20 +155,21 @@ def test_start_server_path_not_found(mocker):
 
     assert not success
     # Update the string we are checking for:
-    assert "Server executable path missing or not found in config" in message # <-- CORRECTED ASSERTION
+    assert "Server executable path not found" in message
     assert pid is None
 
 def test_start_server_immediate_fail(mocker):
     """Test start when the server process fails immediately."""
-    mocker.patch('man_llama.LLAMA_CONFIG', MOCK_LLAMA_CONFIG)
-    mocker.patch('man_llama.pid_llama.read_pid', return_value=None)
+    patch_config(mocker)
+    mocker.patch('llama_man.llama_pid.read_pid', return_value=None)
     mocker.patch('os.path.exists', return_value=True)
     mock_process = MagicMock(spec=subprocess.Popen)
     mock_process.pid = 789
     mock_process.poll.return_value = 1 # Indicate process exited with error code 1
     mocker.patch('subprocess.Popen', return_value=mock_process)
     mocker.patch('time.sleep')
-    mock_delete_pid = mocker.patch('man_llama.pid_llama.delete_pid_file')
+    mocker.patch('llama_man.llama_pid.write_pid', return_value=True)
+    mock_delete_pid = mocker.patch('llama_man.llama_pid.delete_pid_file')
 
     success, message, pid = llama_man.start_llama_server()
 
@@ -154,10 +182,10 @@ def test_start_server_immediate_fail(mocker):
 
 def test_stop_server_not_running_no_pid(mocker):
     """Test stop when server isn't running (no PID file)."""
-    mocker.patch('man_llama.pid_llama.read_pid', return_value=None)
+    mocker.patch('llama_man.llama_pid.read_pid', return_value=None)
     mock_kill = mocker.patch('os.kill')
 
-    success, message = man_llama.stop_llama_server()
+    success, message = llama_man.stop_llama_server()
 
     assert success
     assert "no PID file" in message
@@ -165,9 +193,9 @@ def test_stop_server_not_running_no_pid(mocker):
 
 def test_stop_server_stale_pid(mocker):
     """Test stop when PID file exists but process isn't running."""
-    mocker.patch('man_llama.pid_llama.read_pid', return_value=456)
-    mocker.patch('man_llama.pid_llama.is_process_running', return_value=False)
-    mock_delete_pid = mocker.patch('man_llama.pid_llama.delete_pid_file')
+    mocker.patch('llama_man.llama_pid.read_pid', return_value=456)
+    mocker.patch('llama_man.llama_pid.is_process_running', return_value=False)
+    mock_delete_pid = mocker.patch('llama_man.llama_pid.delete_pid_file')
     mock_kill = mocker.patch('os.kill')
 
     success, message = llama_man.stop_llama_server()
@@ -180,12 +208,12 @@ def test_stop_server_stale_pid(mocker):
 def test_stop_server_graceful_success_unix(mocker):
     """Test successful graceful stop on Unix."""
     mocker.patch('sys.platform', 'linux') # Mock platform
-    mocker.patch('man_llama.pid_llama.read_pid', return_value=123)
+    mocker.patch('llama_man.llama_pid.read_pid', return_value=123)
     # Simulate process running initially, then stopping after sleep
-    mock_is_running = mocker.patch('man_llama.pid_llama.is_process_running', side_effect=[True, False])
+    mock_is_running = mocker.patch('llama_man.llama_pid.is_process_running', side_effect=[True, False])
     mock_kill = mocker.patch('os.kill')
     mocker.patch('time.sleep')
-    mock_delete_pid = mocker.patch('man_llama.pid_llama.delete_pid_file')
+    mock_delete_pid = mocker.patch('llama_man.llama_pid.delete_pid_file')
 
     success, message = llama_man.stop_llama_server(force=False)
 
@@ -198,12 +226,13 @@ def test_stop_server_graceful_success_unix(mocker):
 def test_stop_server_graceful_fail_no_force(mocker):
     """Test graceful stop fails and force is False."""
     mocker.patch('sys.platform', 'linux')
-    mocker.patch('man_llama.pid_llama.read_pid', return_value=123)
+    mocker.patch('llama_man.llama_pid.read_pid', return_value=123)
     # Simulate process never stopping
-    mocker.patch('man_llama.pid_llama.is_process_running', return_value=True)
+    mocker.patch('llama_man.llama_pid.is_process_running', return_value=True)
+    mock_wait = mocker.patch('llama_man.llama_pid.wait_for_exit', return_value=False)
     mock_kill = mocker.patch('os.kill')
     mock_sleep = mocker.patch('time.sleep')
-    mock_delete_pid = mocker.patch('man_llama.pid_llama.delete_pid_file')
+    mock_delete_pid = mocker.patch('llama_man.llama_pid.delete_pid_file')
     mock_subprocess_run = mocker.patch('subprocess.run') # For potential force kill
 
     success, message = llama_man.stop_llama_server(force=False)
@@ -211,33 +240,33 @@ def test_stop_server_graceful_fail_no_force(mocker):
     assert not success
     assert "did not stop gracefully" in message
     mock_kill.assert_called_once_with(123, signal.SIGINT) # Should have tried graceful
-    assert mock_sleep.call_count == 5 # Should have waited 5 times
+    mock_wait.assert_called_once_with(123, llama_man.STOP_TIMEOUT, None) # Waited on the exit event once
+    mock_sleep.assert_not_called()
     mock_delete_pid.assert_not_called()
     mock_subprocess_run.assert_not_called() # Ensure force kill wasn't attempted
     # Ensure SIGTERM/KILL weren't attempted on os.kill mock
     assert all(call.args[1] == signal.SIGINT for call in mock_kill.call_args_list)
 
 
+@pytest.mark.skipif(not hasattr(signal, 'SIGBREAK'), reason="signal.SIGBREAK only exists on Windows")
 def test_stop_server_force_success_windows(mocker):
     """Test graceful fail, then successful force stop on Windows."""
     mocker.patch('sys.platform', 'win32')
-    mocker.patch('man_llama.pid_llama.read_pid', return_value=123)
+    mocker.patch('llama_man.llama_pid.read_pid', return_value=123)
 
-    # --- CORRECTED side_effect list ---
-    # Needs 1 initial True + 5 Trues for the wait loop + 1 final False after force kill
+    # 1 initial True + 1 final False after force kill; the graceful wait times out
     mock_is_running = mocker.patch(
-        'man_llama.pid_llama.is_process_running',
-        side_effect=[True] * 6 + [False] # 6 Trues, then False
+        'llama_man.llama_pid.is_process_running',
+        side_effect=[True, False]
     )
-    # --- End Correction ---
+    mock_wait = mocker.patch('llama_man.llama_pid.wait_for_exit', return_value=False)
 
     mock_kill = mocker.patch('os.kill') # Mock for graceful SIGBREAK attempt
-    mock_sleep = mocker.patch('time.sleep')
-    mock_delete_pid = mocker.patch('man_llama.pid_llama.delete_pid_file')
+    mock_delete_pid = mocker.patch('llama_man.llama_pid.delete_pid_file')
     # Mock successful taskkill - basic mock is fine, it just needs to not raise error for check=True
     mock_subprocess_run = mocker.patch('subprocess.run')
 
-    success, message = man_llama.stop_llama_server(force=True)
+    success, message = llama_man.stop_llama_server(force=True)
 
     # --- Assertion should now pass ---
     assert success
@@ -246,12 +275,47 @@ def test_stop_server_force_success_windows(mocker):
     assert "terminated forcefully" in message
     # Check graceful attempt
     mock_kill.assert_called_once_with(123, signal.SIGBREAK)
-    assert mock_sleep.call_count == 5 # Waited 5 times
+    mock_wait.assert_called_once_with(123, llama_man.STOP_TIMEOUT, None)
     # Check force attempt
     mock_subprocess_run.assert_called_once_with(
         ['taskkill', '/F', '/PID', '123'], check=True, capture_output=True
     )
     # Check PID file deletion
     mock_delete_pid.assert_called_once()
-    # Check is_process_running call count (initial + loop + after force)
-    assert mock_is_running.call_count == 7
\ No newline at end of file
+    # Check is_process_running call count (initial + after force)
+    assert mock_is_running.call_count == 2
+
+
+# --- Supervisor ---
+
+def test_supervisor_restarts_crashed_server_and_stream_resumes(fake_llama_install, tmp_path, mocker):
+    server = tmp_path / "crashing-server"
+    server.write_text(f'#!/bin/sh\nexec "{sys.executable}" "{FAKE_SERVER}" --crash-after 5 --token-rate 50 "$@"\n')
+    server.chmod(0o755)
+    mocker.patch('llama_man.SERVER_PATH', str(server))
+    mocker.patch('llama_man.SLOT_SAVE_PATH', None)
+    mocker.patch('llama_man.RESTART_BACKOFF', 0.05)
+    results = []
+    stop = threading.Event()
+    supervisor = threading.Thread(target=lambda: results.append(llama_man.supervise(stop)))
+    supervisor.start()
+    try:
+        deadline = time.monotonic() + 30
+        while (llama_man.read_supervisor_state() or {}).get('state') != 'running' and time.monotonic() < deadline:
+            time.sleep(0.05)
+        events = list(llama_client.iter_completion(f"http://127.0.0.1:{llama_man.PORT}",
+                                                   {"prompt": "a b c ", "n_predict": 12}, resume=3))
+        # The resumed stream may be served before the supervisor has recorded the restart
+        while llama_man.read_supervisor_state()['restarts'] < 2 and time.monotonic() < deadline:
+            time.sleep(0.05)
+        state = llama_man.read_supervisor_state()
+        assert (state['running'], state['crashes'], state['restarts'], state['failed_starts']) == (True, 2, 2, 0)
+    finally:
+        llama_man.stop_llama_server(force=True) # A deliberate stop also ends the supervisor
+        stop.set()
+        supervisor.join(10)
+    content = "".join(llama_client.llama_sse.extract_content(e) or "" for e in events)
+    assert content == "".join(reply_tokens("a b c ", 12))
+    assert '"resumed":2' in events[-1]
+    assert results and results[0][0] and "was stopped" in results[0][1]
+    assert llama_man.read_supervisor_state()['state'] == 'stopped'